@@ -11,8 +11,17 @@ Use config.py to set analysis parameters.
 """
 
 import os
+import sys
 import argparse
 from pyprf.analysis.pyprf_main import pyprf
+from pyprf.analysis.pyprf_stages import pyprf_stages
+from pyprf.analysis.pyprf_stages import lstStg
+from pyprf.analysis.pyprf_shard import pyprf_shard
+from pyprf.analysis.pyprf_shard import pyprf_merge
+from pyprf.analysis.pyprf_batch import pyprf_batch
+from pyprf.analysis.pyprf_serve import pyprf_serve
+from pyprf.analysis.pyprf_serve import pyprf_submit
+from pyprf.analysis.pyprf_rt import pyprf_rt
 from pyprf import __version__
 
 
@@ -41,6 +50,148 @@ def main():
                                  testing mode.'
                            )
 
+    # Add argument to namespace - resume flag:
+    objParser.add_argument('-resume', '--resume',
+                           action='store_true',
+                           help='Resume an interrupted analysis, i.e. skip \
+                                 voxel chunks that have already been \
+                                 completed according to the checkpoint.'
+                           )
+
+    # Add argument to namespace - stage:
+    objParser.add_argument('-stage', '--stage',
+                           choices=(['all'] + lstStg),
+                           help='Run the analysis stage by stage, with the \
+                                 outputs of each stage saved to disk. If \
+                                 "all", all stages that are not up to date \
+                                 are run. Otherwise, the given stage is \
+                                 (re-)run, together with preceding stages \
+                                 that are not up to date.'
+                           )
+
+    # Subcommands for sharded pRF finding (e.g. on several nodes of a cluster
+    # with a shared file system):
+    objSubPrsrs = objParser.add_subparsers(dest='command')
+
+    objPrsrShrd = objSubPrsrs.add_parser(
+        'shard',
+        help='Find pRF models for one shard of the voxels. Chunks are \
+              claimed through lock files (in the directory \
+              `strPathOut` + "_stages/shards"). Lock files of shards that \
+              have died are reclaimed by shards on the same host; lock \
+              files of shards that have died on other hosts have to be \
+              removed manually.')
+    objPrsrShrd.add_argument('-config',
+                             metavar='config.csv',
+                             default=argparse.SUPPRESS,
+                             help='Absolute file path of config file.')
+    objPrsrShrd.add_argument('-shard',
+                             type=int,
+                             metavar='i',
+                             help='Index of shard (static sharding, from 0 to \
+                                   N - 1). If not provided, chunks of voxels \
+                                   are claimed dynamically.')
+    objPrsrShrd.add_argument('-nshard',
+                             type=int,
+                             metavar='N',
+                             help='Number of shards (static sharding).')
+    objPrsrShrd.add_argument('-nchunk',
+                             type=int,
+                             default=100,
+                             help='Number of chunks of voxels (dynamic \
+                                   sharding, has to be the same for all \
+                                   shards).')
+
+    objPrsrMrge = objSubPrsrs.add_parser(
+        'merge',
+        help='Assemble results of shards & export them.')
+    objPrsrMrge.add_argument('-config',
+                             metavar='config.csv',
+                             default=argparse.SUPPRESS,
+                             help='Absolute file path of config file.')
+
+    objPrsrBtch = objSubPrsrs.add_parser(
+        'batch',
+        help='Run pRF analysis for several subjects with the same pRF \
+              models.')
+    objPrsrBtch.add_argument('-config',
+                             metavar='config.csv',
+                             default=argparse.SUPPRESS,
+                             help='Absolute file path of config file.')
+    objPrsrBtch.add_argument('-subjects',
+                             metavar='subjects.txt',
+                             required=True,
+                             help='Text file with one subject per line, \
+                                   e.g. (["/sub01/run01.nii.gz", \
+                                   "/sub01/run02.nii.gz"], \
+                                   "/sub01/mask.nii.gz", "/sub01/prf").')
+    objPrsrBtch.add_argument('-resume', '--resume',
+                             action='store_true',
+                             default=argparse.SUPPRESS,
+                             help='Resume interrupted pRF finding.')
+
+    objPrsrSrv = objSubPrsrs.add_parser(
+        'serve',
+        help='Keep pRF models in memory & run pRF analysis jobs submitted \
+              over a local Unix socket.')
+    objPrsrSrv.add_argument('-config',
+                            metavar='config.csv',
+                            action='append',
+                            default=argparse.SUPPRESS,
+                            help='Absolute file path of config file (can be \
+                                  given several times, one model bank per \
+                                  config file).')
+    objPrsrSrv.add_argument('-socket',
+                            required=True,
+                            help='Path of Unix socket.')
+
+    objPrsrSbmt = objSubPrsrs.add_parser(
+        'submit',
+        help='Submit a pRF analysis job to a running service & wait for it.')
+    objPrsrSbmt.add_argument('-socket',
+                             required=True,
+                             help='Path of Unix socket of service.')
+    objPrsrSbmt.add_argument('-func',
+                             nargs='+',
+                             help='File path(s) of functional data.')
+    objPrsrSbmt.add_argument('-mask',
+                             help='File path of mask.')
+    objPrsrSbmt.add_argument('-out',
+                             help='Output basename.')
+    objPrsrSbmt.add_argument('-bank',
+                             help='Name of model bank (name of config file \
+                                   without extension), if the service has \
+                                   several model banks.')
+    objPrsrSbmt.add_argument('-ping',
+                             action='store_true',
+                             help='Check whether service is running.')
+    objPrsrSbmt.add_argument('-shutdown',
+                             action='store_true',
+                             help='Stop service.')
+
+    objPrsrRt = objSubPrsrs.add_parser(
+        'realtime',
+        help='Real-time pRF mapping, with results updated as new volumes \
+              arrive in a directory.')
+    objPrsrRt.add_argument('-config',
+                           metavar='config.csv',
+                           default=argparse.SUPPRESS,
+                           help='Absolute file path of config file.')
+    objPrsrRt.add_argument('-watch',
+                           required=True,
+                           help='Directory that is watched for new volumes \
+                                 (nii files, processed in alphabetical \
+                                 order).')
+    objPrsrRt.add_argument('-interval',
+                           type=int,
+                           default=10,
+                           help='Export results after every N volumes.')
+    objPrsrRt.add_argument('-timeout',
+                           type=float,
+                           default=60.0,
+                           help='Stop if no new volumes arrive for this \
+                                 number of seconds.')
+
     # # Add argument to namespace - test flag:
     # objParser.add_argument('-test',
     #                        action='store_true',
@@ -69,8 +220,28 @@ def main():
     # Get path of config file from argument parser:
     strCsvCnfg = objNspc.config
 
+    # Submit job to service (no config file needed):
+    if objNspc.command == 'submit':
+        if objNspc.ping:
+            dicReq = {'cmd': 'ping'}
+        elif objNspc.shutdown:
+            dicReq = {'cmd': 'shutdown'}
+        elif None in [objNspc.func, objNspc.mask, objNspc.out]:
+            objParser.error('-func, -mask and -out have to be provided')
+        else:
+            dicReq = {'cmd': 'fit',
+                      'func': [os.path.abspath(strTmp)
+                               for strTmp in objNspc.func],
+                      'mask': os.path.abspath(objNspc.mask),
+                      'out': os.path.abspath(objNspc.out),
+                      'bank': objNspc.bank}
+        dicRes = pyprf_submit(objNspc.socket, dicReq)
+        print(dicRes)
+        if dicRes['status'] != 'ok':
+            sys.exit(1)
+
     # Print info if no config argument is provided.
-    if strCsvCnfg is None:
+    elif strCsvCnfg is None:
         print('Please provide the file path to a config file, e.g.:')
         print('   pyprf -config /path/to/my_config_file.csv')
 
@@ -79,8 +250,42 @@ def main():
         # Signal non-test mode to lower functions (needed for pytest):
         lgcTest = False
 
-        # Call to main function, to invoke pRF analysis:
-        pyprf(strCsvCnfg, lgcTest)
+        if objNspc.command == 'shard':
+            if (objNspc.shard is None) != (objNspc.nshard is None):
+                objParser.error('-shard and -nshard have to be provided '
+                                + 'together')
+            if ((objNspc.shard is not None)
+                    and not (0 <= objNspc.shard < objNspc.nshard)):
+                objParser.error('-shard has to be between 0 and -nshard - 1')
+            if objNspc.nchunk < 1:
+                objParser.error('-nchunk has to be at least 1')
+            # Sharded pRF finding:
+            pyprf_shard(strCsvCnfg, lgcTest, idxShrd=objNspc.shard,
+                        varNumShrd=objNspc.nshard, varNumChnk=objNspc.nchunk)
+        elif objNspc.command == 'batch':
+            # Several subjects with the same pRF models:
+            pyprf_batch(strCsvCnfg, objNspc.subjects, lgcTest,
+                        lgcResume=objNspc.resume)
+        elif objNspc.command == 'serve':
+            # Service (several config files possible):
+            if not isinstance(strCsvCnfg, list):
+                strCsvCnfg = [strCsvCnfg]
+            pyprf_serve(strCsvCnfg, objNspc.socket, lgcTest)
+        elif objNspc.command == 'realtime':
+            # Real-time pRF mapping:
+            pyprf_rt(strCsvCnfg, objNspc.watch, lgcTest,
+                     varExpIntv=objNspc.interval,
+                     varTmeOut=objNspc.timeout)
+        elif objNspc.command == 'merge':
+            # Assemble results of shards:
+            pyprf_merge(strCsvCnfg, lgcTest)
+        elif objNspc.stage is None:
+            # Call to main function, to invoke pRF analysis:
+            pyprf(strCsvCnfg, lgcTest, lgcResume=objNspc.resume)
+        else:
+            # Stage-wise pRF analysis:
+            pyprf_stages(strCsvCnfg, lgcTest, strStg=objNspc.stage,
+                         lgcResume=objNspc.resume)
 
 
 if __name__ == "__main__":
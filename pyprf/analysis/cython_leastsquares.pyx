@@ -148,3 +148,138 @@ cdef float[:] funcCyRes(float[:] vecPrfTc_view,
     # Return memory view:
     return vecRes_view
 # *****************************************************************************
+
+
+# *****************************************************************************
+# *** Least squares solution with early abandoning
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cpdef np.ndarray[np.float32_t, ndim=1] cy_lst_sq_abnd(
+    np.ndarray[np.float32_t, ndim=1] vecPrfTc,
+    np.ndarray[np.float32_t, ndim=2] aryFuncChnk,
+    np.ndarray[np.float32_t, ndim=1] vecBstRes):
+    """
+    Cythonised least squares GLM model fitting, with early abandoning.
+
+    Parameters
+    ----------
+    vecPrfTc : np.array
+        1D numpy array, at float32 precision, containing a single pRF model
+        time course (along time dimension).
+    aryFuncChnk : np.array
+        2D numpy array, at float32 precision, containing a chunk of functional
+        data (i.e. voxel time courses). Dimensionality: aryFuncChnk[time,
+        voxel].
+    vecBstRes : np.array
+        1D numpy array, at float32 precision, with the residuals of the best
+        fitting model so far for each voxel. Dimensionality: vecBstRes[voxel].
+
+    Returns
+    -------
+    vecRes : np.array
+        1D numpy array with model residuals for all voxels in the chunk of
+        functional data. Dimensionality: vecRes[voxel]
+
+    Notes
+    -----
+    Same as `cy_lst_sq`, but the accumulation of the squared residuals of a
+    voxel is stopped as soon as it exceeds the voxel's best residual so far
+    (the model cannot be the best fitting model for this voxel anymore). In
+    this case, the returned value is the partial sum, which is greater than
+    the best residual so far. Otherwise, the returned value is identical to
+    that of `cy_lst_sq`.
+    """
+
+    cdef float varVarY = 0
+    cdef float[:] vecPrfTc_view = vecPrfTc
+    cdef unsigned long varNumVoxChnk
+    cdef unsigned int idxVol, varNumVols
+
+    # Number of voxels in the input data chunk:
+    varNumVoxChnk = int(aryFuncChnk.shape[1])
+
+    # Define 1D array for results (i.e. for residuals of least squares
+    # solution):
+    cdef np.ndarray[np.float32_t, ndim=1] vecRes = np.zeros(varNumVoxChnk,
+                                                            dtype=np.float32)
+    # Memory views on arrays for results & best residuals so far:
+    cdef float[:] vecRes_view = vecRes
+    cdef float[:] vecBstRes_view = vecBstRes
+
+    # Memory view on numpy array with functional data:
+    cdef float [:, :] aryFuncChnk_view = aryFuncChnk
+
+    # Calculate variance of pRF model time course (i.e. variance in the model):
+    varNumVols = int(vecPrfTc.shape[0])
+    for idxVol in range(varNumVols):
+        varVarY += vecPrfTc_view[idxVol] ** 2
+
+    # Call optimised cdef function for calculation of residuals:
+    vecRes_view = funcCyResAbnd(vecPrfTc_view,
+                                aryFuncChnk_view,
+                                vecBstRes_view,
+                                vecRes_view,
+                                varNumVoxChnk,
+                                varNumVols,
+                                varVarY)
+
+    # Convert memory view to numpy array before returning it:
+    vecRes = np.asarray(vecRes_view)
+
+    return vecRes
+# *****************************************************************************
+
+
+# *****************************************************************************
+# *** Function for fast calculation of residuals, with early abandoning
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef float[:] funcCyResAbnd(float[:] vecPrfTc_view,
+                            float[:, :] aryFuncChnk_view,
+                            float[:] vecBstRes_view,
+                            float[:] vecRes_view,
+                            unsigned long varNumVoxChnk,
+                            unsigned int varNumVols,
+                            float varVarY):
+
+    cdef float varCovXy, varRes, varSlope, varXhat, varBstRes
+    cdef unsigned int idxVol
+    cdef unsigned long idxVox
+
+    # Loop through voxels:
+    for idxVox in range(varNumVoxChnk):
+
+        # Covariance and residuals of current voxel:
+        varCovXy = 0
+        varRes = 0
+        varBstRes = vecBstRes_view[idxVox]
+
+        # Loop through volumes and calculate covariance between the model and
+        # the current voxel:
+        for idxVol in range(varNumVols):
+            varCovXy += (aryFuncChnk_view[idxVol, idxVox]
+                         * vecPrfTc_view[idxVol])
+        # Obtain the slope of the regression of the model on the data:
+        varSlope = varCovXy / varVarY
+
+        # Loop through volumes again in order to calculate the error in the
+        # prediction, until the best residual so far is exceeded:
+        for idxVol in range(varNumVols):
+            # The predicted voxel time course value:
+            varXhat = vecPrfTc_view[idxVol] * varSlope
+            # Mismatch between prediction and actual voxel value (variance):
+            varRes += (aryFuncChnk_view[idxVol, idxVox] - varXhat) ** 2
+            # The residuals can only increase, so that the current model
+            # cannot be the best fitting model anymore:
+            if varRes > varBstRes:
+                break
+
+        vecRes_view[idxVox] = varRes
+
+    # Return memory view:
+    return vecRes_view
+# *****************************************************************************
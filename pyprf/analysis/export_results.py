@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""Assembly & export of pRF finding results."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import numpy as np
+import nibabel as nb
+from pyprf.analysis.utilities import cls_bckgrnd
+
+# List with name suffices of output images:
+lstNiiNames = ['_x_pos',
+               '_y_pos',
+               '_SD',
+               '_R2',
+               '_polar_angle',
+               '_eccentricity']
+
+# List with name suffices of posterior maps (mean & standard deviation of
+# x-position, y-position, and pRF size):
+lstPstNames = ['_x_pos_pst_mean',
+               '_y_pos_pst_mean',
+               '_SD_pst_mean',
+               '_x_pos_pst_sd',
+               '_y_pos_pst_sd',
+               '_SD_pst_sd']
+
+# List with name suffices of maps of best fitting pairs of models (two
+# Gaussians):
+lstPairNames = ['_x_pos_1',
+                '_y_pos_1',
+                '_SD_1',
+                '_x_pos_2',
+                '_y_pos_2',
+                '_SD_2',
+                '_R2_pair',
+                '_weight_1',
+                '_weight_2']
+
+
+def asmbl_prf_res(aryBstXpos, aryBstYpos, aryBstSd, aryBstR2, aryLgcMsk,
+                  aryLgcVar, tplNiiShp):
+    """
+    Put pRF finding results into original image dimensions.
+
+    Parameters
+    ----------
+    aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 : np.array
+        1D arrays with best fitting x-position, y-position, pRF size, and R2
+        value for each voxel that was included in pRF finding.
+    aryLgcMsk : np.array
+        1D logical array (one value per voxel in the volume), voxels that are
+        `False` were excluded by the mask.
+    aryLgcVar : np.array
+        1D logical array (one value per voxel within the mask), voxels that
+        are `False` were excluded because of low variance.
+    tplNiiShp : tuple
+        Spatial dimensions of the volume (number of voxels in x, y, z
+        direction).
+
+    Returns
+    -------
+    aryPrfRes : np.array
+        4D array with pRF finding results, of the form aryPrfRes[x, y, z, 6],
+        where the last dimension contains (0) pRF-x-pos, (1) pRF-y-pos, (2)
+        pRF-SD, (3) pRF-R2, (4) polar angle, and (5) eccentricity.
+    """
+    # Put results form pRF finding into array. Voxels were selected for pRF
+    # model finding in two stages: First, a mask was applied. Second, voxels
+    # with low variance were removed. The indices of the included voxels in
+    # the (flattened) volume are determined first, and the results are placed
+    # there directly.
+    vecIdxVox = np.flatnonzero(aryLgcMsk)[aryLgcVar]
+
+    # Total number of voxels:
+    varNumVoxTlt = (tplNiiShp[0] * tplNiiShp[1] * tplNiiShp[2])
+
+    # Array for pRF finding results, of the form aryPrfRes[voxel-count, 0:6]
+    # (see above for order of parameters):
+    aryPrfRes = np.zeros((varNumVoxTlt, 6), dtype=np.float32)
+    aryPrfRes[vecIdxVox, 0] = aryBstXpos
+    aryPrfRes[vecIdxVox, 1] = aryBstYpos
+    aryPrfRes[vecIdxVox, 2] = aryBstSd
+    aryPrfRes[vecIdxVox, 3] = aryBstR2
+
+    # Reshape pRF finding results into original image dimensions:
+    aryPrfRes = np.reshape(aryPrfRes,
+                           [tplNiiShp[0],
+                            tplNiiShp[1],
+                            tplNiiShp[2],
+                            6])
+
+    # Calculate polar angle map:
+    aryPrfRes[:, :, :, 4] = np.arctan2(aryPrfRes[:, :, :, 1],
+                                       aryPrfRes[:, :, :, 0])
+
+    # Calculate eccentricity map (r = sqrt( x^2 + y^2 ) ):
+    aryPrfRes[:, :, :, 5] = np.sqrt(np.add(np.power(aryPrfRes[:, :, :, 0],
+                                                    2.0),
+                                           np.power(aryPrfRes[:, :, :, 1],
+                                                    2.0)))
+
+    return aryPrfRes
+
+
+def save_nii(niiOut, strPathOut, varCmprLvl):
+    """
+    Save nii image, with given gzip compression level.
+
+    Parameters
+    ----------
+    niiOut : nibabel-image-object
+        Image to save.
+    strPathOut : str
+        Output path (including file extension).
+    varCmprLvl : int
+        Gzip compression level (1 to 9). If zero, the image is saved without
+        compression.
+    """
+    if varCmprLvl == 0:
+        nb.save(niiOut, strPathOut)
+    else:
+        # The image is serialised first and compressed with the requested
+        # level (zlib releases the GIL, so that several images can be
+        # compressed in parallel threads):
+        bytNii = niiOut.to_bytes()
+        with gzip.open(strPathOut, 'wb', compresslevel=varCmprLvl) as fleOut:
+            fleOut.write(bytNii)
+
+
+def export_nii(aryPrfRes, hdrMsk, aryAff, strPathOut, varCmprLvl=1,
+               lgcOut4d=False, varPar=1):
+    """
+    Save pRF finding results as nii files.
+
+    Parameters
+    ----------
+    aryPrfRes : np.array
+        4D array with pRF finding results (see `asmbl_prf_res`).
+    hdrMsk : nibabel-header-object
+        Nii header of mask.
+    aryAff : np.array
+        Array containing 'affine', i.e. information about spatial positioning
+        of mask nii data.
+    strPathOut : str
+        Output basename. One nii file is created per parameter, with the
+        suffices in `lstNiiNames` (e.g. `strPathOut + '_R2.nii.gz'`).
+    varCmprLvl : int
+        Gzip compression level (1 to 9). If zero, uncompressed nii files are
+        saved (e.g. `strPathOut + '_R2.nii'`).
+    lgcOut4d : bool
+        If `True`, a single 4D nii file with all parameters (in the order of
+        `lstNiiNames`) is saved instead (`strPathOut + '_params.nii.gz'`).
+    varPar : int
+        Number of nii files to save in parallel.
+    """
+    print('---------Exporting results')
+
+    # File extension:
+    if varCmprLvl == 0:
+        strExt = '.nii'
+    else:
+        strExt = '.nii.gz'
+
+    # Create nii objects for results:
+    if lgcOut4d:
+        lstNii = [nb.Nifti1Image(np.asarray(aryPrfRes), aryAff,
+                                 header=hdrMsk)]
+        lstPathOut = [(strPathOut + '_params' + strExt)]
+    else:
+        lstNii = [nb.Nifti1Image(aryPrfRes[:, :, :, idxOut], aryAff,
+                                 header=hdrMsk) for idxOut in range(0, 6)]
+        lstPathOut = [(strPathOut + strTmp + strExt)
+                      for strTmp in lstNiiNames]
+
+    # Save nii files, up to `varPar` at a time:
+    varPar = max(1, varPar)
+    for idxSrt in range(0, len(lstNii), varPar):
+        lstThrd = [cls_bckgrnd(save_nii, lstNii[idxOut], lstPathOut[idxOut],
+                               varCmprLvl)
+                   for idxOut in range(idxSrt,
+                                       min(len(lstNii), (idxSrt + varPar)))]
+        for objThrd in lstThrd:
+            objThrd.start()
+        for objThrd in lstThrd:
+            objThrd.get()
+
+
+def export_map(aryMap, hdrMsk, aryAff, strPathOut, varCmprLvl=1):
+    """
+    Save an additional 3D map as nii file.
+
+    Parameters
+    ----------
+    aryMap : np.array
+        3D array with map (same spatial dimensions as mask).
+    hdrMsk : nibabel-header-object
+        Nii header of mask.
+    aryAff : np.array
+        Array containing 'affine' of mask.
+    strPathOut : str
+        Output path, without file extension (e.g. `strPathOut + '_R2_xval'`).
+    varCmprLvl : int
+        Gzip compression level (see `export_nii`).
+    """
+    if varCmprLvl == 0:
+        strExt = '.nii'
+    else:
+        strExt = '.nii.gz'
+    save_nii(nb.Nifti1Image(aryMap.astype(np.float32), aryAff, header=hdrMsk),
+             (strPathOut + strExt), varCmprLvl)
+
+
+def export_sdcr(aryPrfRes, aryLgcMsk, aryAff, strPathOut):
+    """
+    Save pRF finding results of voxels within mask as compact npz file.
+
+    Parameters
+    ----------
+    aryPrfRes : np.array
+        4D array with pRF finding results (see `asmbl_prf_res`).
+    aryLgcMsk : np.array
+        1D logical array (one value per voxel in the volume), voxels that are
+        `False` were excluded by the mask.
+    aryAff : np.array
+        Array containing 'affine' of mask.
+    strPathOut : str
+        Output basename, results are saved as `strPathOut + '_params.npz'`.
+
+    Notes
+    -----
+    The npz file contains the indices of the voxels within the mask (in the
+    flattened volume, `vecIdxVox`), their parameters (`aryPrm`, float32, one
+    row per voxel, with columns in the order of `lstNiiNames`), the names of
+    the parameters (`lstNames`), the spatial dimensions of the volume
+    (`tplNiiShp`), and the affine (`aryAff`).
+    """
+    print('---------Exporting results (npz sidecar)')
+
+    tplNiiShp = aryPrfRes.shape[:3]
+
+    vecIdxVox = np.flatnonzero(aryLgcMsk)
+
+    aryPrm = np.reshape(aryPrfRes, (-1, aryPrfRes.shape[3]))[vecIdxVox, :]
+
+    np.savez((strPathOut + '_params.npz'),
+             vecIdxVox=vecIdxVox.astype(np.int64),
+             aryPrm=aryPrm.astype(np.float32),
+             lstNames=np.array([strTmp[1:] for strTmp in lstNiiNames]),
+             tplNiiShp=np.array(tplNiiShp),
+             aryAff=aryAff)
+
+
+def export_topk(aryTopIdx, aryTopRes, aryTopR2, vecIdxVox, tplNiiShp, aryAff,
+                tplMdlPrm, strPathOut):
+    """
+    Save best fitting models of each voxel (top-K) as compact npz file.
+
+    Parameters
+    ----------
+    aryTopIdx, aryTopRes, aryTopR2 : np.array
+        2D arrays with indices (in the flattened model array), residuals, and
+        R2 values of the best fitting models of each voxel, with shape
+        aryTopIdx[voxel, K] (see `find_prf`).
+    vecIdxVox : np.array
+        1D array with index (in the flattened volume) of each voxel.
+    tplNiiShp : tuple
+        Spatial dimensions of the volume.
+    aryAff : np.array
+        Array containing 'affine' of mask.
+    tplMdlPrm : tuple
+        Modelled x-positions, y-positions, and pRF sizes (see
+        `crt_mdl_prms`).
+    strPathOut : str
+        Output basename, results are saved as `strPathOut + '_topk.npz'`.
+
+    Notes
+    -----
+    The model indices refer to the flattened model array, i.e. the model
+    parameters are `vecMdlXpos[idxX]`, `vecMdlYpos[idxY]`, and
+    `vecMdlSd[idxSd]`, with `idxX, idxY, idxSd = np.unravel_index(aryTopIdx,
+    (vecMdlXpos.size, vecMdlYpos.size, vecMdlSd.size))`. The models of each
+    voxel are sorted by residuals (best fitting model first).
+    """
+    print('---------Exporting best fitting models (npz)')
+
+    vecMdlXpos, vecMdlYpos, vecMdlSd = tplMdlPrm
+
+    np.savez((strPathOut + '_topk.npz'),
+             vecIdxVox=vecIdxVox.astype(np.int64),
+             aryTopIdx=aryTopIdx.astype(np.int32),
+             aryTopRes=aryTopRes.astype(np.float32),
+             aryTopR2=aryTopR2.astype(np.float32),
+             vecMdlXpos=vecMdlXpos,
+             vecMdlYpos=vecMdlYpos,
+             vecMdlSd=vecMdlSd,
+             tplNiiShp=np.array(tplNiiShp[0:3]),
+             aryAff=aryAff)
+
+
+def export_pst(aryPst, aryLgcMsk, aryLgcVar, tplNiiShp, hdrMsk, aryAff,
+               strPathOut, varCmprLvl=1):
+    """
+    Save posterior mean & standard deviation of pRF parameters as nii files.
+
+    Parameters
+    ----------
+    aryPst : np.array
+        2D array with posterior mean of x-position, y-position, and pRF size,
+        followed by their posterior standard deviations, for each voxel
+        included in pRF finding, with shape aryPst[voxel, 6] (see
+        `find_prf`).
+    aryLgcMsk, aryLgcVar, tplNiiShp
+        Mask, variance mask, and dimensions of the functional data (see
+        `asmbl_prf_res`).
+    hdrMsk : nibabel-header-object
+        Nii header of mask.
+    aryAff : np.array
+        Array containing 'affine' of mask.
+    strPathOut : str
+        Output basename, maps are saved with the suffices in `lstPstNames`.
+    varCmprLvl : int
+        Gzip compression level (see `export_nii`).
+    """
+    print('---------Exporting posterior of pRF parameters')
+
+    vecIdxVox = np.flatnonzero(aryLgcMsk)[aryLgcVar]
+
+    for idxPrm, strSfx in enumerate(lstPstNames):
+        aryMap = np.zeros(aryLgcMsk.shape, dtype=np.float32)
+        aryMap[vecIdxVox] = aryPst[:, idxPrm]
+        export_map(np.reshape(aryMap, tuple(tplNiiShp[0:3])), hdrMsk, aryAff,
+                   (strPathOut + strSfx), varCmprLvl=varCmprLvl)
+
+
+def export_pair(aryPair, aryLgcMsk, aryLgcVar, tplNiiShp, hdrMsk, aryAff,
+                strPathOut, varCmprLvl=1):
+    """
+    Save best fitting pairs of pRF models (two Gaussians) as nii files.
+
+    Parameters
+    ----------
+    aryPair : np.array
+        2D array with parameters of the best fitting pair of models, for each
+        voxel included in pRF finding, with shape aryPair[voxel, 9] (see
+        `find_prf_pair`).
+    aryLgcMsk, aryLgcVar, tplNiiShp, hdrMsk, aryAff, strPathOut, varCmprLvl
+        See `export_pst`. Maps are saved with the suffices in `lstPairNames`.
+    """
+    print('---------Exporting best fitting pairs of models')
+
+    vecIdxVox = np.flatnonzero(aryLgcMsk)[aryLgcVar]
+
+    for idxPrm, strSfx in enumerate(lstPairNames):
+        aryMap = np.zeros(aryLgcMsk.shape, dtype=np.float32)
+        aryMap[vecIdxVox] = aryPair[:, idxPrm]
+        export_map(np.reshape(aryMap, tuple(tplNiiShp[0:3])), hdrMsk, aryAff,
+                   (strPathOut + strSfx), varCmprLvl=varCmprLvl)
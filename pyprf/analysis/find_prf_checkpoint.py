@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Checkpointing of pRF finding results."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import hashlib
+import numpy as np
+
+# Version of the checkpoint layout. Needs to be incremented whenever the
+# format of the checkpoint files changes.
+strChkVrsn = 'pyprf-checkpoint-1'
+
+
+def crt_chk_key(aryFunc, aryPrfTc, vecIdxChnks, strVersion):
+    """
+    Create key for checkpoint of pRF finding results.
+
+    Parameters
+    ----------
+    aryFunc : np.array
+        2D array with preprocessed functional data, with shape
+        aryFunc[voxel, time].
+    aryPrfTc : np.array
+        4D array with preprocessed pRF time course models.
+    vecIdxChnks : np.array
+        1D array with indices at which the voxels are separated into chunks
+        (including the number of voxels as last element).
+    strVersion : str
+        Version used for pRF finding ('numpy', 'cython', or 'gpu').
+
+    Returns
+    -------
+    strKey : str
+        Hexadecimal SHA-1 digest over functional data, models, chunk
+        boundaries and version.
+
+    Notes
+    -----
+    Results from a checkpoint are only reused if the key is identical, i.e.
+    if the same data are fitted with the same models and the same chunks.
+    """
+    objHsh = hashlib.sha1()
+
+    strPrm = (strChkVrsn
+              + '|strVersion=' + str(strVersion)
+              + '|aryFunc=' + str(aryFunc.shape)
+              + '|aryPrfTc=' + str(aryPrfTc.shape)
+              + '|vecIdxChnks=' + str([int(x) for x in vecIdxChnks]))
+    objHsh.update(strPrm.encode('utf-8'))
+
+    # Data & models are hashed in blocks of rows, to avoid creating a copy of
+    # the entire array:
+    for aryTmp in [aryFunc, aryPrfTc.reshape(-1, aryPrfTc.shape[-1])]:
+        for idxRow in range(0, aryTmp.shape[0], 10000):
+            objHsh.update(np.ascontiguousarray(
+                aryTmp[idxRow:(idxRow + 10000), :],
+                dtype=np.float32).data)
+
+    return objHsh.hexdigest()
+
+
+def open_chk(strPathChk, strKey, varNumVox, varNumChnk, lgcResume,
+             varNumCol=4):
+    """
+    Open (or create) checkpoint of pRF finding results.
+
+    Parameters
+    ----------
+    strPathChk : str
+        Directory of checkpoints. Created if it does not exist.
+    strKey : str
+        Checkpoint key (see `crt_chk_key`).
+    varNumVox : int
+        Number of voxels on which pRF finding is performed.
+    varNumChnk : int
+        Number of chunks into which the voxels are separated.
+    lgcResume : bool
+        Whether to reuse the results of an existing checkpoint with the same
+        key. If `False`, an existing checkpoint is discarded.
+    varNumCol : int
+        Number of results per voxel.
+
+    Returns
+    -------
+    aryChkRes : np.memmap
+        2D array of shape (varNumVox, varNumCol), memory-mapped, with best
+        fitting x-position, y-position, pRF size, and R2 value for each voxel
+        (followed by the best fitting models, see `find_prf`).
+    vecChkDne : np.memmap
+        1D array of shape (varNumChnk,), memory-mapped, with value one for
+        chunks whose results have been written to `aryChkRes`.
+
+    Notes
+    -----
+    Results of a chunk have to be flushed to disk (`aryChkRes.flush()`)
+    before the chunk is marked as completed in `vecChkDne` (and
+    `vecChkDne.flush()`), so that an interruption in between never marks a
+    chunk as completed whose results are missing.
+    """
+    strDirKey = os.path.join(strPathChk, strKey)
+    strPathRes = os.path.join(strDirKey, 'aryChkRes.npy')
+    strPathDne = os.path.join(strDirKey, 'vecChkDne.npy')
+
+    if lgcResume and os.path.isfile(strPathDne):
+        aryChkRes = np.load(strPathRes, mmap_mode='r+')
+        vecChkDne = np.load(strPathDne, mmap_mode='r+')
+        return aryChkRes, vecChkDne
+
+    # Discard existing (or incomplete) checkpoint with the same key:
+    if os.path.isdir(strDirKey):
+        shutil.rmtree(strDirKey)
+    os.makedirs(strDirKey)
+
+    aryChkRes = np.lib.format.open_memmap(strPathRes,
+                                          mode='w+',
+                                          dtype=np.float32,
+                                          shape=(varNumVox, varNumCol))
+    aryChkRes.flush()
+
+    # The file marking completed chunks is created last (`lgcResume` relies
+    # on its existence):
+    vecChkDne = np.lib.format.open_memmap(strPathDne,
+                                          mode='w+',
+                                          dtype=np.uint8,
+                                          shape=(varNumChnk,))
+    vecChkDne.flush()
+
+    return aryChkRes, vecChkDne
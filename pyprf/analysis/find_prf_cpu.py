@@ -20,10 +20,21 @@
 import numpy as np
 from pyprf.analysis.utilities import cls_set_config
 from pyprf.analysis.cython_leastsquares import cy_lst_sq
+from pyprf.analysis.cython_leastsquares import cy_lst_sq_abnd
+
+# Number of models whose residuals are collected before the best fitting
+# models of each voxel (top-K) are updated (limits the size of temporary
+# arrays, which have size number-of-models times number-of-voxels):
+varNumMdlBlck = 100
+
+# Lower limit of residuals for the calculation of the posterior (avoids the
+# logarithm of zero for a perfect fit):
+varTnyRes = 1e-12
 
 
 def find_prf_cpu(idxPrc, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
-                 aryFuncChnk, aryPrfTc, strVersion, queOut):
+                 aryFuncChnk, aryPrfTc, strVersion, queOut, varNumTopK=0,
+                 lgcPst=False):
     """
     Find best fitting pRF model for voxel time course, using the CPU.
 
@@ -50,6 +61,13 @@ def find_prf_cpu(idxPrc, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
         Which version to use for pRF finding; 'numpy' or 'cython'.
     queOut : multiprocessing.queues.Queue
         Queue to put the results on.
+    varNumTopK : int
+        Number of best fitting models that are retained for each voxel. If
+        greater than one, the indices, residuals and R2 values of these models
+        are placed on the queue in addition.
+    lgcPst : bool
+        Whether to calculate the posterior mean and standard deviation of the
+        pRF parameters of each voxel (placed on the queue in addition).
 
     Returns
     -------
@@ -70,12 +88,48 @@ def find_prf_cpu(idxPrc, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
         vecBstR2 : np.array
             1D array with R2 value of 'winning' pRF model for each voxel, with
             shape vecBstR2[voxel].
+        aryTopIdx : np.array
+            Only if `varNumTopK` is greater than one. 2D array with indices (in
+            the flattened model array) of the best fitting models of each
+            voxel, sorted by residuals, with shape aryTopIdx[voxel, K]. Models
+            that have not been fitted (e.g. if there are fewer than K models
+            with non-zero variance) are -1.
+        aryTopRes : np.array
+            Only if `varNumTopK` is greater than one. 2D array with residuals
+            of the best fitting models, with shape aryTopRes[voxel, K].
+        aryTopR2 : np.array
+            Only if `varNumTopK` is greater than one. 2D array with R2 values
+            of the best fitting models, with shape aryTopR2[voxel, K].
+        aryPst : np.array
+            Only if `lgcPst` is `True`. 2D array with posterior mean of
+            x-position, y-position, and pRF size, followed by their posterior
+            standard deviations, with shape aryPst[voxel, 6] (see `fin_pst`).
 
     Notes
     -----
     The list with results is not returned directly, but placed on a
     multiprocessing queue. This version performs the model finding on the CPU,
     using numpy or cython (depending on the value of `strVersion`).
+
+    In the cython version, the calculation of the residuals of a voxel is
+    abandoned as soon as they exceed the voxel's best residuals so far (see
+    `cy_lst_sq_abnd`). In order to find good fits early, the models are
+    fitted in the order given by `crt_mdl_ord`. Ties are resolved in favour of
+    the model that comes first in the model array, so that the results do not
+    depend on the order.
+
+    If `varNumTopK` is greater than one, the residuals of `varNumMdlBlck`
+    models at a time are merged with the best fitting models so far (see
+    `upd_topk`). In the cython version, the residuals are then only abandoned
+    once they exceed those of the K-th best fitting model so far.
+
+    If `lgcPst` is `True`, the moments of the pRF parameters over all models
+    are accumulated for each voxel, with each model weighted by its
+    likelihood, `RSS ** (-n / (2 * varTmpPst))` (residual sum of squares RSS,
+    n volumes, Gaussian noise with unknown variance). With `varTmpPst` equal
+    to one, this is the posterior for a uniform prior over the model grid.
+    The residuals of all models are needed, and are therefore calculated
+    without early abandoning in the cython version (see `cy_lst_sq`).
     """
     # Load config parameters from dictionary into namespace:
     cfg = cls_set_config(dicCnfg)
@@ -108,6 +162,30 @@ def find_prf_cpu(idxPrc, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
     # solution so far. We initialise with an arbitrary, high value
     vecBstRes = np.add(np.zeros(varNumVoxChnk), 100000000.0).astype(np.float32)
 
+    # Index of best fitting model so far (in the flattened model array), for
+    # the resolution of ties:
+    varNumMdls = (varNumX * varNumY * varNumPrfSizes)
+    vecBstIdx = np.zeros(varNumVoxChnk, dtype=np.int64) + varNumMdls
+
+    # Best fitting models so far (top-K), sorted by residuals, and residuals
+    # of the current block of models:
+    lgcTopK = (1 < varNumTopK)
+    if lgcTopK:
+        aryTopRes = np.full((varNumTopK, varNumVoxChnk), np.inf,
+                            dtype=np.float32)
+        aryTopIdx = np.zeros((varNumTopK, varNumVoxChnk), dtype=np.int64) - 1
+        aryBlckRes = np.zeros((varNumMdlBlck, varNumVoxChnk),
+                              dtype=np.float32)
+        vecBlckIdx = np.zeros(varNumMdlBlck, dtype=np.int64)
+        varCntBlck = 0
+
+    # Accumulated weighted moments of the pRF parameters (see `upd_pst`). The
+    # log-likelihood of a model is proportional to the logarithm of its
+    # residuals:
+    if lgcPst:
+        aryPst = crt_pst(varNumVoxChnk)
+        varFctPst = -0.5 * varNumVol / cfg.varTmpPst
+
     # Vector that will hold the temporary residuals from the model fitting:
     # vecTmpRes = np.zeros(varNumVoxChnk).astype(np.float32)
 
@@ -139,9 +217,6 @@ def find_prf_cpu(idxPrc, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
         # algorithm. Number of steps of the status indicator:
         varStsStpSze = 20
 
-        # Number of pRF models to fit:
-        varNumMdls = (varNumX * varNumY * varNumPrfSizes)
-
         # Vector with pRF values at which to give status feedback:
         vecStatPrf = np.linspace(0,
                                  varNumMdls,
@@ -172,87 +247,145 @@ def find_prf_cpu(idxPrc, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
     # Zero with float32 precision for comparison:
     varZero32 = np.array(([0.0])).astype(np.float32)[0]
 
-    # Loop through pRF models:
-    for idxX in range(0, varNumX):
-
-        for idxY in range(0, varNumY):
-
-            for idxSd in range(0, varNumPrfSizes):
-
-                # Status indicator (only used in the first of the parallel
-                # processes):
-                if idxPrc == 0:
-
-                    # Status indicator:
-                    if varCntSts02 == vecStatPrf[varCntSts01]:
-
-                        # Prepare status message:
-                        strStsMsg = ('------------Progress: ' +
-                                     str(vecStatPrc[varCntSts01]) +
-                                     ' % --- ' +
-                                     str(vecStatPrf[varCntSts01]) +
-                                     ' pRF models out of ' +
-                                     str(varNumMdls))
-
-                        print(strStsMsg)
-
-                        # Only increment counter if the last value has not been
-                        # reached yet:
-                        if varCntSts01 < varStsStpSze:
-                            varCntSts01 = varCntSts01 + int(1)
-
-                # Only fit pRF model if variance is not zero:
-                if np.greater(aryPrfTcVar[idxX, idxY, idxSd], varZero32):
-
-                    # Calculation of the ratio of the explained variance (R
-                    # square) for the current model for all voxel time courses.
-
-                    # Cython version:
-                    if strVersion == 'cython':
-
-                        # A cython function is used to calculate the residuals
-                        # of the current model:
-                        vecTmpRes = cy_lst_sq(
-                            aryPrfTc[idxX, idxY, idxSd, :].flatten(),
-                            aryFuncChnk)
-
-                    # Numpy version:
-                    elif strVersion == 'numpy':
-
-                        # Current pRF time course model:
-                        vecMdlTc = aryPrfTc[idxX, idxY, idxSd, :].flatten()
-
-                        # We create a design matrix including the current pRF
-                        # time course model, and a constant term:
-                        aryDsgn = np.vstack([vecMdlTc,
-                                             vecConst]).T
-
-                        # Change type to float32:
-                        # aryDsgn = aryDsgn.astype(np.float32)
-
-                        # Calculate the least-squares solution for all voxels:
-                        vecTmpRes = np.linalg.lstsq(aryDsgn,
-                                                    aryFuncChnk,
-                                                    rcond=None)[1]
-
-                    # Check whether current residuals are lower than previously
-                    # calculated ones:
-                    vecLgcTmpRes = np.less(vecTmpRes, vecBstRes)
-
-                    # Replace best x and y position values, and SD values.
-                    vecBstXpos[vecLgcTmpRes] = vecMdlXpos[idxX]
-                    vecBstYpos[vecLgcTmpRes] = vecMdlYpos[idxY]
-                    vecBstSd[vecLgcTmpRes] = vecMdlSd[idxSd]
-
-                    # Replace best residual values:
-                    vecBstRes[vecLgcTmpRes] = vecTmpRes[vecLgcTmpRes]
-
-                # Status indicator (only used in the first of the parallel
-                # processes):
-                if idxPrc == 0:
+    # Order in which the pRF models are fitted (indices in the flattened model
+    # array). In the cython version, a coarse grid of models is fitted first,
+    # and the order of the remaining models is determined afterwards:
+    if strVersion == 'cython':
+        vecIdxMdl = crt_mdl_ord(aryPrfTc.shape[0:3])
+    else:
+        vecIdxMdl = np.arange(varNumMdls)
 
-                    # Increment status indicator counter:
-                    varCntSts02 = varCntSts02 + 1
+    # Loop through pRF models:
+    idxOrd = 0
+    while idxOrd < vecIdxMdl.size:
+
+        idxX, idxY, idxSd = np.unravel_index(vecIdxMdl[idxOrd],
+                                             aryPrfTc.shape[0:3])
+
+        # Status indicator (only used in the first of the parallel
+        # processes):
+        if idxPrc == 0:
+
+            # Status indicator:
+            if varCntSts02 == vecStatPrf[varCntSts01]:
+
+                # Prepare status message:
+                strStsMsg = ('------------Progress: ' +
+                             str(vecStatPrc[varCntSts01]) +
+                             ' % --- ' +
+                             str(vecStatPrf[varCntSts01]) +
+                             ' pRF models out of ' +
+                             str(varNumMdls))
+
+                print(strStsMsg)
+
+                # Only increment counter if the last value has not been
+                # reached yet:
+                if varCntSts01 < varStsStpSze:
+                    varCntSts01 = varCntSts01 + int(1)
+
+        # Only fit pRF model if variance is not zero:
+        if np.greater(aryPrfTcVar[idxX, idxY, idxSd], varZero32):
+
+            # Calculation of the ratio of the explained variance (R
+            # square) for the current model for all voxel time courses.
+
+            # Cython version:
+            if strVersion == 'cython':
+
+                # A cython function is used to calculate the residuals
+                # of the current model (with early abandoning, unless the
+                # residuals of all models are needed for the posterior; if
+                # the best fitting models are retained, only once the
+                # residuals exceed those of the K-th best fitting model):
+                if lgcPst:
+                    vecTmpRes = cy_lst_sq(
+                        aryPrfTc[idxX, idxY, idxSd, :].flatten(),
+                        aryFuncChnk)
+                else:
+                    if lgcTopK:
+                        vecThrRes = aryTopRes[-1, :]
+                    else:
+                        vecThrRes = vecBstRes
+                    vecTmpRes = cy_lst_sq_abnd(
+                        aryPrfTc[idxX, idxY, idxSd, :].flatten(),
+                        aryFuncChnk,
+                        vecThrRes)
+
+            # Numpy version:
+            elif strVersion == 'numpy':
+
+                # Current pRF time course model:
+                vecMdlTc = aryPrfTc[idxX, idxY, idxSd, :].flatten()
+
+                # We create a design matrix including the current pRF
+                # time course model, and a constant term:
+                aryDsgn = np.vstack([vecMdlTc,
+                                     vecConst]).T
+
+                # Change type to float32:
+                # aryDsgn = aryDsgn.astype(np.float32)
+
+                # Calculate the least-squares solution for all voxels:
+                vecTmpRes = np.linalg.lstsq(aryDsgn,
+                                            aryFuncChnk,
+                                            rcond=None)[1]
+
+            # Check whether current residuals are lower than previously
+            # calculated ones (or equal, for a model that comes first
+            # in the model array):
+            vecLgcTmpRes = np.logical_or(
+                np.less(vecTmpRes, vecBstRes),
+                np.logical_and(
+                    np.equal(vecTmpRes, vecBstRes),
+                    np.less(vecIdxMdl[idxOrd], vecBstIdx)))
+
+            # Replace best x and y position values, and SD values.
+            vecBstXpos[vecLgcTmpRes] = vecMdlXpos[idxX]
+            vecBstYpos[vecLgcTmpRes] = vecMdlYpos[idxY]
+            vecBstSd[vecLgcTmpRes] = vecMdlSd[idxSd]
+
+            # Replace best residual values:
+            vecBstRes[vecLgcTmpRes] = vecTmpRes[vecLgcTmpRes]
+            vecBstIdx[vecLgcTmpRes] = vecIdxMdl[idxOrd]
+
+            # Update weighted moments of the pRF parameters:
+            if lgcPst:
+                upd_pst(aryPst,
+                        (varFctPst * np.log(np.maximum(vecTmpRes,
+                                                       varTnyRes))),
+                        (vecMdlXpos[idxX], vecMdlYpos[idxY], vecMdlSd[idxSd]))
+
+            # Collect residuals for the update of the best fitting models:
+            if lgcTopK:
+                aryBlckRes[varCntBlck, :] = vecTmpRes
+                vecBlckIdx[varCntBlck] = vecIdxMdl[idxOrd]
+                varCntBlck += 1
+                if varCntBlck == varNumMdlBlck:
+                    aryTopRes, aryTopIdx = upd_topk(aryTopRes, aryTopIdx,
+                                                    aryBlckRes, vecBlckIdx)
+                    varCntBlck = 0
+
+        # Status indicator (only used in the first of the parallel
+        # processes):
+        if idxPrc == 0:
+
+            # Increment status indicator counter:
+            varCntSts02 = varCntSts02 + 1
+
+        idxOrd += 1
+
+        # Once the coarse grid has been fitted, the remaining models
+        # are appended (cython version):
+        if (idxOrd == vecIdxMdl.size) and (idxOrd < varNumMdls):
+            if lgcTopK and (0 < varCntBlck):
+                aryTopRes, aryTopIdx = upd_topk(
+                    aryTopRes, aryTopIdx, aryBlckRes[:varCntBlck, :],
+                    vecBlckIdx[:varCntBlck])
+                varCntBlck = 0
+            vecIdxMdl = crt_mdl_ord(aryPrfTc.shape[0:3],
+                                    vecIdxCrs=vecIdxMdl,
+                                    vecBstIdx=vecBstIdx)
 
     # After finding the best fitting model for each voxel, we still have to
     # calculate the coefficient of determination (R-squared) for each voxel. We
@@ -277,4 +410,185 @@ def find_prf_cpu(idxPrc, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
               vecBstSd,
               vecBstR2]
 
+    if lgcTopK:
+        if 0 < varCntBlck:
+            aryTopRes, aryTopIdx = upd_topk(aryTopRes, aryTopIdx,
+                                            aryBlckRes[:varCntBlck, :],
+                                            vecBlckIdx[:varCntBlck])
+        aryTopR2 = np.subtract(1.0, np.divide(aryTopRes, vecSsTot[None, :]))
+        aryTopR2[np.less(aryTopIdx, 0)] = 0.0
+        lstOut += [aryTopIdx.T, aryTopRes.T, aryTopR2.T]
+
+    if lgcPst:
+        lstOut.append(fin_pst(aryPst))
+
     queOut.put(lstOut)
+
+
+def upd_topk(aryTopRes, aryTopIdx, aryBlckRes, vecBlckIdx):
+    """
+    Update best fitting models of each voxel with a block of models.
+
+    Parameters
+    ----------
+    aryTopRes : np.array
+        2D array with residuals of the best fitting models so far, sorted by
+        residuals, with shape aryTopRes[K, voxel].
+    aryTopIdx : np.array
+        2D array with indices (in the flattened model array) of the best
+        fitting models so far, with shape aryTopIdx[K, voxel].
+    aryBlckRes : np.array
+        2D array with residuals of a block of models, with shape
+        aryBlckRes[model, voxel].
+    vecBlckIdx : np.array
+        1D array with indices (in the flattened model array) of the models of
+        the block.
+
+    Returns
+    -------
+    aryTopRes, aryTopIdx : np.array
+        Updated residuals & indices of the best fitting models.
+
+    Notes
+    -----
+    Ties are resolved in favour of the model that comes first in the model
+    array (as for the best fitting model).
+    """
+    varNumTopK, varNumVox = aryTopRes.shape
+    aryRes = np.concatenate((aryTopRes, aryBlckRes), axis=0)
+    aryIdx = np.concatenate(
+        (aryTopIdx, np.repeat(vecBlckIdx[:, None], varNumVox, axis=1)),
+        axis=0)
+    # Models that have not been fitted (index -1) come last:
+    aryOrd = np.lexsort((np.where(np.less(aryIdx, 0), np.iinfo(np.int64).max,
+                                  aryIdx), aryRes), axis=0)[:varNumTopK, :]
+    return (np.take_along_axis(aryRes, aryOrd, axis=0),
+            np.take_along_axis(aryIdx, aryOrd, axis=0))
+
+
+def crt_mdl_ord(tplShp, vecIdxCrs=None, vecBstIdx=None):
+    """
+    Create order in which pRF models are fitted.
+
+    Parameters
+    ----------
+    tplShp : tuple
+        Number of modelled x-positions, y-positions, and pRF sizes.
+    vecIdxCrs : np.array or None
+        1D array with indices (in the flattened model array) of the models of
+        the coarse grid, which have been fitted already. If `None`, the
+        coarse grid is returned.
+    vecBstIdx : np.array or None
+        1D array with index of best fitting model of the coarse grid for each
+        voxel.
+
+    Returns
+    -------
+    vecIdxMdl : np.array
+        1D array with indices of models (in the flattened model array), in the
+        order in which they are fitted. If `vecIdxCrs` is given, the coarse
+        grid is followed by the remaining models.
+
+    Notes
+    -----
+    The coarse grid consists of every second x-position, y-position, and pRF
+    size. The remaining models are sorted by the number of voxels for which
+    the neighbouring model on the coarse grid (towards lower indices) is the
+    best fitting model, so that models close to frequent winners are fitted
+    first.
+    """
+    aryIdx = np.arange(np.prod(tplShp)).reshape(tplShp)
+
+    if vecIdxCrs is None:
+        return aryIdx[::2, ::2, ::2].flatten()
+
+    # Neighbouring model on the coarse grid for each model:
+    aryIdxNgb = aryIdx[np.ix_((2 * (np.arange(tplShp[0]) // 2)),
+                              (2 * (np.arange(tplShp[1]) // 2)),
+                              (2 * (np.arange(tplShp[2]) // 2)))]
+
+    # Number of voxels for which each model is the best fitting model:
+    vecCnt = np.bincount(vecBstIdx[vecBstIdx < aryIdx.size],
+                         minlength=aryIdx.size)
+
+    vecIdxRst = np.setdiff1d(aryIdx.flatten(), vecIdxCrs)
+    vecCntRst = vecCnt[aryIdxNgb.flatten()[vecIdxRst]]
+    vecIdxRst = vecIdxRst[np.argsort(-vecCntRst, kind='mergesort')]
+
+    return np.concatenate((vecIdxCrs, vecIdxRst))
+
+
+def crt_pst(varNumVox):
+    """
+    Create accumulators for the posterior of the pRF parameters.
+
+    Parameters
+    ----------
+    varNumVox : int
+        Number of voxels.
+
+    Returns
+    -------
+    aryPst : np.array
+        2D array with accumulators, with shape aryPst[8, voxel] (see
+        `upd_pst`).
+    """
+    aryPst = np.zeros((8, varNumVox), dtype=np.float64)
+    aryPst[0, :] = -np.inf
+    return aryPst
+
+
+def upd_pst(aryPst, vecLogWgt, tplPrm):
+    """
+    Add a model to the weighted moments of the pRF parameters.
+
+    Parameters
+    ----------
+    aryPst : np.array
+        2D array with accumulators (see `crt_pst`), updated in place. The
+        rows contain the largest log-weight so far, followed by the sums of
+        the weights, of the weighted parameters (x-position, y-position, and
+        pRF size), and of the weighted squared parameters, all relative to the
+        largest weight so far.
+    vecLogWgt : np.array
+        1D array with log-weight (log-likelihood) of the model for each voxel.
+    tplPrm : tuple
+        x-position, y-position, and pRF size of the model.
+
+    Notes
+    -----
+    The weights are accumulated relative to the largest weight so far (as in
+    a streaming log-sum-exp), so that they neither overflow nor underflow,
+    and the residuals of the models do not have to be stored.
+    """
+    vecMax = np.maximum(aryPst[0, :], vecLogWgt)
+    aryPst[1:, :] *= np.exp(aryPst[0, :] - vecMax)[None, :]
+    vecWgt = np.exp(vecLogWgt - vecMax)
+    aryPst[0, :] = vecMax
+    aryPst[1, :] += vecWgt
+    for idxPrm, varPrm in enumerate(tplPrm):
+        aryPst[(2 + idxPrm), :] += vecWgt * float(varPrm)
+        aryPst[(5 + idxPrm), :] += vecWgt * np.square(float(varPrm))
+
+
+def fin_pst(aryPst):
+    """
+    Calculate posterior mean & standard deviation of the pRF parameters.
+
+    Parameters
+    ----------
+    aryPst : np.array
+        2D array with accumulators (see `upd_pst`).
+
+    Returns
+    -------
+    aryPst : np.array
+        2D array with posterior mean of x-position, y-position, and pRF size,
+        followed by their posterior standard deviations, with shape
+        aryPst[voxel, 6] (float32). Voxels without any model are zero.
+    """
+    vecSum = np.maximum(aryPst[1, :], np.finfo(np.float64).tiny)
+    aryMean = aryPst[2:5, :] / vecSum[None, :]
+    arySd = np.sqrt(np.maximum(
+        (aryPst[5:8, :] / vecSum[None, :] - np.square(aryMean)), 0.0))
+    return np.concatenate((aryMean, arySd), axis=0).T.astype(np.float32)
@@ -19,12 +19,11 @@
 
 import os
 import numpy as np
-import threading
 import tensorflow as tf
 
 
 def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
-                 aryPrfTc, queOut):
+                 aryPrfTc, queOut, varNumMdlBtch=1000):
     """
     Find best fitting pRF model for voxel time course, using the GPU.
 
@@ -47,6 +46,8 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
         aryPrfTc[x-pos, y-pos, SD, time]
     queOut : multiprocessing.queues.Queue
         Queue to put the results on.
+    varNumMdlBtch : int
+        Number of pRF models that are evaluated per call to the graph.
 
     Returns
     -------
@@ -70,35 +71,23 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
 
     Notes
     -----
-    Uses a queue that runs in a separate thread to put model time courses on
-    the computational graph. The list with results is not returned directly,
-    but placed on the queue. This version performs the model finding on the
-    GPU, using tensorflow.
+    The design matrix of each model consists of the model time course and a
+    constant term. The least squares solution for such a design can be
+    expressed with the pseudo-inverse of the de-meaned model time course,
+    which is computed once for all models (before the graph is run): after
+    de-meaning and scaling to unit length, the residual sum of squares of a
+    voxel time course `y` is `sum((y - mean(y))**2) - (x.T * y)**2`. Thus,
+    the residuals of a whole batch of models (for all voxels in a chunk of
+    functional data) are obtained with one matrix multiplication per call to
+    the graph. Batches of model time courses are fed to the graph directly
+    (no queue runners). The graph is defined once; for each chunk of
+    functional data, only the minimum residual (and the index of the
+    respective model) per voxel is kept on the graph and updated after each
+    batch, so that the residuals of all models never need to be stored. The
+    list with results is not returned directly, but
+    placed on the queue. This version performs the model finding on the GPU,
+    using tensorflow, or on the CPU if no GPU is available.
     """
-    # -------------------------------------------------------------------------
-    # *** Queue-feeding-function that will run in extra thread
-    def funcPlcIn():
-        """Place data on queue."""
-        # Iteration counter:
-        idxCnt = 0
-
-        # Stop if coordinator says stop:
-        while not(objCoord.should_stop()):
-
-            # Feed example to Tensorflow placeholder
-            # aryTmp02 = np.copy(lstPrfTc[idxCnt])
-            aryTmp02 = lstPrfTc[idxCnt]
-            dicIn = {objPlcHld01: aryTmp02}
-
-            # Push to the queue:
-            objSess.run(objEnQ, feed_dict=dicIn)
-
-            idxCnt += 1
-
-            # Stop if all data has been put on the queue:
-            if idxCnt == varNumMdls:
-                break
-
     # -------------------------------------------------------------------------
     # *** Prepare pRF model time courses for graph
 
@@ -138,13 +127,19 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
     # Take models with variance less than zero out of the array:
     aryPrfTc = aryPrfTc[vecLgcVar, :]
 
-    # Add extra dimension for constant term:
-    aryPrfTc = np.reshape(aryPrfTc, (aryPrfTc.shape[0], aryPrfTc.shape[1], 1))
-
-    # Add constant term (ones):
-    aryPrfTc = np.concatenate((aryPrfTc,
-                               np.ones(aryPrfTc.shape).astype(np.float32)),
-                              axis=2)
+    # The constant term of the design matrix is accounted for by de-meaning
+    # the model time courses (and the functional data, see below). The
+    # pseudo-inverse of a de-meaned model time course `x` is `x.T / (x.T *
+    # x)`; we scale the model time courses to unit length, so that the
+    # pseudo-inverse and the model time course coincide. Calculated with
+    # float64 precision, and converted to float32 afterwards.
+    aryPrfTc = np.subtract(aryPrfTc.astype(np.float64),
+                           np.mean(aryPrfTc, axis=1,
+                                   dtype=np.float64)[:, None])
+    aryPrfTc = np.divide(aryPrfTc,
+                         np.sqrt(np.sum(np.power(aryPrfTc, 2.0),
+                                        axis=1))[:, None])
+    aryPrfTc = aryPrfTc.astype(np.float32)
 
     # Size of pRF time courses in MB:
     varSzePrf = np.divide(float(aryPrfTc.nbytes),
@@ -154,14 +149,11 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
            + str(np.around(varSzePrf))
            + ' MB'))
 
-    # Put pRF model time courses into list:
-    lstPrfTc = [None] * aryPrfTc.shape[0]
-    for idxMdl in range(int(aryPrfTc.shape[0])):
-        lstPrfTc[idxMdl] = aryPrfTc[idxMdl, :, :]
-    del(aryPrfTc)
-
     # Total number of pRF models to fit:
-    varNumMdls = len(lstPrfTc)
+    varNumMdls = aryPrfTc.shape[0]
+
+    # Number of volumes:
+    varNumVol = aryPrfTc.shape[1]
 
     # -------------------------------------------------------------------------
     # *** Prepare functional data for graph
@@ -171,9 +163,6 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
     # Number of voxels to be fitted:
     varNumVox = aryFunc.shape[0]
 
-    # Number of volumes:
-    # varNumVol = aryFunc.shape[1]
-
     # We reshape the voxel time courses, so that time goes down the column,
     # i.e. from top to bottom.
     aryFunc = aryFunc.T
@@ -182,8 +171,11 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
     aryFunc = aryFunc.astype(np.float32)
 
     # We cannot commit the entire functional data to GPU memory, we need to
-    # create chunks. Establish the limit (maximum size) of one chunk (in MB):
-    varSzeMax = 50.0
+    # create chunks. Establish the limit (maximum size) of one chunk (in MB).
+    # Because only the running minimum of the residuals is kept on the graph
+    # (instead of the residuals of all models), the chunk size is limited by
+    # the functional data and the residuals of one batch of models.
+    varSzeMax = 200.0
 
     # Size of functional data in MB:
     varSzeFunc = np.divide(float(aryFunc.nbytes),
@@ -234,13 +226,30 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
     # Sum of squares:
     vecSsTot = np.sum(np.power(vecFuncDev,
                                2.0),
-                      axis=0)
+                      axis=0).astype(np.float32)
 
     # We don't need the original array with the functional data anymore (the
     # above seems to have created a hard copy):
     del(vecFuncDev)
     del(aryFunc)
 
+    # Maximum number of voxels per chunk. All chunks are padded to this size,
+    # so that the same graph can be used for all chunks:
+    varNumVoxChnk = int(np.max(np.diff(vecIdxChnks)))
+
+    # Number of models per batch. The residuals of one batch (for all voxels
+    # in a chunk) should not be larger than the maximum chunk size:
+    varNumMdlBtch = int(max(1,
+                            min(varNumMdlBtch,
+                                np.floor(np.divide((varSzeMax * 1000000.0),
+                                                   (4.0 * varNumVoxChnk))))))
+
+    # Vector with the indicies at which the models are separated into batches:
+    varNumBtch = int(np.ceil(np.divide(float(varNumMdls),
+                                       float(varNumMdlBtch))))
+    vecIdxBtch = np.minimum((np.arange(0, (varNumBtch + 1)) * varNumMdlBtch),
+                            varNumMdls)
+
     # -------------------------------------------------------------------------
     # *** Miscellaneous preparations
 
@@ -250,9 +259,6 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
     # Vector for indices of models with minimum residuals:
     vecResSsMinIdx = np.zeros((varNumVox), dtype=np.int32)
 
-    # L2 regularization factor for regression:
-    # varL2reg = 0.0
-
     # Reduce logging verbosity:
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
@@ -276,9 +282,9 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
     # algorithm. Number of steps of the status indicator:
     varStsStpSze = 20
 
-    # Vector with pRF values at which to give status feedback:
+    # Vector with batch counts at which to give status feedback:
     vecStatPrf = np.linspace(0,
-                             (varNumMdls * varNumChnk),
+                             (varNumBtch * varNumChnk),
                              num=(varStsStpSze+1),
                              endpoint=True)
     vecStatPrf = np.ceil(vecStatPrf)
@@ -297,131 +303,107 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
     varCntSts01 = 0
     varCntSts02 = 0
 
+    # -------------------------------------------------------------------------
+    # *** Define the graph
+
+    # The graph is defined once, and used for all chunks of functional data.
+    # For each chunk, the functional data are assigned to a variable, and the
+    # running minimum of the residuals (and the index of the respective model)
+    # is kept on the graph while batches of models are fed.
+
+    print('------Define computational graph')
+
+    objGrph = tf.Graph()
+
+    with objGrph.as_default():
+
+        # Place variables & operations on GPU or CPU, depending on GPU
+        # availability:
+        with tf.device(strPu):
+
+            # Placeholders for a chunk of functional data (of the form [time,
+            # voxel]) and the respective total sum of squares:
+            objPlcFunc = tf.placeholder(tf.float32,
+                                        shape=[varNumVol, varNumVoxChnk])
+            objPlcSsTot = tf.placeholder(tf.float32,
+                                         shape=[varNumVoxChnk])
+
+            # Variables holding the current chunk of functional data:
+            objFunc = tf.Variable(tf.zeros([varNumVol, varNumVoxChnk],
+                                           dtype=tf.float32),
+                                  trainable=False)
+            objSsTot = tf.Variable(tf.zeros([varNumVoxChnk],
+                                            dtype=tf.float32),
+                                   trainable=False)
+
+            # Variables for running minimum of residuals & index of the
+            # respective model:
+            objResMin = tf.Variable(tf.zeros([varNumVoxChnk],
+                                             dtype=tf.float32),
+                                    trainable=False)
+            objResMinIdx = tf.Variable(tf.zeros([varNumVoxChnk],
+                                                dtype=tf.int32),
+                                       trainable=False)
+
+            # Operation that places a new chunk of functional data on the
+            # graph, and resets the running minimum:
+            objLdChnk = tf.group(
+                objFunc.assign(objPlcFunc),
+                objSsTot.assign(objPlcSsTot),
+                objResMin.assign(tf.fill([varNumVoxChnk], np.inf)),
+                objResMinIdx.assign(tf.zeros([varNumVoxChnk],
+                                             dtype=tf.int32)))
+
+            # Placeholder for a batch of (de-meaned & normalised) model time
+            # courses, of the form [model, time], and for the index of the
+            # first model in the batch:
+            objMdl = tf.placeholder(tf.float32, shape=[None, varNumVol])
+            objBtchStr = tf.placeholder(tf.int32, shape=[])
+
+            # Residual sum of squares for all models in the batch & all voxels
+            # in the chunk, of the form [model, voxel]:
+            objMatSlve = tf.subtract(
+                tf.expand_dims(objSsTot, 0),
+                tf.square(tf.matmul(objMdl, objFunc)))
+
+            # Minimum residuals within the batch, and index of the respective
+            # models (with respect to all models):
+            objBtchMin = tf.reduce_min(objMatSlve, axis=0)
+            objBtchMinIdx = tf.add(
+                tf.cast(tf.argmin(objMatSlve, axis=0), tf.int32),
+                objBtchStr)
+
+            # Update the running minimum for voxels for which a model in the
+            # current batch is better than the best model so far. (In case of
+            # equal residuals, the model with the lower index is kept, as with
+            # `np.argmin`.)
+            objLgcUpd = tf.less(objBtchMin, objResMin)
+            objUpdMin = tf.group(
+                objResMin.assign(tf.where(objLgcUpd,
+                                          objBtchMin,
+                                          objResMin)),
+                objResMinIdx.assign(tf.where(objLgcUpd,
+                                             objBtchMinIdx,
+                                             objResMinIdx)))
+
+            # Variables need to be initialised:
+            objInit = tf.global_variables_initializer()
+
     # -------------------------------------------------------------------------
     # *** Loop through chunks
 
     print('------Run graph')
 
-    for idxChnk in range(varNumChnk):
-
-        # print(('---------Chunk: ' + str(idxChnk)))
-
-        # Define session:
-        # objSess = tf.Session()
-        with tf.Graph().as_default(), tf.Session() as objSess:
-
-            # ------------------------------------------------------------------
-            # *** Prepare queue
-
-            # print('------Define computational graph, queue & session')
-
-            # Queue capacity:
-            varCapQ = 10
-
-            # Dimensions of placeholder have to be determined outside of the
-            # tensor object, otherwise the object on which the size is
-            # calculated is loaded into GPU memory.
-            varDim01 = lstPrfTc[0].shape[0]
-            varDim02 = lstPrfTc[0].shape[1]
-
-            # The queue:
-            objQ = tf.FIFOQueue(capacity=varCapQ,
-                                dtypes=[tf.float32],
-                                shapes=[(varDim01, varDim02)])
-
-            # Method for getting queue size:
-            objSzeQ = objQ.size()
-
-            # Placeholder that is used to put design matrix on computational
-            # graph:
-            objPlcHld01 = tf.placeholder(tf.float32,
-                                         shape=[varDim01, varDim02])
-
-            # The enqueue operation that puts data on the graph.
-            objEnQ = objQ.enqueue([objPlcHld01])
-
-            # Number of threads that will be created:
-            varNumThrd = 1
-
-            # The queue runner (places the enqueue operation on the queue?).
-            objRunQ = tf.train.QueueRunner(objQ, [objEnQ] * varNumThrd)
-            tf.train.add_queue_runner(objRunQ)
-
-            # The tensor object that is retrieved from the queue. Functions
-            # like placeholders for the data in the queue when defining the
-            # graph.
-            objDsng = objQ.dequeue()
-
-            # Coordinator needs to be initialised:
-            objCoord = tf.train.Coordinator()
-
-            # ------------------------------------------------------------------
-            # *** Fill queue
-
-            # Buffer size (number of samples to put on queue before starting
-            # execution of graph):
-            varBuff = 10
-
-            # Define & run extra thread with graph that places data on queue:
-            objThrd = threading.Thread(target=funcPlcIn)
-            objThrd.setDaemon(True)
-            objThrd.start()
-
-            # Stay in this while loop until the specified number of samples
-            # (varBuffer) have been placed on the queue).
-            varTmpSzeQ = 0
-            while varTmpSzeQ < varBuff:
-                varTmpSzeQ = objSess.run(objSzeQ)
-
-            # ------------------------------------------------------------------
-            # *** Prepare & run the graph
-
-            # Chunk of functional data:
-            aryTmp01 = np.copy(lstFunc[idxChnk])
-
-            # Place functional data on GPU or CPU, depending on GPU
-            # availability:
-            with tf.device(strPu):
-                objFunc = tf.Variable(aryTmp01)
-
-
-            # The computational graph. Operation that solves matrix (in the
-            # least squares sense), and calculates residuals along time
-            # dimension:
-            objMatSlve = tf.reduce_sum(
-                                       tf.squared_difference(
-                                                             objFunc,
-                                                             tf.matmul(
-                                                                       objDsng,
-                                                                       tf.matmul(
-                                                                                 tf.matmul(
-                                                                                           tf.matrix_inverse(
-                                                                                                             tf.matmul(
-                                                                                                                       objDsng,
-                                                                                                                       objDsng,
-                                                                                                                       transpose_a=True,
-                                                                                                                       transpose_b=False
-                                                                                                                       )
-                                                                                                             ),
-                                                                                           objDsng,
-                                                                                           transpose_a=False,
-                                                                                           transpose_b=True
-                                                                                           ),
-                                                                                 objFunc
-                                                                                 )
-                                                                       ),
-                                                             ),
-                                       axis=0
-                                       )
-
-            # Use GPU, if available:
-            with tf.device(strPu):
-                # Variables need to be (re-)initialised:
-                objSess.run(tf.global_variables_initializer())
-
-            # Mark graph as read-only (would throw an error in case of memory
-            # leak):
-            objSess.graph.finalize()
+    with tf.Session(graph=objGrph) as objSess:
+
+        # Initialise variables:
+        objSess.run(objInit)
+
+        # Mark graph as read-only (would throw an error in case of memory
+        # leak):
+        objSess.graph.finalize()
+
+        for idxChnk in range(varNumChnk):
 
             # Index of first voxel in current chunk (needed to assign results):
             varChnkStr = int(vecIdxChnks[idxChnk])
@@ -429,29 +411,46 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
             # Index of last voxel in current chunk (needed to assign results):
             varChnkEnd = int(vecIdxChnks[(idxChnk+1)])
 
-            # Array for results of current chunk:
-            aryTmpRes = np.zeros((varNumMdls,
-                                  lstFunc[idxChnk].shape[1]),
-                                 dtype=np.float32)
-
-            # Loop through models:
-            for idxMdl in range(varNumMdls):
-
-                # Run main computational graph and put results in list:
-                # varTme01 = time.time()
-                aryTmpRes[idxMdl, :] = objSess.run(objMatSlve)
-                # print(('---------Time for graph call: '
-                #        + str(time.time() - varTme01)))
+            # Number of voxels in current chunk:
+            varTmpNumVox = varChnkEnd - varChnkStr
+
+            # Chunk of functional data and total sum of squares, padded to the
+            # chunk size of the graph (results for padded voxels are
+            # discarded):
+            aryTmp01 = np.zeros((varNumVol, varNumVoxChnk), dtype=np.float32)
+            aryTmp01[:, :varTmpNumVox] = lstFunc[idxChnk]
+            vecTmp01 = np.zeros(varNumVoxChnk, dtype=np.float32)
+            vecTmp01[:varTmpNumVox] = vecSsTot[varChnkStr:varChnkEnd]
+
+            # Place chunk of functional data on graph:
+            objSess.run(objLdChnk,
+                        feed_dict={objPlcFunc: aryTmp01,
+                                   objPlcSsTot: vecTmp01})
+            del(aryTmp01)
+            del(vecTmp01)
+
+            # Loop through batches of models:
+            for idxBtch in range(varNumBtch):
+
+                # Index of first & last model in current batch:
+                varBtchStr = vecIdxBtch[idxBtch]
+                varBtchEnd = vecIdxBtch[idxBtch + 1]
+
+                # Run main computational graph (update running minimum):
+                objSess.run(
+                    objUpdMin,
+                    feed_dict={objMdl: aryPrfTc[varBtchStr:varBtchEnd, :],
+                               objBtchStr: varBtchStr})
 
                 # Status indicator:
                 if varCntSts02 == vecStatPrf[varCntSts01]:
-                    # Number of elements on queue:
-                    varTmpSzeQ = objSess.run(objSzeQ)
                     # Prepare status message:
                     strStsMsg = ('---------Progress: '
                                  + str(vecStatPrc[varCntSts01])
-                                 + ' % --- Number of elements on queue: '
-                                 + str(varTmpSzeQ))
+                                 + ' % --- '
+                                 + str(varCntSts02)
+                                 + ' batches of pRF models out of '
+                                 + str(varNumBtch * varNumChnk))
                     print(strStsMsg)
                     # Only increment counter if the last value has not been
                     # reached yet:
@@ -460,19 +459,12 @@ def find_prf_gpu(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFunc,  #noqa
                 # Increment status indicator counter:
                 varCntSts02 = varCntSts02 + 1
 
-            # Stop threads.
-            objCoord.request_stop()
-            # objSess.close()
-
-        # Get indices of models with minimum residuals (minimum along
-        # model-space) for current chunk:
-        vecResSsMinIdx[varChnkStr:varChnkEnd] = np.argmin(aryTmpRes, axis=0
-                                                          ).astype(np.int32)
-        # Get minimum residuals of those models:
-        vecResSsMin[varChnkStr:varChnkEnd] = np.min(aryTmpRes, axis=0)
-
-        # Avoid memory overflow between chunks:
-        del(aryTmpRes)
+            # Get minimum residuals and indices of models with minimum
+            # residuals for current chunk:
+            vecTmpMin, vecTmpMinIdx = objSess.run([objResMin, objResMinIdx])
+            vecResSsMin[varChnkStr:varChnkEnd] = vecTmpMin[:varTmpNumVox]
+            vecResSsMinIdx[varChnkStr:varChnkEnd] = \
+                vecTmpMinIdx[:varTmpNumVox]
 
     # -------------------------------------------------------------------------
     # *** Post-process results
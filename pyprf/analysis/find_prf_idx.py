@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+"""Find best fitting pRF models using a cluster index of the models."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+import numpy as np
+
+# Version of the index layout. Needs to be incremented whenever the creation
+# of the index, or the way in which it is stored, changes.
+strIdxVrsn = 'pyprf-index-2'
+
+# Number of iterations of k-means clustering:
+varNumItr = 20
+
+# Number of voxels for which the model scores are calculated at once:
+varSzeBlck = 1000
+
+# Tolerance added to the upper bounds of the branch-and-bound search, so that
+# rounding errors cannot lead to clusters being skipped wrongly:
+varTolBnd = 1e-4
+
+
+def crt_mdl_nrm(aryPrfTc):
+    """
+    Create de-meaned, normalised model time courses.
+
+    Parameters
+    ----------
+    aryPrfTc : np.array
+        Array with pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+
+    Returns
+    -------
+    aryMdlNrm : np.array
+        2D array with de-meaned model time courses of unit length, with shape
+        aryMdlNrm[model, time] (float32). Models with a variance of zero are
+        set to zero (they are never selected, as in `find_prf_cpu`).
+
+    Notes
+    -----
+    For a linear regression with a model time course and a constant term,
+    the explained sum of squares is the squared inner product of the
+    de-meaned, normalised model time course and the de-meaned voxel time
+    course. Finding the best fitting model is therefore a search for the
+    maximum absolute inner product.
+    """
+    aryMdl = np.reshape(aryPrfTc, (-1, aryPrfTc.shape[3])).astype(np.float64)
+    aryMdl = aryMdl - np.mean(aryMdl, axis=1)[:, None]
+    vecNrm = np.sqrt(np.sum(np.square(aryMdl), axis=1))
+    vecLgc = np.greater(vecNrm, 1e-6 * np.max(vecNrm))
+    aryMdl[vecLgc, :] = aryMdl[vecLgc, :] / vecNrm[vecLgc, None]
+    aryMdl[~vecLgc, :] = 0.0
+    return aryMdl.astype(np.float32)
+
+
+def crt_idx(aryMdlNrm, varNumClst, varSeed=0):
+    """
+    Create cluster index of normalised model time courses.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    varNumClst : int
+        Number of clusters.
+    varSeed : int
+        Seed for the random initialisation of the clusters.
+
+    Returns
+    -------
+    aryCntr : np.array
+        2D array with unit-length cluster centroids, with shape
+        aryCntr[cluster, time].
+    vecLbl : np.array
+        1D array with cluster index of each model.
+
+    Notes
+    -----
+    The models are clustered with spherical k-means. Because the sign of a
+    model does not affect its fit, the similarity between a model and a
+    centroid is the absolute value of their inner product, and models are
+    sign-flipped towards their centroid when the centroids are updated.
+    """
+    varNumMdl = aryMdlNrm.shape[0]
+    varNumClst = min(varNumClst, varNumMdl)
+
+    objRnd = np.random.RandomState(varSeed)
+    aryCntr = aryMdlNrm[objRnd.choice(varNumMdl, size=varNumClst,
+                                      replace=False), :].astype(np.float64)
+
+    for idxItr in range(varNumItr):
+
+        # Assign models to most similar centroid:
+        arySim = np.dot(aryMdlNrm, aryCntr.T)
+        vecLbl = np.argmax(np.abs(arySim), axis=1)
+        vecSgn = np.sign(arySim[np.arange(varNumMdl), vecLbl])
+        vecSgn[vecSgn == 0.0] = 1.0
+
+        # Update centroids (empty clusters keep their centroid):
+        aryCntrNew = np.zeros(aryCntr.shape)
+        np.add.at(aryCntrNew, vecLbl, (aryMdlNrm * vecSgn[:, None]))
+        vecNrm = np.sqrt(np.sum(np.square(aryCntrNew), axis=1))
+        vecLgc = np.greater(vecNrm, 0.0)
+        aryCntrNew[vecLgc, :] = aryCntrNew[vecLgc, :] / vecNrm[vecLgc, None]
+        aryCntrNew[~vecLgc, :] = aryCntr[~vecLgc, :]
+
+        if np.array_equal(aryCntrNew, aryCntr):
+            break
+        aryCntr = aryCntrNew
+
+    # Final assignment:
+    vecLbl = np.argmax(np.abs(np.dot(aryMdlNrm, aryCntr.T)), axis=1)
+
+    return aryCntr.astype(np.float32), vecLbl.astype(np.int64)
+
+
+def crt_rad(aryMdlNrm, aryCntr, vecLbl):
+    """
+    Calculate angular radius of clusters of models.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    aryCntr, vecLbl : np.array
+        Cluster centroids, and cluster index of each model (see `crt_idx`).
+
+    Returns
+    -------
+    vecRad : np.array
+        1D array with angular radius of each cluster [rad], i.e. the maximum
+        angle between the centroid and the models of the cluster (irrespective
+        of their sign). Models with a variance of zero are ignored.
+    """
+    vecCor = np.abs(np.sum((aryMdlNrm.astype(np.float64)
+                            * aryCntr[vecLbl, :]), axis=1))
+    vecAng = np.arccos(np.clip(vecCor, 0.0, 1.0))
+    vecLgc = np.any(np.not_equal(aryMdlNrm, 0.0), axis=1)
+    vecRad = np.zeros(aryCntr.shape[0])
+    np.maximum.at(vecRad, vecLbl[vecLgc], vecAng[vecLgc])
+    return vecRad
+
+
+def crt_hrc(aryMdlNrm, varNumClst):
+    """
+    Create hierarchical cluster index of normalised model time courses.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    varNumClst : int
+        Number of clusters (lower level of the hierarchy).
+
+    Returns
+    -------
+    tplIdx : tuple
+        Tuple with (0) cluster centroids, (1) cluster index of each model, (2)
+        angular radius of each cluster, (3) centroids of the groups of
+        clusters (upper level of the hierarchy), (4) group index of each
+        cluster, and (5) angular radius of each group (with respect to the
+        models of the group).
+
+    Notes
+    -----
+    The clusters are grouped by clustering their centroids (see `crt_idx`),
+    with about as many groups as there are clusters per group.
+    """
+    aryCntr, vecLbl = crt_idx(aryMdlNrm, varNumClst)
+    vecRad = crt_rad(aryMdlNrm, aryCntr, vecLbl)
+    varNumGrp = int(np.ceil(np.sqrt(aryCntr.shape[0])))
+    aryCntrTop, vecLblTop = crt_idx(aryCntr, varNumGrp)
+    vecRadTop = crt_rad(aryMdlNrm, aryCntrTop, vecLblTop[vecLbl])
+    return aryCntr, vecLbl, vecRad, aryCntrTop, vecLblTop, vecRadTop
+
+
+def load_idx(strPathMdl, aryMdlNrm, varNumClst):
+    """
+    Load cluster index of models, or create & save it.
+
+    Parameters
+    ----------
+    strPathMdl : str
+        Path of pRF time course models (without file extension). The index is
+        saved next to the models (`strPathMdl` + '_index.npz').
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    varNumClst : int
+        Number of clusters.
+
+    Returns
+    -------
+    tplIdx : tuple
+        Hierarchical cluster index (see `crt_hrc`).
+
+    Notes
+    -----
+    The index is only reused if it has been created for the same
+    (preprocessed) model time courses and the same number of clusters.
+    """
+    lstKey = ['aryCntr', 'vecLbl', 'vecRad', 'aryCntrTop', 'vecLblTop',
+              'vecRadTop']
+
+    objHsh = hashlib.sha1()
+    objHsh.update((strIdxVrsn + '|varNumClst=' + str(varNumClst)
+                   + '|' + str(aryMdlNrm.shape)).encode('utf-8'))
+    objHsh.update(np.ascontiguousarray(aryMdlNrm).tobytes())
+    strKey = objHsh.hexdigest()
+
+    strPathIdx = strPathMdl + '_index.npz'
+
+    if os.path.isfile(strPathIdx):
+        objNpz = np.load(strPathIdx)
+        if str(objNpz['strKey']) == strKey:
+            print('---------Using model index: ' + strPathIdx)
+            return tuple([objNpz[strTmp] for strTmp in lstKey])
+
+    print('---------Create model index (' + str(varNumClst) + ' clusters)')
+    tplIdx = crt_hrc(aryMdlNrm, varNumClst)
+
+    # The index is written to a temporary file first (several processes may
+    # create the same index at the same time):
+    strPathTmp = strPathMdl + '_index.' + str(os.getpid()) + '.tmp.npz'
+    np.savez(strPathTmp, strKey=strKey, **dict(zip(lstKey, tplIdx)))
+    os.replace(strPathTmp, strPathIdx)
+
+    return tplIdx
+
+
+def prp_func(aryFunc):
+    """
+    Prepare voxel time courses for the search using the index.
+
+    Parameters
+    ----------
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+
+    Returns
+    -------
+    aryFuncNrm : np.array
+        2D array with de-meaned voxel time courses of unit length (float64).
+        Voxels without variance are set to zero.
+    """
+    aryFuncNrm = aryFunc.astype(np.float64)
+    aryFuncNrm -= np.mean(aryFuncNrm, axis=1)[:, None]
+    vecNrm = np.sqrt(np.sum(np.square(aryFuncNrm), axis=1))
+    vecLgc = np.greater(vecNrm, 0.0)
+    aryFuncNrm[vecLgc, :] /= vecNrm[vecLgc, None]
+    aryFuncNrm[~vecLgc, :] = 0.0
+    return aryFuncNrm
+
+
+def upd_bst(aryMdlNrm, vecMbr, aryFuncNrm, vecVox, vecIdxBst, vecBstCor):
+    """
+    Compare voxels with models, and update best fitting models (in place).
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    vecMbr : np.array
+        1D array with indices of the models to compare.
+    aryFuncNrm : np.array
+        2D array with normalised voxel time courses (see `prp_func`).
+    vecVox : np.array
+        1D array with indices of the voxels to compare.
+    vecIdxBst, vecBstCor : np.array
+        1D arrays with index of best fitting model so far, and its absolute
+        correlation with the voxel time course, for each voxel in
+        `aryFuncNrm`. Ties are resolved in favour of the model with the lower
+        index (as in the exhaustive search).
+
+    Notes
+    -----
+    The correlations are calculated at double precision, because the
+    correlations of neighbouring models on dense model grids can differ by
+    less than the rounding error at single precision.
+    """
+    aryCor = np.abs(np.dot(aryMdlNrm[vecMbr, :].astype(np.float64),
+                           aryFuncNrm[vecVox, :].T))
+    vecTmpIdx = np.argmax(aryCor, axis=0)
+    vecTmpCor = aryCor[vecTmpIdx, np.arange(vecVox.size)]
+    vecTmpIdx = vecMbr[vecTmpIdx]
+    vecLgc = np.logical_or(
+        np.greater(vecTmpCor, vecBstCor[vecVox]),
+        np.logical_and(np.equal(vecTmpCor, vecBstCor[vecVox]),
+                       np.less(vecTmpIdx, vecIdxBst[vecVox])))
+    vecBstCor[vecVox[vecLgc]] = vecTmpCor[vecLgc]
+    vecIdxBst[vecVox[vecLgc]] = vecTmpIdx[vecLgc]
+
+
+def crt_bnd(aryCor, vecRad):
+    """
+    Calculate upper bounds of correlations with models in clusters.
+
+    Parameters
+    ----------
+    aryCor : np.array
+        2D array with absolute correlation of cluster centroids and voxel time
+        courses, with shape aryCor[cluster, voxel].
+    vecRad : np.array
+        1D array with angular radius of each cluster.
+
+    Returns
+    -------
+    aryBnd : np.array
+        2D array with upper bound of the absolute correlation of any model of
+        the cluster with the voxel time course (see `srch_idx`).
+    """
+    aryAng = np.arccos(np.clip(aryCor, 0.0, 1.0))
+    return np.cos(np.maximum((aryAng - vecRad[:, None]), 0.0))
+
+
+def srch_idx(aryMdlNrm, tplIdx, aryFunc, varNumPrb, lgcExct=False):
+    """
+    Find best fitting models using the cluster index.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    tplIdx : tuple
+        Hierarchical cluster index (see `crt_hrc`).
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+    varNumPrb : int
+        Number of clusters that are searched for each voxel (the clusters
+        with the most similar centroids). The higher the number, the higher
+        the probability that the best fitting model is found (recall), and the
+        longer the search takes.
+    lgcExct : bool
+        Whether to search exactly (branch and bound). If `True`, the
+        `varNumPrb` clusters with the most similar centroids are searched
+        first, and all other clusters that may contain a better fitting model
+        are searched afterwards, so that the same models are found as with the
+        exhaustive search.
+
+    Returns
+    -------
+    vecIdxBst : np.array
+        1D array with index of best fitting model (in flattened model array)
+        for each voxel.
+    vecBstR2 : np.array
+        1D array with R2 value of best fitting model for each voxel.
+    varNumCmp : int
+        Number of comparisons of models and voxel time courses.
+
+    Notes
+    -----
+    For a voxel time course y (de-meaned, unit length) at angle a to the
+    centroid of a cluster with angular radius r, the absolute correlation of
+    any model of the cluster with y is at most cos(max(a - r, 0)), because the
+    angle between a model and y is at least a - r (Cauchy-Schwarz inequality,
+    on the unit sphere). In the exact search, clusters with an upper bound
+    below the correlation of the best fitting model found so far are skipped
+    (first for whole groups of clusters, then for single clusters).
+    """
+    aryCntr, vecLbl, vecRad, aryCntrTop, vecLblTop, vecRadTop = tplIdx
+
+    varNumVox = aryFunc.shape[0]
+    varNumClst = aryCntr.shape[0]
+    varNumPrb = max(1, min(varNumPrb, varNumClst))
+
+    aryFuncNrm = prp_func(aryFunc)
+
+    # Models in each cluster, and clusters in each group:
+    lstMbr = [np.flatnonzero(vecLbl == idxClst)
+              for idxClst in range(varNumClst)]
+    lstMbrTop = [np.flatnonzero(vecLblTop == idxGrp)
+                 for idxGrp in range(aryCntrTop.shape[0])]
+
+    vecIdxBst = np.zeros(varNumVox, dtype=np.int64)
+    vecBstCor = np.full(varNumVox, -1.0)
+    varNumCmp = 0
+
+    for idxBlck in range(0, varNumVox, varSzeBlck):
+
+        aryFuncBlck = aryFuncNrm[idxBlck:(idxBlck + varSzeBlck), :]
+        varNumVoxBlck = aryFuncBlck.shape[0]
+        vecIdxBlck = np.zeros(varNumVoxBlck, dtype=np.int64)
+        vecCorBlck = np.full(varNumVoxBlck, -1.0)
+
+        # Clusters to be searched first for each voxel (most similar
+        # centroids):
+        aryCntrCor = np.abs(np.dot(aryCntr, aryFuncBlck.T))
+        aryPrb = np.argpartition(-aryCntrCor, (varNumPrb - 1),
+                                 axis=0)[:varNumPrb, :]
+        aryLgcDne = np.zeros(aryCntrCor.shape, dtype=bool)
+        aryLgcDne[aryPrb, np.arange(varNumVoxBlck)[None, :]] = True
+
+        for idxClst in range(varNumClst):
+            vecVox = np.flatnonzero(aryLgcDne[idxClst, :])
+            if (vecVox.size == 0) or (lstMbr[idxClst].size == 0):
+                continue
+            upd_bst(aryMdlNrm, lstMbr[idxClst], aryFuncBlck, vecVox,
+                    vecIdxBlck, vecCorBlck)
+            varNumCmp += lstMbr[idxClst].size * vecVox.size
+
+        # Remaining clusters that may contain a better fitting model (groups
+        # with the most similar centroids first):
+        if lgcExct:
+            aryBndTop = crt_bnd(np.abs(np.dot(aryCntrTop, aryFuncBlck.T)),
+                                vecRadTop)
+            aryBnd = crt_bnd(aryCntrCor, vecRad)
+            for idxGrp in np.argsort(-np.mean(aryBndTop, axis=1)):
+                vecVoxGrp = np.flatnonzero(np.greater_equal(
+                    aryBndTop[idxGrp, :] + varTolBnd, vecCorBlck))
+                if vecVoxGrp.size == 0:
+                    continue
+                for idxClst in lstMbrTop[idxGrp]:
+                    vecVox = vecVoxGrp[np.logical_and(
+                        np.greater_equal(aryBnd[idxClst, vecVoxGrp]
+                                         + varTolBnd,
+                                         vecCorBlck[vecVoxGrp]),
+                        ~aryLgcDne[idxClst, vecVoxGrp])]
+                    if (vecVox.size == 0) or (lstMbr[idxClst].size == 0):
+                        continue
+                    upd_bst(aryMdlNrm, lstMbr[idxClst], aryFuncBlck, vecVox,
+                            vecIdxBlck, vecCorBlck)
+                    varNumCmp += lstMbr[idxClst].size * vecVox.size
+
+        vecIdxBst[idxBlck:(idxBlck + varSzeBlck)] = vecIdxBlck
+        vecBstCor[idxBlck:(idxBlck + varSzeBlck)] = vecCorBlck
+
+    # The coefficient of determination is the squared correlation:
+    vecBstR2 = np.square(np.maximum(vecBstCor, 0.0)).astype(np.float32)
+
+    return vecIdxBst, vecBstR2, varNumCmp
+
+
+def srch_full(aryMdlNrm, aryFunc):
+    """
+    Find best fitting models by exhaustive search (see `srch_idx`).
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+
+    Returns
+    -------
+    vecIdxBst : np.array
+        1D array with index of best fitting model for each voxel.
+    """
+    varNumVox = aryFunc.shape[0]
+    varNumMdl = aryMdlNrm.shape[0]
+    aryFuncNrm = prp_func(aryFunc)
+    vecIdxBst = np.zeros(varNumVox, dtype=np.int64)
+    vecBstCor = np.full(varNumVox, -1.0)
+    for idxVox in range(0, varNumVox, varSzeBlck):
+        vecVox = np.arange(idxVox, min((idxVox + varSzeBlck), varNumVox))
+        for idxMdl in range(0, varNumMdl, varSzeBlck):
+            vecMbr = np.arange(idxMdl, min((idxMdl + varSzeBlck), varNumMdl))
+            upd_bst(aryMdlNrm, vecMbr, aryFuncNrm, vecVox, vecIdxBst,
+                    vecBstCor)
+    return vecIdxBst
+
+
+def rcl_idx(aryMdlNrm, tplIdx, aryFunc, varNumPrb, varNumVoxRcl,
+            lgcExct=False):
+    """
+    Estimate recall of the cluster index on a sample of voxels.
+
+    Parameters
+    ----------
+    aryMdlNrm, tplIdx, aryFunc, varNumPrb, lgcExct
+        See `srch_idx`.
+    varNumVoxRcl : int
+        Number of randomly selected voxels.
+
+    Returns
+    -------
+    varRcl : float
+        Fraction of sampled voxels for which the search using the index finds
+        the same model as the exhaustive search.
+    varFrcCmp : float
+        Number of comparisons of models and voxel time courses, relative to
+        the exhaustive search.
+    """
+    objRnd = np.random.RandomState(0)
+    varNumVoxRcl = min(varNumVoxRcl, aryFunc.shape[0])
+    vecIdxVox = np.sort(objRnd.choice(aryFunc.shape[0], size=varNumVoxRcl,
+                                      replace=False))
+    aryFuncRcl = np.asarray(aryFunc[vecIdxVox, :])
+    vecIdxIdx, _, varNumCmp = srch_idx(aryMdlNrm, tplIdx, aryFuncRcl,
+                                       varNumPrb, lgcExct=lgcExct)
+    vecIdxFull = srch_full(aryMdlNrm, aryFuncRcl)
+    varRcl = float(np.mean(np.equal(vecIdxIdx, vecIdxFull)))
+    varFrcCmp = (float(varNumCmp)
+                 / float(aryMdlNrm.shape[0] * max(varNumVoxRcl, 1)))
+    return varRcl, varFrcCmp
+
+
+def find_prf_idx(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,  #noqa
+                 aryMdlNrm, tplIdx, varNumPrb, lgcExct, queOut):
+    """
+    Find best fitting pRF models for voxel time courses, using the index.
+
+    Parameters
+    ----------
+    idxPrc : int
+        Index of the chunk processed by this process.
+    vecMdlXpos, vecMdlYpos, vecMdlSd : np.array
+        1D arrays with x position, y position, and size of each model, in the
+        order of the flattened model array (see `crt_mdl_prms_flat`).
+    aryFuncChnk : np.array
+        2D array with functional data, with shape aryFuncChnk[voxel, time].
+    aryMdlNrm, tplIdx, varNumPrb, lgcExct
+        See `srch_idx`.
+    queOut : multiprocessing.queues.Queue
+        Queue to put the results on.
+
+    Notes
+    -----
+    The results are placed on the queue in the same format as in
+    `find_prf_cpu`.
+    """
+    vecIdxBst, vecBstR2, _ = srch_idx(aryMdlNrm, tplIdx, aryFuncChnk,
+                                      varNumPrb, lgcExct=lgcExct)
+
+    queOut.put([idxPrc,
+                vecMdlXpos[vecIdxBst],
+                vecMdlYpos[vecIdxBst],
+                vecMdlSd[vecIdxBst],
+                vecBstR2])
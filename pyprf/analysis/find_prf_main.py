@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+"""Parallelised pRF finding."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.find_prf_checkpoint import crt_chk_key
+from pyprf.analysis.find_prf_checkpoint import open_chk
+
+# Maximum interval at which processes are checked for having exceeded the
+# timeout while waiting for results [s]:
+varTmePoll = 5.0
+
+
+class cls_pipe_out(object):
+    """
+    Sending end of a pipe, with the `put` method of a queue.
+
+    Parameters
+    ----------
+    objCon : multiprocessing.connection.Connection
+        Sending end of a pipe (see `multiprocessing.Pipe`).
+
+    Notes
+    -----
+    Each process of the pRF finding sends its results through a pipe of its
+    own. A process that is terminated while sending its results can only
+    corrupt its own pipe, which is discarded, whereas a queue shared by all
+    processes could be left in an unusable state (e.g. with a lock held by
+    the terminated process).
+    """
+
+    def __init__(self, objCon):
+        self.objCon = objCon
+
+    def put(self, objIn):
+        """Send object through pipe."""
+        self.objCon.send(objIn)
+
+
+def crt_mdl_prms(dicCnfg):
+    """
+    Create vectors with pRF model parameters.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+
+    Returns
+    -------
+    vecMdlXpos : np.array
+        1D array with pRF model x positions.
+    vecMdlYpos : np.array
+        1D array with pRF model y positions.
+    vecMdlSd : np.array
+        1D array with pRF model sizes (SD of Gaussian).
+    """
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    # Vector with the moddeled x-positions of the pRFs:
+    vecMdlXpos = np.linspace(cfg.varExtXmin,
+                             cfg.varExtXmax,
+                             cfg.varNumX,
+                             endpoint=True,
+                             dtype=np.float32)
+
+    # Vector with the moddeled y-positions of the pRFs:
+    vecMdlYpos = np.linspace(cfg.varExtYmin,
+                             cfg.varExtYmax,
+                             cfg.varNumY,
+                             endpoint=True,
+                             dtype=np.float32)
+
+    # Vector with the moddeled standard deviations of the pRFs:
+    vecMdlSd = np.linspace(cfg.varPrfStdMin,
+                           cfg.varPrfStdMax,
+                           cfg.varNumPrfSizes,
+                           endpoint=True,
+                           dtype=np.float32)
+
+    return vecMdlXpos, vecMdlYpos, vecMdlSd
+
+
+def find_prf(dicCnfg, aryFunc, aryPrfTc, strPathChk=None, lgcResume=False,  #noqa
+             lgcTopK=False, lgcPst=False):
+    """
+    Find best fitting pRF models for voxel time courses.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    aryFunc : np.array
+        2D array with preprocessed functional data, with shape
+        aryFunc[voxel, time].
+    aryPrfTc : np.array
+        4D array with preprocessed pRF time course models, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+    strPathChk : str or None
+        Directory for checkpoints (see `find_prf_checkpoint`). If `None`, no
+        checkpoint is created.
+    lgcResume : bool
+        Whether to skip chunks that have already been completed according to
+        an existing checkpoint (for the same data, models and chunks).
+    lgcTopK : bool
+        Whether to return the `varNumTopK` best fitting models of each voxel
+        in addition. Only possible with the exhaustive search on the CPU.
+    lgcPst : bool
+        Whether to return the posterior mean and standard deviation of the pRF
+        parameters of each voxel in addition. Only possible with the
+        exhaustive search on the CPU.
+
+    Returns
+    -------
+    aryBstXpos : np.array
+        1D array with best fitting x-position for each voxel.
+    aryBstYpos : np.array
+        1D array with best fitting y-position for each voxel.
+    aryBstSd : np.array
+        1D array with best fitting pRF size for each voxel.
+    aryBstR2 : np.array
+        1D array with R2 value of 'winning' pRF model for each voxel.
+    aryTopIdx, aryTopRes, aryTopR2 : np.array
+        Only if `lgcTopK` is `True`. 2D arrays with indices (in the flattened
+        model array), residuals, and R2 values of the best fitting models of
+        each voxel, with shape aryTopIdx[voxel, K] (see `find_prf_cpu`).
+    aryPst : np.array
+        Only if `lgcPst` is `True`. 2D array with posterior mean of
+        x-position, y-position, and pRF size, followed by their posterior
+        standard deviations, with shape aryPst[voxel, 6] (see `find_prf_cpu`).
+
+    Notes
+    -----
+    The functional data are split into chunks (one chunk per parallel
+    process, or chunks of `varChnkSze` voxels). Each chunk is processed by a
+    separate process, with up to `varPar` processes running at the same
+    time. Depending on the config parameter `strVersion`, pRF finding is
+    performed on the CPU (numpy or cython) or on the GPU (tensorflow). On the
+    CPU, the search can be restricted to the most similar clusters of models
+    if `varNumClst` is greater than zero (see `find_prf_idx`), either
+    approximately or exactly (`lgcIdxExct`). Alternatively, candidate models
+    can be selected using random sketches of the time courses, if
+    `varSzeSktch` is greater than zero (see `find_prf_sktch`). With the
+    exhaustive search on the CPU, the `varNumTopK` best fitting models of
+    each voxel can be retained (`lgcTopK`), and the posterior of the pRF
+    parameters can be calculated (`lgcPst`).
+
+    Processes that die (or exceed the timeout `varTmeOut`) are detected, and
+    their chunk is processed again (up to `varNumRtry` times). Each process
+    sends its results through a pipe of its own (see `cls_pipe_out`). If a
+    checkpoint directory is given, the results of each chunk are written to
+    a memory-mapped file as soon as the chunk is completed.
+    """
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    # Conditional imports:
+    if cfg.strVersion == 'gpu':
+        from pyprf.analysis.find_prf_gpu import find_prf_gpu
+    if ((cfg.strVersion == 'cython') or (cfg.strVersion == 'numpy')):
+        from pyprf.analysis.find_prf_cpu import find_prf_cpu
+    lgcIdx = ((0 < cfg.varNumClst)
+              and ((cfg.strVersion == 'cython')
+                   or (cfg.strVersion == 'numpy')))
+    lgcSktch = ((not lgcIdx) and (0 < cfg.varSzeSktch)
+                and ((cfg.strVersion == 'cython')
+                     or (cfg.strVersion == 'numpy')))
+    if lgcIdx or lgcSktch:
+        from pyprf.analysis.find_prf_suff import crt_mdl_prms_flat
+        from pyprf.analysis import find_prf_idx
+    if lgcSktch:
+        from pyprf.analysis import find_prf_sktch
+    if ((lgcTopK or lgcPst)
+            and (lgcIdx or lgcSktch or (cfg.strVersion == 'gpu'))):
+        raise ValueError(('The best fitting models (varNumTopK) and the '
+                          + 'posterior (lgcPst) can only be calculated with '
+                          + 'the exhaustive search on the CPU'))
+    # Number of best fitting models retained per voxel (zero if only the best
+    # fitting model is needed):
+    varNumTopK = (cfg.varNumTopK if (lgcTopK and (1 < cfg.varNumTopK))
+                  else 0)
+
+    print('------Find pRF models for voxel time courses')
+
+    # Number of voxels for which pRF finding will be performed:
+    varNumVoxInc = aryFunc.shape[0]
+
+    print('---------Number of voxels on which pRF finding will be performed: '
+          + str(varNumVoxInc))
+
+    print('---------Preparing parallel pRF model finding')
+
+    # For the GPU version, we need to set down the parallelisation to 1 now,
+    # because no separate CPU threads are to be created. We may still use CPU
+    # parallelisation for preprocessing, which is why the parallelisation
+    # factor is only reduced now, not earlier.
+    if cfg.strVersion == 'gpu':
+        cfg.varPar = 1
+
+    # Vectors with the moddeled x-positions, y-positions, and standard
+    # deviations of the pRFs:
+    vecMdlXpos, vecMdlYpos, vecMdlSd = crt_mdl_prms(dicCnfg)
+
+    # Number of chunks. By default, there is one chunk per parallel process.
+    # Smaller chunks (`varChnkSze`) mean that less work is lost if a process
+    # dies.
+    if 0 < cfg.varChnkSze:
+        varNumChnk = max(cfg.varPar,
+                         int(np.ceil(np.divide(float(varNumVoxInc),
+                                               float(cfg.varChnkSze)))))
+    else:
+        varNumChnk = cfg.varPar
+
+    # Vector with the indicies at which the functional data will be separated
+    # in order to be chunked up for the parallel processes:
+    vecIdxChnks = np.linspace(0,
+                              varNumVoxInc,
+                              num=varNumChnk,
+                              endpoint=False)
+    vecIdxChnks = np.hstack((vecIdxChnks, varNumVoxInc))
+
+    # Make sure type is float32 (without copying arrays that are float32
+    # already, e.g. memory-mapped models that are shared between processes):
+    aryFunc = aryFunc.astype(np.float32, copy=False)
+    aryPrfTc = aryPrfTc.astype(np.float32, copy=False)
+
+    # Model index (clusters of normalised model time courses), and model
+    # parameters in the order of the flattened model array:
+    if lgcIdx:
+        aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+        tplIdx = find_prf_idx.load_idx(cfg.strPathMdl, aryMdlNrm,
+                                       cfg.varNumClst)
+        vecMdlXposFlt, vecMdlYposFlt, vecMdlSdFlt = crt_mdl_prms_flat(
+            vecMdlXpos, vecMdlYpos, vecMdlSd)
+        varRcl, varFrcCmp = find_prf_idx.rcl_idx(
+            aryMdlNrm, tplIdx, aryFunc, cfg.varNumPrb, cfg.varNumVoxRcl,
+            lgcExct=cfg.lgcIdxExct)
+        if cfg.lgcIdxExct:
+            print('---------Exact search using model index')
+        else:
+            print('---------Search using model index (' + str(cfg.varNumPrb)
+                  + ' out of ' + str(tplIdx[0].shape[0])
+                  + ' clusters per voxel)')
+        print('---------Recall: ' + str(np.around(varRcl, decimals=3))
+              + ', fraction of models compared: '
+              + str(np.around(varFrcCmp, decimals=3)))
+
+    # Random projection along time (sketch), and sketches of normalised model
+    # time courses:
+    if lgcSktch:
+        aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+        arySktch = find_prf_sktch.crt_sktch(aryPrfTc.shape[3],
+                                            cfg.varSzeSktch)
+        aryMdlSktch = np.dot(aryMdlNrm, arySktch)
+        vecMdlXposFlt, vecMdlYposFlt, vecMdlSdFlt = crt_mdl_prms_flat(
+            vecMdlXpos, vecMdlYpos, vecMdlSd)
+        varRcl = find_prf_sktch.rcl_sktch(aryMdlNrm, aryMdlSktch, arySktch,
+                                          aryFunc, cfg.varNumCnd,
+                                          cfg.varNumVoxRcl)
+        print('---------Search using sketches (' + str(cfg.varSzeSktch)
+              + ' instead of ' + str(aryPrfTc.shape[3]) + ' volumes, '
+              + str(cfg.varNumCnd) + ' candidates per voxel)')
+        print('---------Recall: ' + str(np.around(varRcl, decimals=3)))
+
+    # Array for results (best fitting x-position, y-position, pRF size, and
+    # R2 value for each voxel, followed by the indices, residuals, and R2
+    # values of the best fitting models, and by the posterior) & vector
+    # marking completed chunks. If checkpointing is enabled, these are
+    # memory-mapped. Model indices are exact at float32 precision for up to
+    # 2^24 models.
+    varNumCol = 4 + 3 * varNumTopK + 6 * int(lgcPst)
+    if strPathChk is None:
+        aryRes = np.zeros((varNumVoxInc, varNumCol), dtype=np.float32)
+        vecDne = np.zeros(varNumChnk, dtype=np.uint8)
+    else:
+        # Results obtained with the model index may differ from those of the
+        # exhaustive search:
+        strVrsnChk = cfg.strVersion
+        if lgcIdx:
+            strVrsnChk += ('_index_' + str(cfg.varNumClst) + '_'
+                           + str(cfg.varNumPrb) + '_'
+                           + str(cfg.lgcIdxExct))
+        if lgcSktch:
+            strVrsnChk += ('_sketch_' + str(cfg.varSzeSktch) + '_'
+                           + str(cfg.varNumCnd))
+        if 0 < varNumTopK:
+            strVrsnChk += '_topk_' + str(varNumTopK)
+        if lgcPst:
+            strVrsnChk += '_pst_' + str(cfg.varTmpPst)
+        strKey = crt_chk_key(aryFunc, aryPrfTc, vecIdxChnks, strVrsnChk)
+        aryRes, vecDne = open_chk(strPathChk, strKey, varNumVoxInc,
+                                  varNumChnk, lgcResume, varNumCol=varNumCol)
+        if lgcResume:
+            print('---------Resuming from checkpoint, '
+                  + str(int(np.sum(vecDne))) + ' out of ' + str(varNumChnk)
+                  + ' chunks already completed')
+
+    # List of chunks that remain to be processed:
+    lstChnkTodo = [idxChnk for idxChnk in range(varNumChnk)
+                   if not vecDne[idxChnk]]
+
+    # Number of times each chunk has been retried:
+    vecNumRtry = np.zeros(varNumChnk, dtype=np.int32)
+
+    if cfg.strVersion == 'gpu':
+        print('---------pRF finding on GPU')
+    else:
+        print('---------pRF finding on CPU')
+
+    # Running processes (chunk index as key, list with process, start time,
+    # and receiving end of the pipe for its results as value):
+    dicPrcs = {}
+
+    while lstChnkTodo or dicPrcs:
+
+        # Start processes for pending chunks:
+        while lstChnkTodo and (len(dicPrcs) < cfg.varPar):
+
+            idxChnk = lstChnkTodo.pop(0)
+
+            # Functional data of current chunk:
+            aryFuncChnk = aryFunc[int(vecIdxChnks[idxChnk]):
+                                  int(vecIdxChnks[(idxChnk + 1)]), :]
+
+            # Pipe for the results of the current chunk:
+            objRcv, objSnd = mp.Pipe(duplex=False)
+            queOut = cls_pipe_out(objSnd)
+
+            # CPU version, using the model index:
+            if lgcIdx:
+                objPrc = mp.Process(target=find_prf_idx.find_prf_idx,
+                                    args=(idxChnk,
+                                          vecMdlXposFlt,
+                                          vecMdlYposFlt,
+                                          vecMdlSdFlt,
+                                          aryFuncChnk,
+                                          aryMdlNrm,
+                                          tplIdx,
+                                          cfg.varNumPrb,
+                                          cfg.lgcIdxExct,
+                                          queOut)
+                                    )
+
+            # CPU version, using sketches:
+            elif lgcSktch:
+                objPrc = mp.Process(target=find_prf_sktch.find_prf_sktch,
+                                    args=(idxChnk,
+                                          vecMdlXposFlt,
+                                          vecMdlYposFlt,
+                                          vecMdlSdFlt,
+                                          aryFuncChnk,
+                                          aryMdlNrm,
+                                          aryMdlSktch,
+                                          arySktch,
+                                          cfg.varNumCnd,
+                                          queOut)
+                                    )
+
+            # CPU version (using numpy or cython for pRF finding):
+            elif ((cfg.strVersion == 'numpy')
+                  or (cfg.strVersion == 'cython')):
+                objPrc = mp.Process(target=find_prf_cpu,
+                                    args=(idxChnk,
+                                          dicCnfg,
+                                          vecMdlXpos,
+                                          vecMdlYpos,
+                                          vecMdlSd,
+                                          aryFuncChnk,
+                                          aryPrfTc,
+                                          cfg.strVersion,
+                                          queOut,
+                                          varNumTopK,
+                                          lgcPst)
+                                    )
+
+            # GPU version (using tensorflow for pRF finding):
+            elif cfg.strVersion == 'gpu':
+                objPrc = mp.Process(target=find_prf_gpu,
+                                    args=(idxChnk,
+                                          vecMdlXpos,
+                                          vecMdlYpos,
+                                          vecMdlSd,
+                                          aryFuncChnk,
+                                          aryPrfTc,
+                                          queOut)
+                                    )
+
+            # Daemon (kills processes when exiting):
+            objPrc.daemon = True
+            objPrc.start()
+            # The sending end is only needed by the process (closing it here
+            # means that the receiving end reports the end of the pipe if the
+            # process dies):
+            objSnd.close()
+            dicPrcs[idxChnk] = [objPrc, time.time(), objRcv]
+            del(aryFuncChnk, queOut)
+
+        # Wait for results. The receiving end of a pipe is also ready if its
+        # process has exited without sending results.
+        lstRdy = wait([lstTmp[2] for lstTmp in dicPrcs.values()],
+                      timeout=varTmePoll)
+
+        # Check processes for results, and for having died or exceeded the
+        # timeout:
+        for idxChnk in list(dicPrcs.keys()):
+
+            objPrc, varTmeSrt, objRcv = dicPrcs[idxChnk]
+
+            if objRcv in lstRdy:
+                try:
+                    lstPrfRes = objRcv.recv()
+                except EOFError:
+                    lstPrfRes = None
+                objPrc.join()
+                objRcv.close()
+                del(dicPrcs[idxChnk])
+                if lstPrfRes is not None:
+                    varTmpChnkSrt = int(vecIdxChnks[idxChnk])
+                    varTmpChnkEnd = int(vecIdxChnks[(idxChnk + 1)])
+                    for idxPrm in range(4):
+                        aryRes[varTmpChnkSrt:varTmpChnkEnd, idxPrm] = \
+                            lstPrfRes[(idxPrm + 1)]
+                    # Best fitting models of each voxel & posterior (2D
+                    # arrays with one row per voxel):
+                    if 4 < varNumCol:
+                        aryRes[varTmpChnkSrt:varTmpChnkEnd, 4:] = \
+                            np.concatenate(lstPrfRes[5:], axis=1)
+                    # Results have to be written before the chunk is marked
+                    # as completed (see `open_chk`):
+                    if strPathChk is not None:
+                        aryRes.flush()
+                    vecDne[idxChnk] = 1
+                    if strPathChk is not None:
+                        vecDne.flush()
+                    print('---------Completed chunks: '
+                          + str(int(np.sum(vecDne))) + ' out of '
+                          + str(varNumChnk))
+                    continue
+                print('---------WARNING: Process for chunk ' + str(idxChnk)
+                      + ' died (exit code ' + str(objPrc.exitcode) + ')')
+            elif ((0.0 < cfg.varTmeOut)
+                  and (cfg.varTmeOut < (time.time() - varTmeSrt))):
+                print('---------WARNING: Process for chunk '
+                      + str(idxChnk) + ' exceeded timeout')
+                objPrc.terminate()
+                objPrc.join()
+                objRcv.close()
+                del(dicPrcs[idxChnk])
+            else:
+                continue
+
+            # Retry chunk:
+            if vecNumRtry[idxChnk] < cfg.varNumRtry:
+                vecNumRtry[idxChnk] += 1
+                print('---------Retrying chunk ' + str(idxChnk) + ' (attempt '
+                      + str(vecNumRtry[idxChnk] + 1) + ')')
+                lstChnkTodo.append(idxChnk)
+            else:
+                # Stop remaining processes before giving up:
+                for lstTmp in dicPrcs.values():
+                    lstTmp[0].terminate()
+                    lstTmp[0].join()
+                    lstTmp[2].close()
+                raise RuntimeError(('pRF finding failed for chunk '
+                                    + str(idxChnk) + ' after '
+                                    + str(cfg.varNumRtry + 1) + ' attempts'))
+
+    # We don't need the original array with the functional data anymore:
+    del(aryFunc)
+
+    print('---------Prepare pRF finding results for export')
+
+    # Copy results (the results array may be memory-mapped):
+    aryBstXpos = np.array(aryRes[:, 0])
+    aryBstYpos = np.array(aryRes[:, 1])
+    aryBstSd = np.array(aryRes[:, 2])
+    aryBstR2 = np.array(aryRes[:, 3])
+
+    tplOut = (aryBstXpos, aryBstYpos, aryBstSd, aryBstR2)
+
+    if lgcTopK:
+        aryTopIdx = np.array(aryRes[:, 4:(4 + varNumTopK)]).astype(np.int64)
+        aryTopRes = np.array(aryRes[:, (4 + varNumTopK):(4 + 2 * varNumTopK)])
+        aryTopR2 = np.array(aryRes[:, (4 + 2 * varNumTopK):
+                                   (4 + 3 * varNumTopK)])
+        tplOut += (aryTopIdx, aryTopRes, aryTopR2)
+
+    if lgcPst:
+        tplOut += (np.array(aryRes[:, (varNumCol - 6):]),)
+
+    return tplOut
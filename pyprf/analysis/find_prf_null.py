@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Null distributions of R2 values from surrogate data."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.find_prf_idx import crt_mdl_nrm
+from pyprf.analysis.find_prf_idx import prp_func
+
+# Number of surrogate time courses that are compared with the models at once
+# (limits the size of temporary arrays, which have size number-of-models times
+# number-of-surrogate-time-courses):
+varSzeBlck = 1000
+
+
+def crt_srgt(aryFunc, varNumSrgt, strSrgt, varSzeBlckPrm, objRnd):
+    """
+    Create surrogate time courses.
+
+    Parameters
+    ----------
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+    varNumSrgt : int
+        Number of surrogate time courses per voxel.
+    strSrgt : str
+        Type of surrogate data, 'phase' (phase randomisation) or 'block'
+        (permutation of blocks of volumes).
+    varSzeBlckPrm : int
+        Number of volumes per block (only used for block permutation).
+    objRnd : np.random.RandomState
+        Random number generator.
+
+    Returns
+    -------
+    arySrgt : np.array
+        3D array with surrogate time courses, with shape arySrgt[voxel,
+        surrogate, time].
+
+    Notes
+    -----
+    Phase randomisation preserves the power spectrum (i.e. the temporal
+    autocorrelation) of each voxel time course, with random phases drawn
+    independently for each voxel and surrogate. Block permutation preserves
+    the temporal autocorrelation within blocks.
+    """
+    varNumVox, varNumVol = aryFunc.shape
+
+    if strSrgt == 'phase':
+        aryFft = np.fft.rfft(aryFunc.astype(np.float64), axis=1)
+        aryPhs = objRnd.uniform(0.0, (2.0 * np.pi),
+                                size=(varNumVox, varNumSrgt, aryFft.shape[1]))
+        # The constant term (and the Nyquist frequency, for an even number of
+        # volumes) have to remain real:
+        aryPhs[:, :, 0] = 0.0
+        if (varNumVol % 2) == 0:
+            aryPhs[:, :, -1] = 0.0
+        arySrgt = np.fft.irfft((aryFft[:, None, :] * np.exp(1j * aryPhs)),
+                               n=varNumVol, axis=2)
+
+    elif strSrgt == 'block':
+        vecIdxVol = np.arange(varNumVol)
+        lstBlck = np.array_split(
+            vecIdxVol, int(np.ceil(float(varNumVol) / float(varSzeBlckPrm))))
+        arySrgt = np.zeros((varNumVox, varNumSrgt, varNumVol))
+        for idxSrgt in range(varNumSrgt):
+            vecIdxPrm = np.concatenate(
+                [lstBlck[idxBlck]
+                 for idxBlck in objRnd.permutation(len(lstBlck))])
+            arySrgt[:, idxSrgt, :] = aryFunc[:, vecIdxPrm]
+
+    else:
+        raise ValueError(('Invalid type of surrogate data: ' + str(strSrgt)))
+
+    return arySrgt
+
+
+def null_r2(aryMdlNrm, arySrgt):
+    """
+    Calculate R2 values of the best fitting models of surrogate time courses.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    arySrgt : np.array
+        3D array with surrogate time courses (see `crt_srgt`).
+
+    Returns
+    -------
+    aryR2Null : np.array
+        2D array with R2 value of the best fitting model of each surrogate
+        time course, with shape aryR2Null[voxel, surrogate].
+
+    Notes
+    -----
+    The R2 value of a model (with a constant term) is the squared inner
+    product of the normalised model & time courses (see `crt_mdl_nrm`), so
+    that all surrogate time courses of a block are compared with all models
+    with one matrix product.
+    """
+    varNumVox, varNumSrgt, varNumVol = arySrgt.shape
+    arySrgt = np.reshape(arySrgt, (-1, varNumVol))
+    vecR2Null = np.zeros(arySrgt.shape[0], dtype=np.float32)
+    for idxBlck in range(0, arySrgt.shape[0], varSzeBlck):
+        arySrgtNrm = prp_func(arySrgt[idxBlck:(idxBlck + varSzeBlck), :])
+        vecR2Null[idxBlck:(idxBlck + varSzeBlck)] = np.square(np.max(
+            np.abs(np.dot(aryMdlNrm, arySrgtNrm.astype(np.float32).T)),
+            axis=0))
+    return np.reshape(vecR2Null, (varNumVox, varNumSrgt))
+
+
+def fdr_thr(vecPval, varQ):
+    """
+    Find p-value threshold controlling the false discovery rate.
+
+    Parameters
+    ----------
+    vecPval : np.array
+        1D array with p-values.
+    varQ : float
+        False discovery rate.
+
+    Returns
+    -------
+    varThr : float
+        Largest p-value that is significant according to the Benjamini &
+        Hochberg procedure (zero if no p-value is significant).
+    """
+    vecSrt = np.sort(vecPval)
+    vecLgc = np.less_equal(
+        vecSrt, (varQ * np.arange(1, (vecSrt.size + 1)) / vecSrt.size))
+    if not np.any(vecLgc):
+        return 0.0
+    return float(vecSrt[np.flatnonzero(vecLgc)[-1]])
+
+
+def find_prf_null(dicCnfg, aryFunc, aryPrfTc, vecR2):
+    """
+    Calculate p-values of R2 values from surrogate data.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    aryFunc : np.array
+        2D array with preprocessed functional data, with shape
+        aryFunc[voxel, time].
+    aryPrfTc : np.array
+        4D array with preprocessed pRF time course models, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+    vecR2 : np.array
+        1D array with R2 value of the best fitting model of each voxel (see
+        `find_prf`).
+
+    Returns
+    -------
+    vecPval : np.array
+        1D array with p-value of the R2 value of each voxel (float32).
+
+    Notes
+    -----
+    For each voxel, `varNumSrgt` surrogate time courses are created (see
+    `crt_srgt`), and the R2 values of their best fitting models form the null
+    distribution of the voxel's R2 value. The p-value is the fraction of
+    surrogates (including the observed time course) with an R2 value at
+    least as high as the observed one, i.e. the smallest possible p-value is
+    one over `varNumSrgt` plus one.
+    """
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    print('------Null distributions of R2 values from surrogate data')
+    print('---------Surrogates per voxel: ' + str(cfg.varNumSrgt) + ' ('
+          + str(cfg.strSrgt) + ')')
+
+    varTme01 = time.time()
+
+    aryMdlNrm = crt_mdl_nrm(aryPrfTc)
+    objRnd = np.random.RandomState(0)
+
+    varNumVox = aryFunc.shape[0]
+    vecPval = np.ones(varNumVox, dtype=np.float32)
+
+    # Number of voxels whose surrogates are created at once:
+    varNumVoxBlck = max(1, (varSzeBlck // cfg.varNumSrgt))
+
+    for idxBlck in range(0, varNumVox, varNumVoxBlck):
+        arySrgt = crt_srgt(
+            np.asarray(aryFunc[idxBlck:(idxBlck + varNumVoxBlck), :]),
+            cfg.varNumSrgt, cfg.strSrgt, cfg.varSzeBlckSrgt, objRnd)
+        aryR2Null = null_r2(aryMdlNrm, arySrgt)
+        vecPval[idxBlck:(idxBlck + varNumVoxBlck)] = np.divide(
+            (1.0 + np.sum(np.greater_equal(
+                aryR2Null,
+                vecR2[idxBlck:(idxBlck + varNumVoxBlck), None]), axis=1)),
+            (1.0 + cfg.varNumSrgt))
+
+    print('---------Elapsed time: '
+          + str(np.around((time.time() - varTme01), decimals=3)) + ' s')
+
+    return vecPval
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""Find best fitting pairs of pRF models (two Gaussians)."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.find_prf_main import crt_mdl_prms
+from pyprf.analysis.find_prf_idx import crt_mdl_nrm
+from pyprf.analysis.find_prf_idx import prp_func
+
+# Number of voxels that are processed at once, and number of pairs of models
+# that are compared with these voxels at once (limits the size of temporary
+# arrays, which have size number-of-pairs times number-of-voxels):
+varSzeBlckVox = 1000
+varSzeBlckPair = 10000
+
+# Number of entries of the Gram matrix of the models (inner products of model
+# time courses) that are calculated at once, when pairs are created:
+varSzeBlckGrm = 1000000
+
+# Pairs of models whose normalised time courses are (almost) collinear are
+# excluded (the fit of the pair is not defined):
+varTolGrm = 1e-6
+
+
+def crt_pair(aryMdlNrm, tplShp, varNumNgbPair):
+    """
+    Create pairs of models and their inner products, block by block.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    tplShp : tuple
+        Number of modelled x-positions, y-positions, and pRF sizes.
+    varNumNgbPair : int
+        If greater than zero, only pairs of models whose x-positions and
+        y-positions differ by at most `varNumNgbPair` grid steps are
+        included. Otherwise, all pairs are included.
+
+    Yields
+    ------
+    vecIdx1, vecIdx2 : np.array
+        1D arrays with indices (in the flattened model array) of the first
+        and second model of each pair of the block (first index lower than
+        second).
+    vecGrm : np.array
+        1D array with inner product of the normalised time courses of the two
+        models of each pair of the block (entries of the Gram matrix).
+
+    Notes
+    -----
+    Models with a variance of zero, and pairs of (almost) collinear models
+    are excluded. Pairs are created from a few rows of the Gram matrix at a
+    time (`varSzeBlckGrm`), and are yielded in blocks of `varSzeBlckPair`
+    pairs (ordered by first, then second index), so that memory usage does
+    not grow with the number of pairs (i.e. with the square of the number of
+    models).
+    """
+    varNumMdl = aryMdlNrm.shape[0]
+    aryMdl = aryMdlNrm.astype(np.float64)
+    vecLgcMdl = np.greater(np.sum(np.square(aryMdl), axis=1), 0.5)
+    aryIdxGrd = np.stack(np.unravel_index(np.arange(varNumMdl), tplShp),
+                         axis=1)
+
+    # Models with variance (first model of pairs), and number of rows of the
+    # Gram matrix that are calculated at once:
+    vecIdxMdl = np.flatnonzero(vecLgcMdl)
+    varSzeBlckRow = max(1, (varSzeBlckGrm // varNumMdl))
+
+    # Pairs that have been created, but not yet yielded:
+    lstIdx1 = []
+    lstIdx2 = []
+    lstGrm = []
+    varNumBuf = 0
+
+    for idxRow in range(0, vecIdxMdl.size, varSzeBlckRow):
+
+        # Rows of the Gram matrix, for the second models of the pairs (i.e.
+        # models with a higher index than the first model):
+        vecRow = vecIdxMdl[idxRow:(idxRow + varSzeBlckRow)]
+        vecCol = np.arange((vecRow[0] + 1), varNumMdl)
+        aryGrm = np.dot(aryMdl[vecRow, :], aryMdl[vecCol, :].T)
+
+        aryLgc = np.logical_and(np.greater(vecCol[None, :], vecRow[:, None]),
+                                vecLgcMdl[None, vecCol])
+        aryLgc = np.logical_and(aryLgc, np.less(np.abs(aryGrm),
+                                                (1.0 - varTolGrm)))
+        if 0 < varNumNgbPair:
+            aryLgc = np.logical_and(aryLgc, np.all(np.less_equal(
+                np.abs(aryIdxGrd[None, vecCol, 0:2]
+                       - aryIdxGrd[vecRow, None, 0:2]),
+                varNumNgbPair), axis=2))
+
+        vecTmp1, vecTmp2 = np.nonzero(aryLgc)
+        lstIdx1.append(vecRow[vecTmp1])
+        lstIdx2.append(vecCol[vecTmp2])
+        lstGrm.append(aryGrm[vecTmp1, vecTmp2])
+        varNumBuf += vecTmp1.size
+        del(aryGrm, aryLgc)
+
+        # Yield complete blocks of pairs (and all remaining pairs after the
+        # last rows):
+        lgcLst = (vecIdxMdl.size <= (idxRow + varSzeBlckRow))
+        if (varSzeBlckPair <= varNumBuf) or (lgcLst and (0 < varNumBuf)):
+            vecIdx1 = np.concatenate(lstIdx1)
+            vecIdx2 = np.concatenate(lstIdx2)
+            vecGrm = np.concatenate(lstGrm)
+            if lgcLst:
+                varNumYld = varNumBuf
+            else:
+                varNumYld = (varNumBuf // varSzeBlckPair) * varSzeBlckPair
+            for idxPair in range(0, varNumYld, varSzeBlckPair):
+                varEnd = min((idxPair + varSzeBlckPair), varNumYld)
+                yield (vecIdx1[idxPair:varEnd], vecIdx2[idxPair:varEnd],
+                       vecGrm[idxPair:varEnd])
+            lstIdx1 = [vecIdx1[varNumYld:]]
+            lstIdx2 = [vecIdx2[varNumYld:]]
+            lstGrm = [vecGrm[varNumYld:]]
+            varNumBuf -= varNumYld
+
+
+def srch_pair(aryMdlNrm, aryFunc, tplShp, varNumNgbPair):
+    """
+    Find best fitting pair of models for each voxel.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+    tplShp : tuple
+        Number of modelled x-positions, y-positions, and pRF sizes.
+    varNumNgbPair : int
+        Neighbourhood of pairs of models (see `crt_pair`).
+
+    Returns
+    -------
+    aryIdxBst : np.array
+        2D array with indices (in the flattened model array) of the two
+        models of the best fitting pair for each voxel, with shape
+        aryIdxBst[voxel, 2] (-1 if there are no pairs).
+    vecBstR2 : np.array
+        1D array with R2 value of the best fitting pair for each voxel.
+    aryBstWgt : np.array
+        2D array with weights of the two models of the best fitting pair,
+        with shape aryBstWgt[voxel, 2]. The weights refer to the normalised
+        model & voxel time courses (standardised regression coefficients).
+
+    Notes
+    -----
+    With the inner products a & b of the normalised voxel time course with
+    the normalised time courses of the two models, and the inner product g of
+    the two model time courses, the R2 value of a linear regression with both
+    models and a constant term is (a^2 + b^2 - 2 g a b) / (1 - g^2). The inner
+    products of voxel & model time courses are calculated once for all
+    models, so that the pairs are compared without the time courses. The
+    weights of the two models are not constrained in sign. The pairs are
+    created again for each block of voxels (see `crt_pair`), instead of being
+    held in memory.
+    """
+    varNumVox = aryFunc.shape[0]
+
+    aryIdxBst = np.zeros((varNumVox, 2), dtype=np.int64) - 1
+    vecBstR2 = np.zeros(varNumVox, dtype=np.float64)
+    aryBstWgt = np.zeros((varNumVox, 2), dtype=np.float64)
+
+    for idxVox in range(0, varNumVox, varSzeBlckVox):
+
+        vecIdxVox = np.arange(idxVox, min((idxVox + varSzeBlckVox),
+                                          varNumVox))
+
+        # Inner products of voxel & model time courses:
+        aryPrj = np.dot(aryMdlNrm.astype(np.float64),
+                        prp_func(aryFunc[vecIdxVox, :]).T)
+
+        varNumPair = 0
+        for vecIdx1, vecIdx2, vecGrm in crt_pair(aryMdlNrm, tplShp,
+                                                 varNumNgbPair):
+            varNumPair += vecIdx1.size
+            aryA = aryPrj[vecIdx1, :]
+            aryB = aryPrj[vecIdx2, :]
+            vecG = vecGrm[:, None]
+            aryR2 = ((np.square(aryA) + np.square(aryB)
+                      - 2.0 * vecG * aryA * aryB)
+                     / (1.0 - np.square(vecG)))
+
+            # Update best fitting pairs (ties are resolved in favour of the
+            # pair that comes first):
+            vecTmp = np.argmax(aryR2, axis=0)
+            vecR2 = aryR2[vecTmp, np.arange(vecIdxVox.size)]
+            vecLgc = np.greater(vecR2, vecBstR2[vecIdxVox])
+            vecLgc = np.logical_or(vecLgc,
+                                   np.less(aryIdxBst[vecIdxVox, 0], 0))
+            vecCol = np.flatnonzero(vecLgc)
+            vecUpd = vecIdxVox[vecCol]
+            aryIdxBst[vecUpd, 0] = vecIdx1[vecTmp[vecCol]]
+            aryIdxBst[vecUpd, 1] = vecIdx2[vecTmp[vecCol]]
+            vecBstR2[vecUpd] = vecR2[vecCol]
+            vecA = aryA[vecTmp[vecCol], vecCol]
+            vecB = aryB[vecTmp[vecCol], vecCol]
+            vecG = vecGrm[vecTmp[vecCol]]
+            aryBstWgt[vecUpd, 0] = (vecA - vecG * vecB) / (1.0 - vecG ** 2)
+            aryBstWgt[vecUpd, 1] = (vecB - vecG * vecA) / (1.0 - vecG ** 2)
+
+        if idxVox == 0:
+            print('---------Number of pairs of models: ' + str(varNumPair))
+
+    return aryIdxBst, vecBstR2.astype(np.float32), aryBstWgt.astype(np.float32)
+
+
+def find_prf_pair(dicCnfg, aryFunc, aryPrfTc):
+    """
+    Find best fitting pairs of pRF models (two Gaussians) for each voxel.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    aryFunc : np.array
+        2D array with preprocessed functional data, with shape
+        aryFunc[voxel, time].
+    aryPrfTc : np.array
+        4D array with preprocessed pRF time course models, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+
+    Returns
+    -------
+    aryPair : np.array
+        2D array with x-position, y-position, and pRF size of the first and
+        of the second model of the best fitting pair, R2 value, and weights of
+        the two models (see `srch_pair`), with shape aryPair[voxel, 9]
+        (float32). Voxels without a pair are zero.
+
+    Notes
+    -----
+    Pairs are formed from all models, or only from models that are close in
+    the visual field (`varNumNgbPair`). The time courses are only used to
+    calculate the inner products of voxel & model time courses (see
+    `srch_pair`).
+    """
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    print('------Find best fitting pairs of pRF models')
+
+    varTme01 = time.time()
+
+    aryMdlNrm = crt_mdl_nrm(aryPrfTc)
+
+    aryIdxBst, vecBstR2, aryBstWgt = srch_pair(aryMdlNrm, aryFunc,
+                                               aryPrfTc.shape[0:3],
+                                               cfg.varNumNgbPair)
+
+    vecMdlXpos, vecMdlYpos, vecMdlSd = crt_mdl_prms(dicCnfg)
+    vecLgc = np.greater_equal(aryIdxBst[:, 0], 0)
+    aryPair = np.zeros((aryFunc.shape[0], 9), dtype=np.float32)
+    for idxMdl in range(2):
+        vecIdxMdl = aryIdxBst[vecLgc, idxMdl]
+        tplIdxGrd = np.unravel_index(vecIdxMdl, aryPrfTc.shape[0:3])
+        for idxPrm, vecMdl in enumerate([vecMdlXpos, vecMdlYpos, vecMdlSd]):
+            aryPair[vecLgc, (3 * idxMdl + idxPrm)] = vecMdl[tplIdxGrd[idxPrm]]
+    aryPair[vecLgc, 6] = vecBstR2[vecLgc]
+    aryPair[vecLgc, 7:9] = aryBstWgt[vecLgc, :]
+
+    print('---------Elapsed time: '
+          + str(np.around((time.time() - varTme01), decimals=3)) + ' s')
+
+    return aryPair
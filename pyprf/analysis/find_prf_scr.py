@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""Screening of voxels before pRF finding."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from pyprf.analysis.find_prf_idx import crt_mdl_nrm
+from pyprf.analysis.find_prf_idx import prp_func
+
+# Number of voxels that are screened at once (limits the size of temporary
+# arrays, which have size number-of-models times number-of-voxels):
+varSzeBlck = 1000
+
+
+def crt_bss_scr(aryPrfTc, varRnkScr):
+    """
+    Create low-rank projection of pRF model time courses for screening.
+
+    Parameters
+    ----------
+    aryPrfTc : np.array
+        4D array with preprocessed pRF time course models, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+    varRnkScr : int
+        Rank of the projection.
+
+    Returns
+    -------
+    tplBss : tuple
+        Tuple with (0) orthonormal basis, with shape aryBss[time, rank], (1)
+        projection of the de-meaned, normalised model time courses onto the
+        basis, with shape aryMdlPrj[model, rank], and (2) norm of the part of
+        each model time course that lies outside of the span of the basis.
+
+    Notes
+    -----
+    The basis consists of the leading eigenvectors of the matrix of sums of
+    products over models (time by time), i.e. of the leading right singular
+    vectors of the matrix of model time courses.
+    """
+    aryMdlNrm = crt_mdl_nrm(aryPrfTc).astype(np.float64)
+    vecEig, aryEig = np.linalg.eigh(np.dot(aryMdlNrm.T, aryMdlNrm))
+    varRnkScr = min(varRnkScr, vecEig.size)
+    # Eigenvalues are in ascending order:
+    aryBss = aryEig[:, ::-1][:, :varRnkScr]
+    aryMdlPrj = np.dot(aryMdlNrm, aryBss)
+    vecMdlRsd = np.sqrt(np.maximum((np.sum(np.square(aryMdlNrm), axis=1)
+                                    - np.sum(np.square(aryMdlPrj), axis=1)),
+                                   0.0))
+    return aryBss, aryMdlPrj, vecMdlRsd
+
+
+def scr_vox(aryFunc, tplBss):
+    """
+    Calculate screening R2 of voxel time courses.
+
+    Parameters
+    ----------
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+    tplBss : tuple
+        Low-rank projection of model time courses (see `crt_bss_scr`).
+
+    Returns
+    -------
+    vecR2Scr : np.array
+        1D array with screening R2 for each voxel (float32).
+
+    Notes
+    -----
+    The screening R2 is an upper bound of the R2 of the best fitting model.
+    With y the de-meaned, normalised voxel time course, and P & Q the
+    projections onto the span of the basis and onto its complement, the
+    absolute correlation of a model time course u with y is at most
+    |Pu . Py| + |Qu| |Qy| (Cauchy-Schwarz inequality). The first term is
+    calculated in the low-rank space, and the second from the norms outside
+    of the span of the basis. Therefore, voxels with a screening R2 below a
+    threshold cannot have a best fitting model with an R2 above the
+    threshold, and the cost of the screening is the rank of the projection
+    divided by the number of volumes, relative to an exhaustive search.
+    """
+    aryBss, aryMdlPrj, vecMdlRsd = tplBss
+    varNumVox = aryFunc.shape[0]
+    vecR2Scr = np.zeros(varNumVox, dtype=np.float32)
+    for idxBlck in range(0, varNumVox, varSzeBlck):
+        aryFuncPrj = np.dot(
+            prp_func(aryFunc[idxBlck:(idxBlck + varSzeBlck), :]), aryBss)
+        vecFuncRsd = np.sqrt(np.maximum(
+            (1.0 - np.sum(np.square(aryFuncPrj), axis=1)), 0.0))
+        vecCor = np.max((np.abs(np.dot(aryMdlPrj, aryFuncPrj.T))
+                         + np.outer(vecMdlRsd, vecFuncRsd)), axis=0)
+        vecR2Scr[idxBlck:(idxBlck + varSzeBlck)] = np.square(
+            np.minimum(vecCor, 1.0))
+    return vecR2Scr
+
+
+def expnd_res(lstRes, vecLgcScr):
+    """
+    Put pRF finding results of screened voxels into arrays for all voxels.
+
+    Parameters
+    ----------
+    lstRes : list
+        List of 1D arrays with pRF finding results (e.g. x-position,
+        y-position, pRF size, and R2) of voxels that passed the screening.
+    vecLgcScr : np.array
+        1D logical array, voxels that passed the screening are `True`.
+
+    Returns
+    -------
+    lstRes : list
+        List of 1D arrays with pRF finding results of all voxels. Voxels that
+        have been skipped are set to zero.
+    """
+    lstOut = []
+    for vecRes in lstRes:
+        vecTmp = np.zeros(vecLgcScr.shape, dtype=vecRes.dtype)
+        vecTmp[vecLgcScr] = vecRes
+        lstOut.append(vecTmp)
+    return lstOut
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Find best fitting pRF models using random sketches of the time courses."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+from pyprf.analysis.find_prf_idx import prp_func
+from pyprf.analysis.find_prf_idx import srch_full
+
+# Number of voxels for which the models are compared at once (limits the size
+# of temporary arrays, which have size number-of-models times number-of-voxels
+# in sketch space, and number-of-candidates times number-of-volumes times
+# number-of-voxels in full space):
+varSzeBlck = 200
+
+
+def crt_sktch(varNumVol, varSzeSktch, varSeed=0):
+    """
+    Create random projection for sketching of time courses.
+
+    Parameters
+    ----------
+    varNumVol : int
+        Number of volumes (length of time courses).
+    varSzeSktch : int
+        Number of dimensions of the sketch.
+    varSeed : int
+        Seed of the random projection.
+
+    Returns
+    -------
+    arySktch : np.array
+        2D array with random projection, with shape arySktch[time, sketch]
+        (float32). The entries are +1 or -1, scaled by the square root of the
+        sketch size, so that inner products are preserved in expectation.
+    """
+    objRnd = np.random.RandomState(varSeed)
+    arySktch = objRnd.randint(0, 2, size=(varNumVol, varSzeSktch))
+    arySktch = (2.0 * arySktch - 1.0) / np.sqrt(varSzeSktch)
+    return arySktch.astype(np.float32)
+
+
+def srch_sktch(aryMdlNrm, aryMdlSktch, arySktch, aryFunc, varNumCnd):
+    """
+    Find best fitting models in sketch space, and re-rank them exactly.
+
+    Parameters
+    ----------
+    aryMdlNrm : np.array
+        2D array with normalised model time courses (see `crt_mdl_nrm`).
+    aryMdlSktch : np.array
+        2D array with sketches of normalised model time courses, i.e.
+        `np.dot(aryMdlNrm, arySktch)`.
+    arySktch : np.array
+        2D array with random projection (see `crt_sktch`).
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+    varNumCnd : int
+        Number of candidate models per voxel (the models with the highest
+        absolute correlation in sketch space), which are compared with the
+        voxel time course in full space.
+
+    Returns
+    -------
+    vecIdxBst : np.array
+        1D array with index of best fitting model (in flattened model array)
+        for each voxel.
+    vecBstR2 : np.array
+        1D array with R2 value of best fitting model for each voxel.
+
+    Notes
+    -----
+    The best fitting model is the candidate with the highest absolute
+    correlation in full space, so that its R2 value is exact. The best
+    fitting model of the exhaustive search is found if it is among the
+    candidates (see `rcl_sktch`).
+    """
+    varNumVox = aryFunc.shape[0]
+    varNumCnd = max(1, min(varNumCnd, aryMdlNrm.shape[0]))
+
+    vecIdxBst = np.zeros(varNumVox, dtype=np.int64)
+    vecBstR2 = np.zeros(varNumVox, dtype=np.float32)
+
+    for idxBlck in range(0, varNumVox, varSzeBlck):
+
+        aryFuncNrm = prp_func(aryFunc[idxBlck:(idxBlck + varSzeBlck), :])
+
+        # Candidate models (highest absolute correlation in sketch space):
+        aryScrSktch = np.abs(np.dot(
+            aryMdlSktch, np.dot(aryFuncNrm.astype(np.float32), arySktch).T))
+        aryCnd = np.argpartition(-aryScrSktch, (varNumCnd - 1),
+                                 axis=0)[:varNumCnd, :]
+        # Sort candidates by index, so that ties are resolved in favour of
+        # the model with the lower index (as in the exhaustive search):
+        aryCnd = np.sort(aryCnd, axis=0)
+
+        # Correlation of candidates & voxel time courses in full space:
+        aryCor = np.abs(np.einsum('cvt,vt->cv',
+                                  aryMdlNrm[aryCnd, :].astype(np.float64),
+                                  aryFuncNrm))
+        vecTmp = np.argmax(aryCor, axis=0)
+        vecIdxVox = np.arange(aryCor.shape[1])
+        vecIdxBst[idxBlck:(idxBlck + varSzeBlck)] = aryCnd[vecTmp, vecIdxVox]
+        vecBstR2[idxBlck:(idxBlck + varSzeBlck)] = np.square(
+            aryCor[vecTmp, vecIdxVox])
+
+    return vecIdxBst, vecBstR2
+
+
+def rcl_sktch(aryMdlNrm, aryMdlSktch, arySktch, aryFunc, varNumCnd,
+              varNumVoxRcl):
+    """
+    Estimate recall of the search in sketch space on a sample of voxels.
+
+    Parameters
+    ----------
+    aryMdlNrm, aryMdlSktch, arySktch, aryFunc, varNumCnd
+        See `srch_sktch`.
+    varNumVoxRcl : int
+        Number of randomly selected voxels.
+
+    Returns
+    -------
+    varRcl : float
+        Fraction of sampled voxels for which the same model is found as with
+        the exhaustive search.
+    """
+    objRnd = np.random.RandomState(0)
+    varNumVoxRcl = min(varNumVoxRcl, aryFunc.shape[0])
+    vecIdxVox = np.sort(objRnd.choice(aryFunc.shape[0], size=varNumVoxRcl,
+                                      replace=False))
+    aryFuncRcl = np.asarray(aryFunc[vecIdxVox, :])
+    vecIdxSktch, _ = srch_sktch(aryMdlNrm, aryMdlSktch, arySktch, aryFuncRcl,
+                                varNumCnd)
+    vecIdxFull = srch_full(aryMdlNrm, aryFuncRcl)
+    return float(np.mean(np.equal(vecIdxSktch, vecIdxFull)))
+
+
+def find_prf_sktch(idxPrc, vecMdlXpos, vecMdlYpos, vecMdlSd,  #noqa
+                   aryFuncChnk, aryMdlNrm, aryMdlSktch, arySktch, varNumCnd,
+                   queOut):
+    """
+    Find best fitting pRF models for voxel time courses, using sketches.
+
+    Parameters
+    ----------
+    idxPrc : int
+        Index of the chunk processed by this process.
+    vecMdlXpos, vecMdlYpos, vecMdlSd : np.array
+        1D arrays with x position, y position, and size of each model, in the
+        order of the flattened model array (see `crt_mdl_prms_flat`).
+    aryFuncChnk : np.array
+        2D array with functional data, with shape aryFuncChnk[voxel, time].
+    aryMdlNrm, aryMdlSktch, arySktch, varNumCnd
+        See `srch_sktch`.
+    queOut : multiprocessing.queues.Queue
+        Queue to put the results on.
+
+    Notes
+    -----
+    The results are placed on the queue in the same format as in
+    `find_prf_cpu`.
+    """
+    vecIdxBst, vecBstR2 = srch_sktch(aryMdlNrm, aryMdlSktch, arySktch,
+                                     aryFuncChnk, varNumCnd)
+
+    queOut.put([idxPrc,
+                vecMdlXpos[vecIdxBst],
+                vecMdlYpos[vecIdxBst],
+                vecMdlSd[vecIdxBst],
+                vecBstR2])
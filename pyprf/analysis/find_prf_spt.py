@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""Find best fitting pRF models, using the fits of neighbouring voxels."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import numpy as np
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.find_prf_main import crt_mdl_prms
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.find_prf_idx import crt_mdl_nrm
+from pyprf.analysis.find_prf_idx import prp_func
+from pyprf.analysis.find_prf_idx import upd_bst
+
+
+def crt_vox_pos(aryLgcMsk, aryLgcVar, tplNiiShp):
+    """
+    Get position in the volume of voxels included in pRF finding.
+
+    Parameters
+    ----------
+    aryLgcMsk, aryLgcVar, tplNiiShp
+        Mask, variance mask, and dimensions of the functional data (only the
+        spatial dimensions are used), see `pre_pro_func`.
+
+    Returns
+    -------
+    aryVoxPos : np.array
+        2D array with x, y, and z index of each voxel included in pRF finding,
+        with shape aryVoxPos[voxel, 3].
+    """
+    vecIdxVox = np.flatnonzero(aryLgcMsk)[aryLgcVar]
+    return np.stack(np.unravel_index(vecIdxVox, tuple(tplNiiShp[0:3])),
+                    axis=1)
+
+
+def get_ngb(aryVoxPos, vecLgcLtc, varSpcLtc):
+    """
+    Find neighbouring lattice voxels.
+
+    Parameters
+    ----------
+    aryVoxPos : np.array
+        2D array with position of each voxel (see `crt_vox_pos`).
+    vecLgcLtc : np.array
+        1D logical array, voxels that are `True` are on the lattice.
+    varSpcLtc : int
+        Spacing of the lattice [voxels].
+
+    Returns
+    -------
+    aryNgb : np.array
+        2D array with indices of the lattice voxels within `varSpcLtc` voxels
+        (in each direction) of each voxel, with shape aryNgb[voxel,
+        neighbour]. Missing neighbours (outside of the volume, or not included
+        in pRF finding) are -1.
+    """
+    tplShp = tuple(np.max(aryVoxPos, axis=0) + varSpcLtc + 1)
+
+    # Index of lattice voxels in the volume (-1 elsewhere):
+    aryIdxLtc = np.zeros(tplShp, dtype=np.int64) - 1
+    aryIdxLtc[tuple(aryVoxPos[vecLgcLtc, :].T)] = np.flatnonzero(vecLgcLtc)
+
+    lstNgb = []
+    vecOfst = np.arange(-varSpcLtc, (varSpcLtc + 1))
+    for varOfstX in vecOfst:
+        for varOfstY in vecOfst:
+            for varOfstZ in vecOfst:
+                aryPos = aryVoxPos + np.array([varOfstX, varOfstY, varOfstZ])
+                vecLgc = np.all(np.greater_equal(aryPos, 0), axis=1)
+                vecNgb = np.zeros(aryVoxPos.shape[0], dtype=np.int64) - 1
+                vecNgb[vecLgc] = aryIdxLtc[tuple(aryPos[vecLgc, :].T)]
+                lstNgb.append(vecNgb)
+
+    return np.stack(lstNgb, axis=1)
+
+
+def find_prf_spt(dicCnfg, aryFunc, aryPrfTc, aryVoxPos):
+    """
+    Find best fitting pRF models, starting from the fits of neighbours.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    aryFunc : np.array
+        2D array with preprocessed functional data, with shape
+        aryFunc[voxel, time].
+    aryPrfTc : np.array
+        4D array with preprocessed pRF time course models, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+    aryVoxPos : np.array
+        2D array with position of each voxel in the volume (see
+        `crt_vox_pos`).
+
+    Returns
+    -------
+    aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 : np.array
+        1D arrays with best fitting x-position, y-position, pRF size, and R2
+        value for each voxel (see `find_prf`).
+
+    Notes
+    -----
+    Voxels on a sparse lattice (every `varSpcLtc`-th voxel in each direction)
+    are fitted first, with an exhaustive search (see `find_prf`). The other
+    voxels are only compared with the models in the smallest box of the
+    model grid that contains the best fitting models of their neighbouring
+    lattice voxels (within `varSpcLtc` voxels in each direction), extended by
+    `varNumNgb` grid steps in each direction (x-position, y-position, pRF
+    size). If the R2 value of a voxel is lower than that of all its lattice
+    neighbours (or if it has none), the voxel is fitted again with an
+    exhaustive search.
+    """
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    print('------Find pRF models, starting from neighbouring voxels')
+
+    varNumVox = aryFunc.shape[0]
+    tplShpMdl = aryPrfTc.shape[0:3]
+    vecMdlXpos, vecMdlYpos, vecMdlSd = crt_mdl_prms(dicCnfg)
+
+    aryBstXpos = np.zeros(varNumVox, dtype=np.float32)
+    aryBstYpos = np.zeros(varNumVox, dtype=np.float32)
+    aryBstSd = np.zeros(varNumVox, dtype=np.float32)
+    aryBstR2 = np.zeros(varNumVox, dtype=np.float32)
+
+    # *************************************************************************
+    # *** Exhaustive search for lattice voxels
+
+    vecLgcLtc = np.all(np.equal(np.mod(aryVoxPos, cfg.varSpcLtc), 0), axis=1)
+    varNumLtc = int(np.sum(vecLgcLtc))
+
+    print('---------Lattice voxels: ' + str(varNumLtc) + ' out of '
+          + str(varNumVox))
+
+    if 0 < varNumLtc:
+        aryBstXpos[vecLgcLtc], aryBstYpos[vecLgcLtc], aryBstSd[vecLgcLtc], \
+            aryBstR2[vecLgcLtc] = find_prf(dicCnfg, aryFunc[vecLgcLtc, :],
+                                           aryPrfTc)
+
+    # Grid indices of best fitting models of lattice voxels:
+    aryIdxGrd = np.stack(
+        [np.argmin(np.abs(np.subtract(aryBst[:, None], vecMdl[None, :])),
+                   axis=1)
+         for aryBst, vecMdl in zip([aryBstXpos, aryBstYpos, aryBstSd],
+                                   [vecMdlXpos, vecMdlYpos, vecMdlSd])],
+        axis=1)
+    # *************************************************************************
+
+    # *************************************************************************
+    # *** Search in neighbourhood of neighbours' fits
+
+    varTme01 = time.time()
+
+    vecIdxRst = np.flatnonzero(~vecLgcLtc)
+    aryNgb = get_ngb(aryVoxPos, vecLgcLtc, cfg.varSpcLtc)[vecIdxRst, :]
+    aryLgcNgb = np.greater_equal(aryNgb, 0)
+    vecLgcHasNgb = np.any(aryLgcNgb, axis=1)
+
+    # Box of the model grid to be searched for each voxel (lower & upper
+    # grid index in each dimension):
+    aryBox = np.zeros((vecIdxRst.size, 6), dtype=np.int64)
+    for idxDim in range(3):
+        aryTmp = aryIdxGrd[np.maximum(aryNgb, 0), idxDim]
+        aryBox[:, idxDim] = np.maximum(
+            (np.min(np.where(aryLgcNgb, aryTmp, tplShpMdl[idxDim]), axis=1)
+             - cfg.varNumNgb), 0)
+        aryBox[:, (idxDim + 3)] = np.minimum(
+            (np.max(np.where(aryLgcNgb, aryTmp, -1), axis=1)
+             + cfg.varNumNgb), (tplShpMdl[idxDim] - 1))
+
+    aryMdlNrm = crt_mdl_nrm(aryPrfTc)
+    aryIdxMdl = np.arange(aryMdlNrm.shape[0]).reshape(tplShpMdl)
+    aryFuncNrm = prp_func(aryFunc[vecIdxRst, :])
+    vecIdxBst = np.zeros(vecIdxRst.size, dtype=np.int64)
+    vecBstCor = np.full(vecIdxRst.size, -1.0)
+    varNumCmp = 0
+
+    # Voxels with the same box are compared with the models at once:
+    aryBoxUnq, vecIdxBox = np.unique(aryBox[vecLgcHasNgb, :], axis=0,
+                                     return_inverse=True)
+    vecIdxBox = vecIdxBox.flatten()
+    vecVoxHasNgb = np.flatnonzero(vecLgcHasNgb)
+    for idxBox in range(aryBoxUnq.shape[0]):
+        vecBox = aryBoxUnq[idxBox, :]
+        vecMbr = aryIdxMdl[vecBox[0]:(vecBox[3] + 1),
+                           vecBox[1]:(vecBox[4] + 1),
+                           vecBox[2]:(vecBox[5] + 1)].flatten()
+        vecVox = vecVoxHasNgb[vecIdxBox == idxBox]
+        upd_bst(aryMdlNrm, vecMbr, aryFuncNrm, vecVox, vecIdxBst, vecBstCor)
+        varNumCmp += vecMbr.size * vecVox.size
+
+    aryBstXpos[vecIdxRst], aryBstYpos[vecIdxRst], aryBstSd[vecIdxRst] = [
+        vecMdl[vecIdx] for vecMdl, vecIdx
+        in zip([vecMdlXpos, vecMdlYpos, vecMdlSd],
+               np.unravel_index(vecIdxBst, tplShpMdl))]
+    aryBstR2[vecIdxRst] = np.square(np.maximum(vecBstCor, 0.0))
+
+    print('---------Neighbourhood search: ' + str(int(np.sum(vecLgcHasNgb)))
+          + ' voxels, fraction of models compared: '
+          + str(np.around((float(varNumCmp)
+                           / float(max(1, (np.sum(vecLgcHasNgb)
+                                           * aryMdlNrm.shape[0])))),
+                          decimals=3))
+          + ', elapsed time: '
+          + str(np.around((time.time() - varTme01), decimals=3)) + ' s')
+    # *************************************************************************
+
+    # *************************************************************************
+    # *** Exhaustive search for voxels that fit worse than their neighbours
+
+    vecR2Ngb = np.min(np.where(aryLgcNgb, aryBstR2[np.maximum(aryNgb, 0)],
+                               np.inf), axis=1)
+    vecLgcFll = np.zeros(varNumVox, dtype=bool)
+    vecLgcFll[vecIdxRst] = np.less(aryBstR2[vecIdxRst], vecR2Ngb)
+    varNumFll = int(np.sum(vecLgcFll))
+
+    print('---------Voxels with exhaustive search (fit worse than '
+          + 'neighbours): ' + str(varNumFll))
+
+    if 0 < varNumFll:
+        aryBstXpos[vecLgcFll], aryBstYpos[vecLgcFll], aryBstSd[vecLgcFll], \
+            aryBstR2[vecLgcFll] = find_prf(dicCnfg, aryFunc[vecLgcFll, :],
+                                           aryPrfTc)
+    # *************************************************************************
+
+    return aryBstXpos, aryBstYpos, aryBstSd, aryBstR2
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Find best fitting pRF models from sufficient statistics."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+# Number of voxels for which the model comparison is performed at once (limits
+# the size of temporary arrays, which have size number-of-models times
+# number-of-voxels):
+varSzeBlck = 1000
+
+
+def crt_mdl_prms_flat(vecMdlXpos, vecMdlYpos, vecMdlSd):
+    """
+    Create pRF model parameters for each model in flattened model array.
+
+    Parameters
+    ----------
+    vecMdlXpos, vecMdlYpos, vecMdlSd : np.array
+        1D arrays with pRF model x positions, y positions, and sizes (see
+        `crt_mdl_prms`).
+
+    Returns
+    -------
+    vecMdlXpos, vecMdlYpos, vecMdlSd : np.array
+        1D arrays with x position, y position, and size of each model, in the
+        order of the flattened model array (i.e. of
+        `aryPrfTc.reshape(-1, varNumVol)`).
+    """
+    aryMdlXpos, aryMdlYpos, aryMdlSd = np.meshgrid(vecMdlXpos, vecMdlYpos,
+                                                   vecMdlSd, indexing='ij')
+    return aryMdlXpos.flatten(), aryMdlYpos.flatten(), aryMdlSd.flatten()
+
+
+def crt_suff(aryMdl, aryFunc):
+    """
+    Calculate sufficient statistics for pRF finding.
+
+    Parameters
+    ----------
+    aryMdl : np.array
+        2D array with pRF model time courses, with shape aryMdl[model, time].
+    aryFunc : np.array
+        2D array with functional data, with shape aryFunc[voxel, time].
+
+    Returns
+    -------
+    tplSuff : tuple
+        Tuple with (0) cross products of models and voxel time courses, with
+        shape aryXy[model, voxel], (1) sum over time of models, (2) sum over
+        time of squared models, (3) sum over time of voxel time courses, (4)
+        sum over time of squared voxel time courses, and (5) number of time
+        points. All sums are calculated at double precision.
+
+    Notes
+    -----
+    The sufficient statistics of several segments of the time series (e.g.
+    runs, or volumes in real-time mode) can be added up (see `add_suff`). The
+    cross products are calculated for one block of voxels at a time, so that
+    only one block of the functional data is converted to double precision at
+    once.
+    """
+    aryMdl = aryMdl.astype(np.float64)
+
+    varNumVox = aryFunc.shape[0]
+
+    aryXy = np.zeros((aryMdl.shape[0], varNumVox))
+    vecY = np.zeros(varNumVox)
+    vecYy = np.zeros(varNumVox)
+
+    for idxBlck in range(0, varNumVox, varSzeBlck):
+        objSlc = slice(idxBlck, (idxBlck + varSzeBlck))
+        aryFuncBlck = aryFunc[objSlc, :].astype(np.float64)
+        aryXy[:, objSlc] = np.dot(aryMdl, aryFuncBlck.T)
+        vecY[objSlc] = np.sum(aryFuncBlck, axis=1)
+        vecYy[objSlc] = np.sum(np.square(aryFuncBlck), axis=1)
+
+    return (aryXy,
+            np.sum(aryMdl, axis=1),
+            np.sum(np.square(aryMdl), axis=1),
+            vecY,
+            vecYy,
+            aryMdl.shape[1])
+
+
+def add_suff(tplSuff01, tplSuff02):
+    """Add sufficient statistics of two segments of the time series."""
+    if tplSuff01 is None:
+        return tplSuff02
+    return tuple([(objTmp01 + objTmp02) for objTmp01, objTmp02
+                  in zip(tplSuff01, tplSuff02)])
+
+
+def find_prf_suff(tplSuff):
+    """
+    Find best fitting pRF models from sufficient statistics.
+
+    Parameters
+    ----------
+    tplSuff : tuple
+        Sufficient statistics (see `crt_suff`).
+
+    Returns
+    -------
+    vecIdxBst : np.array
+        1D array with index of best fitting model (in flattened model array)
+        for each voxel.
+    vecBstR2 : np.array
+        1D array with R2 value of best fitting model for each voxel.
+
+    Notes
+    -----
+    For each model, a linear regression with the model time course and a
+    constant term is performed. With S_xy, S_xx and S_yy denoting the centred
+    sums of products, the residual sum of squares is S_yy - S_xy^2 / S_xx, so
+    that the best fitting model is the one with the highest value of
+    S_xy^2 / S_xx, and R2 = S_xy^2 / (S_xx * S_yy). Models with a variance of
+    zero are ignored (as in `find_prf_cpu`). In case of ties, the first model
+    is selected (as in `find_prf_cpu`).
+    """
+    aryXy, vecX, vecXx, vecY, vecYy, varNumVol = tplSuff
+
+    varNumVox = aryXy.shape[1]
+
+    # Centred sums of squares of models & voxel time courses:
+    vecSxx = vecXx - np.square(vecX) / varNumVol
+    vecSyy = vecYy - np.square(vecY) / varNumVol
+
+    # Models with a variance of zero are ignored:
+    vecLgcMdl = np.greater(vecSxx, 1e-12 * np.max(np.abs(vecXx)))
+    vecSxxInv = np.zeros(vecSxx.shape)
+    vecSxxInv[vecLgcMdl] = np.divide(1.0, vecSxx[vecLgcMdl])
+
+    vecIdxBst = np.zeros(varNumVox, dtype=np.int64)
+    vecBstScr = np.zeros(varNumVox)
+
+    # Model comparison, for one block of voxels at a time:
+    for idxBlck in range(0, varNumVox, varSzeBlck):
+        objSlc = slice(idxBlck, (idxBlck + varSzeBlck))
+        arySxy = (aryXy[:, objSlc]
+                  - np.outer(vecX, vecY[objSlc]) / varNumVol)
+        aryScr = np.square(arySxy) * vecSxxInv[:, None]
+        vecIdxBst[objSlc] = np.argmax(aryScr, axis=0)
+        vecBstScr[objSlc] = np.max(aryScr, axis=0)
+
+    # Coefficient of determination:
+    vecBstR2 = np.zeros(varNumVox, dtype=np.float32)
+    vecLgcVox = np.greater(vecSyy, 0.0)
+    vecBstR2[vecLgcVox] = np.divide(vecBstScr[vecLgcVox],
+                                    vecSyy[vecLgcVox])
+
+    return vecIdxBst, vecBstR2
+
+
+def xval_suff(lstSuff):
+    """
+    Calculate leave-one-run-out cross-validated R2 from per-run statistics.
+
+    Parameters
+    ----------
+    lstSuff : list
+        Sufficient statistics of each run (see `crt_suff`), at least two
+        runs.
+
+    Returns
+    -------
+    vecR2Xval : np.array
+        1D array with cross-validated R2 value for each voxel.
+
+    Notes
+    -----
+    For each fold, the statistics of the training runs are obtained by
+    subtracting those of the held-out run from the sum over all runs. The best
+    fitting model, and its slope & intercept, are determined on the training
+    runs, and the residual sum of squares on the held-out run is calculated
+    from the uncentred sums of the held-out run, i.e. sum((y - b * x - c)^2)
+    = Syy - 2 b Sxy - 2 c Sy + b^2 Sxx + 2 b c Sx + c^2 n. The cross-validated
+    R2 is one minus the sum (over folds) of the held-out residual sums of
+    squares, divided by the sum of the held-out total sums of squares. It can
+    be negative if the models do not generalise across runs.
+    """
+    if len(lstSuff) < 2:
+        raise ValueError('Cross-validation needs at least two runs')
+
+    tplSuff = None
+    for tplRun in lstSuff:
+        tplSuff = add_suff(tplSuff, tplRun)
+
+    varNumVox = tplSuff[0].shape[1]
+    vecIdxVox = np.arange(varNumVox)
+
+    vecRss = np.zeros(varNumVox)
+    vecTss = np.zeros(varNumVox)
+
+    for tplTst in lstSuff:
+
+        # Statistics of training runs:
+        tplTrn = tuple([(objTmp01 - objTmp02) for objTmp01, objTmp02
+                        in zip(tplSuff, tplTst)])
+
+        vecIdxBst, _ = find_prf_suff(tplTrn)
+
+        # Slope & intercept of best fitting model on training runs:
+        aryXy, vecX, vecXx, vecY, _, varNumVol = tplTrn
+        vecXBst = vecX[vecIdxBst]
+        vecSxy = aryXy[vecIdxBst, vecIdxVox] - vecXBst * vecY / varNumVol
+        vecSxx = vecXx[vecIdxBst] - np.square(vecXBst) / varNumVol
+        vecSlp = np.zeros(varNumVox)
+        vecLgc = np.greater(vecSxx, 0.0)
+        vecSlp[vecLgc] = vecSxy[vecLgc] / vecSxx[vecLgc]
+        vecIcpt = (vecY - vecSlp * vecXBst) / varNumVol
+        del(tplTrn)
+
+        # Residual & total sum of squares on held-out run:
+        aryXy, vecX, vecXx, vecY, vecYy, varNumVol = tplTst
+        vecRss += (vecYy
+                   - 2.0 * vecSlp * aryXy[vecIdxBst, vecIdxVox]
+                   - 2.0 * vecIcpt * vecY
+                   + np.square(vecSlp) * vecXx[vecIdxBst]
+                   + 2.0 * vecSlp * vecIcpt * vecX[vecIdxBst]
+                   + np.square(vecIcpt) * varNumVol)
+        vecTss += vecYy - np.square(vecY) / varNumVol
+
+    vecR2Xval = np.zeros(varNumVox, dtype=np.float32)
+    vecLgc = np.greater(vecTss, 0.0)
+    vecR2Xval[vecLgc] = 1.0 - vecRss[vecLgc] / vecTss[vecLgc]
+
+    return vecR2Xval
@@ -215,8 +215,13 @@ def load_config(strCsvCnfg, lgcTest=False):  #noqa
         print('   ' + str(dicCnfg['strPathMdl']))
 
     # If we create new pRF time course models, the following parameters have to
-    # be provided:
-    if dicCnfg['lgcCrteMdl']:
+    # be provided. Otherwise, they are optional, and only used to check
+    # whether existing models for one run match the stimuli (see
+    # `strAvgRun`):
+    lgcPng = (dicCnfg['lgcCrteMdl']
+              or all([(strTmp in dicCnfg) for strTmp
+                      in ['lstPathPng', 'varStrtIdx', 'varZfill']]))
+    if lgcPng:
 
         # Basename of the screenshots (PNG images) of pRF stimuli. A list with
         # one path per experimental run. (Number & order of entries in
@@ -243,6 +248,302 @@ def load_config(strCsvCnfg, lgcTest=False):  #noqa
             print('---Zero padding of PNG file names: '
                   + str(dicCnfg['varZfill']))
 
+    # Directory for cache of preprocessed functional data (optional). If
+    # empty, functional data are preprocessed from scratch every time.
+    dicCnfg['strPathCch'] = ast.literal_eval(dicCnfg.get('strPathCch',
+                                                         "''"))
+    if lgcPrint:
+        print('---Directory for cache of preprocessed functional data:')
+        print('   ' + str(dicCnfg['strPathCch']))
+
+    # Memory budget for slab-wise processing [MB] (optional). If greater
+    # than zero, the functional data are preprocessed and fitted slab by slab
+    # (along the z-dimension), such that peak memory usage stays (roughly)
+    # within the budget.
+    dicCnfg['varMemBdgt'] = float(dicCnfg.get('varMemBdgt', '0.0'))
+    if lgcPrint:
+        print('---Memory budget for slab-wise processing [MB]: '
+              + str(dicCnfg['varMemBdgt']))
+
+    # Number of voxels per chunk for pRF finding (optional). Each chunk is
+    # processed by a separate process, and its results are checkpointed once
+    # it is completed. If zero, there is one chunk per parallel process.
+    dicCnfg['varChnkSze'] = int(dicCnfg.get('varChnkSze', '0'))
+    if lgcPrint:
+        print('---Number of voxels per chunk for pRF finding: '
+              + str(dicCnfg['varChnkSze']))
+
+    # Timeout for processing of one chunk [s] (optional). Processes exceeding
+    # the timeout are terminated, and their chunk is processed again. If
+    # zero, there is no timeout.
+    dicCnfg['varTmeOut'] = float(dicCnfg.get('varTmeOut', '0.0'))
+    if lgcPrint:
+        print('---Timeout for processing of one chunk [s]: '
+              + str(dicCnfg['varTmeOut']))
+
+    # Number of times a chunk is processed again after its process has died
+    # or exceeded the timeout (optional):
+    dicCnfg['varNumRtry'] = int(dicCnfg.get('varNumRtry', '2'))
+    if lgcPrint:
+        print('---Number of retries per chunk: '
+              + str(dicCnfg['varNumRtry']))
+
+    # Gzip compression level of nii output files (optional). If zero, nii
+    # files are saved without compression.
+    dicCnfg['varCmprLvl'] = int(dicCnfg.get('varCmprLvl', '1'))
+    if lgcPrint:
+        print('---Compression level of nii output files: '
+              + str(dicCnfg['varCmprLvl']))
+
+    # Save all parameters in a single 4D nii file instead of one nii file per
+    # parameter (optional)?
+    dicCnfg['lgcOut4d'] = (dicCnfg.get('lgcOut4d', 'False') == 'True')
+    if lgcPrint:
+        print('---Save results as single 4D nii file: '
+              + str(dicCnfg['lgcOut4d']))
+
+    # Additionally save results of voxels within the mask as compact npz file
+    # (optional)?
+    dicCnfg['lgcSdcr'] = (dicCnfg.get('lgcSdcr', 'False') == 'True')
+    if lgcPrint:
+        print('---Save results as npz file: ' + str(dicCnfg['lgcSdcr']))
+
+    # Find pRF models from per-run sufficient statistics instead of the
+    # concatenated functional data (optional):
+    dicCnfg['lgcSuff'] = (dicCnfg.get('lgcSuff', 'False') == 'True')
+    if lgcPrint:
+        print('---Find pRF models from per-run sufficient statistics: '
+              + str(dicCnfg['lgcSuff']))
+
+    # Indices of runs that are used with sufficient statistics (optional). If
+    # empty, all runs are used.
+    dicCnfg['lstRunSuff'] = ast.literal_eval(dicCnfg.get('lstRunSuff', '[]'))
+    if lgcPrint and dicCnfg['lgcSuff']:
+        print('---Runs used with sufficient statistics: '
+              + str(dicCnfg['lstRunSuff']))
+
+    # Directory for per-run sufficient statistics (optional). If empty,
+    # `strPathOut` + '_suff' is used.
+    dicCnfg['strPathSuff'] = ast.literal_eval(dicCnfg.get('strPathSuff',
+                                                          "''"))
+    if lgcPrint and dicCnfg['lgcSuff']:
+        print('---Directory for sufficient statistics:')
+        print('   ' + str(dicCnfg['strPathSuff']))
+
+    # Leave-one-run-out cross-validation (optional). Implies pRF finding from
+    # per-run sufficient statistics.
+    dicCnfg['lgcXval'] = (dicCnfg.get('lgcXval', 'False') == 'True')
+    if lgcPrint:
+        print('---Leave-one-run-out cross-validation: '
+              + str(dicCnfg['lgcXval']))
+
+    # Average runs with the same stimulus sequence (optional). 'none' (runs
+    # are concatenated), 'always' (all runs have the same stimulus sequence),
+    # or 'auto' (runs are averaged if their stimulus sequences are found to be
+    # identical).
+    dicCnfg['strAvgRun'] = ast.literal_eval(dicCnfg.get('strAvgRun',
+                                                        "'none'"))
+    if dicCnfg['strAvgRun'] not in ['none', 'always', 'auto']:
+        raise ValueError(('Invalid value for strAvgRun: '
+                          + str(dicCnfg['strAvgRun'])))
+    if lgcPrint:
+        print('---Average runs with same stimulus sequence: '
+              + str(dicCnfg['strAvgRun']))
+    if ((dicCnfg['strAvgRun'] != 'none')
+            and (dicCnfg['lgcSuff'] or dicCnfg['lgcXval']
+                 or (0.0 < dicCnfg['varMemBdgt']))):
+        raise ValueError(('Averaging of runs (strAvgRun) cannot be combined '
+                          + 'with sufficient statistics or slab-wise '
+                          + 'processing'))
+
+    # Number of clusters of the model index (optional). If greater than zero,
+    # the best fitting models are searched for using an index of the model
+    # time courses (clusters of similar models), which is saved next to the
+    # models (`strPathMdl` + '_index.npz'). If zero, all models are compared
+    # with each voxel time course. Only used with the numpy & cython versions.
+    dicCnfg['varNumClst'] = int(dicCnfg.get('varNumClst', '0'))
+    if lgcPrint:
+        print('---Number of clusters of model index: '
+              + str(dicCnfg['varNumClst']))
+
+    # Number of clusters of the model index that are searched for each voxel
+    # (optional). More clusters mean a higher probability of finding the best
+    # fitting model (recall), and a longer search.
+    dicCnfg['varNumPrb'] = int(dicCnfg.get('varNumPrb', '4'))
+    if lgcPrint:
+        print('---Number of clusters searched per voxel: '
+              + str(dicCnfg['varNumPrb']))
+
+    # Exact search using the model index (optional)? If yes, all clusters of
+    # models that may contain a better fitting model than the ones found so
+    # far are searched (branch and bound), so that the results are the same as
+    # those of the exhaustive search.
+    dicCnfg['lgcIdxExct'] = (dicCnfg.get('lgcIdxExct', 'False') == 'True')
+    if lgcPrint:
+        print('---Exact search using model index: '
+              + str(dicCnfg['lgcIdxExct']))
+
+    # Number of voxels on which the recall of the model index is estimated
+    # (optional), by comparison with the exhaustive search.
+    dicCnfg['varNumVoxRcl'] = int(dicCnfg.get('varNumVoxRcl', '1000'))
+    if lgcPrint:
+        print('---Number of voxels for estimation of recall: '
+              + str(dicCnfg['varNumVoxRcl']))
+
+    # Spacing of the lattice of voxels that are fitted first (optional). If
+    # greater than zero, the voxels on the lattice (every `varSpcLtc`-th voxel
+    # in each direction) are fitted with an exhaustive search, and the other
+    # voxels are only compared with models close to the best fitting models
+    # of their neighbouring lattice voxels. Cannot be combined with sufficient
+    # statistics (`lgcSuff`) or slab-wise processing (`varMemBdgt`).
+    dicCnfg['varSpcLtc'] = int(dicCnfg.get('varSpcLtc', '0'))
+    if lgcPrint:
+        print('---Spacing of lattice of voxels fitted first: '
+              + str(dicCnfg['varSpcLtc']))
+
+    # Size of the neighbourhood of the neighbours' best fitting models that is
+    # searched, in grid steps of the model parameters (optional):
+    dicCnfg['varNumNgb'] = int(dicCnfg.get('varNumNgb', '1'))
+    if lgcPrint:
+        print('---Size of neighbourhood in model grid: '
+              + str(dicCnfg['varNumNgb']))
+
+    # Threshold for screening of voxels (optional). If greater than zero,
+    # voxels are only included in pRF finding if an upper bound of their R2
+    # value, calculated from a low-rank projection of the model time courses
+    # (screening R2), exceeds the threshold. Cannot be combined with sufficient
+    # statistics (`lgcSuff`) or slab-wise processing (`varMemBdgt`).
+    dicCnfg['varThrScr'] = float(dicCnfg.get('varThrScr', '0.0'))
+    if lgcPrint:
+        print('---Threshold for screening of voxels: '
+              + str(dicCnfg['varThrScr']))
+
+    # Number of leading components of the model time courses used for
+    # screening (optional):
+    dicCnfg['varRnkScr'] = int(dicCnfg.get('varRnkScr', '20'))
+    if lgcPrint:
+        print('---Number of components for screening: '
+              + str(dicCnfg['varRnkScr']))
+
+    # Size of random sketches of the time courses (optional). If greater than
+    # zero, candidate models are selected by comparing random projections of
+    # the voxel & model time courses (with `varSzeSktch` instead of the number
+    # of volumes), and the candidates are compared with the voxel time
+    # courses in full. Only used with the numpy & cython versions, and not if
+    # the model index is used (`varNumClst`).
+    dicCnfg['varSzeSktch'] = int(dicCnfg.get('varSzeSktch', '0'))
+    if lgcPrint:
+        print('---Size of random sketches of time courses: '
+              + str(dicCnfg['varSzeSktch']))
+
+    # Number of candidate models per voxel selected using sketches (optional):
+    dicCnfg['varNumCnd'] = int(dicCnfg.get('varNumCnd', '10'))
+    if lgcPrint:
+        print('---Number of candidate models per voxel: '
+              + str(dicCnfg['varNumCnd']))
+
+    # Number of best fitting models retained for each voxel (optional). If
+    # greater than one, the indices, residuals, and R2 values of these models
+    # are saved (`strPathOut` + '_topk.npz'). Only possible with the
+    # exhaustive search on the CPU.
+    dicCnfg['varNumTopK'] = int(dicCnfg.get('varNumTopK', '0'))
+    if lgcPrint:
+        print('---Number of best fitting models retained per voxel: '
+              + str(dicCnfg['varNumTopK']))
+
+    # Calculate the posterior mean & standard deviation of the pRF parameters
+    # (optional)? If yes, the moments of the parameters over all models,
+    # weighted by the likelihood of each model, are accumulated during pRF
+    # finding, and saved as additional maps. Only possible with the
+    # exhaustive search on the CPU.
+    dicCnfg['lgcPst'] = (dicCnfg.get('lgcPst', 'False') == 'True')
+    if lgcPrint:
+        print('---Posterior of pRF parameters: ' + str(dicCnfg['lgcPst']))
+
+    # Temperature of the posterior (optional). The log-likelihood of the
+    # models is divided by the temperature, higher values give a broader
+    # posterior.
+    dicCnfg['varTmpPst'] = float(dicCnfg.get('varTmpPst', '1.0'))
+    if lgcPrint:
+        print('---Temperature of posterior: ' + str(dicCnfg['varTmpPst']))
+
+    if (((1 < dicCnfg['varNumTopK']) or dicCnfg['lgcPst'])
+            and ((dicCnfg['strVersion'] == 'gpu')
+                 or (0 < dicCnfg['varNumClst'])
+                 or (0 < dicCnfg['varSzeSktch'])
+                 or (0 < dicCnfg['varSpcLtc']))):
+        raise ValueError(('The best fitting models (varNumTopK) and the '
+                          + 'posterior (lgcPst) can only be calculated with '
+                          + 'the exhaustive search on the CPU'))
+
+    # Number of surrogate time courses per voxel for the null distribution of
+    # R2 values (optional). If greater than zero, surrogate data are created
+    # for each voxel, and the p-value of the R2 value of each voxel is saved
+    # (`strPathOut` + '_R2_pval'), together with the R2 map thresholded at
+    # the false discovery rate `varQFdr` (`strPathOut` + '_R2_fdr'). Not used
+    # with sufficient statistics (`lgcSuff`) or slab-wise processing
+    # (`varMemBdgt`).
+    dicCnfg['varNumSrgt'] = int(dicCnfg.get('varNumSrgt', '0'))
+    if lgcPrint:
+        print('---Number of surrogates per voxel: '
+              + str(dicCnfg['varNumSrgt']))
+
+    # Type of surrogate data (optional), 'phase' (phase randomisation) or
+    # 'block' (permutation of blocks of `varSzeBlckSrgt` volumes):
+    dicCnfg['strSrgt'] = ast.literal_eval(dicCnfg.get('strSrgt', "'phase'"))
+    if dicCnfg['strSrgt'] not in ['phase', 'block']:
+        raise ValueError(('Invalid value for strSrgt: '
+                          + str(dicCnfg['strSrgt'])))
+    if lgcPrint:
+        print('---Type of surrogate data: ' + str(dicCnfg['strSrgt']))
+
+    # Number of volumes per block for block permutation (optional):
+    dicCnfg['varSzeBlckSrgt'] = int(dicCnfg.get('varSzeBlckSrgt', '10'))
+    if lgcPrint:
+        print('---Number of volumes per block for permutation: '
+              + str(dicCnfg['varSzeBlckSrgt']))
+
+    # False discovery rate for thresholding of R2 map (optional):
+    dicCnfg['varQFdr'] = float(dicCnfg.get('varQFdr', '0.05'))
+    if lgcPrint:
+        print('---False discovery rate: ' + str(dicCnfg['varQFdr']))
+
+    # Find best fitting pairs of pRF models (two Gaussians) in addition
+    # (optional)? If yes, the results are saved as additional maps (e.g.
+    # `strPathOut` + '_x_pos_1', '_x_pos_2', and '_R2_pair'). Cannot be
+    # combined with sufficient statistics (`lgcSuff`) or slab-wise processing
+    # (`varMemBdgt`).
+    dicCnfg['lgcPair'] = (dicCnfg.get('lgcPair', 'False') == 'True')
+    if lgcPrint:
+        print('---Find best fitting pairs of models: '
+              + str(dicCnfg['lgcPair']))
+
+    # Maximum distance of the two models of a pair, in grid steps of the
+    # x-positions & y-positions (optional). If zero, all pairs of models are
+    # compared.
+    dicCnfg['varNumNgbPair'] = int(dicCnfg.get('varNumNgbPair', '0'))
+    if lgcPrint:
+        print('---Maximum distance of models of a pair: '
+              + str(dicCnfg['varNumNgbPair']))
+
+    # The options of the regular pRF finding that are not implemented for
+    # sufficient statistics or slab-wise processing must not be ignored
+    # silently:
+    if ((dicCnfg['lgcSuff'] or dicCnfg['lgcXval']
+            or (0.0 < dicCnfg['varMemBdgt']))
+            and ((0 < dicCnfg['varSpcLtc'])
+                 or (0.0 < dicCnfg['varThrScr'])
+                 or (1 < dicCnfg['varNumTopK'])
+                 or dicCnfg['lgcPst']
+                 or (0 < dicCnfg['varNumSrgt'])
+                 or dicCnfg['lgcPair'])):
+        raise ValueError(('The lattice (varSpcLtc), screening (varThrScr), '
+                          + 'best fitting models (varNumTopK), posterior '
+                          + '(lgcPst), null distribution (varNumSrgt), and '
+                          + 'pairs of models (lgcPair) cannot be combined '
+                          + 'with sufficient statistics or slab-wise '
+                          + 'processing'))
+
     # Is this a test?
     if lgcTest:
 
@@ -250,6 +551,10 @@ def load_config(strCsvCnfg, lgcTest=False):  #noqa
         dicCnfg['strPathNiiMask'] = (strDir + dicCnfg['strPathNiiMask'])
         dicCnfg['strPathOut'] = (strDir + dicCnfg['strPathOut'])
         dicCnfg['strPathMdl'] = (strDir + dicCnfg['strPathMdl'])
+        if dicCnfg['strPathCch']:
+            dicCnfg['strPathCch'] = (strDir + dicCnfg['strPathCch'])
+        if dicCnfg['strPathSuff']:
+            dicCnfg['strPathSuff'] = (strDir + dicCnfg['strPathSuff'])
 
         # Loop through functional runs & prepend absolute path:
         varNumRun = len(dicCnfg['lstPathNiiFunc'])
@@ -260,8 +565,8 @@ def load_config(strCsvCnfg, lgcTest=False):  #noqa
                 )
 
         # Preprend absolute parent path of testing folder to config file paths
-        # if new models are supposed to be created:
-        if dicCnfg['lgcCrteMdl']:
+        # of PNG files (if given, see above):
+        if lgcPng:
 
             # Loop through functional runs & prepend absolute path:
             varNumRun = len(dicCnfg['lstPathPng'])
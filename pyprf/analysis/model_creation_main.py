@@ -17,6 +17,8 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import hashlib
 import numpy as np
 import nibabel as nb
 from pyprf.analysis.model_creation_load_png import load_png
@@ -24,8 +26,102 @@ from pyprf.analysis.model_creation_pixelwise import conv_dsgn_mat
 from pyprf.analysis.model_creation_timecourses import crt_prf_tcmdl
 from pyprf.analysis.utilities import cls_set_config
 
+# Version of the key of models for one run (see `crt_avg_key`). Needs to be
+# incremented whenever the creation of the models changes.
+strAvgVrsn = 'pyprf-avg-1'
 
-def model_creation(dicCnfg):
+
+def chk_rpt(aryIn, varNumRun):
+    """
+    Check whether all runs have the same stimulus sequence.
+
+    Parameters
+    ----------
+    aryIn : np.array
+        Array with stimulus information or model time courses of the
+        concatenated runs, with time as last dimension.
+    varNumRun : int
+        Number of runs.
+
+    Returns
+    -------
+    lgcRpt : bool
+        `True` if the array consists of `varNumRun` identical segments along
+        the last dimension.
+    """
+    varNumVol = aryIn.shape[-1]
+    if (varNumRun < 2) or (varNumVol % varNumRun != 0):
+        return False
+    varNumVolRun = varNumVol // varNumRun
+    for idxRun in range(1, varNumRun):
+        if not np.array_equal(aryIn[..., :varNumVolRun],
+                              aryIn[..., (idxRun * varNumVolRun):
+                                    ((idxRun + 1) * varNumVolRun)]):
+            return False
+    return True
+
+
+def crt_avg_key(dicCnfg, strAvgRun):
+    """
+    Create key identifying pRF time course models for one run.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    strAvgRun : str
+        Averaging of runs with the same stimulus sequence ('always' or
+        'auto', see `model_creation`).
+
+    Returns
+    -------
+    strKey : str or None
+        Hexadecimal SHA-1 digest over the contents of the PNG files of all
+        runs, the run layout (number of runs & volumes per run), and the
+        parameters of the models. `None` if the PNG files are not given in
+        the config file (see `load_config`).
+
+    Notes
+    -----
+    Models for one run are saved together with their key (`strPathMdl` +
+    '_avg.key'), and are only reused if the key matches (see
+    `model_creation`).
+    """
+    if not isinstance(dicCnfg.get('lstPathPng'), list):
+        return None
+
+    cfg = cls_set_config(dicCnfg)
+
+    objHsh = hashlib.sha1()
+    strPrm = (strAvgVrsn
+              + '|strAvgRun=' + strAvgRun
+              + '|varNumRun=' + str(len(cfg.lstPathPng))
+              + '|varNumVol=' + str(int(cfg.varNumVol)))
+    for strTmp in ['varStrtIdx', 'varZfill', 'tplVslSpcSze', 'varTr',
+                   'varNumX', 'varNumY', 'varNumPrfSizes', 'varExtXmin',
+                   'varExtXmax', 'varExtYmin', 'varExtYmax', 'varPrfStdMin',
+                   'varPrfStdMax']:
+        strPrm += '|' + strTmp + '=' + repr(dicCnfg[strTmp])
+    objHsh.update(strPrm.encode('utf-8'))
+
+    # File contents of PNG files of all runs (see `load_png`):
+    for strPathPng in cfg.lstPathPng:
+        for idxVol in range(int(cfg.varNumVol)):
+            strPathIn = (strPathPng
+                         + str(idxVol + cfg.varStrtIdx).zfill(cfg.varZfill)
+                         + '.png')
+            if os.path.isfile(strPathIn):
+                with open(strPathIn, 'rb') as fleIn:
+                    objHsh.update(fleIn.read())
+            else:
+                objHsh.update(b'missing')
+            # Separator between files:
+            objHsh.update(b'|')
+
+    return objHsh.hexdigest()
+
+
+def model_creation(dicCnfg, lgcAvg=False):
     """
     Create or load pRF model time courses.
 
@@ -33,18 +129,40 @@ def model_creation(dicCnfg):
     ----------
     dicCnfg : dict
         Dictionary containing config parameters.
+    lgcAvg : bool
+        Whether the caller averages functional runs with the same stimulus
+        sequence (see `strAvgRun` & `pre_pro_avg`). If `False`, models for
+        all runs are returned, irrespective of `strAvgRun`.
 
     Returns
     -------
     aryPrfTc : np.array
         4D numpy array with pRF time course models, with following dimensions:
         `aryPrfTc[x-position, y-position, SD, volume]`.
+
+    Notes
+    -----
+    If `lgcAvg` is `True` and all runs have the same stimulus sequence
+    (`strAvgRun` is 'always', or 'auto' and the sequences are found to be
+    identical), the models are only created (or returned) for one run, and
+    the caller has to average the functional runs. Models that are created
+    for one run are saved separately (`strPathMdl` + '_avg'), so that the
+    models for all runs (`strPathMdl`) are never replaced by them. Existing
+    models for one run are only loaded if they have been created from the
+    same PNG files, with the same run layout & parameters (see
+    `crt_avg_key`). Otherwise, the models for all runs are loaded.
     """
     # *************************************************************************
     # *** Load parameters from config file
 
     # Load config parameters from dictionary into namespace:
     cfg = cls_set_config(dicCnfg)
+
+    # Averaging of runs (only if the caller averages the functional runs):
+    strAvgRun = cfg.strAvgRun if lgcAvg else 'none'
+
+    # Path of models for one run (all runs with the same stimulus sequence):
+    strPathMdlAvg = cfg.strPathMdl + '_avg'
     # *************************************************************************
 
     if cfg.lgcCrteMdl:  #noqa
@@ -54,11 +172,30 @@ def model_creation(dicCnfg):
 
         print('------Load stimulus information from PNG files')
 
+        # If all runs are known to have the same stimulus sequence, only the
+        # PNG files of the first run are needed:
+        if strAvgRun == 'always':
+            lstPathPng = cfg.lstPathPng[:1]
+        else:
+            lstPathPng = cfg.lstPathPng
+
         aryPngData = load_png(cfg.varNumVol,
-                              cfg.lstPathPng,
+                              lstPathPng,
                               cfg.tplVslSpcSze,
                               varStrtIdx=cfg.varStrtIdx,
                               varZfill=cfg.varZfill)
+
+        if ((strAvgRun == 'auto')
+                and chk_rpt(aryPngData, len(lstPathPng))):
+            print('---------Identical stimulus sequence in all runs, models '
+                  + 'are created for one run')
+            aryPngData = aryPngData[:, :, :int(cfg.varNumVol)]
+
+        # Models for one run are saved separately:
+        if aryPngData.shape[2] < (int(cfg.varNumVol) * len(cfg.lstPathPng)):
+            strPathMdl = strPathMdlAvg
+        else:
+            strPathMdl = cfg.strPathMdl
         # *********************************************************************
 
         # *********************************************************************
@@ -103,13 +240,23 @@ def model_creation(dicCnfg):
 
         print('------Save pRF time course models to disk')
 
+        # Key of models for one run is only valid once the models have been
+        # saved (see below):
+        if os.path.isfile(strPathMdl + '.key'):
+            os.remove(strPathMdl + '.key')
+
         # Save the 4D array as '*.npy' file:
-        np.save(cfg.strPathMdl,
+        np.save(strPathMdl,
                 aryPrfTc)
 
         # Save 4D array as '*.nii' file (for debugging purposes):
         niiPrfTc = nb.Nifti1Image(aryPrfTc, np.eye(4))
-        nb.save(niiPrfTc, cfg.strPathMdl)
+        nb.save(niiPrfTc, strPathMdl)
+
+        # Save key of models for one run (see `crt_avg_key`):
+        if strPathMdl == strPathMdlAvg:
+            with open((strPathMdlAvg + '.key'), 'w') as fleOut:
+                fleOut.write(crt_avg_key(dicCnfg, strAvgRun))
         # *********************************************************************
 
     else:
@@ -119,8 +266,23 @@ def model_creation(dicCnfg):
 
         print('------Load pRF time course models from disk')
 
-        # Load the file:
-        aryPrfTc = np.load((cfg.strPathMdl + '.npy'))
+        # Load the file. Models for one run (see above) are used if runs are
+        # averaged, and if they have been created from the same stimuli
+        # (PNG files) & with the same parameters:
+        lgcMdlAvg = False
+        if (strAvgRun != 'none') and os.path.isfile(strPathMdlAvg + '.npy'):
+            strKey = crt_avg_key(dicCnfg, strAvgRun)
+            if (strKey is not None) and os.path.isfile(strPathMdlAvg
+                                                       + '.key'):
+                with open((strPathMdlAvg + '.key'), 'r') as fleIn:
+                    lgcMdlAvg = (fleIn.read() == strKey)
+            if not lgcMdlAvg:
+                print('---------Models for one run do not match stimuli, '
+                      + 'models for all runs are used')
+        if lgcMdlAvg:
+            aryPrfTc = np.load((strPathMdlAvg + '.npy'))
+        else:
+            aryPrfTc = np.load((cfg.strPathMdl + '.npy'))
 
         # Check whether pRF time course model matrix has the expected
         # dimensions:
@@ -138,6 +300,18 @@ def model_creation(dicCnfg):
         strErrMsg = ('Dimensions of specified pRF time course models do not '
                      + 'agree with specified model parameters')
         assert lgcDim, strErrMsg
+
+        # Models for all runs, with the same stimulus sequence in all runs,
+        # are reduced to one run (in memory only, the file is not changed):
+        varNumRun = len(cfg.lstPathNiiFunc)
+        if (strAvgRun != 'none') and (1 < varNumRun):
+            varNumVolRun = nb.load(cfg.lstPathNiiFunc[0]).shape[3]
+            if ((vecPrfTcShp[3] == (varNumVolRun * varNumRun))
+                    and ((strAvgRun == 'always')
+                         or chk_rpt(aryPrfTc, varNumRun))):
+                print('---------Same stimulus sequence in all runs, models '
+                      + 'are used for one run')
+                aryPrfTc = np.copy(aryPrfTc[:, :, :, :varNumVolRun])
         # *********************************************************************
 
     return aryPrfTc
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Cache for preprocessed functional data."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+# Version of the cache layout. Needs to be incremented whenever the
+# preprocessing itself, or the way in which the cache is stored, changes (so
+# that outdated cache entries are not reused).
+strCchVrsn = 'pyprf-func-cache-1'
+
+
+def crt_cache_key(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd, varSdSmthTmp,
+                  varSdSmthSpt, varTr):
+    """
+    Create key for cache of preprocessed functional data.
+
+    Parameters
+    ----------
+    strPathNiiMask: str
+        Path of mask used to restrict pRF model finding.
+    lstPathNiiFunc : list
+        List of paths of functional data (nii files).
+    lgcLinTrnd : bool
+        Whether to perform linear trend removal on functional data.
+    varSdSmthTmp : float
+        Extent of temporal smoothing.
+    varSdSmthSpt : float
+        Extent of spatial smoothing.
+    varTr : float
+        Volume TR of functional data [s].
+
+    Returns
+    -------
+    strKey : str
+        Hexadecimal SHA-1 digest over the contents of the mask and of all
+        functional runs, and over the preprocessing parameters.
+
+    Notes
+    -----
+    The key is based on file contents, not on file names or modification
+    times, so that the cache remains valid when files are copied or touched,
+    and becomes invalid when a file is overwritten with different data.
+    """
+    objHsh = hashlib.sha1()
+
+    # Preprocessing parameters (the representation of floats is exact, so
+    # that different parameter values always lead to a different key):
+    strPrm = (strCchVrsn
+              + '|lgcLinTrnd=' + repr(bool(lgcLinTrnd))
+              + '|varSdSmthTmp=' + repr(float(varSdSmthTmp))
+              + '|varSdSmthSpt=' + repr(float(varSdSmthSpt))
+              + '|varTr=' + repr(None if varTr is None else float(varTr))
+              + '|varNumRun=' + str(len(lstPathNiiFunc)))
+    objHsh.update(strPrm.encode('utf-8'))
+
+    # File contents of mask and functional runs (in the order in which runs
+    # are concatenated):
+    for strPathIn in ([strPathNiiMask] + list(lstPathNiiFunc)):
+        with open(strPathIn, 'rb') as fleIn:
+            # Read file in blocks of 16 MB, to avoid loading large files into
+            # memory at once:
+            for bytBlck in iter(lambda: fleIn.read(16777216), b''):
+                objHsh.update(bytBlck)
+        # Separator between files:
+        objHsh.update(b'|')
+
+    return objHsh.hexdigest()
+
+
+def load_func_cache(strPathCch, strKey):
+    """
+    Load preprocessed functional data from cache.
+
+    Parameters
+    ----------
+    strPathCch : str
+        Directory of cache.
+    strKey : str
+        Cache key (see `crt_cache_key`).
+
+    Returns
+    -------
+    tplOut : tuple or None
+        `None` if there is no cache entry for the key. Otherwise, tuple with
+        the same elements as returned by `pre_pro_func`, i.e. `(aryLgcMsk,
+        hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp)`. The functional data
+        (`aryFunc`) are memory-mapped (read-only).
+    """
+    strDirKey = os.path.join(strPathCch, strKey)
+
+    # The entry is only complete if the file with meta information exists,
+    # because it is the last one to be written (see `save_func_cache`).
+    if not os.path.isfile(os.path.join(strDirKey, 'meta.pkl')):
+        return None
+
+    with open(os.path.join(strDirKey, 'meta.pkl'), 'rb') as fleIn:
+        hdrMsk, aryAff, tplNiiShp = pickle.load(fleIn)
+
+    aryLgcMsk = np.load(os.path.join(strDirKey, 'aryLgcMsk.npy'))
+    aryLgcVar = np.load(os.path.join(strDirKey, 'aryLgcVar.npy'))
+
+    # Functional data are memory-mapped, so that only those parts that are
+    # actually accessed are read from disk:
+    aryFunc = np.load(os.path.join(strDirKey, 'aryFunc.npy'), mmap_mode='r')
+
+    return aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp
+
+
+def save_func_cache(strPathCch, strKey, aryLgcMsk, hdrMsk, aryAff, aryLgcVar,
+                    aryFunc, tplNiiShp):
+    """
+    Save preprocessed functional data to cache.
+
+    Parameters
+    ----------
+    strPathCch : str
+        Directory of cache. Created if it does not exist.
+    strKey : str
+        Cache key (see `crt_cache_key`).
+    aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp
+        Output of `pre_pro_func`.
+
+    Notes
+    -----
+    The cache entry is written to a temporary directory first, which is
+    renamed once all files have been written. Thus, an interrupted write (or
+    a concurrent process writing the same entry) never leaves behind an
+    incomplete entry that would be picked up by `load_func_cache`.
+    """
+    strDirKey = os.path.join(strPathCch, strKey)
+
+    # Nothing to do if entry already exists:
+    if os.path.isdir(strDirKey):
+        return
+
+    strDirTmp = os.path.join(strPathCch,
+                             ('.tmp_' + strKey + '_' + str(os.getpid())))
+    os.makedirs(strDirTmp)
+
+    np.save(os.path.join(strDirTmp, 'aryLgcMsk.npy'), aryLgcMsk)
+    np.save(os.path.join(strDirTmp, 'aryLgcVar.npy'), aryLgcVar)
+    np.save(os.path.join(strDirTmp, 'aryFunc.npy'),
+            aryFunc.astype(np.float32, copy=False))
+    with open(os.path.join(strDirTmp, 'meta.pkl'), 'wb') as fleOut:
+        pickle.dump((hdrMsk, aryAff, tuple(tplNiiShp)), fleOut)
+
+    try:
+        os.rename(strDirTmp, strDirKey)
+    except OSError:
+        # Another process has created the same entry in the meantime:
+        shutil.rmtree(strDirTmp, ignore_errors=True)
@@ -17,13 +17,19 @@
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import numpy as np
 from pyprf.analysis.utilities import load_nii
+from pyprf.analysis.utilities import load_nii_prefetch
 from pyprf.analysis.preprocessing_par import pre_pro_par
+from pyprf.analysis.preprocessing_cache import crt_cache_key
+from pyprf.analysis.preprocessing_cache import load_func_cache
+from pyprf.analysis.preprocessing_cache import save_func_cache
 
 
-def pre_pro_func(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,
-                 varSdSmthTmp=2.0, varSdSmthSpt=0.0, varPar=10.0):
+def pre_pro_func(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,  #noqa
+                 varSdSmthTmp=2.0, varSdSmthSpt=0.0, varPar=10.0,
+                 strPathCch=None, varTr=None, varPrfDpth=1, tplSlb=None):
     """
     Load & preprocess functional data.
 
@@ -45,6 +51,20 @@ def pre_pro_func(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,
         no spatial smoothing is applied.
     varPar : int
         Number of processes to run in parallel (multiprocessing).
+    strPathCch : str or None
+        Directory of cache for preprocessed functional data. If `None` or
+        empty, no cache is used.
+    varTr : float or None
+        Volume TR of functional data [s]. Only used as part of the cache key.
+    varPrfDpth : int
+        Number of functional runs that are loaded ahead of the run that is
+        currently being preprocessed (in a background thread, or in
+        background processes if `varPar` is greater than one).
+    tplSlb : tuple or None
+        If not `None`, only a slab of the volume along the z-dimension is
+        preprocessed. Tuple with index of first and (exclusive) last slice
+        of the slab, e.g. `(10, 20)`. In this case, all outputs refer to the
+        slab (not to the entire volume). The cache is not used for slabs.
 
     Returns
     -------
@@ -81,9 +101,107 @@ def pre_pro_func(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,
     time]. A mask is applied (externally supplied, e.g. a grey matter mask).
     Subsequently, the functional data is de-meaned, and intensities are
     converted into z-scores.
+
+    If a cache directory is provided, the results are stored in the cache,
+    keyed by the contents of the mask & functional data and by the
+    preprocessing parameters. On a subsequent call with the same input, the
+    results are loaded from the cache instead (with `aryFunc` memory-mapped).
+
+    If only a slab is preprocessed and spatial smoothing is applied, the slab
+    is extended by a halo of neighbouring slices (the radius of the Gaussian
+    kernel) before preprocessing, and the halo is removed afterwards. Thus,
+    the results are identical to those for the respective slices of the
+    entire volume.
     """
+    # The cache is only used for entire volumes:
+    if tplSlb is not None:
+        strPathCch = None
+
+    # Look up preprocessed data in cache:
+    if strPathCch:
+        print('------Look up preprocessed nii data in cache')
+        strCchKey = crt_cache_key(strPathNiiMask, lstPathNiiFunc,
+                                  lgcLinTrnd, varSdSmthTmp, varSdSmthSpt,
+                                  varTr)
+        tplCch = load_func_cache(strPathCch, strCchKey)
+        if tplCch is not None:
+            print('---------Using cached data: '
+                  + os.path.join(strPathCch, strCchKey))
+            return tplCch
+
     print('------Load & preprocess nii data')
 
+    # Preprocessed functional data of separate runs:
+    lstFunc = []
+    for aryLgcMsk, hdrMsk, aryAff, aryTmpFunc, tplNiiShp in pre_pro_runs(
+            strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=lgcLinTrnd,
+            varSdSmthTmp=varSdSmthTmp, varSdSmthSpt=varSdSmthSpt,
+            varPar=varPar, varPrfDpth=varPrfDpth, tplSlb=tplSlb):
+        lstFunc.append(aryTmpFunc)
+        del(aryTmpFunc)
+
+    # Put functional data from separate runs into one array. 2D array of the
+    # form aryFunc[voxelCount, time]
+    aryFunc = np.concatenate(lstFunc, axis=1).astype(np.float32, copy=False)
+    del(lstFunc)
+
+    # Voxels that are outside the brain and have no, or very little, signal
+    # should not be included in the pRF model finding. We take the variance
+    # over time and exclude voxels with a suspiciously low variance. Because
+    # the data given into the cython or GPU function has float32 precision, we
+    # calculate the variance on data with float32 precision.
+    aryFuncVar = np.var(aryFunc, axis=1, dtype=np.float32)
+
+    # Is the variance greater than zero?
+    aryLgcVar = np.greater(aryFuncVar,
+                           np.array([0.0001]).astype(np.float32)[0])
+
+    # Array with functional data for which conditions (mask inclusion and
+    # cutoff value) are fullfilled:
+    aryFunc = aryFunc[aryLgcVar, :]
+
+    # Store preprocessed data in cache:
+    if strPathCch:
+        print('---------Save preprocessed data to cache')
+        save_func_cache(strPathCch, strCchKey, aryLgcMsk, hdrMsk, aryAff,
+                        aryLgcVar, aryFunc, tplNiiShp)
+
+    return aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp
+
+
+def pre_pro_runs(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,  #noqa
+                 varSdSmthTmp=2.0, varSdSmthSpt=0.0, varPar=10.0,
+                 varPrfDpth=1, tplSlb=None):
+    """
+    Load & preprocess functional data, run by run.
+
+    Parameters
+    ----------
+    strPathNiiMask, lstPathNiiFunc, lgcLinTrnd, varSdSmthTmp, varSdSmthSpt,
+    varPar, varPrfDpth, tplSlb
+        See `pre_pro_func`.
+
+    Yields
+    ------
+    aryLgcMsk : np.array
+        1D numpy array with logical values (one value per voxel in the
+        volume or slab). Voxels that are `False` in the mask are excluded.
+    hdrMsk : nibabel-header-object
+        Nii header of mask.
+    aryAff : np.array
+        Array containing 'affine' of mask nii data.
+    aryTmpFunc : np.array
+        2D numpy array containing preprocessed functional data of the current
+        run, of the form aryTmpFunc[voxelCount, time] (voxels within the
+        mask, not yet excluded because of low variance).
+    tplNiiShp : tuple
+        Dimensions of functional data of the current run (x, y, z, time).
+
+    Notes
+    -----
+    Runs are preprocessed separately (see `pre_pro_func`), so that they can
+    also be processed one at a time (e.g. see `pyprf_suff`).
+    """
     # Load mask (to restrict model fitting):
     aryMask, hdrMsk, aryAff = load_nii(strPathNiiMask)
 
@@ -93,32 +211,62 @@ def pre_pro_func(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,
     # Number of non-zero voxels in mask:
     # varNumVoxMsk = int(np.count_nonzero(aryMask))
 
+    if tplSlb is not None:
+
+        # Radius of Gaussian kernel for spatial smoothing (same as in
+        # `scipy.ndimage.gaussian_filter`, with `truncate=4.0`):
+        if 0.0 < varSdSmthSpt:
+            varHalo = int(4.0 * float(varSdSmthSpt) + 0.5)
+        else:
+            varHalo = 0
+
+        # Slab including halo:
+        tplSlbHalo = (max(0, (tplSlb[0] - varHalo)),
+                      min(aryMask.shape[2], (tplSlb[1] + varHalo)))
+
+        # Position of the slab within the slab including halo:
+        varSlbSrt = tplSlb[0] - tplSlbHalo[0]
+        varSlbEnd = tplSlb[1] - tplSlbHalo[0]
+
+        # Preprocessing is performed on slab including halo:
+        aryMask = aryMask[:, :, tplSlbHalo[0]:tplSlbHalo[1]]
+
+        # Mask of the slab itself, used to select voxels after preprocessing:
+        aryMaskSlb = aryMask[:, :, varSlbSrt:varSlbEnd]
+
+    else:
+
+        tplSlbHalo = None
+        aryMaskSlb = aryMask
+
     # Dimensions of nii data:
-    tplNiiShp = aryMask.shape
+    tplNiiShp = aryMaskSlb.shape
 
     # Total number of voxels:
     varNumVoxTlt = (tplNiiShp[0] * tplNiiShp[1] * tplNiiShp[2])
 
     # Reshape mask:
-    aryMask = np.reshape(aryMask, varNumVoxTlt)
-
-    # List for arrays with functional data (possibly several runs):
-    lstFunc = []
+    aryMaskSlb = np.reshape(aryMaskSlb, varNumVoxTlt)
 
     # Number of runs:
     varNumRun = len(lstPathNiiFunc)
 
+    # Runs are loaded in the background, so that loading (i.e. gzip
+    # decompression) of the next run overlaps with preprocessing of the
+    # current run. Processes must not be forked while another thread is
+    # running (the child may inherit locks held by that thread), so runs are
+    # loaded in background processes if preprocessing forks processes
+    # (`varPar` greater than one):
+    objNiiFunc = load_nii_prefetch(lstPathNiiFunc, varPrfDpth=varPrfDpth,
+                                   tplSlb=tplSlbHalo, lgcPrc=(varPar != 1))
+
     # Loop through runs and load data:
     for idxRun in range(varNumRun):
 
         print(('---------Preprocess run ' + str(idxRun + 1)))
 
         # Load 4D nii data:
-        aryTmpFunc, _, _ = load_nii(lstPathNiiFunc[idxRun])
-
-        # Dimensions of nii data (including temporal dimension; spatial
-        # dimensions need to be the same for mask & functional data):
-        tplNiiShp = aryTmpFunc.shape
+        aryTmpFunc, _, _ = next(objNiiFunc)
 
         # Preprocessing of nii data:
         aryTmpFunc = pre_pro_par(aryTmpFunc,
@@ -128,12 +276,20 @@ def pre_pro_func(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,
                                  varSdSmthSpt=varSdSmthSpt,
                                  varPar=varPar)
 
+        # Remove halo:
+        if tplSlb is not None:
+            aryTmpFunc = aryTmpFunc[:, :, varSlbSrt:varSlbEnd, :]
+
+        # Dimensions of nii data (including temporal dimension; spatial
+        # dimensions need to be the same for mask & functional data):
+        tplNiiShp = aryTmpFunc.shape
+
         # Reshape functional nii data, from now on of the form
         # aryTmpFunc[voxelCount, time]:
         aryTmpFunc = np.reshape(aryTmpFunc, [varNumVoxTlt, tplNiiShp[3]])
 
         # Apply mask:
-        aryLgcMsk = np.greater(aryMask.astype(np.int16),
+        aryLgcMsk = np.greater(aryMaskSlb.astype(np.int16),
                                np.array([0], dtype=np.int16)[0])
         aryTmpFunc = aryTmpFunc[aryLgcMsk, :]
 
@@ -161,31 +317,39 @@ def pre_pro_func(strPathNiiMask, lstPathNiiFunc, lgcLinTrnd=True,
         aryTmpLgc = np.not_equal(aryTmpLgc, True)
         aryTmpFunc[aryTmpLgc, :] = np.array([0.0], dtype=np.float32)[0]
 
-        # Put preprocessed functional data of current run into list:
-        lstFunc.append(aryTmpFunc)
+        yield aryLgcMsk, hdrMsk, aryAff, aryTmpFunc, tplNiiShp
         del(aryTmpFunc)
 
-    # Put functional data from separate runs into one array. 2D array of the
-    # form aryFunc[voxelCount, time]
-    aryFunc = np.concatenate(lstFunc, axis=1).astype(np.float32, copy=False)
-    del(lstFunc)
+    # Stop background loading:
+    objNiiFunc.close()
 
-    # Voxels that are outside the brain and have no, or very little, signal
-    # should not be included in the pRF model finding. We take the variance
-    # over time and exclude voxels with a suspiciously low variance. Because
-    # the data given into the cython or GPU function has float32 precision, we
-    # calculate the variance on data with float32 precision.
-    aryFuncVar = np.var(aryFunc, axis=1, dtype=np.float32)
 
-    # Is the variance greater than zero?
-    aryLgcVar = np.greater(aryFuncVar,
-                           np.array([0.0001]).astype(np.float32)[0])
+def pre_pro_avg(aryFunc, varNumRun):
+    """
+    Average functional runs with the same stimulus sequence.
 
-    # Array with functional data for which conditions (mask inclusion and
-    # cutoff value) are fullfilled:
-    aryFunc = aryFunc[aryLgcVar, :]
+    Parameters
+    ----------
+    aryFunc : np.array
+        2D numpy array with preprocessed functional data of the concatenated
+        runs, of the form aryFunc[voxelCount, time] (see `pre_pro_func`).
+    varNumRun : int
+        Number of runs (all runs need to have the same number of volumes).
 
-    return aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp
+    Returns
+    -------
+    aryFunc : np.array
+        2D numpy array with functional data averaged over runs, of the form
+        aryFunc[voxelCount, time], with the number of volumes of one run.
+    """
+    if aryFunc.shape[1] % varNumRun != 0:
+        raise ValueError(('Runs cannot be averaged, total number of volumes ('
+                          + str(aryFunc.shape[1]) + ') is not a multiple '
+                          + 'of the number of runs (' + str(varNumRun)
+                          + ')'))
+    print('------Average ' + str(varNumRun) + ' runs')
+    return np.mean(np.reshape(aryFunc, (aryFunc.shape[0], varNumRun, -1)),
+                   axis=1, dtype=np.float32)
 
 
 def pre_pro_models(aryPrfTc, varSdSmthTmp=2.0, varPar=10):
@@ -19,6 +19,7 @@
 
 import numpy as np
 import time
+import queue
 import multiprocessing as mp
 from scipy.ndimage.filters import gaussian_filter
 from scipy.ndimage.filters import gaussian_filter1d
@@ -86,9 +87,6 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
         # Empty list for processes:
         lstPrcs = [None] * varPar
 
-        # Create a queue to put the results in:
-        queOut = mp.Queue()
-
         # Total number of elements to loop over (voxels):
         varNumEleTlt = (vecInShp[0] * vecInShp[1] * vecInShp[2])
 
@@ -146,29 +144,44 @@ def pre_pro_par(aryFunc, aryMask=np.array([], dtype=np.int16),  #noqa
         # We don't need the original array with the functional data anymore:
         del(aryData)
 
-        print('------------Creating parallel processes')
-
-        # Create processes:
-        for idxPrc in range(0, varPar):
-            lstPrcs[idxPrc] = mp.Process(target=funcIn,
-                                         args=(idxPrc,
-                                               lstFunc[idxPrc],
-                                               varSdSmthTmp,
-                                               queOut))
-            # Daemon (kills processes when exiting):
-            lstPrcs[idxPrc].Daemon = True
-
-        # Start processes:
-        for idxPrc in range(0, varPar):
-            lstPrcs[idxPrc].start()
-
-        # Collect results from queue:
-        for idxPrc in range(0, varPar):
-            lstResPar[idxPrc] = queOut.get(True)
-
-        # Join processes:
-        for idxPrc in range(0, varPar):
-            lstPrcs[idxPrc].join()
+        # Without parallelisation, the function is called in this process
+        # (no process is forked, so that it is safe to have background
+        # threads running at the same time, see `load_nii_prefetch`):
+        if varPar == 1:
+
+            # Create a queue to put the results in:
+            queOut = queue.Queue()
+            funcIn(0, lstFunc[0], varSdSmthTmp, queOut)
+            lstResPar[0] = queOut.get(True)
+
+        else:
+
+            print('------------Creating parallel processes')
+
+            # Create a queue to put the results in:
+            queOut = mp.Queue()
+
+            # Create processes:
+            for idxPrc in range(0, varPar):
+                lstPrcs[idxPrc] = mp.Process(target=funcIn,
+                                             args=(idxPrc,
+                                                   lstFunc[idxPrc],
+                                                   varSdSmthTmp,
+                                                   queOut))
+                # Daemon (kills processes when exiting):
+                lstPrcs[idxPrc].Daemon = True
+
+            # Start processes:
+            for idxPrc in range(0, varPar):
+                lstPrcs[idxPrc].start()
+
+            # Collect results from queue:
+            for idxPrc in range(0, varPar):
+                lstResPar[idxPrc] = queOut.get(True)
+
+            # Join processes:
+            for idxPrc in range(0, varPar):
+                lstPrcs[idxPrc].join()
 
         print('------------Post-process data from parallel function')
 
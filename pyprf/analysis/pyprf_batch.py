@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""pRF mapping for several subjects with the same pRF models."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import ast
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from pyprf.analysis.load_config import load_config
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.utilities import cls_bckgrnd_prc
+from pyprf.analysis.model_creation_main import model_creation
+from pyprf.analysis.preprocessing_main import pre_pro_models
+from pyprf.analysis.preprocessing_main import pre_pro_func
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.export_results import asmbl_prf_res
+from pyprf.analysis.export_results import export_nii
+from pyprf.analysis.export_results import export_sdcr
+from pyprf.analysis.pyprf_slab import pyprf_slab
+
+
+def load_subjects(strPathSubj):
+    """
+    Load list of subjects for batch mode.
+
+    Parameters
+    ----------
+    strPathSubj : str
+        Path of text file with one subject per line. Each line contains a
+        tuple with (1) a list of paths of functional runs, (2) the path of
+        the mask, and (3) the output basename, e.g.
+        `(['/sub01/run01.nii.gz', '/sub01/run02.nii.gz'], '/sub01/mask.nii.gz',
+        '/sub01/prf')`. Lines starting with '#' and empty lines are ignored.
+
+    Returns
+    -------
+    lstSubj : list
+        List of tuples `(lstPathNiiFunc, strPathNiiMask, strPathOut)`.
+    """
+    lstSubj = []
+    with open(strPathSubj, 'r') as fleIn:
+        for strLne in fleIn:
+            strLne = strLne.strip()
+            if (not strLne) or (strLne[0] == '#'):
+                continue
+            tplSubj = ast.literal_eval(strLne)
+            if not ((len(tplSubj) == 3)
+                    and isinstance(tplSubj[0], (list, tuple))
+                    and isinstance(tplSubj[1], str)
+                    and isinstance(tplSubj[2], str)):
+                raise ValueError(('Invalid subject in ' + strPathSubj + ': '
+                                  + strLne))
+            lstSubj.append((list(tplSubj[0]), tplSubj[1], tplSubj[2]))
+    return lstSubj
+
+
+def pre_pro_subj(cfg, lstPathNiiFunc, strPathNiiMask):
+    """Preprocess functional data of one subject (see `pre_pro_func`)."""
+    return pre_pro_func(strPathNiiMask, lstPathNiiFunc,
+                        lgcLinTrnd=cfg.lgcLinTrnd,
+                        varSdSmthTmp=cfg.varSdSmthTmp,
+                        varSdSmthSpt=cfg.varSdSmthSpt,
+                        varPar=cfg.varPar, strPathCch=cfg.strPathCch,
+                        varTr=cfg.varTr)
+
+
+def export_subj(cfg, aryPrfRes, hdrMsk, aryAff, aryLgcMsk, strPathOut):
+    """Export results of one subject & remove its checkpoint."""
+    export_nii(aryPrfRes, hdrMsk, aryAff, strPathOut,
+               varCmprLvl=cfg.varCmprLvl, lgcOut4d=cfg.lgcOut4d,
+               varPar=cfg.varPar)
+    if cfg.lgcSdcr:
+        export_sdcr(aryPrfRes, aryLgcMsk, aryAff, strPathOut)
+    shutil.rmtree(strPathOut + '_checkpoint', ignore_errors=True)
+
+
+def pyprf_batch(strCsvCnfg, strPathSubj, lgcTest=False, lgcResume=False):  #noqa
+    """
+    Run pRF mapping for several subjects with the same pRF models.
+
+    Parameters
+    ----------
+    strCsvCnfg : str
+        Absolute file path of config file. The functional data, mask and
+        output basename in the config file are ignored (they are taken from
+        the list of subjects instead).
+    strPathSubj : str
+        Path of text file with list of subjects (see `load_subjects`).
+    lgcTest : Boolean
+        Whether this is a test (pytest). If yes, absolute path of pyprf libary
+        will be prepended to config file paths.
+    lgcResume : Boolean
+        Whether to resume interrupted pRF finding (see `find_prf`).
+
+    Notes
+    -----
+    The pRF time course models are created (or loaded) and preprocessed only
+    once. The preprocessed models are saved to a temporary file and
+    memory-mapped, so that all processes used for pRF finding share the same
+    copy in memory (page cache). Loading & preprocessing of the functional
+    data of the next subject, and export of the results of the previous
+    subject, take place in background processes while pRF finding is
+    performed for the current subject. (Background processes are started as
+    new interpreters, see `cls_bckgrnd_prc`, because processes for pRF
+    finding must not be forked while other threads are running.) With
+    slab-wise processing (`varMemBdgt`), subjects are processed one after
+    the other.
+    """
+    print('---pRF analysis (batch mode)')
+    varTme01 = time.time()
+
+    # Load config parameters from csv file into dictionary:
+    dicCnfg = load_config(strCsvCnfg, lgcTest=lgcTest)
+
+    # Batch mode only implements the exhaustive search (with the model index
+    # or sketches, or slab by slab) and the export of the best fitting
+    # models. Options of `pyprf` that would change the outputs are not
+    # ignored silently:
+    if dicCnfg['strAvgRun'] != 'none':
+        raise ValueError(('Averaging of runs (strAvgRun) is not supported in '
+                          + 'batch mode'))
+    if ((1 < dicCnfg['varNumTopK'])
+            or dicCnfg['lgcPst']
+            or (0 < dicCnfg['varSpcLtc'])
+            or (0.0 < dicCnfg['varThrScr'])
+            or (0 < dicCnfg['varNumSrgt'])
+            or dicCnfg['lgcPair']
+            or dicCnfg['lgcSuff']
+            or dicCnfg['lgcXval']):
+        raise ValueError(('Batch mode does not support the best fitting '
+                          + 'models (varNumTopK), posterior (lgcPst), '
+                          + 'lattice (varSpcLtc), screening (varThrScr), '
+                          + 'null distribution (varNumSrgt), pairs of models '
+                          + '(lgcPair), or sufficient statistics (lgcSuff, '
+                          + 'lgcXval)'))
+
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    # Convert preprocessing parameters (for temporal and spatial smoothing)
+    # from SI units (i.e. [s] and [mm]) into units of data array (volumes and
+    # voxels):
+    cfg.varSdSmthTmp = np.divide(cfg.varSdSmthTmp, cfg.varTr)
+    cfg.varSdSmthSpt = np.divide(cfg.varSdSmthSpt, cfg.varVoxRes)
+
+    lstSubj = load_subjects(strPathSubj)
+    varNumSubj = len(lstSubj)
+    print('---Number of subjects: ' + str(varNumSubj))
+
+    # *************************************************************************
+    # *** Create or load & preprocess pRF time course models (once)
+
+    aryPrfTc = model_creation(dicCnfg)
+    aryPrfTc = pre_pro_models(aryPrfTc, varSdSmthTmp=cfg.varSdSmthTmp,
+                              varPar=cfg.varPar).astype(np.float32)
+
+    # Save preprocessed models to temporary file (in memory, if available),
+    # and memory-map it:
+    if os.path.isdir('/dev/shm'):
+        strDirTmp = tempfile.mkdtemp(prefix='pyprf_', dir='/dev/shm')
+    else:
+        strDirTmp = tempfile.mkdtemp(prefix='pyprf_')
+    strPathMdl = os.path.join(strDirTmp, 'aryPrfTc.npy')
+    np.save(strPathMdl, aryPrfTc)
+    del(aryPrfTc)
+    aryPrfTc = np.load(strPathMdl, mmap_mode='r')
+    # *************************************************************************
+
+    # Background processes for preprocessing of the next subject & export of
+    # the previous subject:
+    objPre = None
+    objExp = None
+
+    try:
+
+        for idxSubj in range(varNumSubj):
+
+            lstPathNiiFunc, strPathNiiMask, strPathOut = lstSubj[idxSubj]
+
+            print('---Subject ' + str(idxSubj + 1) + ' out of '
+                  + str(varNumSubj) + ': ' + strPathOut)
+
+            # Config for current subject:
+            dicCnfgSubj = dict(dicCnfg)
+            dicCnfgSubj['lstPathNiiFunc'] = lstPathNiiFunc
+            dicCnfgSubj['strPathNiiMask'] = strPathNiiMask
+            dicCnfgSubj['strPathOut'] = strPathOut
+
+            # Checkpoint of pRF finding (see `pyprf`):
+            if (0 < cfg.varChnkSze) or lgcResume:
+                strPathChk = strPathOut + '_checkpoint'
+            else:
+                strPathChk = None
+
+            if 0.0 < cfg.varMemBdgt:
+
+                # Slab-wise pRF finding:
+                strPathRes = strPathOut + '_slab_results.npy'
+                aryPrfRes, hdrMsk, aryAff, aryLgcMsk = pyprf_slab(
+                    dicCnfgSubj, aryPrfTc, cfg.varSdSmthTmp,
+                    cfg.varSdSmthSpt, strPathRes,
+                    strPathChk=strPathChk,
+                    lgcResume=lgcResume)
+                export_subj(cfg, aryPrfRes, hdrMsk, aryAff, aryLgcMsk,
+                            strPathOut)
+                del(aryPrfRes)
+                os.remove(strPathRes)
+                continue
+
+            # Preprocessing of functional data of current subject (started
+            # during pRF finding for the previous subject):
+            if objPre is None:
+                aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp = \
+                    pre_pro_subj(cfg, lstPathNiiFunc, strPathNiiMask)
+            else:
+                aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp = \
+                    objPre.get()
+            objPre = None
+
+            if aryFunc.shape[1] != aryPrfTc.shape[3]:
+                raise ValueError(('Number of volumes of functional data of '
+                                  + 'subject ' + strPathOut + ' ('
+                                  + str(aryFunc.shape[1]) + ') does not '
+                                  + 'match pRF time course models ('
+                                  + str(aryPrfTc.shape[3]) + ')'))
+
+            # Start preprocessing of functional data of next subject:
+            if (idxSubj + 1) < varNumSubj:
+                objPre = cls_bckgrnd_prc(pre_pro_subj, cfg,
+                                         lstSubj[(idxSubj + 1)][0],
+                                         lstSubj[(idxSubj + 1)][1])
+                objPre.start()
+
+            # Find pRF models for voxel time courses:
+            aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 = find_prf(
+                dicCnfgSubj, aryFunc, aryPrfTc,
+                strPathChk=strPathChk,
+                lgcResume=lgcResume)
+            del(aryFunc)
+
+            # Put results into original image dimensions:
+            aryPrfRes = asmbl_prf_res(aryBstXpos, aryBstYpos, aryBstSd,
+                                      aryBstR2, aryLgcMsk, aryLgcVar,
+                                      tplNiiShp)
+
+            # Export results of current subject in the background (after the
+            # export of the previous subject has been completed):
+            if objExp is not None:
+                objExp.get()
+            objExp = cls_bckgrnd_prc(export_subj, cfg, aryPrfRes, hdrMsk,
+                                     aryAff, aryLgcMsk, strPathOut)
+            objExp.start()
+
+        if objExp is not None:
+            objExp.get()
+            objExp = None
+
+    finally:
+
+        # Stop background processes (if pRF finding or export of a subject
+        # has failed):
+        for objPrc in [objPre, objExp]:
+            if objPrc is not None:
+                objPrc.terminate()
+
+        # Remove temporary file with models:
+        del(aryPrfTc)
+        shutil.rmtree(strDirTmp, ignore_errors=True)
+
+    varTme02 = time.time()
+    varTme03 = varTme02 - varTme01
+    print('---Elapsed time: ' + str(varTme03) + ' s')
+    print('---Done.')
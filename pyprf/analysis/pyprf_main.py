@@ -23,20 +23,42 @@ Use `import pRF_config_motion as cfg` for pRF analysis with motion stimuli.
 # You should have received a copy of the GNU General Public License along with
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import time
+import shutil
 import numpy as np
-import nibabel as nb
-import multiprocessing as mp
 
 from pyprf.analysis.load_config import load_config
 from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.utilities import cls_bckgrnd
+from pyprf.analysis.utilities import cls_bckgrnd_prc
 
 from pyprf.analysis.model_creation_main import model_creation
 from pyprf.analysis.preprocessing_main import pre_pro_models
 from pyprf.analysis.preprocessing_main import pre_pro_func
-
-
-def pyprf(strCsvCnfg, lgcTest=False):  #noqa
+from pyprf.analysis.preprocessing_main import pre_pro_avg
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.find_prf_main import crt_mdl_prms
+from pyprf.analysis.find_prf_spt import find_prf_spt
+from pyprf.analysis.find_prf_spt import crt_vox_pos
+from pyprf.analysis.find_prf_scr import crt_bss_scr
+from pyprf.analysis.find_prf_scr import scr_vox
+from pyprf.analysis.find_prf_scr import expnd_res
+from pyprf.analysis.find_prf_null import find_prf_null
+from pyprf.analysis.find_prf_null import fdr_thr
+from pyprf.analysis.find_prf_pair import find_prf_pair
+from pyprf.analysis.export_results import asmbl_prf_res
+from pyprf.analysis.export_results import export_nii
+from pyprf.analysis.export_results import export_sdcr
+from pyprf.analysis.export_results import export_map
+from pyprf.analysis.export_results import export_topk
+from pyprf.analysis.export_results import export_pst
+from pyprf.analysis.export_results import export_pair
+from pyprf.analysis.pyprf_slab import pyprf_slab
+from pyprf.analysis.pyprf_suff import pyprf_suff
+
+
+def pyprf(strCsvCnfg, lgcTest=False, lgcResume=False):  #noqa
     """
     Main function for pRF mapping.
 
@@ -47,6 +69,10 @@ def pyprf(strCsvCnfg, lgcTest=False):  #noqa
     lgcTest : Boolean
         Whether this is a test (pytest). If yes, absolute path of pyprf libary
         will be prepended to config file paths.
+    lgcResume : Boolean
+        Whether to resume an interrupted analysis, i.e. to reuse the results
+        of voxel chunks that have already been completed (stored in the
+        checkpoint directory, `strPathOut` + '_checkpoint').
     """
     # *************************************************************************
     # *** Check time
@@ -63,289 +89,278 @@ def pyprf(strCsvCnfg, lgcTest=False):  #noqa
     # Load config parameters from dictionary into namespace:
     cfg = cls_set_config(dicCnfg)
 
-    # Conditional imports:
-    if cfg.strVersion == 'gpu':
-        from pyprf.analysis.find_prf_gpu import find_prf_gpu
-    if ((cfg.strVersion == 'cython') or (cfg.strVersion == 'numpy')):
-        from pyprf.analysis.find_prf_cpu import find_prf_cpu
-
     # Convert preprocessing parameters (for temporal and spatial smoothing)
     # from SI units (i.e. [s] and [mm]) into units of data array (volumes and
     # voxels):
     cfg.varSdSmthTmp = np.divide(cfg.varSdSmthTmp, cfg.varTr)
     cfg.varSdSmthSpt = np.divide(cfg.varSdSmthSpt, cfg.varVoxRes)
-    # *************************************************************************
 
+    # Directory for checkpoints of pRF finding results (removed once the
+    # results have been exported). Checkpoints are only created if the data
+    # are split into chunks of `varChnkSze` voxels, or if an analysis is
+    # resumed.
+    if (0 < cfg.varChnkSze) or lgcResume:
+        strPathChk = cfg.strPathOut + '_checkpoint'
+    else:
+        strPathChk = None
     # *************************************************************************
-    # *** Create or load pRF time course models
 
-    aryPrfTc = model_creation(dicCnfg)
     # *************************************************************************
+    # *** pRF finding from per-run sufficient statistics
 
-    # *************************************************************************
-    # *** Preprocessing
+    if cfg.lgcSuff or cfg.lgcXval:
 
-    # Preprocessing of pRF model time courses:
-    aryPrfTc = pre_pro_models(aryPrfTc, varSdSmthTmp=cfg.varSdSmthTmp,
-                              varPar=cfg.varPar)
+        # Create or load pRF time course models:
+        aryPrfTc = model_creation(dicCnfg)
+
+        # Preprocessing of pRF model time courses:
+        aryPrfTc = pre_pro_models(aryPrfTc, varSdSmthTmp=cfg.varSdSmthTmp,
+                                  varPar=cfg.varPar)
+
+        # Preprocessing of functional data & pRF finding, run by run:
+        aryPrfRes, hdrMsk, aryAff, aryLgcMsk, aryR2Xval = pyprf_suff(
+            dicCnfg, aryPrfTc, cfg.varSdSmthTmp, cfg.varSdSmthSpt)
+
+        # Export results:
+        export_nii(aryPrfRes, hdrMsk, aryAff, cfg.strPathOut,
+                   varCmprLvl=cfg.varCmprLvl, lgcOut4d=cfg.lgcOut4d,
+                   varPar=cfg.varPar)
+        if cfg.lgcSdcr:
+            export_sdcr(aryPrfRes, aryLgcMsk, aryAff, cfg.strPathOut)
+        if aryR2Xval is not None:
+            export_map(aryR2Xval, hdrMsk, aryAff,
+                       (cfg.strPathOut + '_R2_xval'),
+                       varCmprLvl=cfg.varCmprLvl)
 
-    # Preprocessing of functional data:
-    aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp = pre_pro_func(
-        cfg.strPathNiiMask, cfg.lstPathNiiFunc, lgcLinTrnd=cfg.lgcLinTrnd,
-        varSdSmthTmp=cfg.varSdSmthTmp, varSdSmthSpt=cfg.varSdSmthSpt,
-        varPar=cfg.varPar)
     # *************************************************************************
 
     # *************************************************************************
-    # *** Find pRF models for voxel time courses
-
-    print('------Find pRF models for voxel time courses')
-
-    # Number of voxels for which pRF finding will be performed:
-    varNumVoxInc = aryFunc.shape[0]
-
-    print('---------Number of voxels on which pRF finding will be performed: '
-          + str(varNumVoxInc))
-
-    print('---------Preparing parallel pRF model finding')
-
-    # For the GPU version, we need to set down the parallelisation to 1 now,
-    # because no separate CPU threads are to be created. We may still use CPU
-    # parallelisation for preprocessing, which is why the parallelisation
-    # factor is only reduced now, not earlier.
-    if cfg.strVersion == 'gpu':
-        cfg.varPar = 1
-
-    # Vector with the moddeled x-positions of the pRFs:
-    vecMdlXpos = np.linspace(cfg.varExtXmin,
-                             cfg.varExtXmax,
-                             cfg.varNumX,
-                             endpoint=True,
-                             dtype=np.float32)
-
-    # Vector with the moddeled y-positions of the pRFs:
-    vecMdlYpos = np.linspace(cfg.varExtYmin,
-                             cfg.varExtYmax,
-                             cfg.varNumY,
-                             endpoint=True,
-                             dtype=np.float32)
-
-    # Vector with the moddeled standard deviations of the pRFs:
-    vecMdlSd = np.linspace(cfg.varPrfStdMin,
-                           cfg.varPrfStdMax,
-                           cfg.varNumPrfSizes,
-                           endpoint=True,
-                           dtype=np.float32)
-
-    # Empty list for results (parameters of best fitting pRF model):
-    lstPrfRes = [None] * cfg.varPar
-
-    # Empty list for processes:
-    lstPrcs = [None] * cfg.varPar
-
-    # Create a queue to put the results in:
-    queOut = mp.Queue()
-
-    # List into which the chunks of functional data for the parallel processes
-    # will be put:
-    lstFunc = [None] * cfg.varPar
-
-    # Vector with the indicies at which the functional data will be separated
-    # in order to be chunked up for the parallel processes:
-    vecIdxChnks = np.linspace(0,
-                              varNumVoxInc,
-                              num=cfg.varPar,
-                              endpoint=False)
-    vecIdxChnks = np.hstack((vecIdxChnks, varNumVoxInc))
-
-    # Make sure type is float32:
-    aryFunc = aryFunc.astype(np.float32)
-    aryPrfTc = aryPrfTc.astype(np.float32)
-
-    # Put functional data into chunks:
-    for idxChnk in range(0, cfg.varPar):
-        # Index of first voxel to be included in current chunk:
-        varTmpChnkSrt = int(vecIdxChnks[idxChnk])
-        # Index of last voxel to be included in current chunk:
-        varTmpChnkEnd = int(vecIdxChnks[(idxChnk+1)])
-        # Put voxel array into list:
-        lstFunc[idxChnk] = aryFunc[varTmpChnkSrt:varTmpChnkEnd, :]
-
-    # We don't need the original array with the functional data anymore:
-    del(aryFunc)
-
-    # CPU version (using numpy or cython for pRF finding):
-    if ((cfg.strVersion == 'numpy') or (cfg.strVersion == 'cython')):
-
-        print('---------pRF finding on CPU')
-
-        print('---------Creating parallel processes')
-
-        # Create processes:
-        for idxPrc in range(0, cfg.varPar):
-            lstPrcs[idxPrc] = mp.Process(target=find_prf_cpu,
-                                         args=(idxPrc,
-                                               dicCnfg,
-                                               vecMdlXpos,
-                                               vecMdlYpos,
-                                               vecMdlSd,
-                                               lstFunc[idxPrc],
-                                               aryPrfTc,
-                                               cfg.strVersion,
-                                               queOut)
-                                         )
-            # Daemon (kills processes when exiting):
-            lstPrcs[idxPrc].Daemon = True
-
-    # GPU version (using tensorflow for pRF finding):
-    elif cfg.strVersion == 'gpu':
-
-        print('---------pRF finding on GPU')
-
-        # Create processes:
-        for idxPrc in range(0, cfg.varPar):
-            lstPrcs[idxPrc] = mp.Process(target=find_prf_gpu,
-                                         args=(idxPrc,
-                                               vecMdlXpos,
-                                               vecMdlYpos,
-                                               vecMdlSd,
-                                               lstFunc[idxPrc],
-                                               aryPrfTc,
-                                               queOut)
-                                         )
-            # Daemon (kills processes when exiting):
-            lstPrcs[idxPrc].Daemon = True
-
-    # Start processes:
-    for idxPrc in range(0, cfg.varPar):
-        lstPrcs[idxPrc].start()
-
-    # Delete reference to list with function data (the data continues to exists
-    # in child process):
-    del(lstFunc)
-
-    # Collect results from queue:
-    for idxPrc in range(0, cfg.varPar):
-        lstPrfRes[idxPrc] = queOut.get(True)
-
-    # Join processes:
-    for idxPrc in range(0, cfg.varPar):
-        lstPrcs[idxPrc].join()
-
-    print('---------Prepare pRF finding results for export')
-
-    # Create list for vectors with fitting results, in order to put the results
-    # into the correct order:
-    lstResXpos = [None] * cfg.varPar
-    lstResYpos = [None] * cfg.varPar
-    lstResSd = [None] * cfg.varPar
-    lstResR2 = [None] * cfg.varPar
-
-    # Put output into correct order:
-    for idxRes in range(0, cfg.varPar):
-
-        # Index of results (first item in output list):
-        varTmpIdx = lstPrfRes[idxRes][0]
-
-        # Put fitting results into list, in correct order:
-        lstResXpos[varTmpIdx] = lstPrfRes[idxRes][1]
-        lstResYpos[varTmpIdx] = lstPrfRes[idxRes][2]
-        lstResSd[varTmpIdx] = lstPrfRes[idxRes][3]
-        lstResR2[varTmpIdx] = lstPrfRes[idxRes][4]
-
-    # Concatenate output vectors (into the same order as the voxels that were
-    # included in the fitting):
-    aryBstXpos = np.zeros(0, dtype=np.float32)
-    aryBstYpos = np.zeros(0, dtype=np.float32)
-    aryBstSd = np.zeros(0, dtype=np.float32)
-    aryBstR2 = np.zeros(0, dtype=np.float32)
-    for idxRes in range(0, cfg.varPar):
-        aryBstXpos = np.append(aryBstXpos, lstResXpos[idxRes])
-        aryBstYpos = np.append(aryBstYpos, lstResYpos[idxRes])
-        aryBstSd = np.append(aryBstSd, lstResSd[idxRes])
-        aryBstR2 = np.append(aryBstR2, lstResR2[idxRes])
-
-    # Delete unneeded large objects:
-    del(lstPrfRes)
-    del(lstResXpos)
-    del(lstResYpos)
-    del(lstResSd)
-    del(lstResR2)
-
-    # Put results form pRF finding into array (they originally needed to be
-    # saved in a list due to parallelisation). Voxels were selected for pRF
-    # model finding in two stages: First, a mask was applied. Second, voxels
-    # with low variance were removed. Voxels are put back into the original
-    # format accordingly.
-
-    # Number of voxels that were included in the mask:
-    varNumVoxMsk = np.sum(aryLgcMsk)
-
-    # Array for pRF finding results, of the form aryPrfRes[voxel-count, 0:3],
-    # where the 2nd dimension contains the parameters of the best-fitting pRF
-    # model for the voxel, in the order (0) pRF-x-pos, (1) pRF-y-pos, (2)
-    # pRF-SD, (3) pRF-R2. At this step, only the voxels included in the mask
-    # are represented.
-    aryPrfRes01 = np.zeros((varNumVoxMsk, 6), dtype=np.float32)
-
-    # Place voxels based on low-variance exlusion:
-    aryPrfRes01[aryLgcVar, 0] = aryBstXpos
-    aryPrfRes01[aryLgcVar, 1] = aryBstYpos
-    aryPrfRes01[aryLgcVar, 2] = aryBstSd
-    aryPrfRes01[aryLgcVar, 3] = aryBstR2
-
-    # Total number of voxels:
-    varNumVoxTlt = (tplNiiShp[0] * tplNiiShp[1] * tplNiiShp[2])
-
-    # Place voxels based on mask-exclusion:
-    aryPrfRes02 = np.zeros((varNumVoxTlt, 6), dtype=np.float32)
-    aryPrfRes02[aryLgcMsk, 0] = aryPrfRes01[:, 0]
-    aryPrfRes02[aryLgcMsk, 1] = aryPrfRes01[:, 1]
-    aryPrfRes02[aryLgcMsk, 2] = aryPrfRes01[:, 2]
-    aryPrfRes02[aryLgcMsk, 3] = aryPrfRes01[:, 3]
-
-    # Reshape pRF finding results into original image dimensions:
-    aryPrfRes = np.reshape(aryPrfRes02,
-                           [tplNiiShp[0],
-                            tplNiiShp[1],
-                            tplNiiShp[2],
-                            6])
-
-    del(aryPrfRes01)
-    del(aryPrfRes02)
-
-    # Calculate polar angle map:
-    aryPrfRes[:, :, :, 4] = np.arctan2(aryPrfRes[:, :, :, 1],
-                                       aryPrfRes[:, :, :, 0])
-
-    # Calculate eccentricity map (r = sqrt( x^2 + y^2 ) ):
-    aryPrfRes[:, :, :, 5] = np.sqrt(np.add(np.power(aryPrfRes[:, :, :, 0],
-                                                    2.0),
-                                           np.power(aryPrfRes[:, :, :, 1],
-                                                    2.0)))
-
-    # List with name suffices of output images:
-    lstNiiNames = ['_x_pos',
-                   '_y_pos',
-                   '_SD',
-                   '_R2',
-                   '_polar_angle',
-                   '_eccentricity']
-
-    print('---------Exporting results')
-
-    # Save nii results:
-    for idxOut in range(0, 6):
-        # Create nii object for results:
-        niiOut = nb.Nifti1Image(aryPrfRes[:, :, :, idxOut],
-                                aryAff,
-                                header=hdrMsk
-                                )
-        # Save nii:
-        strTmp = (cfg.strPathOut + lstNiiNames[idxOut] + '.nii.gz')
-        nb.save(niiOut, strTmp)
+    # *** Slab-wise pRF finding
+
+    elif 0.0 < cfg.varMemBdgt:
+
+        # Create or load pRF time course models:
+        aryPrfTc = model_creation(dicCnfg)
+
+        # Preprocessing of pRF model time courses:
+        aryPrfTc = pre_pro_models(aryPrfTc, varSdSmthTmp=cfg.varSdSmthTmp,
+                                  varPar=cfg.varPar)
+
+        # Path of memory-mapped results:
+        strPathRes = cfg.strPathOut + '_slab_results.npy'
+
+        # Preprocessing of functional data & pRF finding, slab by slab:
+        aryPrfRes, hdrMsk, aryAff, aryLgcMsk = pyprf_slab(dicCnfg, aryPrfTc,
+                                               cfg.varSdSmthTmp,
+                                               cfg.varSdSmthSpt,
+                                               strPathRes,
+                                               strPathChk=strPathChk,
+                                               lgcResume=lgcResume)
+
+        # Export results:
+        export_nii(aryPrfRes, hdrMsk, aryAff, cfg.strPathOut,
+                   varCmprLvl=cfg.varCmprLvl, lgcOut4d=cfg.lgcOut4d,
+                   varPar=cfg.varPar)
+        if cfg.lgcSdcr:
+            export_sdcr(aryPrfRes, aryLgcMsk, aryAff, cfg.strPathOut)
+
+        # Remove memory-mapped results:
+        del(aryPrfRes)
+        os.remove(strPathRes)
+
     # *************************************************************************
 
+    else:
+
+        # *********************************************************************
+        # *** Create or load pRF time course models
+
+        # Existing pRF time course models are loaded from disk in the
+        # background, so that loading overlaps with the preprocessing of the
+        # functional data. If preprocessing forks processes (i.e. if `varPar`
+        # is greater than one), models are loaded in a spawned process,
+        # because a forked process may inherit locks held by a loading
+        # thread. Models may be created (or returned) for one run only, if
+        # runs with the same stimulus sequence are averaged (see below).
+        lgcBckgrnd = not cfg.lgcCrteMdl
+
+        if lgcBckgrnd:
+            if cfg.varPar == 1:
+                objMdl = cls_bckgrnd(model_creation, dicCnfg, lgcAvg=True)
+            else:
+                objMdl = cls_bckgrnd_prc(model_creation, dicCnfg,
+                                         lgcAvg=True)
+            objMdl.start()
+        else:
+            # Create pRF time course models, or load them from disk:
+            aryPrfTc = model_creation(dicCnfg, lgcAvg=True)
+        # *********************************************************************
+
+        # *********************************************************************
+        # *** Preprocessing
+
+        # Preprocessing of functional data:
+        aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp = \
+            pre_pro_func(cfg.strPathNiiMask, cfg.lstPathNiiFunc,
+                         lgcLinTrnd=cfg.lgcLinTrnd,
+                         varSdSmthTmp=cfg.varSdSmthTmp,
+                         varSdSmthSpt=cfg.varSdSmthSpt,
+                         varPar=cfg.varPar, strPathCch=cfg.strPathCch,
+                         varTr=cfg.varTr)
+
+        # Wait for pRF time course models to be loaded:
+        if lgcBckgrnd:
+            aryPrfTc = objMdl.get()
+            del(objMdl)
+
+        # Average runs with the same stimulus sequence (if the models have
+        # been created for one run only):
+        if ((cfg.strAvgRun != 'none')
+                and (aryPrfTc.shape[3] < aryFunc.shape[1])):
+            aryFunc = pre_pro_avg(aryFunc, len(cfg.lstPathNiiFunc))
+
+        # Preprocessing of pRF model time courses:
+        aryPrfTc = pre_pro_models(aryPrfTc, varSdSmthTmp=cfg.varSdSmthTmp,
+                                  varPar=cfg.varPar)
+        # *********************************************************************
+
+        # *********************************************************************
+        # *** Screening of voxels
+
+        # Voxels for which no model can reach the screening threshold are
+        # skipped (see `scr_vox`):
+        vecLgcScr = np.ones(aryFunc.shape[0], dtype=bool)
+        if 0.0 < cfg.varThrScr:
+            print('------Screening of voxels')
+            varTmeScr = time.time()
+            vecLgcScr = np.greater(
+                scr_vox(aryFunc, crt_bss_scr(aryPrfTc, cfg.varRnkScr)),
+                cfg.varThrScr)
+            aryFunc = aryFunc[vecLgcScr, :]
+            print('---------Elapsed time: '
+                  + str(np.around((time.time() - varTmeScr), decimals=3))
+                  + ' s')
+            print('---------Skipped voxels: '
+                  + str(int(np.sum(~vecLgcScr))) + ' out of '
+                  + str(vecLgcScr.size))
+        # *********************************************************************
+
+        # *********************************************************************
+        # *** Find pRF models for voxel time courses
+
+        varTmeFit = time.time()
+        if 0 < cfg.varSpcLtc:
+            # Starting from the fits of a sparse lattice of voxels:
+            aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 = find_prf_spt(
+                dicCnfg, aryFunc, aryPrfTc,
+                crt_vox_pos(aryLgcMsk, aryLgcVar, tplNiiShp)[vecLgcScr, :])
+        else:
+            # Optionally retaining the best fitting models of each voxel, and
+            # calculating the posterior of the pRF parameters:
+            tplRes = find_prf(dicCnfg, aryFunc, aryPrfTc,
+                              strPathChk=strPathChk, lgcResume=lgcResume,
+                              lgcTopK=(1 < cfg.varNumTopK),
+                              lgcPst=cfg.lgcPst)
+            aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 = tplRes[0:4]
+            if 1 < cfg.varNumTopK:
+                aryTopIdx, aryTopRes, aryTopR2 = tplRes[4:7]
+            if cfg.lgcPst:
+                aryPst = tplRes[-1]
+            del(tplRes)
+        varTmeFit = time.time() - varTmeFit
+
+        # P-values of R2 values from surrogate data:
+        if 0 < cfg.varNumSrgt:
+            vecPval = find_prf_null(dicCnfg, aryFunc, aryPrfTc, aryBstR2)
+
+        # Best fitting pairs of models (two Gaussians):
+        if cfg.lgcPair:
+            aryPair = find_prf_pair(dicCnfg, aryFunc, aryPrfTc)
+        del(aryFunc)
+
+        # Skipped voxels are set to zero:
+        if 0.0 < cfg.varThrScr:
+            aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 = expnd_res(
+                [aryBstXpos, aryBstYpos, aryBstSd, aryBstR2], vecLgcScr)
+            print('------Estimated time saved by screening: '
+                  + str(np.around((varTmeFit * np.sum(~vecLgcScr)
+                                   / max(1, np.sum(vecLgcScr))), decimals=3))
+                  + ' s')
+        # *********************************************************************
+
+        # *********************************************************************
+        # *** Export results
+
+        # Put results into original image dimensions:
+        aryPrfRes = asmbl_prf_res(aryBstXpos, aryBstYpos, aryBstSd,
+                                  aryBstR2, aryLgcMsk, aryLgcVar, tplNiiShp)
+
+        # Save nii files:
+        export_nii(aryPrfRes, hdrMsk, aryAff, cfg.strPathOut,
+                   varCmprLvl=cfg.varCmprLvl, lgcOut4d=cfg.lgcOut4d,
+                   varPar=cfg.varPar)
+
+        # Save npz file:
+        if cfg.lgcSdcr:
+            export_sdcr(aryPrfRes, aryLgcMsk, aryAff, cfg.strPathOut)
+
+        # Save posterior of pRF parameters (voxels skipped by the screening are
+        # set to zero):
+        if cfg.lgcPst:
+            aryPst = np.stack(expnd_res(list(aryPst.T), vecLgcScr), axis=1)
+            export_pst(aryPst, aryLgcMsk, aryLgcVar, tplNiiShp, hdrMsk,
+                       aryAff, cfg.strPathOut, varCmprLvl=cfg.varCmprLvl)
+
+        # Save best fitting pairs of models (voxels skipped by the screening
+        # are set to zero):
+        if cfg.lgcPair:
+            aryPair = np.stack(expnd_res(list(aryPair.T), vecLgcScr), axis=1)
+            export_pair(aryPair, aryLgcMsk, aryLgcVar, tplNiiShp, hdrMsk,
+                        aryAff, cfg.strPathOut, varCmprLvl=cfg.varCmprLvl)
+
+        # Save p-values of R2 values, and R2 map thresholded at the false
+        # discovery rate (voxels skipped by the screening have a p-value of
+        # one):
+        if 0 < cfg.varNumSrgt:
+            vecTmp = np.ones(vecLgcScr.shape, dtype=np.float32)
+            vecTmp[vecLgcScr] = vecPval
+            vecPval = vecTmp
+            varThrFdr = fdr_thr(vecPval, cfg.varQFdr)
+            print('------Voxels with significant R2 value (false discovery '
+                  + 'rate ' + str(cfg.varQFdr) + '): '
+                  + str(int(np.sum(np.less_equal(vecPval, varThrFdr)))))
+            for vecMap, strSfx in zip(
+                    [vecPval,
+                     np.where(np.less_equal(vecPval, varThrFdr), aryBstR2,
+                              0.0)],
+                    ['_R2_pval', '_R2_fdr']):
+                aryMap = np.zeros(aryLgcMsk.shape, dtype=np.float32)
+                aryMap[np.flatnonzero(aryLgcMsk)[aryLgcVar]] = vecMap
+                aryMap = np.reshape(aryMap, tplNiiShp[0:3])
+                export_map(aryMap, hdrMsk, aryAff, (cfg.strPathOut + strSfx),
+                           varCmprLvl=cfg.varCmprLvl)
+
+        # Save best fitting models of each voxel (voxels skipped by the
+        # screening are not included):
+        if 1 < cfg.varNumTopK:
+            export_topk(aryTopIdx, aryTopRes, aryTopR2,
+                        np.flatnonzero(aryLgcMsk)[aryLgcVar][vecLgcScr],
+                        tplNiiShp, aryAff, crt_mdl_prms(dicCnfg),
+                        cfg.strPathOut)
+
+        # Save map of voxels skipped by the screening:
+        if 0.0 < cfg.varThrScr:
+            arySkp = np.zeros(aryLgcMsk.shape, dtype=np.float32)
+            arySkp[np.flatnonzero(aryLgcMsk)[aryLgcVar]] = ~vecLgcScr
+            arySkp = np.reshape(arySkp, tplNiiShp[0:3])
+            export_map(arySkp, hdrMsk, aryAff, (cfg.strPathOut + '_skipped'),
+                       varCmprLvl=cfg.varCmprLvl)
+        # *********************************************************************
+
+    # Remove checkpoint (results have been exported):
+    if strPathChk is not None:
+        shutil.rmtree(strPathChk, ignore_errors=True)
+
     # *************************************************************************
     # *** Report time
 
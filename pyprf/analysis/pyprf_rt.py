@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""Real-time pRF mapping, updated with every new volume."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from pyprf.analysis.load_config import load_config
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.utilities import load_nii
+from pyprf.analysis.model_creation_main import model_creation
+from pyprf.analysis.find_prf_main import crt_mdl_prms
+from pyprf.analysis.find_prf_suff import crt_mdl_prms_flat
+from pyprf.analysis.find_prf_suff import crt_suff
+from pyprf.analysis.find_prf_suff import add_suff
+from pyprf.analysis.find_prf_suff import find_prf_suff
+from pyprf.analysis.export_results import asmbl_prf_res
+from pyprf.analysis.export_results import export_nii
+
+# Interval at which the input directory is checked for new volumes [s]:
+varTmePoll = 0.2
+
+
+class cls_rt_prf(object):
+    """
+    Incremental pRF finding, updated with every new volume.
+
+    Parameters
+    ----------
+    aryPrfTc : np.array
+        Array with pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+    aryMask : np.array
+        3D array with mask; voxels with values greater than zero are included.
+    vecMdlXpos, vecMdlYpos, vecMdlSd : np.array
+        1D arrays with pRF model parameters (see `crt_mdl_prms`).
+    varSdSmthSpt : float
+        Extent of spatial smoothing, in voxels (SD of Gaussian kernel), applied
+        to each volume. No smoothing if zero.
+    varNumBuf : int
+        Number of volumes that are collected before the sufficient statistics
+        are updated (the update is always performed before results are
+        returned).
+
+    Notes
+    -----
+    For each model and voxel, the sufficient statistics for a linear
+    regression with the model time course and a constant term (sums of cross
+    products, sums, and sums of squares) are updated with every new volume
+    (see `crt_suff`), so that the best fitting models for the volumes acquired
+    so far can be obtained at any time (see `find_prf_suff`), at a cost that
+    does not depend on the number of volumes. Volumes are added with
+    `add_vol()`, and results are obtained with `get_res()`. Because linear
+    trend removal and temporal smoothing require the complete time series,
+    they are not performed (neither for the data nor for the models).
+    """
+
+    def __init__(self, aryPrfTc, aryMask, vecMdlXpos, vecMdlYpos, vecMdlSd,
+                 varSdSmthSpt=0.0, varNumBuf=10):
+        """Prepare incremental pRF finding."""
+        # Model time courses, with shape aryMdl[model, time]:
+        self.aryMdl = np.reshape(aryPrfTc, (-1, aryPrfTc.shape[3]))
+        self.vecMdlXpos, self.vecMdlYpos, self.vecMdlSd = crt_mdl_prms_flat(
+            vecMdlXpos, vecMdlYpos, vecMdlSd)
+        self.tplNiiShp = aryMask.shape[0:3]
+        self.aryLgcMsk = np.greater(aryMask.flatten(), 0)
+        self.varSdSmthSpt = varSdSmthSpt
+        self.varNumBuf = varNumBuf
+        # Volumes that have not been added to the sufficient statistics yet:
+        self.lstBuf = []
+        # Sufficient statistics, and number of volumes added to them:
+        self.tplSuff = None
+        self.varNumVol = 0
+        # Offset subtracted from the voxel time courses (first volume), in
+        # order to avoid loss of precision in the sums of squares (the offset
+        # does not affect the results, because a constant term is fitted):
+        self.vecOfst = None
+
+    def get_num_vol(self):
+        """Get number of volumes added so far."""
+        return self.varNumVol + len(self.lstBuf)
+
+    def add_vol(self, aryVol):
+        """
+        Add a new volume.
+
+        Parameters
+        ----------
+        aryVol : np.array
+            3D array with new volume (same dimensions as mask).
+        """
+        if self.get_num_vol() >= self.aryMdl.shape[1]:
+            raise ValueError(('Number of volumes exceeds length of pRF time '
+                              + 'course models (' + str(self.aryMdl.shape[1])
+                              + ')'))
+        if 0.0 < self.varSdSmthSpt:
+            aryVol = gaussian_filter(aryVol.astype(np.float32),
+                                     self.varSdSmthSpt,
+                                     order=0,
+                                     mode='nearest',
+                                     truncate=4.0)
+        vecVol = aryVol.flatten()[self.aryLgcMsk].astype(np.float64)
+        if self.vecOfst is None:
+            self.vecOfst = vecVol
+        self.lstBuf.append(vecVol - self.vecOfst)
+        if len(self.lstBuf) >= self.varNumBuf:
+            self.upd()
+
+    def upd(self):
+        """Add buffered volumes to sufficient statistics."""
+        if not self.lstBuf:
+            return
+        varNumBuf = len(self.lstBuf)
+        self.tplSuff = add_suff(
+            self.tplSuff,
+            crt_suff(self.aryMdl[:, self.varNumVol:(self.varNumVol
+                                                     + varNumBuf)],
+                     np.stack(self.lstBuf, axis=1)))
+        self.varNumVol += varNumBuf
+        self.lstBuf = []
+
+    def get_res(self):
+        """
+        Get pRF finding results for the volumes added so far.
+
+        Returns
+        -------
+        aryPrfRes : np.array
+            4D array with pRF finding results (see `asmbl_prf_res`). Voxels
+            without variance over time are set to zero.
+        """
+        self.upd()
+        if self.varNumVol < 2:
+            raise ValueError('At least two volumes are needed')
+        vecIdxBst, vecBstR2 = find_prf_suff(self.tplSuff)
+        # Voxels without variance over time:
+        vecYy = self.tplSuff[4] - (np.square(self.tplSuff[3])
+                                   / self.varNumVol)
+        aryLgcVar = np.greater(vecYy, 0.0)
+        vecIdxBst = vecIdxBst[aryLgcVar]
+        return asmbl_prf_res(self.vecMdlXpos[vecIdxBst],
+                             self.vecMdlYpos[vecIdxBst],
+                             self.vecMdlSd[vecIdxBst],
+                             vecBstR2[aryLgcVar],
+                             self.aryLgcMsk,
+                             aryLgcVar,
+                             self.tplNiiShp)
+
+
+def pyprf_rt(strCsvCnfg, strDirIn, lgcTest=False, varExpIntv=10,  #noqa
+             varTmeOut=60.0):
+    """
+    Real-time pRF mapping, with volumes read from a directory.
+
+    Parameters
+    ----------
+    strCsvCnfg : str
+        Absolute file path of config file. The functional data in the config
+        file are ignored (they are read from `strDirIn` instead).
+    strDirIn : str
+        Directory that is watched for new volumes (nii files, e.g. exported
+        by the scanner). Files are processed in alphabetical order, so file
+        names need to be zero-padded. Each file can contain a single volume,
+        or several volumes (4D).
+    lgcTest : Boolean
+        Whether this is a test (pytest). If yes, absolute path of pyprf libary
+        will be prepended to config file paths.
+    varExpIntv : int
+        Results are exported after every `varExpIntv` volumes (and once all
+        volumes have been processed).
+    varTmeOut : float
+        Time [s] after which the analysis is stopped if no new volumes
+        arrive.
+
+    Notes
+    -----
+    The analysis stops when the number of volumes of the pRF time course
+    models has been reached, or when no new volumes have arrived for
+    `varTmeOut` seconds. Intermediate & final results are exported to
+    `strPathOut` (as in `pyprf`). Files that cannot be loaded (e.g. because
+    they are still being written) are retried. See `cls_rt_prf` for the
+    in-process interface.
+    """
+    print('---pRF analysis (real-time)')
+
+    # Load config parameters from csv file into dictionary:
+    dicCnfg = load_config(strCsvCnfg, lgcTest=lgcTest)
+    if dicCnfg['strAvgRun'] != 'none':
+        raise ValueError(('Averaging of runs (strAvgRun) is not supported in '
+                          + 'real-time mode'))
+
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    # Convert spatial smoothing parameter from SI units (i.e. [mm]) into
+    # units of data array (voxels):
+    cfg.varSdSmthSpt = np.divide(cfg.varSdSmthSpt, cfg.varVoxRes)
+
+    # Create or load pRF time course models:
+    aryPrfTc = model_creation(dicCnfg)
+    vecMdlXpos, vecMdlYpos, vecMdlSd = crt_mdl_prms(dicCnfg)
+
+    aryMask, hdrMsk, aryAff = load_nii(cfg.strPathNiiMask)
+
+    objRt = cls_rt_prf(aryPrfTc, aryMask, vecMdlXpos, vecMdlYpos, vecMdlSd,
+                       varSdSmthSpt=float(cfg.varSdSmthSpt))
+    varNumVolTlt = aryPrfTc.shape[3]
+    del(aryPrfTc)
+
+    def export():
+        export_nii(objRt.get_res(), hdrMsk, aryAff, cfg.strPathOut,
+                   varCmprLvl=cfg.varCmprLvl, lgcOut4d=cfg.lgcOut4d,
+                   varPar=cfg.varPar)
+
+    print('------Waiting for volumes in ' + strDirIn)
+
+    setDne = set()
+    varTmeLst = time.time()
+    varNumExp = 0
+
+    while objRt.get_num_vol() < varNumVolTlt:
+
+        varNumVolBfr = objRt.get_num_vol()
+
+        lstNew = sorted([strTmp for strTmp in os.listdir(strDirIn)
+                         if (strTmp.endswith(('.nii', '.nii.gz'))
+                             and strTmp not in setDne)])
+
+        for strTmp in lstNew:
+            try:
+                aryNii = load_nii(os.path.join(strDirIn, strTmp))[0]
+            except Exception:
+                # File is probably still being written, retry later (files
+                # are processed in order, so the remaining files wait, too):
+                break
+            setDne.add(strTmp)
+            if aryNii.ndim == 3:
+                aryNii = aryNii[:, :, :, None]
+            for idxVol in range(aryNii.shape[3]):
+                if objRt.get_num_vol() < varNumVolTlt:
+                    objRt.add_vol(aryNii[:, :, :, idxVol])
+            varTmeLst = time.time()
+
+        if (objRt.get_num_vol() // varExpIntv) > varNumExp:
+            varTme01 = time.time()
+            varNumExp = objRt.get_num_vol() // varExpIntv
+            export()
+            print('---------Volume ' + str(objRt.get_num_vol()) + ' out of '
+                  + str(varNumVolTlt) + ', results updated in '
+                  + str(np.around((time.time() - varTme01), decimals=3))
+                  + ' s')
+
+        if (time.time() - varTmeLst) > varTmeOut:
+            print('------No new volumes for ' + str(varTmeOut) + ' s, '
+                  + 'stopping')
+            break
+
+        if objRt.get_num_vol() == varNumVolBfr:
+            time.sleep(varTmePoll)
+
+    # Final results:
+    if objRt.get_num_vol() > 1:
+        export()
+    print('------Number of volumes: ' + str(objRt.get_num_vol()))
+    print('---Done.')
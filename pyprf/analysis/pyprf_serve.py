@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""Local pRF mapping service, keeping pRF models in memory."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import traceback
+import socketserver
+import numpy as np
+import multiprocessing as mp
+
+from pyprf.analysis.load_config import load_config
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.utilities import cls_bckgrnd_prc
+from pyprf.analysis.model_creation_main import model_creation
+from pyprf.analysis.preprocessing_main import pre_pro_models
+from pyprf.analysis.preprocessing_main import pre_pro_func
+from pyprf.analysis.find_prf_main import crt_mdl_prms
+from pyprf.analysis.export_results import asmbl_prf_res
+from pyprf.analysis.export_results import export_nii
+from pyprf.analysis.export_results import export_sdcr
+
+# Model banks in worker processes (bank name as key, see `init_worker`):
+dicBnkWrk = {}
+
+
+def init_worker(dicBnk):
+    """Make model banks available in worker process."""
+    dicBnkWrk.update(dicBnk)
+
+
+def fit_chunk(strBnk, idxChnk, aryFuncChnk):
+    """
+    Find pRF models for one chunk of voxels, in a worker process.
+
+    Parameters
+    ----------
+    strBnk : str
+        Name of model bank.
+    idxChnk : int
+        Index of chunk.
+    aryFuncChnk : np.array
+        2D array with preprocessed functional data of chunk, with shape
+        aryFuncChnk[voxel, time].
+
+    Returns
+    -------
+    lstOut : list
+        Index of chunk, followed by best fitting x-position, y-position, pRF
+        size, and R2 value for each voxel (see `find_prf_cpu`).
+    """
+    dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd, aryPrfTc = dicBnkWrk[strBnk]
+    cfg = cls_set_config(dicCnfg)
+
+    # The fitting functions put their results into a queue:
+    queOut = queue.Queue()
+
+    if cfg.strVersion == 'gpu':
+        from pyprf.analysis.find_prf_gpu import find_prf_gpu
+        find_prf_gpu(idxChnk, vecMdlXpos, vecMdlYpos, vecMdlSd, aryFuncChnk,
+                     aryPrfTc, queOut)
+    else:
+        from pyprf.analysis.find_prf_cpu import find_prf_cpu
+        find_prf_cpu(idxChnk, dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd,
+                     aryFuncChnk, aryPrfTc, cfg.strVersion, queOut)
+
+    return queOut.get()
+
+
+def load_bank(strCsvCnfg, lgcTest=False):
+    """
+    Load config & create (or load) and preprocess pRF models.
+
+    Parameters
+    ----------
+    strCsvCnfg : str
+        Absolute file path of config file.
+    lgcTest : Boolean
+        Whether this is a test (pytest).
+
+    Returns
+    -------
+    tplBnk : tuple
+        Config parameters (with extent of smoothing in volumes and voxels),
+        vectors with model x-positions, y-positions and sizes, and 4D array
+        with preprocessed pRF time course models.
+    """
+    dicCnfg = load_config(strCsvCnfg, lgcTest=lgcTest)
+
+    # The service only implements the exhaustive search (see `fit_chunk`) and
+    # the export of the best fitting models. Options of `pyprf` that would
+    # change the outputs are not ignored silently:
+    if dicCnfg['strAvgRun'] != 'none':
+        raise ValueError(('Averaging of runs (strAvgRun) is not supported by '
+                          + 'the service'))
+    if ((0 < dicCnfg['varNumClst'])
+            or (0 < dicCnfg['varSzeSktch'])
+            or (1 < dicCnfg['varNumTopK'])
+            or dicCnfg['lgcPst']
+            or (0 < dicCnfg['varSpcLtc'])
+            or (0.0 < dicCnfg['varThrScr'])
+            or (0 < dicCnfg['varNumSrgt'])
+            or dicCnfg['lgcPair']
+            or dicCnfg['lgcSuff']
+            or dicCnfg['lgcXval']
+            or (0.0 < dicCnfg['varMemBdgt'])):
+        raise ValueError(('The service does not support the model index '
+                          + '(varNumClst), sketches (varSzeSktch), best '
+                          + 'fitting models (varNumTopK), posterior '
+                          + '(lgcPst), lattice (varSpcLtc), screening '
+                          + '(varThrScr), null distribution (varNumSrgt), '
+                          + 'pairs of models (lgcPair), sufficient '
+                          + 'statistics (lgcSuff, lgcXval), or slab-wise '
+                          + 'processing (varMemBdgt)'))
+
+    # Convert preprocessing parameters (for temporal and spatial smoothing)
+    # from SI units (i.e. [s] and [mm]) into units of data array (volumes and
+    # voxels):
+    dicCnfg['varSdSmthTmp'] = float(np.divide(dicCnfg['varSdSmthTmp'],
+                                              dicCnfg['varTr']))
+    dicCnfg['varSdSmthSpt'] = float(np.divide(dicCnfg['varSdSmthSpt'],
+                                              dicCnfg['varVoxRes']))
+
+    aryPrfTc = model_creation(dicCnfg)
+    aryPrfTc = pre_pro_models(aryPrfTc,
+                              varSdSmthTmp=dicCnfg['varSdSmthTmp'],
+                              varPar=dicCnfg['varPar']).astype(np.float32)
+
+    vecMdlXpos, vecMdlYpos, vecMdlSd = crt_mdl_prms(dicCnfg)
+
+    return dicCnfg, vecMdlXpos, vecMdlYpos, vecMdlSd, aryPrfTc
+
+
+def run_job(objPool, dicBnk, dicJob):
+    """
+    Run one pRF mapping job on the worker pool.
+
+    Parameters
+    ----------
+    objPool : multiprocessing.pool.Pool
+        Persistent worker pool (see `init_worker`).
+    dicBnk : dict
+        Model banks (bank name as key, see `load_bank`).
+    dicJob : dict
+        Job, with paths of functional runs ('func'), mask ('mask'), output
+        basename ('out'), and optionally name of model bank ('bank').
+    """
+    strBnk = dicJob.get('bank')
+    if strBnk is None:
+        if len(dicBnk) != 1:
+            raise ValueError(('Several model banks are loaded, please '
+                              + 'specify one of: ' + str(sorted(dicBnk))))
+        strBnk = list(dicBnk.keys())[0]
+    if strBnk not in dicBnk:
+        raise ValueError(('Unknown model bank: ' + str(strBnk)))
+
+    dicCnfg, _, _, _, aryPrfTc = dicBnk[strBnk]
+    cfg = cls_set_config(dicCnfg)
+
+    # Preprocessing of functional data. Preprocessing forks processes, which
+    # must not happen while other threads (of the server) are running, so it
+    # takes place in a spawned process:
+    objPre = cls_bckgrnd_prc(pre_pro_func, dicJob['mask'], dicJob['func'],
+                             lgcLinTrnd=cfg.lgcLinTrnd,
+                             varSdSmthTmp=cfg.varSdSmthTmp,
+                             varSdSmthSpt=cfg.varSdSmthSpt,
+                             varPar=cfg.varPar, strPathCch=cfg.strPathCch,
+                             varTr=cfg.varTr)
+    objPre.start()
+    aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp = objPre.get()
+    del(objPre)
+
+    if aryFunc.shape[1] != aryPrfTc.shape[3]:
+        raise ValueError(('Number of volumes of functional data ('
+                          + str(aryFunc.shape[1]) + ') does not match pRF '
+                          + 'time course models (' + str(aryPrfTc.shape[3])
+                          + ')'))
+
+    # Chunks of voxels (as in `find_prf`):
+    varNumVoxInc = aryFunc.shape[0]
+    if 0 < cfg.varChnkSze:
+        varNumChnk = max(cfg.varPar,
+                         int(np.ceil(np.divide(float(varNumVoxInc),
+                                               float(cfg.varChnkSze)))))
+    else:
+        varNumChnk = cfg.varPar
+    varNumChnk = max(1, min(varNumChnk, varNumVoxInc))
+    vecIdxChnks = np.linspace(0, varNumVoxInc, num=varNumChnk,
+                              endpoint=False)
+    vecIdxChnks = np.hstack((vecIdxChnks, varNumVoxInc)).astype(np.int64)
+
+    print('------Find pRF models for ' + str(varNumVoxInc) + ' voxels')
+
+    lstPrfRes = objPool.starmap(
+        fit_chunk,
+        [(strBnk, idxChnk,
+          np.asarray(aryFunc[vecIdxChnks[idxChnk]:vecIdxChnks[(idxChnk + 1)],
+                             :], dtype=np.float32))
+         for idxChnk in range(varNumChnk)])
+    del(aryFunc)
+
+    # Results are returned in the order of the chunks:
+    aryBstPrm = np.concatenate([np.stack(lstTmp[1:5], axis=1)
+                                for lstTmp in lstPrfRes], axis=0)
+
+    aryPrfRes = asmbl_prf_res(aryBstPrm[:, 0], aryBstPrm[:, 1],
+                              aryBstPrm[:, 2], aryBstPrm[:, 3], aryLgcMsk,
+                              aryLgcVar, tplNiiShp)
+    export_nii(aryPrfRes, hdrMsk, aryAff, dicJob['out'],
+               varCmprLvl=cfg.varCmprLvl, lgcOut4d=cfg.lgcOut4d,
+               varPar=cfg.varPar)
+    if cfg.lgcSdcr:
+        export_sdcr(aryPrfRes, aryLgcMsk, aryAff, dicJob['out'])
+
+
+class cls_srv_hndlr(socketserver.StreamRequestHandler):
+    """Handle one client connection (one request, as one line of JSON)."""
+
+    def handle(self):
+        """Put job into queue & wait for it to be completed."""
+        try:
+            dicReq = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            self.reply({'status': 'error', 'message': 'Invalid request'})
+            return
+
+        strCmd = dicReq.get('cmd', 'fit')
+
+        if strCmd == 'ping':
+            self.reply({'status': 'ok',
+                        'banks': sorted(self.server.dicBnk.keys()),
+                        'queued': self.server.queJob.qsize()})
+
+        elif strCmd == 'shutdown':
+            self.reply({'status': 'ok'})
+            # Has to be called from another thread than `serve_forever`:
+            self.server.objStp.set()
+            threading.Thread(target=self.server.shutdown).start()
+
+        elif strCmd == 'fit':
+            # The job runner sets the event once the job is completed. Jobs
+            # are not accepted anymore once the service is stopping (jobs
+            # that are still queued at that point are answered by the job
+            # runner, see `run_jobs`):
+            objEvnt = threading.Event()
+            dicRes = {}
+            with self.server.objLck:
+                lgcStp = self.server.objStp.is_set()
+                if not lgcStp:
+                    self.server.queJob.put((dicReq, objEvnt, dicRes))
+            if lgcStp:
+                self.reply({'status': 'error',
+                            'message': 'Service is shutting down'})
+                return
+            objEvnt.wait()
+            self.reply(dicRes)
+
+        else:
+            self.reply({'status': 'error',
+                        'message': 'Unknown command: ' + str(strCmd)})
+
+    def reply(self, dicRes):
+        """Send reply to client (as one line of JSON)."""
+        self.wfile.write((json.dumps(dicRes) + '\n').encode('utf-8'))
+
+
+class cls_srv(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server, with one thread per client connection."""
+
+    daemon_threads = True
+
+
+def run_jobs(objSrv, objPool):
+    """Run jobs from the queue, one after the other (job runner thread)."""
+    while not objSrv.objStp.is_set():
+        try:
+            dicJob, objEvnt, dicRes = objSrv.queJob.get(True, 1.0)
+        except queue.Empty:
+            continue
+        print('---Job: ' + str(dicJob.get('out')))
+        varTme01 = time.time()
+        try:
+            run_job(objPool, objSrv.dicBnk, dicJob)
+            dicRes.update({'status': 'ok',
+                           'time': (time.time() - varTme01)})
+        except Exception as objErr:
+            traceback.print_exc()
+            dicRes.update({'status': 'error', 'message': repr(objErr)})
+        print('---Job ' + dicRes['status'] + ': ' + str(dicJob.get('out')))
+        objEvnt.set()
+
+    # Jobs that are still queued are not run, but their clients are answered
+    # (no further jobs are queued once the service is stopping):
+    with objSrv.objLck:
+        while True:
+            try:
+                dicJob, objEvnt, dicRes = objSrv.queJob.get(False)
+            except queue.Empty:
+                break
+            print('---Job cancelled: ' + str(dicJob.get('out')))
+            dicRes.update({'status': 'error',
+                           'message': ('Service stopped before job was '
+                                       + 'run')})
+            objEvnt.set()
+
+
+def pyprf_serve(lstCsvCnfg, strPathSck, lgcTest=False):
+    """
+    Serve pRF mapping jobs over a local Unix socket.
+
+    Parameters
+    ----------
+    lstCsvCnfg : list
+        Absolute file paths of config files. One model bank is loaded per
+        config file, and named after the config file (without directory and
+        file extension).
+    strPathSck : str
+        Path of Unix socket (created).
+    lgcTest : Boolean
+        Whether this is a test (pytest).
+
+    Notes
+    -----
+    The pRF models of all banks are created (or loaded) and preprocessed
+    once, and a pool of `varPar` worker processes (of the first config file)
+    is started, which persists for the lifetime of the service. Jobs are
+    queued and run one after the other, each using all workers. A job is
+    submitted with `pyprf_submit` (`pyprf submit` at command line); the
+    functional data of the job are preprocessed with the parameters of the
+    model bank, and the results are exported with the usual file names
+    (see `export_nii`). On shutdown, the current job is completed, and jobs
+    that are still queued are answered with an error.
+    """
+    print('---pRF analysis service')
+
+    dicBnk = {}
+    for strCsvCnfg in lstCsvCnfg:
+        strBnk = os.path.splitext(os.path.basename(strCsvCnfg))[0]
+        print('---Loading model bank: ' + strBnk)
+        dicBnk[strBnk] = load_bank(strCsvCnfg, lgcTest=lgcTest)
+
+    # Persistent worker pool, with model banks in each worker (a single
+    # worker if the GPU is used):
+    varPar = list(dicBnk.values())[0][0]['varPar']
+    for tplBnk in dicBnk.values():
+        if tplBnk[0]['strVersion'] == 'gpu':
+            varPar = 1
+    objPool = mp.Pool(processes=varPar, initializer=init_worker,
+                      initargs=(dicBnk,))
+
+    if os.path.exists(strPathSck):
+        os.remove(strPathSck)
+    objSrv = cls_srv(strPathSck, cls_srv_hndlr)
+    objSrv.dicBnk = dicBnk
+    objSrv.queJob = queue.Queue()
+    objSrv.objStp = threading.Event()
+    objSrv.objLck = threading.Lock()
+
+    objRun = threading.Thread(target=run_jobs, args=(objSrv, objPool))
+    objRun.daemon = True
+    objRun.start()
+
+    print('---Listening on ' + strPathSck)
+
+    try:
+        objSrv.serve_forever()
+    finally:
+        objSrv.objStp.set()
+        objRun.join()
+        objSrv.server_close()
+        objPool.terminate()
+        objPool.join()
+        if os.path.exists(strPathSck):
+            os.remove(strPathSck)
+
+    print('---Done.')
+
+
+def pyprf_submit(strPathSck, dicReq):
+    """
+    Send request to pRF mapping service & wait for reply.
+
+    Parameters
+    ----------
+    strPathSck : str
+        Path of Unix socket of service.
+    dicReq : dict
+        Request. For a job, paths of functional runs ('func'), mask ('mask'),
+        output basename ('out'), and optionally name of model bank ('bank').
+        Other commands: `{'cmd': 'ping'}` and `{'cmd': 'shutdown'}`.
+
+    Returns
+    -------
+    dicRes : dict
+        Reply of service, with 'status' ('ok' or 'error') and, in case of an
+        error, 'message'.
+    """
+    objSck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        objSck.connect(strPathSck)
+        objSck.sendall((json.dumps(dicReq) + '\n').encode('utf-8'))
+        with objSck.makefile('rb') as fleIn:
+            strRes = fleIn.readline().decode('utf-8')
+    finally:
+        objSck.close()
+    if not strRes:
+        return {'status': 'error', 'message': 'No reply from service'}
+    return json.loads(strRes)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""Sharded pRF finding, for several processes or nodes sharing a disk."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import socket
+import numpy as np
+
+from pyprf.analysis.pyprf_stages import load_stg_config
+from pyprf.analysis.pyprf_stages import get_stg_status
+from pyprf.analysis.pyprf_stages import run_stages
+from pyprf.analysis.find_prf_main import find_prf
+
+# Interval at which shards check whether the preparation (model creation &
+# preprocessing) by another shard has been completed [s]:
+varTmePoll = 5.0
+
+
+def get_shrd_dir(dicCnfg, strDirStg):
+    """
+    Get directory for results of shards.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters (see `load_stg_config`).
+    strDirStg : str
+        Directory with outputs of stages.
+
+    Returns
+    -------
+    strDirShrd : str
+        Directory for results of shards (created if it does not exist). The
+        directory name contains the stamp of the fitting stage, so that
+        results of shards with different data or parameters are never mixed.
+    """
+    dicStmp, _ = get_stg_status(dicCnfg, strDirStg)
+    strDirShrd = os.path.join(strDirStg, 'shards', dicStmp['fit'][:16])
+    if not os.path.isdir(strDirShrd):
+        os.makedirs(strDirShrd)
+    return strDirShrd
+
+
+def get_chnk_name(idxChnk, varNumChnk):
+    """Get name of file with results of a chunk (without extension)."""
+    return ('chunk_' + str(idxChnk).zfill(6) + '_of_'
+            + str(varNumChnk).zfill(6))
+
+
+def is_stale(strPathLck):
+    """
+    Check whether the process that has claimed a lock file has died.
+
+    Parameters
+    ----------
+    strPathLck : str
+        Path of lock file.
+
+    Returns
+    -------
+    lgcStl : bool
+        `True` if the lock file has been claimed by a process on this host
+        that does not exist anymore. `False` otherwise, including for lock
+        files claimed on other hosts (which cannot be checked).
+    """
+    try:
+        with open(strPathLck, 'r') as fleIn:
+            strHost, strPid = fleIn.read().rsplit(':', 1)
+        varPid = int(strPid)
+    except (OSError, ValueError):
+        # Lock file has been removed, or is being written:
+        return False
+    if strHost != socket.gethostname():
+        return False
+    try:
+        os.kill(varPid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # Process exists (owned by another user):
+        return False
+    return False
+
+
+def claim(strPathLck):
+    """
+    Claim a lock file.
+
+    Parameters
+    ----------
+    strPathLck : str
+        Path of lock file.
+
+    Returns
+    -------
+    lgcClm : bool
+        `True` if the lock file has been created by this call, `False` if it
+        already existed.
+
+    Notes
+    -----
+    The lock file is created atomically (`O_CREAT | O_EXCL`), so that only
+    one process succeeds, also on shared file systems. It contains the host
+    name and process ID of the process that has claimed it. A lock file of a
+    process that has died on the same host is reclaimed (see `is_stale`).
+    Lock files of processes that have died on other hosts have to be removed
+    manually.
+    """
+    try:
+        varFd = os.open(strPathLck, (os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        if not is_stale(strPathLck):
+            return False
+        # The stale lock file is renamed before it is removed, so that only
+        # one process removes it:
+        strPathStl = strPathLck + '.' + str(os.getpid()) + '.stale'
+        try:
+            os.rename(strPathLck, strPathStl)
+        except FileNotFoundError:
+            return False
+        os.remove(strPathStl)
+        print('---------Removed stale lock file: ' + strPathLck)
+        return claim(strPathLck)
+    os.write(varFd, (socket.gethostname() + ':' + str(os.getpid()))
+             .encode('utf-8'))
+    os.close(varFd)
+    return True
+
+
+def prepare_shards(dicCnfg, strDirStg):
+    """
+    Create & preprocess models and functional data, once for all shards.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters (see `load_stg_config`).
+    strDirStg : str
+        Directory with outputs of stages.
+
+    Notes
+    -----
+    Model creation and preprocessing are run by the first shard only (which
+    claims a lock file in the stage directory). Other shards wait until the
+    outputs are up to date, and then use them. If a shard is killed during
+    the preparation, the lock file (`prepare.lock`) is reclaimed by the next
+    shard on the same host, or has to be removed manually (see `claim`).
+    """
+    strPathLck = os.path.join(strDirStg, 'prepare.lock')
+    lstPrp = ['model_preprocessing', 'func_preprocessing']
+
+    while True:
+        _, dicUpd = get_stg_status(dicCnfg, strDirStg)
+        if all([dicUpd[strTmp] for strTmp in lstPrp]):
+            return
+        if claim(strPathLck):
+            try:
+                run_stages(dicCnfg, strDirStg, lstPrp, lgcFrce=False)
+            finally:
+                os.remove(strPathLck)
+            return
+        print('---------Waiting for preparation by other shard')
+        time.sleep(varTmePoll)
+
+
+def pyprf_shard(strCsvCnfg, lgcTest=False, idxShrd=None, varNumShrd=None,
+                varNumChnk=100):
+    """
+    Find pRF models for one shard of the voxels.
+
+    Parameters
+    ----------
+    strCsvCnfg : str
+        Absolute file path of config file.
+    lgcTest : Boolean
+        Whether this is a test (pytest). If yes, absolute path of pyprf libary
+        will be prepended to config file paths.
+    idxShrd : int or None
+        Index of shard (static sharding, from 0 to `varNumShrd - 1`). If
+        `None`, chunks are claimed dynamically.
+    varNumShrd : int or None
+        Number of shards (static sharding).
+    varNumChnk : int
+        Number of chunks into which the voxels are separated (dynamic
+        sharding). All shards need to use the same number of chunks.
+
+    Notes
+    -----
+    With static sharding, the voxels are separated into `varNumShrd` chunks,
+    and the shard fits chunk `idxShrd`. With dynamic sharding, the voxels are
+    separated into `varNumChnk` chunks, and the shard claims one chunk after
+    the other (through lock files in the shard directory) until no chunks are
+    left, so that any number of shards can be started (e.g. on different
+    nodes with a shared file system). In both cases, models and preprocessed
+    functional data are taken from (or, by the first shard, written to) the
+    stage directory (see `pyprf_stages`), and the results of each chunk are
+    saved in the shard directory. Use `pyprf_merge` to assemble the results
+    once all chunks have been completed.
+    """
+    print('---pRF analysis (shard)')
+    varTme01 = time.time()
+
+    dicCnfg, strDirStg = load_stg_config(strCsvCnfg, lgcTest=lgcTest)
+
+    # Models & preprocessed functional data:
+    prepare_shards(dicCnfg, strDirStg)
+    aryFunc = np.load(os.path.join(strDirStg, 'aryFunc.npy'), mmap_mode='r')
+    aryPrfTc = np.load(os.path.join(strDirStg, 'aryPrfTcPre.npy'))
+
+    strDirShrd = get_shrd_dir(dicCnfg, strDirStg)
+
+    if idxShrd is None:
+        lstChnk = range(varNumChnk)
+    else:
+        varNumChnk = varNumShrd
+        lstChnk = [idxShrd]
+
+    # Indices at which the voxels are separated into chunks:
+    varNumVoxInc = aryFunc.shape[0]
+    vecIdxChnks = np.linspace(0, varNumVoxInc, num=varNumChnk,
+                              endpoint=False)
+    vecIdxChnks = np.hstack((vecIdxChnks, varNumVoxInc)).astype(np.int64)
+
+    for idxChnk in lstChnk:
+
+        strPathChnk = os.path.join(strDirShrd,
+                                   get_chnk_name(idxChnk, varNumChnk))
+
+        # Skip chunks that have been completed, or claimed by another shard
+        # (dynamic sharding only):
+        if os.path.isfile(strPathChnk + '.npy'):
+            continue
+        if (idxShrd is None) and (not claim(strPathChnk + '.lock')):
+            continue
+
+        print('------Chunk ' + str(idxChnk + 1) + ' out of '
+              + str(varNumChnk))
+
+        aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 = find_prf(
+            dicCnfg,
+            aryFunc[vecIdxChnks[idxChnk]:vecIdxChnks[(idxChnk + 1)], :],
+            aryPrfTc)
+
+        # Results are written to a temporary file first, so that incomplete
+        # results are never picked up by `pyprf_merge`:
+        strPathTmp = strPathChnk + '.' + str(os.getpid()) + '.tmp.npy'
+        np.save(strPathTmp, np.stack((aryBstXpos, aryBstYpos, aryBstSd,
+                                      aryBstR2), axis=1))
+        os.rename(strPathTmp, (strPathChnk + '.npy'))
+
+    varTme02 = time.time()
+    varTme03 = varTme02 - varTme01
+    print('---Elapsed time: ' + str(varTme03) + ' s')
+    print('---Done.')
+
+
+def pyprf_merge(strCsvCnfg, lgcTest=False):
+    """
+    Assemble results of shards & export them.
+
+    Parameters
+    ----------
+    strCsvCnfg : str
+        Absolute file path of config file.
+    lgcTest : Boolean
+        Whether this is a test (pytest). If yes, absolute path of pyprf libary
+        will be prepended to config file paths.
+
+    Notes
+    -----
+    The results of all chunks (for the same number of chunks) are put into
+    the stage directory as output of the fitting stage, and the export stage
+    is run, which creates the usual nii files (see `export_nii`).
+    """
+    print('---pRF analysis (merge shards)')
+
+    dicCnfg, strDirStg = load_stg_config(strCsvCnfg, lgcTest=lgcTest)
+    dicStmp, _ = get_stg_status(dicCnfg, strDirStg)
+    strDirShrd = get_shrd_dir(dicCnfg, strDirStg)
+
+    # Number of chunks (from file names of completed chunks):
+    lstNumChnk = sorted(set([int(strTmp[-10:-4])
+                             for strTmp in os.listdir(strDirShrd)
+                             if (strTmp.startswith('chunk_')
+                                 and strTmp.endswith('.npy')
+                                 and not strTmp.endswith('.tmp.npy'))]))
+    if len(lstNumChnk) != 1:
+        raise RuntimeError(('Results of shards not found, or results with '
+                            + 'different numbers of chunks found, in '
+                            + strDirShrd))
+    varNumChnk = lstNumChnk[0]
+
+    lstPathChnk = [os.path.join(strDirShrd, get_chnk_name(idxChnk,
+                                                          varNumChnk))
+                   for idxChnk in range(varNumChnk)]
+    lstMsng = [strTmp for strTmp in lstPathChnk
+               if not os.path.isfile(strTmp + '.npy')]
+    if lstMsng:
+        raise RuntimeError(('Results of ' + str(len(lstMsng)) + ' out of '
+                            + str(varNumChnk) + ' chunks are missing, e.g. '
+                            + lstMsng[0] + '.npy (if the shard processing '
+                            + 'this chunk has died on another host, remove '
+                            + 'the lock file & run another shard).'))
+
+    aryBstPrm = np.concatenate([np.load(strTmp + '.npy')
+                                for strTmp in lstPathChnk], axis=0)
+
+    # Results become the output of the fitting stage:
+    np.save(os.path.join(strDirStg, 'aryBstPrm.npy'), aryBstPrm)
+    with open(os.path.join(strDirStg, 'fit.stamp'), 'w') as fleOut:
+        fleOut.write(dicStmp['fit'])
+
+    run_stages(dicCnfg, strDirStg, ['export'], lgcFrce=True)
+
+    print('---Done.')
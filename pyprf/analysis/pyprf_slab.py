@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Slab-wise pRF finding for large datasets."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+import nibabel as nb
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.utilities import load_nii
+from pyprf.analysis.preprocessing_main import pre_pro_func
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.export_results import asmbl_prf_res
+
+# Approximate number of copies of the functional data of one slab that exist
+# at the same time during preprocessing (loaded data, masked & reshaped data,
+# intermediate results of the parallelised functions, concatenated runs):
+varFctPrePro = 4.0
+
+
+def get_slab_size(tplNiiShp, varNumVolTlt, varSzeMdl, varMemBdgt, varPar,
+                  varHalo=0):
+    """
+    Determine number of slices per slab, given a memory budget.
+
+    Parameters
+    ----------
+    tplNiiShp : tuple
+        Spatial dimensions of the functional data (x, y, z).
+    varNumVolTlt : int
+        Total number of volumes (across all runs).
+    varSzeMdl : int
+        Size of the pRF time course models [bytes].
+    varMemBdgt : float
+        Memory budget [MB].
+    varPar : int
+        Number of processes to run in parallel.
+    varHalo : int
+        Number of slices that are added on each side of a slab during
+        preprocessing (for spatial smoothing).
+
+    Returns
+    -------
+    varNumSlc : int
+        Number of slices per slab (at least one).
+
+    Notes
+    -----
+    The memory estimate is approximate. Each parallel process for pRF finding
+    holds its own (demeaned) copy of the pRF time course models.
+    """
+    # Memory needed for pRF time course models [bytes]:
+    varMemMdl = float(varSzeMdl) * float(varPar + 1)
+
+    # Memory needed per slice of functional data [bytes]:
+    varMemSlc = (float(tplNiiShp[0] * tplNiiShp[1] * varNumVolTlt)
+                 * 4.0
+                 * varFctPrePro)
+
+    # Number of slices that fit into the budget (including halo):
+    varNumSlc = int(np.floor(np.divide(((varMemBdgt * 1000000.0)
+                                        - varMemMdl),
+                                       varMemSlc)))
+    varNumSlc = varNumSlc - (2 * varHalo)
+
+    if varNumSlc < 1:
+        print('---------WARNING: Memory budget is too small for one slice '
+              + 'per slab, will use one slice per slab anyway.')
+        varNumSlc = 1
+
+    return min(varNumSlc, tplNiiShp[2])
+
+
+def pyprf_slab(dicCnfg, aryPrfTc, varSdSmthTmp, varSdSmthSpt, strPathRes,
+               strPathChk=None, lgcResume=False):
+    """
+    Preprocess functional data & find pRF models slab by slab.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    aryPrfTc : np.array
+        4D array with preprocessed pRF time course models, with shape
+        aryPrfTc[x-pos, y-pos, SD, time].
+    varSdSmthTmp : float
+        Extent of temporal smoothing [SD of Gaussian kernel, in volumes].
+    varSdSmthSpt : float
+        Extent of spatial smoothing [SD of Gaussian kernel, in voxels].
+    strPathRes : str
+        Path of npy file for memory-mapped results (created).
+    strPathChk : str or None
+        Directory for checkpoints of pRF finding results (see `find_prf`).
+    lgcResume : bool
+        Whether to resume from existing checkpoints (see `find_prf`).
+
+    Returns
+    -------
+    aryPrfRes : np.memmap
+        4D array with pRF finding results, memory-mapped from `strPathRes`
+        (see `export_results.asmbl_prf_res` for format).
+    hdrMsk : nibabel-header-object
+        Nii header of mask.
+    aryAff : np.array
+        Array containing 'affine' of mask.
+    aryLgcMsk : np.array
+        1D logical array (one value per voxel in the volume), voxels that are
+        `False` are outside of the mask.
+
+    Notes
+    -----
+    The volume is divided into slabs along the z-dimension. Each slab is
+    loaded, preprocessed, and fitted, and the results are written to the
+    memory-mapped result volume before the next slab is processed. The
+    number of slices per slab is chosen such that peak memory usage stays
+    within the memory budget specified in the config file (`varMemBdgt`).
+    """
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    print('------Slab-wise pRF finding')
+
+    # Load mask (small, only used to determine slabs). The mask is binarised
+    # in the same way as in `pre_pro_func`:
+    aryMask, hdrMsk, aryAff = load_nii(cfg.strPathNiiMask)
+    aryMask = np.greater(np.array(aryMask).astype(np.int16), 0)
+
+    # Spatial dimensions of data:
+    tplNiiShp = aryMask.shape
+
+    # Total number of volumes across runs (without loading data):
+    varNumVolTlt = 0
+    for strPathNiiFunc in cfg.lstPathNiiFunc:
+        varNumVolTlt += nb.load(strPathNiiFunc).shape[3]
+
+    # Halo for spatial smoothing (see `pre_pro_func`):
+    if 0.0 < varSdSmthSpt:
+        varHalo = int(4.0 * float(varSdSmthSpt) + 0.5)
+    else:
+        varHalo = 0
+
+    # Number of slices per slab:
+    varNumSlc = get_slab_size(tplNiiShp, varNumVolTlt, aryPrfTc.nbytes,
+                              cfg.varMemBdgt, cfg.varPar, varHalo=varHalo)
+
+    # Number of slabs:
+    varNumSlb = int(np.ceil(np.divide(float(tplNiiShp[2]),
+                                      float(varNumSlc))))
+
+    print('---------Memory budget: ' + str(cfg.varMemBdgt) + ' MB')
+    print('---------Number of slabs: ' + str(varNumSlb) + ' ('
+          + str(varNumSlc) + ' slices per slab, halo of ' + str(varHalo)
+          + ' slices)')
+
+    # Memory-mapped array for results:
+    aryPrfRes = np.lib.format.open_memmap(strPathRes,
+                                          mode='w+',
+                                          dtype=np.float32,
+                                          shape=(tplNiiShp[0],
+                                                 tplNiiShp[1],
+                                                 tplNiiShp[2],
+                                                 6))
+
+    for idxSlb in range(varNumSlb):
+
+        # First and (exclusive) last slice of current slab:
+        tplSlb = ((idxSlb * varNumSlc),
+                  min(tplNiiShp[2], ((idxSlb + 1) * varNumSlc)))
+
+        print('---------Slab ' + str(idxSlb + 1) + ' out of '
+              + str(varNumSlb) + ' (slices ' + str(tplSlb[0]) + ' to '
+              + str(tplSlb[1] - 1) + ')')
+
+        # Skip slabs without voxels in the mask:
+        if not np.any(aryMask[:, :, tplSlb[0]:tplSlb[1]]):
+            print('------------No voxels in mask, skipping slab')
+            continue
+
+        # Preprocessing of functional data of current slab:
+        aryLgcMsk, _, _, aryLgcVar, aryFunc, tplSlbShp = pre_pro_func(
+            cfg.strPathNiiMask, cfg.lstPathNiiFunc, lgcLinTrnd=cfg.lgcLinTrnd,
+            varSdSmthTmp=varSdSmthTmp, varSdSmthSpt=varSdSmthSpt,
+            varPar=cfg.varPar, tplSlb=tplSlb)
+
+        # Skip slabs without voxels with sufficient variance:
+        if aryFunc.shape[0] == 0:
+            print('------------No voxels with sufficient variance, skipping '
+                  + 'slab')
+            continue
+
+        # Find pRF models for voxels in current slab:
+        aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 = find_prf(
+            dicCnfg, aryFunc, aryPrfTc, strPathChk=strPathChk,
+            lgcResume=lgcResume)
+        del(aryFunc)
+
+        # Put results into result volume:
+        aryPrfRes[:, :, tplSlb[0]:tplSlb[1], :] = asmbl_prf_res(
+            aryBstXpos, aryBstYpos, aryBstSd, aryBstR2, aryLgcMsk, aryLgcVar,
+            tplSlbShp)
+
+        # Write results of current slab to disk:
+        aryPrfRes.flush()
+
+    return aryPrfRes, hdrMsk, aryAff, aryMask.flatten()
@@ -0,0 +1,638 @@
+# -*- coding: utf-8 -*-
+"""pRF mapping as a sequence of stages with on-disk artifacts."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+from pyprf.analysis.load_config import load_config
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.utilities import cls_bckgrnd_prc
+from pyprf.analysis.model_creation_main import model_creation
+from pyprf.analysis.preprocessing_main import pre_pro_models
+from pyprf.analysis.preprocessing_main import pre_pro_func
+from pyprf.analysis.preprocessing_main import pre_pro_avg
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.export_results import asmbl_prf_res
+from pyprf.analysis.export_results import export_nii
+from pyprf.analysis.export_results import export_sdcr
+from pyprf.analysis.export_results import lstNiiNames
+
+# Config parameters that define the pRF model grid:
+lstKeyGrd = ['varNumX', 'varNumY', 'varNumPrfSizes', 'varExtXmin',
+             'varExtXmax', 'varExtYmin', 'varExtYmax', 'varPrfStdMin',
+             'varPrfStdMax']
+
+
+def stg_config(dicCnfg, strDirStg, lgcResume):
+    """Stage: save config parameters."""
+    with open(os.path.join(strDirStg, 'dicCnfg.pkl'), 'wb') as fleOut:
+        pickle.dump(dicCnfg, fleOut)
+
+
+def stg_mdl_crt(dicCnfg, strDirStg, lgcResume):
+    """Stage: create (or load) pRF time course models."""
+    aryPrfTc = model_creation(dicCnfg, lgcAvg=True)
+    np.save(os.path.join(strDirStg, 'aryPrfTc.npy'), aryPrfTc)
+
+
+def stg_mdl_pre(dicCnfg, strDirStg, lgcResume):
+    """Stage: preprocess pRF time course models."""
+    cfg = cls_set_config(dicCnfg)
+    aryPrfTc = np.load(os.path.join(strDirStg, 'aryPrfTc.npy'))
+    aryPrfTc = pre_pro_models(aryPrfTc, varSdSmthTmp=cfg.varSdSmthTmp,
+                              varPar=cfg.varPar)
+    np.save(os.path.join(strDirStg, 'aryPrfTcPre.npy'), aryPrfTc)
+
+
+def stg_func_pre(dicCnfg, strDirStg, lgcResume):
+    """Stage: preprocess functional data."""
+    cfg = cls_set_config(dicCnfg)
+    aryLgcMsk, hdrMsk, aryAff, aryLgcVar, aryFunc, tplNiiShp = \
+        pre_pro_func(cfg.strPathNiiMask, cfg.lstPathNiiFunc,
+                     lgcLinTrnd=cfg.lgcLinTrnd,
+                     varSdSmthTmp=cfg.varSdSmthTmp,
+                     varSdSmthSpt=cfg.varSdSmthSpt,
+                     varPar=cfg.varPar, strPathCch=cfg.strPathCch,
+                     varTr=cfg.varTr)
+    # Average runs with the same stimulus sequence (if the models have been
+    # created for one run only, see `get_stg_dep`):
+    if cfg.strAvgRun != 'none':
+        aryPrfTc = np.load(os.path.join(strDirStg, 'aryPrfTc.npy'),
+                           mmap_mode='r')
+        if aryPrfTc.shape[3] < aryFunc.shape[1]:
+            aryFunc = pre_pro_avg(aryFunc, len(cfg.lstPathNiiFunc))
+        del(aryPrfTc)
+    np.save(os.path.join(strDirStg, 'aryLgcMsk.npy'), aryLgcMsk)
+    np.save(os.path.join(strDirStg, 'aryLgcVar.npy'), aryLgcVar)
+    np.save(os.path.join(strDirStg, 'aryFunc.npy'), aryFunc)
+    with open(os.path.join(strDirStg, 'func_meta.pkl'), 'wb') as fleOut:
+        pickle.dump((hdrMsk, aryAff, tuple(tplNiiShp)), fleOut)
+
+
+def stg_fit(dicCnfg, strDirStg, lgcResume):
+    """Stage: find best fitting pRF models."""
+    aryFunc = np.load(os.path.join(strDirStg, 'aryFunc.npy'), mmap_mode='r')
+    aryPrfTc = np.load(os.path.join(strDirStg, 'aryPrfTcPre.npy'))
+    # Checkpoint of pRF finding (see `pyprf`):
+    if (0 < dicCnfg['varChnkSze']) or lgcResume:
+        strPathChk = os.path.join(strDirStg, 'checkpoint')
+    else:
+        strPathChk = None
+    aryBstXpos, aryBstYpos, aryBstSd, aryBstR2 = find_prf(
+        dicCnfg, aryFunc, aryPrfTc, strPathChk=strPathChk,
+        lgcResume=lgcResume)
+    np.save(os.path.join(strDirStg, 'aryBstPrm.npy'),
+            np.stack((aryBstXpos, aryBstYpos, aryBstSd, aryBstR2), axis=1))
+    # Checkpoint is not needed anymore once the results have been saved:
+    shutil.rmtree(os.path.join(strDirStg, 'checkpoint'), ignore_errors=True)
+
+
+def stg_export(dicCnfg, strDirStg, lgcResume):
+    """Stage: export results as nii files."""
+    cfg = cls_set_config(dicCnfg)
+    aryBstPrm = np.load(os.path.join(strDirStg, 'aryBstPrm.npy'))
+    aryLgcMsk = np.load(os.path.join(strDirStg, 'aryLgcMsk.npy'))
+    aryLgcVar = np.load(os.path.join(strDirStg, 'aryLgcVar.npy'))
+    with open(os.path.join(strDirStg, 'func_meta.pkl'), 'rb') as fleIn:
+        hdrMsk, aryAff, tplNiiShp = pickle.load(fleIn)
+    aryPrfRes = asmbl_prf_res(aryBstPrm[:, 0], aryBstPrm[:, 1],
+                              aryBstPrm[:, 2], aryBstPrm[:, 3], aryLgcMsk,
+                              aryLgcVar, tplNiiShp)
+    export_nii(aryPrfRes, hdrMsk, aryAff, cfg.strPathOut,
+               varCmprLvl=cfg.varCmprLvl, lgcOut4d=cfg.lgcOut4d,
+               varPar=cfg.varPar)
+    if cfg.lgcSdcr:
+        export_sdcr(aryPrfRes, aryLgcMsk, aryAff, cfg.strPathOut)
+
+
+# Stages of the pipeline, in order of execution. For each stage: function,
+# stages whose outputs are needed as inputs, files created in the stage
+# directory (outputs, see also `get_stg_out`), and config parameters that the
+# outputs depend on.
+lstStg = ['config',
+          'model_creation',
+          'model_preprocessing',
+          'func_preprocessing',
+          'fit',
+          'export']
+
+# Stages that are run in a background process, as soon as their input stages
+# are completed, so that they overlap with the stages that are run in the
+# main process (see `run_stages`):
+lstStgBck = ['func_preprocessing']
+
+dicStg = {
+    'config': (stg_config,
+               [],
+               ['dicCnfg.pkl'],
+               None),
+    'model_creation': (stg_mdl_crt,
+                       ['config'],
+                       ['aryPrfTc.npy'],
+                       (['lgcCrteMdl', 'strPathMdl', 'lstPathPng',
+                         'varStrtIdx', 'varZfill', 'varNumVol',
+                         'tplVslSpcSze', 'varTr', 'strAvgRun'] + lstKeyGrd)),
+    'model_preprocessing': (stg_mdl_pre,
+                            ['model_creation'],
+                            ['aryPrfTcPre.npy'],
+                            ['varSdSmthTmp']),
+    'func_preprocessing': (stg_func_pre,
+                           ['config'],
+                           ['aryLgcMsk.npy', 'aryLgcVar.npy', 'aryFunc.npy',
+                            'func_meta.pkl'],
+                           ['strPathNiiMask', 'lstPathNiiFunc', 'lgcLinTrnd',
+                            'varSdSmthTmp', 'varSdSmthSpt', 'varTr',
+                            'strAvgRun']),
+    'fit': (stg_fit,
+            ['model_preprocessing', 'func_preprocessing'],
+            ['aryBstPrm.npy'],
+            (['strVersion', 'varNumClst', 'varNumPrb', 'lgcIdxExct',
+              'varSzeSktch', 'varNumCnd'] + lstKeyGrd)),
+    'export': (stg_export,
+               ['fit', 'func_preprocessing'],
+               [],
+               ['strPathOut', 'varCmprLvl', 'lgcOut4d', 'lgcSdcr']),
+    }
+
+
+def get_stg_dep(dicCnfg, strStg):
+    """
+    Get input stages & config parameters that the outputs of a stage depend on.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    strStg : str
+        Name of stage.
+
+    Returns
+    -------
+    lstIn : list
+        Names of stages whose outputs are needed as inputs.
+    lstKey : list or None
+        Config parameters that the outputs depend on (`None` for all).
+
+    Notes
+    -----
+    If runs with the same stimulus sequence are averaged (`strAvgRun`), the
+    models may be reduced to one run depending on the functional runs, and
+    the preprocessing of the functional data depends on whether the models
+    have been reduced (see `stg_func_pre`). Otherwise, the dependencies are
+    those listed in `dicStg`.
+    """
+    _, lstIn, _, lstKey = dicStg[strStg]
+
+    if dicCnfg.get('strAvgRun', 'none') != 'none':
+        if strStg == 'model_creation':
+            lstKey = lstKey + ['lstPathNiiFunc']
+        if strStg == 'func_preprocessing':
+            lstIn = lstIn + ['model_creation']
+
+    return lstIn, lstKey
+
+
+def get_stg_in(dicCnfg, strStg):
+    """
+    Get input files that the outputs of a stage depend on.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    strStg : str
+        Name of stage.
+
+    Returns
+    -------
+    lstPathIn : list
+        Paths of input files (stimulus PNG files or existing models, mask &
+        functional data).
+    """
+    lstPathIn = []
+
+    if strStg == 'model_creation':
+        # PNG files of all runs (see `load_png`), which are also used to
+        # check existing models for one run (see `crt_avg_key`):
+        if (isinstance(dicCnfg.get('lstPathPng'), list)
+                and (dicCnfg['lgcCrteMdl']
+                     or (dicCnfg.get('strAvgRun', 'none') != 'none'))):
+            for strPathPng in dicCnfg['lstPathPng']:
+                for idxVol in range(int(dicCnfg['varNumVol'])):
+                    lstPathIn.append(
+                        strPathPng
+                        + str(idxVol + dicCnfg['varStrtIdx']).zfill(
+                            dicCnfg['varZfill'])
+                        + '.png')
+        if not dicCnfg['lgcCrteMdl']:
+            lstPathIn.append(dicCnfg['strPathMdl'] + '.npy')
+        # Models may be reduced to one run, depending on the functional runs,
+        # and existing models for one run may be loaded (see
+        # `model_creation`):
+        if dicCnfg.get('strAvgRun', 'none') != 'none':
+            if not dicCnfg['lgcCrteMdl']:
+                lstPathIn.append(dicCnfg['strPathMdl'] + '_avg.npy')
+                lstPathIn.append(dicCnfg['strPathMdl'] + '_avg.key')
+            lstPathIn += list(dicCnfg['lstPathNiiFunc'])
+
+    if strStg == 'func_preprocessing':
+        lstPathIn.append(dicCnfg['strPathNiiMask'])
+        lstPathIn += list(dicCnfg['lstPathNiiFunc'])
+
+    return lstPathIn
+
+
+def get_stg_out(dicCnfg, strDirStg, strStg):
+    """
+    Get output files of a stage.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    strDirStg : str
+        Directory with outputs of stages.
+    strStg : str
+        Name of stage.
+
+    Returns
+    -------
+    lstPathOut : list
+        Paths of output files, i.e. the files in the stage directory listed
+        in `dicStg`, and the exported results of the export stage (see
+        `export_nii` & `export_sdcr`).
+    """
+    lstPathOut = [os.path.join(strDirStg, strOut)
+                  for strOut in dicStg[strStg][2]]
+
+    if strStg == 'export':
+        if dicCnfg['varCmprLvl'] == 0:
+            strExt = '.nii'
+        else:
+            strExt = '.nii.gz'
+        if dicCnfg['lgcOut4d']:
+            lstPathOut.append(dicCnfg['strPathOut'] + '_params' + strExt)
+        else:
+            lstPathOut += [(dicCnfg['strPathOut'] + strTmp + strExt)
+                           for strTmp in lstNiiNames]
+        if dicCnfg['lgcSdcr']:
+            lstPathOut.append(dicCnfg['strPathOut'] + '_params.npz')
+
+    return lstPathOut
+
+
+def get_stamp(dicCnfg, strStg, dicStmp):
+    """
+    Create stamp identifying the outputs of a stage.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    strStg : str
+        Name of stage.
+    dicStmp : dict
+        Stamps of the stages preceding the stage (stage names as keys).
+
+    Returns
+    -------
+    strStmp : str
+        Hexadecimal SHA-1 digest over the config parameters that the outputs
+        of the stage depend on, over the size & modification time of its
+        input files, and over the stamps of its input stages.
+
+    Notes
+    -----
+    The stamp of the config stage covers all config parameters. It is not
+    passed on to later stages, which only depend on the parameters listed in
+    `dicStg` (see `get_stg_dep`), so that a change of, for instance, the
+    number of processes does not invalidate any outputs.
+
+    Input files (see `get_stg_in`) are identified by their size & modification
+    time rather than their contents (unlike the cache key of the preprocessed
+    functional data, see `crt_cache_key`), so that the status of the stages
+    can be determined without reading the data. A file that is overwritten
+    or touched invalidates the outputs of the stage.
+    """
+    lstIn, lstKey = get_stg_dep(dicCnfg, strStg)
+
+    if lstKey is None:
+        lstKey = sorted(dicCnfg.keys())
+
+    objHsh = hashlib.sha1()
+    objHsh.update(strStg.encode('utf-8'))
+    for strKey in lstKey:
+        objHsh.update(('|' + strKey + '=' + repr(dicCnfg.get(strKey)))
+                      .encode('utf-8'))
+    for strPathIn in get_stg_in(dicCnfg, strStg):
+        if os.path.isfile(strPathIn):
+            objStt = os.stat(strPathIn)
+            strStt = str(objStt.st_size) + ':' + str(objStt.st_mtime_ns)
+        else:
+            strStt = 'missing'
+        objHsh.update(('|' + strPathIn + '=' + strStt).encode('utf-8'))
+    for strIn in lstIn:
+        if strIn != 'config':
+            objHsh.update(('|' + dicStmp[strIn]).encode('utf-8'))
+
+    return objHsh.hexdigest()
+
+
+def get_stg_status(dicCnfg, strDirStg):
+    """
+    Determine which stages are up to date.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    strDirStg : str
+        Directory with outputs of stages.
+
+    Returns
+    -------
+    dicStmp : dict
+        Stamp of each stage (stage names as keys).
+    dicUpd : dict
+        Whether each stage is up to date, i.e. whether its outputs exist and
+        were created with the current config parameters (stage names as
+        keys).
+    """
+    dicStmp = {}
+    dicUpd = {}
+
+    for strStg in lstStg:
+
+        dicStmp[strStg] = get_stamp(dicCnfg, strStg, dicStmp)
+
+        # Outputs are only complete if the stamp file exists, because it is
+        # written after all outputs:
+        strPathStmp = os.path.join(strDirStg, (strStg + '.stamp'))
+        lgcUpd = os.path.isfile(strPathStmp)
+        if lgcUpd:
+            with open(strPathStmp, 'r') as fleIn:
+                lgcUpd = (fleIn.read() == dicStmp[strStg])
+        for strPathOut in get_stg_out(dicCnfg, strDirStg, strStg):
+            lgcUpd = lgcUpd and os.path.isfile(strPathOut)
+
+        dicUpd[strStg] = lgcUpd
+
+    return dicStmp, dicUpd
+
+
+def run_stage(dicCnfg, strStg, strDirStg, strStmp, lgcResume):
+    """
+    Run a single stage & record its stamp.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    strStg : str
+        Name of stage.
+    strDirStg : str
+        Directory with outputs of stages.
+    strStmp : str
+        Stamp of stage (see `get_stamp`).
+    lgcResume : bool
+        Whether to resume pRF finding from checkpoint (see `find_prf`).
+    """
+    strPathStmp = os.path.join(strDirStg, (strStg + '.stamp'))
+
+    # Outputs of the stage are invalid while it is running:
+    if os.path.isfile(strPathStmp):
+        os.remove(strPathStmp)
+
+    print('---Stage: ' + strStg)
+    varTme01 = time.time()
+
+    dicStg[strStg][0](dicCnfg, strDirStg, lgcResume)
+
+    with open(strPathStmp, 'w') as fleOut:
+        fleOut.write(strStmp)
+
+    print('---Stage ' + strStg + ' completed in '
+          + str(np.around((time.time() - varTme01), decimals=1)) + ' s')
+
+
+def load_stg_config(strCsvCnfg, lgcTest=False):
+    """
+    Load config parameters for stage-wise pRF analysis.
+
+    Parameters
+    ----------
+    strCsvCnfg : str
+        Absolute file path of config file.
+    lgcTest : Boolean
+        Whether this is a test (pytest). If yes, absolute path of pyprf libary
+        will be prepended to config file paths.
+
+    Returns
+    -------
+    dicCnfg : dict
+        Dictionary containing config parameters, with the extent of temporal
+        and spatial smoothing converted into units of volumes and voxels.
+    strDirStg : str
+        Directory with outputs of stages (`strPathOut` + '_stages', created
+        if it does not exist).
+    """
+    # Load config parameters from csv file into dictionary:
+    dicCnfg = load_config(strCsvCnfg, lgcTest=lgcTest)
+
+    # The stages only implement the exhaustive search (with the model index
+    # or sketches) and the export of the best fitting models. Options of
+    # `pyprf` that would change the outputs are not ignored silently:
+    if ((1 < dicCnfg['varNumTopK'])
+            or dicCnfg['lgcPst']
+            or (0 < dicCnfg['varSpcLtc'])
+            or (0.0 < dicCnfg['varThrScr'])
+            or (0 < dicCnfg['varNumSrgt'])
+            or dicCnfg['lgcPair']
+            or dicCnfg['lgcSuff']
+            or dicCnfg['lgcXval']
+            or (0.0 < dicCnfg['varMemBdgt'])):
+        raise ValueError(('The stage-wise analysis does not support the '
+                          + 'best fitting models (varNumTopK), posterior '
+                          + '(lgcPst), lattice (varSpcLtc), screening '
+                          + '(varThrScr), null distribution (varNumSrgt), '
+                          + 'pairs of models (lgcPair), sufficient '
+                          + 'statistics (lgcSuff, lgcXval), or slab-wise '
+                          + 'processing (varMemBdgt)'))
+
+    # Convert preprocessing parameters (for temporal and spatial smoothing)
+    # from SI units (i.e. [s] and [mm]) into units of data array (volumes and
+    # voxels):
+    dicCnfg['varSdSmthTmp'] = float(np.divide(dicCnfg['varSdSmthTmp'],
+                                              dicCnfg['varTr']))
+    dicCnfg['varSdSmthSpt'] = float(np.divide(dicCnfg['varSdSmthSpt'],
+                                              dicCnfg['varVoxRes']))
+
+    # Directory for outputs of stages:
+    strDirStg = dicCnfg['strPathOut'] + '_stages'
+    if not os.path.isdir(strDirStg):
+        os.makedirs(strDirStg)
+
+    return dicCnfg, strDirStg
+
+
+def run_stages(dicCnfg, strDirStg, lstTrgt, lgcFrce=True, lgcResume=False):
+    """
+    Run stages, together with preceding stages that are not up to date.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters (see `load_stg_config`).
+    strDirStg : str
+        Directory with outputs of stages.
+    lstTrgt : list
+        Names of stages to run.
+    lgcFrce : bool
+        Whether to run the stages in `lstTrgt` even if they are up to date.
+        Preceding stages are only run if they are not up to date.
+    lgcResume : bool
+        Whether to resume pRF finding from checkpoint (see `find_prf`).
+    """
+    dicStmp, dicUpd = get_stg_status(dicCnfg, strDirStg)
+
+    # Stages to run (requested stages & preceding stages that are not up to
+    # date):
+    setNeed = set(lstTrgt)
+    lstRun = []
+    for strTmp in lstStg[::-1]:
+        if strTmp in setNeed:
+            if ((lgcFrce and (strTmp in lstTrgt)) or (not dicUpd[strTmp])):
+                lstRun.insert(0, strTmp)
+                setNeed.update(get_stg_dep(dicCnfg, strTmp)[0])
+
+    # Invalidate later stages that (directly or indirectly) depend on stages
+    # that will be run. Their stamps change if config parameters have changed
+    # anyway, but not if a stage is re-run with unchanged parameters. (As for
+    # the stamps, the config stage is not taken into account.)
+    setInv = set(lstRun) - set(['config'])
+    for strTmp in lstStg:
+        if any([(strIn in setInv)
+                for strIn in get_stg_dep(dicCnfg, strTmp)[0]]):
+            setInv.add(strTmp)
+            strPathStmp = os.path.join(strDirStg, (strTmp + '.stamp'))
+            if (strTmp not in lstRun) and os.path.isfile(strPathStmp):
+                os.remove(strPathStmp)
+
+    print('---Stages up to date: '
+          + str([strTmp for strTmp in lstStg if strTmp not in lstRun]))
+    print('---Stages to run: ' + str(lstRun))
+
+    # Stages are run one after the other in the main process, except for
+    # stages in `lstStgBck`, which are run in a background process. Stages
+    # fork processes for preprocessing & pRF finding, which must not happen
+    # while other threads are running, so background stages are run in
+    # spawned processes (see `cls_bckgrnd_prc`). A stage is only run once
+    # all its input stages are completed.
+    setDne = set(lstStg) - set(lstRun)
+    dicPrc = {}
+    try:
+        for strTmp in lstRun:
+
+            # Start background stages whose input stages are completed:
+            for strBck in lstRun:
+                if ((strBck in lstStgBck)
+                        and (strBck not in dicPrc)
+                        and (strBck not in setDne)
+                        and all([(strIn in setDne) for strIn
+                                 in get_stg_dep(dicCnfg, strBck)[0]])):
+                    print('---Stage ' + strBck + ' started in background')
+                    dicPrc[strBck] = cls_bckgrnd_prc(run_stage, dicCnfg,
+                                                     strBck, strDirStg,
+                                                     dicStmp[strBck],
+                                                     lgcResume)
+                    dicPrc[strBck].start()
+
+            if strTmp in lstStgBck:
+                continue
+
+            # Wait for background stages that are inputs of this stage:
+            for strIn in get_stg_dep(dicCnfg, strTmp)[0]:
+                if strIn in dicPrc:
+                    dicPrc.pop(strIn).get()
+                    setDne.add(strIn)
+
+            run_stage(dicCnfg, strTmp, strDirStg, dicStmp[strTmp], lgcResume)
+            setDne.add(strTmp)
+
+        # Wait for background stages that are not inputs of later stages:
+        for strBck in list(dicPrc.keys()):
+            dicPrc.pop(strBck).get()
+            setDne.add(strBck)
+
+    finally:
+        # Stop background stages (in case of an exception):
+        for objPrc in dicPrc.values():
+            objPrc.terminate()
+
+
+def pyprf_stages(strCsvCnfg, lgcTest=False, strStg='all', lgcResume=False):
+    """
+    Run pRF mapping stage by stage, with on-disk outputs of each stage.
+
+    Parameters
+    ----------
+    strCsvCnfg : str
+        Absolute file path of config file.
+    lgcTest : Boolean
+        Whether this is a test (pytest). If yes, absolute path of pyprf libary
+        will be prepended to config file paths.
+    strStg : str
+        Name of stage to run (see `lstStg`), or 'all'. If 'all', all stages
+        that are not up to date are run. Otherwise, the given stage is run
+        (even if it is up to date), together with any preceding stages that
+        are not up to date. Later stages are not run.
+    lgcResume : Boolean
+        Whether to resume pRF finding from checkpoint (see `find_prf`).
+
+    Notes
+    -----
+    The outputs of all stages are stored in a directory next to the results
+    (`strPathOut` + '_stages'). A stage is up to date if its outputs exist and
+    were created with the same config parameters (only those parameters that
+    the stage depends on) and from the same inputs. Stages are run one after
+    the other (each stage is parallelised in itself, see `varPar`), except
+    for the preprocessing of the functional data, which is run in a
+    background process at the same time as the creation & preprocessing of
+    the models.
+    """
+    print('---pRF analysis (stages)')
+    varTme01 = time.time()
+
+    dicCnfg, strDirStg = load_stg_config(strCsvCnfg, lgcTest=lgcTest)
+
+    if strStg == 'all':
+        run_stages(dicCnfg, strDirStg, lstStg, lgcFrce=False,
+                   lgcResume=lgcResume)
+    else:
+        run_stages(dicCnfg, strDirStg, [strStg], lgcFrce=True,
+                   lgcResume=lgcResume)
+
+    varTme02 = time.time()
+    varTme03 = varTme02 - varTme01
+    print('---Elapsed time: ' + str(varTme03) + ' s')
+    print('---Done.')
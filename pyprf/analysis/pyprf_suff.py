@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""pRF finding from per-run sufficient statistics."""
+
+# Part of py_pRF_mapping library
+# Copyright (C) 2016  Ingo Marquardt
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import hashlib
+import numpy as np
+import nibabel as nb
+
+from pyprf.analysis.utilities import cls_set_config
+from pyprf.analysis.utilities import load_nii
+from pyprf.analysis.preprocessing_main import pre_pro_runs
+from pyprf.analysis.preprocessing_cache import crt_cache_key
+from pyprf.analysis.find_prf_main import crt_mdl_prms
+from pyprf.analysis.find_prf_suff import crt_mdl_prms_flat
+from pyprf.analysis.find_prf_suff import crt_suff
+from pyprf.analysis.find_prf_suff import add_suff
+from pyprf.analysis.find_prf_suff import find_prf_suff
+from pyprf.analysis.find_prf_suff import xval_suff
+from pyprf.analysis.export_results import asmbl_prf_res
+
+# Version of the layout of stored sufficient statistics. Needs to be
+# incremented whenever their calculation, or the way in which they are stored,
+# changes.
+strSuffVrsn = 'pyprf-suff-1'
+
+
+def crt_run_key(strPathNiiMask, strPathNiiFunc, aryMdlRun, lgcLinTrnd,
+                varSdSmthTmp, varSdSmthSpt, varTr):
+    """
+    Create key for sufficient statistics of one run.
+
+    Parameters
+    ----------
+    strPathNiiMask : str
+        Path of mask.
+    strPathNiiFunc : str
+        Path of functional data of the run.
+    aryMdlRun : np.array
+        2D array with preprocessed pRF model time courses for the volumes of
+        the run, with shape aryMdlRun[model, time].
+    lgcLinTrnd, varSdSmthTmp, varSdSmthSpt, varTr
+        Preprocessing parameters (see `crt_cache_key`).
+
+    Returns
+    -------
+    strKey : str
+        Hexadecimal SHA-1 digest over the contents of the mask & functional
+        data, the preprocessing parameters, and the model time courses.
+    """
+    objHsh = hashlib.sha1()
+    objHsh.update(strSuffVrsn.encode('utf-8'))
+    objHsh.update(crt_cache_key(strPathNiiMask, [strPathNiiFunc], lgcLinTrnd,
+                                varSdSmthTmp, varSdSmthSpt,
+                                varTr).encode('utf-8'))
+    objHsh.update(str(aryMdlRun.shape).encode('utf-8'))
+    objHsh.update(np.ascontiguousarray(aryMdlRun,
+                                       dtype=np.float32).tobytes())
+    return objHsh.hexdigest()
+
+
+def load_run_suff(strDirKey):
+    """
+    Load sufficient statistics of one run.
+
+    Parameters
+    ----------
+    strDirKey : str
+        Directory with sufficient statistics of the run.
+
+    Returns
+    -------
+    tplSuff : tuple or None
+        Sufficient statistics (see `crt_suff`), with the cross products
+        memory-mapped (read-only). `None` if the directory does not exist.
+    """
+    if not os.path.isdir(strDirKey):
+        return None
+    objNpz = np.load(os.path.join(strDirKey, 'arySum.npz'))
+    return (np.load(os.path.join(strDirKey, 'aryXy.npy'), mmap_mode='r'),
+            objNpz['vecX'],
+            objNpz['vecXx'],
+            objNpz['vecY'],
+            objNpz['vecYy'],
+            int(objNpz['varNumVol']))
+
+
+def save_run_suff(strDirKey, tplSuff):
+    """
+    Save sufficient statistics of one run.
+
+    Parameters
+    ----------
+    strDirKey : str
+        Directory for sufficient statistics of the run.
+    tplSuff : tuple
+        Sufficient statistics (see `crt_suff`).
+
+    Notes
+    -----
+    The statistics are written to a temporary directory first, which is
+    renamed once it is complete, so that incomplete statistics are never
+    loaded.
+    """
+    strDirTmp = strDirKey + '.' + str(os.getpid()) + '.tmp'
+    shutil.rmtree(strDirTmp, ignore_errors=True)
+    os.makedirs(strDirTmp)
+    np.save(os.path.join(strDirTmp, 'aryXy.npy'), tplSuff[0])
+    np.savez(os.path.join(strDirTmp, 'arySum.npz'),
+             vecX=tplSuff[1],
+             vecXx=tplSuff[2],
+             vecY=tplSuff[3],
+             vecYy=tplSuff[4],
+             varNumVol=tplSuff[5])
+    os.rename(strDirTmp, strDirKey)
+
+
+def get_runs_suff(dicCnfg, aryPrfTc, varSdSmthTmp, varSdSmthSpt,  #noqa
+                  lstIdxRun=None):
+    """
+    Get sufficient statistics of functional runs.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    aryPrfTc : np.array
+        Array with preprocessed pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time] (for the concatenated runs).
+    varSdSmthTmp : float
+        Extent of temporal smoothing, in volumes.
+    varSdSmthSpt : float
+        Extent of spatial smoothing, in voxels.
+    lstIdxRun : list or None
+        Indices of runs (in `lstPathNiiFunc`). If `None`, all runs.
+
+    Returns
+    -------
+    lstSuff : list
+        Sufficient statistics of each run (see `crt_suff`), in the order of
+        `lstIdxRun`.
+
+    Notes
+    -----
+    The sufficient statistics of each run are stored in the directory
+    `strPathSuff` (or `strPathOut` + '_suff'), keyed by the contents of the
+    mask & functional data of the run, the preprocessing parameters, and the
+    model time courses of the run. Only runs without stored statistics are
+    loaded & preprocessed (one run at a time), so that runs can be added as
+    they become available, and any subset of runs can be refitted without
+    accessing the functional data again.
+    """
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    varNumRun = len(cfg.lstPathNiiFunc)
+    if lstIdxRun is None:
+        lstIdxRun = list(range(varNumRun))
+
+    # Model time courses, with shape aryMdl[model, time]:
+    aryMdl = np.reshape(aryPrfTc, (-1, aryPrfTc.shape[3]))
+
+    # Position of each run within the concatenated time series (the number
+    # of volumes is read from the nii headers):
+    vecNumVol = [nb.load(strTmp).shape[3] for strTmp in cfg.lstPathNiiFunc]
+    vecIdxVol = np.hstack((0, np.cumsum(vecNumVol)))
+    if vecIdxVol[-1] != aryMdl.shape[1]:
+        raise ValueError(('Total number of volumes of functional data ('
+                          + str(vecIdxVol[-1]) + ') does not match pRF time '
+                          + 'course models (' + str(aryMdl.shape[1]) + ')'))
+
+    strDirSuff = cfg.strPathSuff
+    if not strDirSuff:
+        strDirSuff = cfg.strPathOut + '_suff'
+    if not os.path.isdir(strDirSuff):
+        os.makedirs(strDirSuff)
+
+    dicDirKey = {}
+    for idxRun in lstIdxRun:
+        strKey = crt_run_key(cfg.strPathNiiMask, cfg.lstPathNiiFunc[idxRun],
+                             aryMdl[:, vecIdxVol[idxRun]:
+                                    vecIdxVol[(idxRun + 1)]],
+                             cfg.lgcLinTrnd, varSdSmthTmp, varSdSmthSpt,
+                             cfg.varTr)
+        dicDirKey[idxRun] = os.path.join(strDirSuff, strKey)
+
+    # Runs without stored statistics:
+    lstIdxNew = sorted(set([idxRun for idxRun in lstIdxRun
+                            if not os.path.isdir(dicDirKey[idxRun])]))
+
+    if lstIdxNew:
+        print('------Calculate sufficient statistics for '
+              + str(len(lstIdxNew)) + ' out of ' + str(len(lstIdxRun))
+              + ' runs')
+        objRuns = pre_pro_runs(cfg.strPathNiiMask,
+                               [cfg.lstPathNiiFunc[idxRun]
+                                for idxRun in lstIdxNew],
+                               lgcLinTrnd=cfg.lgcLinTrnd,
+                               varSdSmthTmp=varSdSmthTmp,
+                               varSdSmthSpt=varSdSmthSpt,
+                               varPar=cfg.varPar)
+        for idxRun, tplRun in zip(lstIdxNew, objRuns):
+            aryFuncRun = tplRun[3]
+            save_run_suff(dicDirKey[idxRun],
+                          crt_suff(aryMdl[:, vecIdxVol[idxRun]:
+                                          vecIdxVol[(idxRun + 1)]],
+                                   aryFuncRun))
+            del(aryFuncRun)
+            del(tplRun)
+
+    return [load_run_suff(dicDirKey[idxRun]) for idxRun in lstIdxRun]
+
+
+def fit_suff(dicCnfg, tplSuff, aryLgcMsk, tplNiiShp):
+    """
+    Find best fitting pRF models from (combined) sufficient statistics.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    tplSuff : tuple
+        Sufficient statistics (see `crt_suff`).
+    aryLgcMsk : np.array
+        1D logical array (one value per voxel in the volume), voxels that are
+        `False` were excluded by the mask.
+    tplNiiShp : tuple
+        Spatial dimensions of the volume.
+
+    Returns
+    -------
+    aryPrfRes : np.array
+        4D array with pRF finding results (see `asmbl_prf_res`).
+    aryLgcVar : np.array
+        1D logical array (one value per voxel within the mask), voxels that
+        are `False` were excluded because of low variance.
+    vecIdxBst : np.array
+        1D array with index of best fitting model for each included voxel.
+
+    Notes
+    -----
+    As in `pre_pro_func`, voxels are excluded if the variance of their
+    (concatenated) time course is below 0.0001.
+    """
+    vecMdlXpos, vecMdlYpos, vecMdlSd = crt_mdl_prms_flat(
+        *crt_mdl_prms(dicCnfg))
+
+    # Variance of the concatenated voxel time courses:
+    varNumVol = tplSuff[5]
+    vecVar = (tplSuff[4] / varNumVol
+              - np.square(tplSuff[3] / varNumVol))
+    aryLgcVar = np.greater(vecVar, 0.0001)
+
+    vecIdxBst, vecBstR2 = find_prf_suff(tplSuff)
+    vecIdxBst = vecIdxBst[aryLgcVar]
+
+    aryPrfRes = asmbl_prf_res(vecMdlXpos[vecIdxBst],
+                              vecMdlYpos[vecIdxBst],
+                              vecMdlSd[vecIdxBst],
+                              vecBstR2[aryLgcVar],
+                              aryLgcMsk,
+                              aryLgcVar,
+                              tplNiiShp)
+
+    return aryPrfRes, aryLgcVar, vecIdxBst
+
+
+def pyprf_suff(dicCnfg, aryPrfTc, varSdSmthTmp, varSdSmthSpt):
+    """
+    Find pRF models from per-run sufficient statistics.
+
+    Parameters
+    ----------
+    dicCnfg : dict
+        Dictionary containing config parameters.
+    aryPrfTc : np.array
+        Array with preprocessed pRF model time courses, with shape
+        aryPrfTc[x-pos, y-pos, SD, time] (for the concatenated runs).
+    varSdSmthTmp : float
+        Extent of temporal smoothing, in volumes.
+    varSdSmthSpt : float
+        Extent of spatial smoothing, in voxels.
+
+    Returns
+    -------
+    aryPrfRes : np.array
+        4D array with pRF finding results (see `asmbl_prf_res`).
+    hdrMsk : nibabel-header-object
+        Nii header of mask.
+    aryAff : np.array
+        Array containing 'affine' of mask nii data.
+    aryLgcMsk : np.array
+        1D logical array (one value per voxel in the volume).
+    aryR2Xval : np.array or None
+        3D array with leave-one-run-out cross-validated R2 (if `lgcXval`),
+        otherwise `None`.
+
+    Notes
+    -----
+    Instead of concatenating the functional runs, the sufficient statistics
+    (cross products of model & voxel time courses, sums, and sums of squares)
+    are calculated for each run (see `get_runs_suff`), and added up. The
+    results are the same as for the concatenated runs, but memory usage
+    depends on the size of one run only (plus the model-by-voxel cross
+    products). Only the runs in `lstRunSuff` are used (all runs if empty).
+
+    The per-run statistics are also sufficient for leave-one-run-out
+    cross-validation (see `xval_suff`), which therefore does not require the
+    functional data to be processed again.
+    """
+    print('------Find pRF models from per-run sufficient statistics')
+
+    # Load config parameters from dictionary into namespace:
+    cfg = cls_set_config(dicCnfg)
+
+    lstIdxRun = cfg.lstRunSuff
+    if not lstIdxRun:
+        lstIdxRun = None
+
+    lstSuff = get_runs_suff(dicCnfg, aryPrfTc, varSdSmthTmp, varSdSmthSpt,
+                            lstIdxRun=lstIdxRun)
+    tplSuff = None
+    for tplRun in lstSuff:
+        tplSuff = add_suff(tplSuff, tplRun)
+
+    # Mask (binarised as in `pre_pro_func`):
+    aryMask, hdrMsk, aryAff = load_nii(cfg.strPathNiiMask)
+    aryLgcMsk = np.greater(aryMask.astype(np.int16).flatten(), 0)
+
+    aryPrfRes, aryLgcVar, _ = fit_suff(dicCnfg, tplSuff, aryLgcMsk,
+                                       aryMask.shape[0:3])
+    del(tplSuff)
+
+    # Leave-one-run-out cross-validation:
+    if cfg.lgcXval:
+        print('------Leave-one-run-out cross-validation ('
+              + str(len(lstSuff)) + ' folds)')
+        vecR2Xval = xval_suff(lstSuff)
+        aryR2Xval = np.zeros(aryLgcMsk.shape, dtype=np.float32)
+        aryR2Xval[np.flatnonzero(aryLgcMsk)[aryLgcVar]] = \
+            vecR2Xval[aryLgcVar]
+        aryR2Xval = np.reshape(aryR2Xval, aryMask.shape[0:3])
+    else:
+        aryR2Xval = None
+
+    return aryPrfRes, hdrMsk, aryAff, aryLgcMsk, aryR2Xval
@@ -0,0 +1,106 @@
+"""Test averaging of runs with the same stimulus sequence."""
+
+import os
+import numpy as np
+import nibabel as nb
+from pyprf.analysis.pyprf_main import pyprf
+from pyprf.analysis.load_config import load_config
+from pyprf.analysis.model_creation_main import chk_rpt
+from pyprf.analysis.model_creation_main import crt_avg_key
+from pyprf.analysis.model_creation_main import model_creation
+from pyprf.analysis.model_creation_load_png import load_png
+from pyprf.analysis.preprocessing_main import pre_pro_func
+from pyprf.analysis.preprocessing_main import pre_pro_models
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.testing.test_shard import crt_test_config
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_chk_rpt():
+    """Test detection of identical stimulus sequences."""
+    strPathPng = strDir + '/stimuli/run_0'
+    for lstRun, lgcRef in [([1, 1], True), ([1, 2], False)]:
+        aryPngData = load_png(20, [(strPathPng + str(idxRun) + '_frame_')
+                                   for idxRun in lstRun],
+                              tplVslSpcSze=(50, 50), varStrtIdx=1)
+        assert chk_rpt(aryPngData, 2) == lgcRef
+
+
+def test_avg_run():
+    """Test that runs are averaged & models are used for one run."""
+    strCsvCnfg, strPathBse = crt_test_config('avg_run_test')
+
+    # Models for two runs with the same stimulus sequence:
+    aryPrfTc = np.load(strPathBse + '_model_tc.npy')[:, :, :, :200]
+    np.save(strPathBse + '_model_tc', np.concatenate((aryPrfTc, aryPrfTc),
+                                                     axis=3))
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("strAvgRun = 'auto'\n")
+    pyprf(strCsvCnfg)
+
+    # Reference, average of preprocessed runs:
+    dicCnfg = load_config(strCsvCnfg)
+    varSdSmthTmp = dicCnfg['varSdSmthTmp'] / dicCnfg['varTr']
+    aryLgcMsk, _, _, aryLgcVar, aryFunc, _ = pre_pro_func(
+        dicCnfg['strPathNiiMask'], dicCnfg['lstPathNiiFunc'],
+        varSdSmthTmp=varSdSmthTmp, varPar=2)
+    aryFunc = 0.5 * (aryFunc[:, :200] + aryFunc[:, 200:])
+    tplRef = find_prf(dicCnfg, aryFunc,
+                      pre_pro_models(aryPrfTc, varSdSmthTmp=varSdSmthTmp,
+                                     varPar=2))
+
+    vecIdxVox = np.flatnonzero(aryLgcMsk)[aryLgcVar]
+    for idxPrm, strNii in enumerate(['_x_pos', '_y_pos', '_SD', '_R2']):
+        aryTest = np.asarray(nb.load(strPathBse + strNii
+                                     + '.nii.gz').dataobj)
+        assert np.allclose(aryTest.flatten()[vecIdxVox], tplRef[idxPrm],
+                           atol=1e-5)
+
+    # The models for all runs on disk are not replaced by the models for one
+    # run:
+    assert np.load(strPathBse + '_model_tc.npy').shape[3] == 400
+
+    # Clean up:
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('avg_run_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
+
+
+def test_avg_key():
+    """Test that models for one run are only loaded if they match."""
+    strCsvCnfg, strPathBse = crt_test_config('avg_key_test')
+
+    # Models for two runs with the same stimulus sequence:
+    aryPrfTc = np.load(strPathBse + '_model_tc.npy')[:, :, :, :200]
+    np.save(strPathBse + '_model_tc', np.concatenate((aryPrfTc, aryPrfTc),
+                                                     axis=3))
+    dicCnfg = load_config(strCsvCnfg)
+    dicCnfg['strAvgRun'] = 'auto'
+    dicCnfg['lstPathPng'] = [(strDir + '/stimuli/run_01_frame_')] * 2
+    dicCnfg['varNumVol'] = 20
+    dicCnfg['varStrtIdx'] = 1
+    dicCnfg['varZfill'] = 3
+
+    # Models for one run without key, or with the key of other stimuli, are
+    # not used (the models for all runs are reduced to one run instead):
+    strPathKey = strPathBse + '_model_tc_avg.key'
+    np.save(strPathBse + '_model_tc_avg', np.zeros_like(aryPrfTc))
+    assert np.array_equal(model_creation(dicCnfg, lgcAvg=True), aryPrfTc)
+    with open(strPathKey, 'w') as fleOut:
+        fleOut.write(crt_avg_key(
+            dict(dicCnfg, lstPathPng=[(strDir + '/stimuli/run_01_frame_'),
+                                      (strDir + '/stimuli/run_02_frame_')]),
+            'auto'))
+    assert np.array_equal(model_creation(dicCnfg, lgcAvg=True), aryPrfTc)
+
+    # Models for one run with matching key are used:
+    with open(strPathKey, 'w') as fleOut:
+        fleOut.write(crt_avg_key(dicCnfg, 'auto'))
+    assert not np.any(model_creation(dicCnfg, lgcAvg=True))
+
+    # Clean up:
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('avg_key_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
@@ -0,0 +1,54 @@
+"""Test batch mode (several subjects with the same pRF models)."""
+
+import os
+import pytest
+import numpy as np
+import nibabel as nb
+from pyprf.analysis.pyprf_main import pyprf
+from pyprf.analysis.pyprf_batch import pyprf_batch
+from pyprf.analysis.export_results import lstNiiNames
+from pyprf.analysis.testing.test_shard import crt_test_config
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_batch():
+    """Test that batch mode gives same results as separate analyses."""
+    strCsvCnfg, strPathBse = crt_test_config('batch_test')
+
+    # Reference (single subject, config file):
+    pyprf(strCsvCnfg)
+
+    # Two subjects (with the same data, different output basenames):
+    lstPathNiiFunc = [(strDir + '/exmpl_data_func_01.nii.gz'),
+                      (strDir + '/exmpl_data_func_02.nii.gz')]
+    strPathSubj = strPathBse + '_subjects.txt'
+    with open(strPathSubj, 'w') as fleOut:
+        fleOut.write('# Functional runs, mask, output basename\n')
+        for idxSubj in range(2):
+            fleOut.write(str((lstPathNiiFunc,
+                              (strDir + '/exmpl_data_mask.nii.gz'),
+                              (strPathBse + '_sub0' + str(idxSubj))))
+                         + '\n')
+
+    pyprf_batch(strCsvCnfg, strPathSubj)
+
+    for strNii in lstNiiNames:
+        aryRef = np.asarray(nb.load(strPathBse + strNii
+                                    + '.nii.gz').dataobj)
+        for idxSubj in range(2):
+            aryTest = np.asarray(nb.load(strPathBse + '_sub0' + str(idxSubj)
+                                         + strNii + '.nii.gz').dataobj)
+            assert np.array_equal(aryRef, aryTest)
+
+    # Options that are not implemented for batch mode are rejected:
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("varNumTopK = 3\n")
+    with pytest.raises(ValueError):
+        pyprf_batch(strCsvCnfg, strPathSubj)
+
+    # Clean up:
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('batch_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
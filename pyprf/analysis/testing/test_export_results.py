@@ -0,0 +1,57 @@
+"""Test assembly & export of pRF finding results."""
+
+import os
+import numpy as np
+import nibabel as nb
+from pyprf.analysis.export_results import asmbl_prf_res
+from pyprf.analysis.export_results import export_nii
+from pyprf.analysis.export_results import export_sdcr
+from pyprf.analysis.export_results import lstNiiNames
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_export():
+    """Test that all output formats contain the same results."""
+    strPathOut = strDir + '/result/export_test'
+
+    # Mask & low-variance exclusion:
+    objRnd = np.random.RandomState(0)
+    tplNiiShp = (4, 5, 3)
+    aryLgcMsk = np.greater(objRnd.rand(60), 0.3)
+    aryLgcVar = np.greater(objRnd.rand(np.sum(aryLgcMsk)), 0.2)
+    aryBst = objRnd.randn(4, np.sum(aryLgcVar)).astype(np.float32)
+
+    aryPrfRes = asmbl_prf_res(aryBst[0], aryBst[1], aryBst[2], aryBst[3],
+                              aryLgcMsk, aryLgcVar, tplNiiShp)
+
+    # Voxels excluded by the mask or because of low variance are zero:
+    aryTmp = np.reshape(aryPrfRes, (-1, 6))
+    assert np.array_equal(aryTmp[aryLgcMsk, :][aryLgcVar, 3], aryBst[3])
+    assert not np.any(aryTmp[np.invert(aryLgcMsk), :])
+    assert not np.any(aryTmp[aryLgcMsk, :][np.invert(aryLgcVar), :])
+
+    hdrMsk = nb.Nifti1Header()
+    hdrMsk.set_data_dtype(np.float32)
+    aryAff = np.eye(4)
+
+    # One file per parameter (compressed) & single 4D file (uncompressed):
+    export_nii(aryPrfRes, hdrMsk, aryAff, strPathOut, varPar=3)
+    export_nii(aryPrfRes, hdrMsk, aryAff, strPathOut, varCmprLvl=0,
+               lgcOut4d=True)
+    aryOut4d = np.asarray(nb.load(strPathOut + '_params.nii').dataobj)
+    assert np.array_equal(aryOut4d, aryPrfRes)
+    for idxOut in range(6):
+        strTmp = strPathOut + lstNiiNames[idxOut] + '.nii.gz'
+        assert np.array_equal(np.asarray(nb.load(strTmp).dataobj),
+                              aryPrfRes[:, :, :, idxOut])
+        os.remove(strTmp)
+    os.remove(strPathOut + '_params.nii')
+
+    # Compact npz file:
+    export_sdcr(aryPrfRes, aryLgcMsk, aryAff, strPathOut)
+    objNpz = np.load(strPathOut + '_params.npz')
+    assert np.array_equal(objNpz['aryPrm'], aryTmp[aryLgcMsk, :])
+    assert np.array_equal(objNpz['vecIdxVox'], np.flatnonzero(aryLgcMsk))
+    os.remove(strPathOut + '_params.npz')
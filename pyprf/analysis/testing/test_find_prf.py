@@ -0,0 +1,584 @@
+"""Test pRF finding functions."""
+
+import os
+import time
+import shutil
+import numpy as np
+from pyprf.analysis import find_prf_main
+from pyprf.analysis import find_prf_cpu
+from pyprf.analysis import find_prf_idx
+from pyprf.analysis import find_prf_scr
+from pyprf.analysis import find_prf_sktch
+from pyprf.analysis import find_prf_null
+from pyprf.analysis import find_prf_pair
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.find_prf_spt import find_prf_spt
+from pyprf.analysis.find_prf_spt import crt_vox_pos
+from pyprf.analysis.cython_leastsquares import cy_lst_sq
+from pyprf.analysis.cython_leastsquares import cy_lst_sq_abnd
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+# Config parameters needed for pRF finding:
+dicCnfg = {'varNumX': 3,
+           'varNumY': 3,
+           'varNumPrfSizes': 2,
+           'varExtXmin': -5.0,
+           'varExtXmax': 5.0,
+           'varExtYmin': -5.0,
+           'varExtYmax': 5.0,
+           'varPrfStdMin': 1.0,
+           'varPrfStdMax': 3.0,
+           'varPar': 2,
+           'strVersion': 'numpy',
+           'varChnkSze': 10,
+           'varTmeOut': 0.0,
+           'varNumRtry': 1,
+           'varNumClst': 0,
+           'varNumPrb': 4,
+           'lgcIdxExct': False,
+           'varSzeSktch': 0,
+           'varNumCnd': 10,
+           'varNumVoxRcl': 1000,
+           'varNumTopK': 0,
+           'lgcPst': False,
+           'varTmpPst': 1.0,
+           'varNumSrgt': 0,
+           'strSrgt': 'phase',
+           'varSzeBlckSrgt': 10,
+           'varQFdr': 0.05,
+           'lgcPair': False,
+           'varNumNgbPair': 0}
+
+
+def crt_test_data():
+    """Create pRF time course models & noisy functional data."""
+    objRnd = np.random.RandomState(0)
+    aryPrfTc = objRnd.randn(3, 3, 2, 40).astype(np.float32)
+    # Each voxel time course is a scaled model time course plus noise:
+    vecIdx = objRnd.randint(0, 18, size=55)
+    aryFunc = (2.0 * aryPrfTc.reshape(18, 40)[vecIdx, :]
+               + 0.1 * objRnd.randn(55, 40)).astype(np.float32)
+    return aryFunc, aryPrfTc
+
+
+def test_find_prf_resume(monkeypatch):
+    """Test recovery from dead processes & resuming from checkpoint."""
+    strPathChk = strDir + '/result/checkpoint_test'
+    strPathFlg = strDir + '/result/checkpoint_test_flag'
+
+    aryFunc, aryPrfTc = crt_test_data()
+
+    # Reference (without checkpoint):
+    tplRef = find_prf(dicCnfg, aryFunc, aryPrfTc)
+
+    # Process for chunk 2 dies on first attempt (the flag file records that
+    # the chunk has failed once):
+    funcOrig = find_prf_cpu.find_prf_cpu
+
+    def find_prf_cpu_crash(idxPrc, *args):
+        if (idxPrc == 2) and (not os.path.isfile(strPathFlg)):
+            open(strPathFlg, 'w').close()
+            os._exit(1)
+        funcOrig(idxPrc, *args)
+
+    monkeypatch.setattr(find_prf_cpu, 'find_prf_cpu', find_prf_cpu_crash)
+    monkeypatch.setattr(find_prf_main, 'varTmePoll', 0.5)
+
+    tplTest = find_prf(dicCnfg, aryFunc, aryPrfTc, strPathChk=strPathChk)
+    assert os.path.isfile(strPathFlg)
+    for idxPrm in range(4):
+        assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+
+    # When resuming, completed chunks are not processed again (any process
+    # that is started would die):
+    def find_prf_cpu_dead(idxPrc, *args):
+        os._exit(1)
+
+    monkeypatch.setattr(find_prf_cpu, 'find_prf_cpu', find_prf_cpu_dead)
+
+    tplTest = find_prf(dicCnfg, aryFunc, aryPrfTc, strPathChk=strPathChk,
+                       lgcResume=True)
+    for idxPrm in range(4):
+        assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+
+    # Clean up:
+    shutil.rmtree(strPathChk)
+    os.remove(strPathFlg)
+
+
+def test_find_prf_timeout(monkeypatch):
+    """Test that processes exceeding the timeout are terminated & retried."""
+    strPathFlg = strDir + '/result/timeout_test_flag'
+
+    aryFunc, aryPrfTc = crt_test_data()
+    tplRef = find_prf(dicCnfg, aryFunc, aryPrfTc)
+
+    # Process for chunk 1 hangs on first attempt (while the results of the
+    # other chunks are sent):
+    funcOrig = find_prf_cpu.find_prf_cpu
+
+    def find_prf_cpu_hang(idxPrc, *args):
+        if (idxPrc == 1) and (not os.path.isfile(strPathFlg)):
+            open(strPathFlg, 'w').close()
+            time.sleep(60.0)
+        funcOrig(idxPrc, *args)
+
+    monkeypatch.setattr(find_prf_cpu, 'find_prf_cpu', find_prf_cpu_hang)
+    monkeypatch.setattr(find_prf_main, 'varTmePoll', 0.5)
+
+    dicCnfgTmp = dict(dicCnfg)
+    dicCnfgTmp['varTmeOut'] = 2.0
+    tplTest = find_prf(dicCnfgTmp, aryFunc, aryPrfTc)
+    assert os.path.isfile(strPathFlg)
+    for idxPrm in range(4):
+        assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+
+    # Clean up:
+    os.remove(strPathFlg)
+
+
+def test_find_prf_idx(monkeypatch):
+    """Test pRF finding using the model index."""
+    strPathMdl = strDir + '/result/index_test'
+
+    aryFunc, aryPrfTc = crt_test_data()
+
+    # Reference (exhaustive search):
+    tplRef = find_prf(dicCnfg, aryFunc, aryPrfTc)
+
+    # If all clusters are searched, the results are the same as those of the
+    # exhaustive search:
+    dicCnfgIdx = dict(dicCnfg)
+    dicCnfgIdx['strPathMdl'] = strPathMdl
+    dicCnfgIdx['varNumClst'] = 4
+    dicCnfgIdx['varNumPrb'] = 4
+    tplTest = find_prf(dicCnfgIdx, aryFunc, aryPrfTc)
+    for idxPrm in range(3):
+        assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+    assert np.allclose(tplRef[3], tplTest[3], atol=1e-4)
+    assert os.path.isfile(strPathMdl + '_index.npz')
+
+    # The saved index is reused:
+    def crt_idx_fail(*args):
+        raise AssertionError('Index should not be created again')
+
+    monkeypatch.setattr(find_prf_idx, 'crt_idx', crt_idx_fail)
+    aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+    tplIdx = find_prf_idx.load_idx(strPathMdl, aryMdlNrm, 4)
+    assert tplIdx[0].shape == (4, 40)
+
+    # Recall is one if all clusters are searched:
+    assert find_prf_idx.rcl_idx(aryMdlNrm, tplIdx, aryFunc, 4, 20)[0] == 1.0
+
+    # Exact search (branch and bound), starting from a single cluster:
+    dicCnfgIdx['varNumPrb'] = 1
+    dicCnfgIdx['lgcIdxExct'] = True
+    tplTest = find_prf(dicCnfgIdx, aryFunc, aryPrfTc)
+    for idxPrm in range(3):
+        assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+    assert np.allclose(tplRef[3], tplTest[3], atol=1e-4)
+
+    # Clean up:
+    os.remove(strPathMdl + '_index.npz')
+
+
+def test_srch_idx_exct():
+    """Test exact search using the model index on a dense model grid."""
+    objRnd = np.random.RandomState(1)
+
+    # Smooth model time courses on a dense grid (neighbouring models are
+    # similar), and noisy voxel time courses:
+    vecTme = np.linspace(0.0, 1.0, num=100)
+    vecCntr = np.linspace(0.0, 1.0, num=30)
+    vecWdth = np.linspace(0.02, 0.2, num=20)
+    aryPrfTc = np.exp(-0.5 * np.square(
+        (vecTme[None, None, :] - vecCntr[:, None, None])
+        / vecWdth[None, :, None]))[:, :, None, :]
+    aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+    vecIdx = objRnd.randint(0, aryMdlNrm.shape[0], size=300)
+    aryFunc = (aryMdlNrm[vecIdx, :]
+               + 0.05 * objRnd.randn(300, 100)).astype(np.float32)
+
+    tplIdx = find_prf_idx.crt_hrc(aryMdlNrm, 25)
+    vecIdxTest, vecR2Test, varNumCmp = find_prf_idx.srch_idx(
+        aryMdlNrm, tplIdx, aryFunc, 1, lgcExct=True)
+
+    vecIdxRef = find_prf_idx.srch_full(aryMdlNrm, aryFunc)
+    assert np.array_equal(vecIdxRef, vecIdxTest)
+    assert varNumCmp < (0.5 * aryMdlNrm.shape[0] * aryFunc.shape[0])
+
+
+def test_find_prf_cython():
+    """Test cython version (early abandoning) against numpy version."""
+    aryFunc, aryPrfTc = crt_test_data()
+
+    # Z-score voxel time courses (the best residuals are initialised with a
+    # fixed value, see `find_prf_cpu`):
+    aryFunc = ((aryFunc - np.mean(aryFunc, axis=1)[:, None])
+               / np.std(aryFunc, axis=1)[:, None])
+
+    tplRef = find_prf(dicCnfg, aryFunc, aryPrfTc)
+
+    dicCnfgCy = dict(dicCnfg)
+    dicCnfgCy['strVersion'] = 'cython'
+    tplTest = find_prf(dicCnfgCy, aryFunc, aryPrfTc)
+    for idxPrm in range(3):
+        assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+    assert np.allclose(tplRef[3], tplTest[3], atol=1e-4)
+
+    # Residuals are only abandoned once they exceed the best residuals:
+    aryFuncT = np.ascontiguousarray(
+        (aryFunc - np.mean(aryFunc, axis=1)[:, None]).T, dtype=np.float32)
+    vecMdl = aryPrfTc[0, 0, 0, :] - np.mean(aryPrfTc[0, 0, 0, :])
+    vecRes = cy_lst_sq(vecMdl, aryFuncT)
+    vecBstRes = np.median(vecRes) * np.ones(vecRes.shape, dtype=np.float32)
+    vecResAbnd = cy_lst_sq_abnd(vecMdl, aryFuncT, vecBstRes)
+    vecLgc = np.less_equal(vecRes, vecBstRes)
+    assert np.array_equal(vecRes[vecLgc], vecResAbnd[vecLgc])
+    assert np.all(np.greater(vecResAbnd[~vecLgc], vecBstRes[~vecLgc]))
+    assert np.all(np.less_equal(vecResAbnd[~vecLgc], vecRes[~vecLgc]))
+
+    # Each model is fitted exactly once:
+    vecIdxCrs = find_prf_cpu.crt_mdl_ord((5, 4, 3))
+    vecIdxMdl = find_prf_cpu.crt_mdl_ord((5, 4, 3), vecIdxCrs=vecIdxCrs,
+                                         vecBstIdx=vecIdxCrs[[1, 1, 2]])
+    assert np.array_equal(np.sort(vecIdxMdl), np.arange(60))
+
+
+def test_find_prf_spt():
+    """Test pRF finding starting from neighbouring voxels."""
+    objRnd = np.random.RandomState(2)
+
+    dicCnfgSpt = dict(dicCnfg)
+    dicCnfgSpt.update({'varNumX': 8, 'varNumY': 8, 'varNumPrfSizes': 3,
+                       'varSpcLtc': 2, 'varNumNgb': 1})
+    vecMdlXpos, vecMdlYpos, vecMdlSd = find_prf_main.crt_mdl_prms(dicCnfgSpt)
+
+    # Model time courses for a bar sweeping horizontally, then vertically:
+    vecBar = np.linspace(-5.0, 5.0, num=40)
+    aryPrfTc = np.concatenate(
+        (np.broadcast_to(np.exp(-0.5 * np.square(
+            (vecBar[None, None, None, :] - vecMdlXpos[:, None, None, None])
+            / vecMdlSd[None, None, :, None])), (8, 8, 3, 40)),
+         np.broadcast_to(np.exp(-0.5 * np.square(
+             (vecBar[None, None, None, :] - vecMdlYpos[None, :, None, None])
+             / vecMdlSd[None, None, :, None])), (8, 8, 3, 40))),
+        axis=3).astype(np.float32)
+
+    # Volume with smoothly changing pRF parameters:
+    aryVoxPos = np.stack(np.unravel_index(np.arange(8 * 8 * 3), (8, 8, 3)),
+                         axis=1)
+    aryIdxMdl = np.stack([aryVoxPos[:, 0], aryVoxPos[:, 1],
+                          (aryVoxPos[:, 2] % 3)], axis=1)
+    aryFunc = (2.0 * aryPrfTc[tuple(aryIdxMdl.T)]
+               + 0.3 * objRnd.randn(aryVoxPos.shape[0], 80))
+    aryFunc = ((aryFunc - np.mean(aryFunc, axis=1)[:, None])
+               / np.std(aryFunc, axis=1)[:, None]).astype(np.float32)
+
+    tplRef = find_prf(dicCnfgSpt, aryFunc, aryPrfTc)
+    tplTest = find_prf_spt(dicCnfgSpt, aryFunc, aryPrfTc, aryVoxPos)
+
+    for idxPrm in range(3):
+        assert np.mean(np.equal(tplRef[idxPrm], tplTest[idxPrm])) > 0.95
+    # The neighbourhood search cannot find better fits than the exhaustive
+    # search:
+    assert np.all(np.less_equal(tplTest[3], (tplRef[3] + 1e-4)))
+
+    # Voxel positions from mask:
+    aryLgcMsk = np.zeros(24, dtype=bool)
+    aryLgcMsk[[1, 5, 7, 20]] = True
+    aryLgcVar = np.array([True, False, True, True])
+    assert np.array_equal(crt_vox_pos(aryLgcMsk, aryLgcVar, (2, 3, 4, 10)),
+                          [[0, 0, 1], [0, 1, 3], [1, 2, 0]])
+
+
+def test_scr_vox():
+    """Test screening of voxels."""
+    objRnd = np.random.RandomState(3)
+
+    # Smooth model time courses, and voxels with & without response:
+    vecTme = np.linspace(0.0, 1.0, num=100)
+    vecCntr = np.linspace(0.0, 1.0, num=30)
+    vecWdth = np.linspace(0.02, 0.2, num=20)
+    aryPrfTc = np.exp(-0.5 * np.square(
+        (vecTme[None, None, :] - vecCntr[:, None, None])
+        / vecWdth[None, :, None]))[:, :, None, :]
+    aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+    vecIdx = objRnd.randint(0, aryMdlNrm.shape[0], size=100)
+    aryFunc = np.concatenate(
+        ((aryMdlNrm[vecIdx, :] + 0.05 * objRnd.randn(100, 100)),
+         objRnd.randn(100, 100))).astype(np.float32)
+
+    # Exact R2 of best fitting model:
+    vecR2 = np.max(np.square(np.dot(aryMdlNrm.astype(np.float64),
+                                    find_prf_idx.prp_func(aryFunc).T)),
+                   axis=0)
+
+    # The screening R2 is an upper bound, tight enough to skip most voxels
+    # without response:
+    for varRnkScr in [5, 20]:
+        vecR2Scr = find_prf_scr.scr_vox(
+            aryFunc, find_prf_scr.crt_bss_scr(aryPrfTc, varRnkScr))
+        assert np.all(np.greater_equal((vecR2Scr + 1e-5), vecR2))
+    assert np.mean(np.less(vecR2Scr[100:], 0.3)) > 0.9
+    assert np.all(np.greater(vecR2Scr[:100], 0.3))
+
+    # Skipped voxels are set to zero:
+    lstRes = find_prf_scr.expnd_res([np.array([1.0, 2.0])],
+                                    np.array([False, True, True, False]))
+    assert np.array_equal(lstRes[0], [0.0, 1.0, 2.0, 0.0])
+
+
+def test_find_prf_sktch():
+    """Test pRF finding using random sketches of the time courses."""
+    aryFunc, aryPrfTc = crt_test_data()
+
+    # If all models are candidates, the results are the same as those of the
+    # exhaustive search:
+    tplRef = find_prf(dicCnfg, aryFunc, aryPrfTc)
+    dicCnfgSktch = dict(dicCnfg)
+    dicCnfgSktch['varSzeSktch'] = 8
+    dicCnfgSktch['varNumCnd'] = 18
+    tplTest = find_prf(dicCnfgSktch, aryFunc, aryPrfTc)
+    for idxPrm in range(3):
+        assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+    assert np.allclose(tplRef[3], tplTest[3], atol=1e-4)
+
+    # Long time courses:
+    objRnd = np.random.RandomState(4)
+    vecTme = np.linspace(0.0, 1.0, num=2000)
+    vecCntr = np.linspace(0.0, 1.0, num=30)
+    vecWdth = np.linspace(0.005, 0.05, num=10)
+    aryPrfTc = np.exp(-0.5 * np.square(
+        (vecTme[None, None, :] - vecCntr[:, None, None])
+        / vecWdth[None, :, None]))[:, :, None, :]
+    aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+    vecIdx = objRnd.randint(0, aryMdlNrm.shape[0], size=200)
+    aryFunc = (aryMdlNrm[vecIdx, :]
+               + 0.02 * objRnd.randn(200, 2000)).astype(np.float32)
+
+    arySktch = find_prf_sktch.crt_sktch(2000, 100)
+    aryMdlSktch = np.dot(aryMdlNrm, arySktch)
+    vecIdxTest, vecR2Test = find_prf_sktch.srch_sktch(
+        aryMdlNrm, aryMdlSktch, arySktch, aryFunc, 10)
+    assert find_prf_sktch.rcl_sktch(aryMdlNrm, aryMdlSktch, arySktch,
+                                    aryFunc, 10, 200) > 0.9
+
+    # The R2 value of the selected model is exact:
+    vecR2Ref = np.square(np.sum(
+        (aryMdlNrm[vecIdxTest, :] * find_prf_idx.prp_func(aryFunc)), axis=1))
+    assert np.allclose(vecR2Ref, vecR2Test, atol=1e-5)
+
+
+def test_find_prf_topk(monkeypatch):
+    """Test retention of the best fitting models of each voxel."""
+    aryFunc, aryPrfTc = crt_test_data()
+
+    # Residuals of all models (with constant term), for comparison:
+    aryDsgn = np.stack([aryPrfTc.reshape(18, 40),
+                        np.ones((18, 40), dtype=np.float32)], axis=2)
+    aryResRef = np.stack([np.linalg.lstsq(aryDsgn[idxMdl], aryFunc.T,
+                                          rcond=None)[1]
+                          for idxMdl in range(18)], axis=1)
+    aryIdxRef = np.argsort(aryResRef, axis=1, kind='mergesort')[:, :5]
+
+    # Small blocks of models, so that the best fitting models are updated
+    # repeatedly:
+    monkeypatch.setattr(find_prf_cpu, 'varNumMdlBlck', 4)
+
+    for strVersion in ['numpy', 'cython']:
+        dicCnfgTopK = dict(dicCnfg)
+        dicCnfgTopK['strVersion'] = strVersion
+        dicCnfgTopK['varNumTopK'] = 5
+        tplRef = find_prf(dicCnfgTopK, aryFunc, aryPrfTc)
+        tplTest = find_prf(dicCnfgTopK, aryFunc, aryPrfTc, lgcTopK=True)
+        for idxPrm in range(4):
+            assert np.array_equal(tplRef[idxPrm], tplTest[idxPrm])
+        aryTopIdx, aryTopRes, aryTopR2 = tplTest[4:]
+        assert aryTopIdx.shape == (55, 5)
+        assert np.array_equal(aryTopIdx, aryIdxRef)
+        assert np.allclose(aryTopRes,
+                           np.take_along_axis(aryResRef, aryIdxRef, axis=1),
+                           rtol=1e-3)
+        # The first model is the best fitting model:
+        assert np.allclose(aryTopR2[:, 0], tplRef[3], atol=1e-5)
+        assert np.all(np.diff(aryTopR2, axis=1) <= 0.0)
+
+    # Fewer models than retained models:
+    tplTest = find_prf_cpu.upd_topk(
+        np.full((3, 2), np.inf, dtype=np.float32),
+        np.zeros((3, 2), dtype=np.int64) - 1,
+        np.array([[2.0, 1.0], [1.0, 1.0]], dtype=np.float32),
+        np.array([7, 4]))
+    assert np.array_equal(tplTest[1], [[4, 4], [7, 7], [-1, -1]])
+
+
+def test_find_prf_pst():
+    """Test calculation of the posterior of the pRF parameters."""
+    aryFunc, aryPrfTc = crt_test_data()
+    # Noisier data, so that the posterior is not concentrated on one model:
+    aryFunc = (aryFunc + 2.0 * np.random.RandomState(1).randn(55, 40)
+               ).astype(np.float32)
+
+    # Posterior from residuals of all models, for comparison:
+    aryDsgn = np.stack([aryPrfTc.reshape(18, 40),
+                        np.ones((18, 40), dtype=np.float32)], axis=2)
+    aryResRef = np.stack([np.linalg.lstsq(aryDsgn[idxMdl], aryFunc.T,
+                                          rcond=None)[1]
+                          for idxMdl in range(18)], axis=1)
+    aryLogWgt = -20.0 * np.log(aryResRef) / 2.0
+    aryWgt = np.exp(aryLogWgt - np.max(aryLogWgt, axis=1)[:, None])
+    aryWgt /= np.sum(aryWgt, axis=1)[:, None]
+    vecMdlXpos, vecMdlYpos, vecMdlSd = find_prf_main.crt_mdl_prms(dicCnfg)
+    aryPrm = np.stack(np.meshgrid(vecMdlXpos, vecMdlYpos, vecMdlSd,
+                                  indexing='ij'), axis=3).reshape(18, 3)
+    aryMeanRef = np.dot(aryWgt, aryPrm)
+    arySdRef = np.sqrt(np.dot(aryWgt, np.square(aryPrm))
+                       - np.square(aryMeanRef))
+
+    for strVersion in ['numpy', 'cython']:
+        dicCnfgPst = dict(dicCnfg)
+        dicCnfgPst['strVersion'] = strVersion
+        dicCnfgPst['lgcPst'] = True
+        dicCnfgPst['varTmpPst'] = 2.0
+        tplTest = find_prf(dicCnfgPst, aryFunc, aryPrfTc, lgcPst=True)
+        assert len(tplTest) == 5
+        aryPst = tplTest[4]
+        assert np.allclose(aryPst[:, :3], aryMeanRef, atol=1e-3)
+        assert np.allclose(aryPst[:, 3:], arySdRef, atol=1e-3)
+        assert np.any(np.greater(aryPst[:, 3:], 0.1))
+
+    # Accumulation does not overflow for large log-weights:
+    aryPst = find_prf_cpu.crt_pst(2)
+    find_prf_cpu.upd_pst(aryPst, np.array([1000.0, -1000.0]), (1.0, 2.0, 3.0))
+    find_prf_cpu.upd_pst(aryPst, np.array([1000.0, -2000.0]), (3.0, 2.0, 1.0))
+    aryPst = find_prf_cpu.fin_pst(aryPst)
+    assert np.allclose(aryPst[0, :], [2.0, 2.0, 2.0, 1.0, 0.0, 1.0])
+    assert np.allclose(aryPst[1, :], [1.0, 2.0, 3.0, 0.0, 0.0, 0.0])
+
+
+def test_find_prf_null():
+    """Test p-values of R2 values from surrogate data."""
+    aryFunc, aryPrfTc = crt_test_data()
+    objRnd = np.random.RandomState(2)
+
+    # Phase randomisation preserves the power spectrum, block permutation the
+    # values of each time course:
+    arySrgt = find_prf_null.crt_srgt(aryFunc[:3, :], 4, 'phase', 10, objRnd)
+    assert arySrgt.shape == (3, 4, 40)
+    assert np.allclose(np.abs(np.fft.rfft(arySrgt, axis=2)),
+                       np.abs(np.fft.rfft(aryFunc[:3, None, :], axis=2)),
+                       atol=1e-3)
+    arySrgt = find_prf_null.crt_srgt(aryFunc[:3, :], 4, 'block', 10, objRnd)
+    assert np.array_equal(np.sort(arySrgt, axis=2),
+                          np.sort(np.repeat(aryFunc[:3, None, :], 4, axis=1),
+                                  axis=2))
+
+    # R2 values of best fitting models of surrogates are those of the
+    # exhaustive search:
+    aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+    aryR2Null = find_prf_null.null_r2(aryMdlNrm, arySrgt)
+    vecIdxRef = find_prf_idx.srch_full(aryMdlNrm, arySrgt.reshape(12, 40))
+    vecR2Ref = np.square(np.sum(
+        (aryMdlNrm[vecIdxRef, :]
+         * find_prf_idx.prp_func(arySrgt.reshape(12, 40))), axis=1))
+    assert np.allclose(aryR2Null.flatten(), vecR2Ref, atol=1e-5)
+
+    # Voxels with signal are significant, p-values of noise are uniform:
+    aryFunc = np.concatenate(
+        (aryFunc, objRnd.randn(200, 40).astype(np.float32)), axis=0)
+    dicCnfgNull = dict(dicCnfg)
+    dicCnfgNull['varNumSrgt'] = 19
+    vecR2 = find_prf(dicCnfgNull, aryFunc, aryPrfTc)[3]
+    vecPval = find_prf_null.find_prf_null(dicCnfgNull, aryFunc, aryPrfTc,
+                                          vecR2)
+    assert np.allclose(vecPval[:55], 0.05)
+    assert 0.4 < np.mean(vecPval[55:]) < 0.6
+    vecLgcSig = np.less_equal(vecPval, find_prf_null.fdr_thr(vecPval, 0.2))
+    assert np.all(vecLgcSig[:55])
+    assert np.mean(vecLgcSig[55:]) < 0.1
+
+    # Benjamini & Hochberg procedure:
+    assert find_prf_null.fdr_thr(np.array([0.01, 0.02, 0.9]), 0.05) == 0.02
+    assert find_prf_null.fdr_thr(np.array([0.5, 0.9]), 0.05) == 0.0
+
+
+def test_find_prf_pair():
+    """Test pRF finding with pairs of models (two Gaussians)."""
+    aryFunc, aryPrfTc = crt_test_data()
+    objRnd = np.random.RandomState(3)
+    # Each voxel time course is a combination of two model time courses:
+    aryMdl = aryPrfTc.reshape(18, 40)
+    vecIdx = objRnd.randint(0, 18, size=55)
+    aryFunc = (aryFunc + aryMdl[vecIdx, :] + 0.1 * objRnd.randn(55, 40)
+               ).astype(np.float32)
+
+    aryMdlNrm = find_prf_idx.crt_mdl_nrm(aryPrfTc)
+    tplPair = tuple([np.concatenate(lstTmp) for lstTmp in zip(
+        *find_prf_pair.crt_pair(aryMdlNrm, (3, 3, 2), 0))])
+    assert tplPair[0].size == 153
+    aryIdxBst, vecR2, aryWgt = find_prf_pair.srch_pair(aryMdlNrm, aryFunc,
+                                                       (3, 3, 2), 0)
+
+    # Comparison with linear regression for all pairs:
+    aryFuncNrm = find_prf_idx.prp_func(aryFunc)
+    aryR2Ref = np.zeros((153, 55))
+    for idxPair in range(153):
+        aryDsgn = np.stack([aryMdlNrm[tplPair[0][idxPair], :],
+                            aryMdlNrm[tplPair[1][idxPair], :],
+                            np.ones(40)], axis=1)
+        aryBeta = np.linalg.lstsq(aryDsgn, aryFuncNrm.T, rcond=None)[0]
+        aryR2Ref[idxPair, :] = 1.0 - np.sum(
+            np.square(aryFuncNrm.T - np.dot(aryDsgn, aryBeta)), axis=0)
+        vecLgc = np.logical_and(np.equal(aryIdxBst[:, 0],
+                                         tplPair[0][idxPair]),
+                                np.equal(aryIdxBst[:, 1],
+                                         tplPair[1][idxPair]))
+        assert np.allclose(aryWgt[vecLgc, :], aryBeta[0:2, vecLgc].T,
+                           atol=1e-4)
+    vecIdxBst = np.argmax(aryR2Ref, axis=0)
+    assert np.array_equal(aryIdxBst[:, 0], tplPair[0][vecIdxBst])
+    assert np.array_equal(aryIdxBst[:, 1], tplPair[1][vecIdxBst])
+    assert np.allclose(vecR2, np.max(aryR2Ref, axis=0), atol=1e-5)
+
+    # Same pairs & results if pairs are created in small blocks:
+    varSzeBlckPair = find_prf_pair.varSzeBlckPair
+    varSzeBlckGrm = find_prf_pair.varSzeBlckGrm
+    try:
+        find_prf_pair.varSzeBlckPair = 7
+        find_prf_pair.varSzeBlckGrm = 40
+        lstBlck = list(find_prf_pair.crt_pair(aryMdlNrm, (3, 3, 2), 0))
+        assert max([tplTmp[0].size for tplTmp in lstBlck]) == 7
+        for idxTmp in range(3):
+            assert np.allclose(np.concatenate([tplTmp[idxTmp]
+                                               for tplTmp in lstBlck]),
+                               tplPair[idxTmp])
+        tplRes = find_prf_pair.srch_pair(aryMdlNrm, aryFunc, (3, 3, 2), 0)
+        assert np.array_equal(tplRes[0], aryIdxBst)
+        assert np.allclose(tplRes[1], vecR2)
+    finally:
+        find_prf_pair.varSzeBlckPair = varSzeBlckPair
+        find_prf_pair.varSzeBlckGrm = varSzeBlckGrm
+
+    # Only pairs of models that are close in the visual field:
+    tplPairNgb = tuple([np.concatenate(lstTmp) for lstTmp in zip(
+        *find_prf_pair.crt_pair(aryMdlNrm, (3, 3, 2), 1))])
+    aryIdx1 = np.stack(np.unravel_index(tplPairNgb[0], (3, 3, 2)), axis=1)
+    aryIdx2 = np.stack(np.unravel_index(tplPairNgb[1], (3, 3, 2)), axis=1)
+    assert np.all(np.abs(aryIdx1[:, 0:2] - aryIdx2[:, 0:2]) <= 1)
+    assert tplPairNgb[0].size < 153
+
+    # Parameters of the best fitting pair:
+    dicCnfgPair = dict(dicCnfg)
+    dicCnfgPair['lgcPair'] = True
+    aryPair = find_prf_pair.find_prf_pair(dicCnfgPair, aryFunc, aryPrfTc)
+    assert aryPair.shape == (55, 9)
+    assert np.allclose(aryPair[:, 6], vecR2)
+    assert np.allclose(aryPair[:, 7:9], aryWgt)
+    vecMdlXpos, vecMdlYpos, vecMdlSd = find_prf_main.crt_mdl_prms(dicCnfg)
+    aryIdx2 = np.stack(np.unravel_index(aryIdxBst[:, 1], (3, 3, 2)), axis=1)
+    assert np.array_equal(aryPair[:, 3], vecMdlXpos[aryIdx2[:, 0]])
+    assert np.array_equal(aryPair[:, 4], vecMdlYpos[aryIdx2[:, 1]])
+    assert np.array_equal(aryPair[:, 5], vecMdlSd[aryIdx2[:, 2]])
@@ -0,0 +1,119 @@
+"""Test preprocessing functions."""
+
+import os
+import shutil
+import numpy as np
+from pyprf.analysis.preprocessing_main import pre_pro_func
+from pyprf.analysis.preprocessing_par import pre_pro_par
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_pre_pro_func_cache():
+    """Test that cached preprocessed data equal freshly preprocessed data."""
+    # Directory for cache (inside the results directory):
+    strPathCch = strDir + '/result/cache_test'
+
+    # Functional data and mask:
+    lstPathNiiFunc = [(strDir + '/exmpl_data_func_01.nii.gz'),
+                      (strDir + '/exmpl_data_func_02.nii.gz')]
+    strPathNiiMask = strDir + '/exmpl_data_mask.nii.gz'
+
+    # Preprocessing parameters:
+    dicPrm = {'lgcLinTrnd': True,
+              'varSdSmthTmp': 1.2,
+              'varSdSmthSpt': 0.0,
+              'varPar': 2,
+              'varTr': 2.079}
+
+    # Without cache:
+    tplRef = pre_pro_func(strPathNiiMask, lstPathNiiFunc, **dicPrm)
+
+    # First call with cache (creates cache entry), second call with cache
+    # (loads cache entry):
+    tplTest01 = pre_pro_func(strPathNiiMask, lstPathNiiFunc,
+                             strPathCch=strPathCch, **dicPrm)
+    tplTest02 = pre_pro_func(strPathNiiMask, lstPathNiiFunc,
+                             strPathCch=strPathCch, **dicPrm)
+
+    # There should be exactly one cache entry:
+    assert len(os.listdir(strPathCch)) == 1
+
+    for tplTest in [tplTest01, tplTest02]:
+        # Mask, low-variance exclusion & functional data:
+        assert np.array_equal(tplRef[0], tplTest[0])
+        assert np.array_equal(tplRef[3], tplTest[3])
+        assert np.array_equal(tplRef[4], tplTest[4])
+        # Affine & shape:
+        assert np.array_equal(tplRef[2], tplTest[2])
+        assert tuple(tplRef[5]) == tuple(tplTest[5])
+
+    # Different preprocessing parameters must not reuse the cache entry:
+    dicPrm['lgcLinTrnd'] = False
+    pre_pro_func(strPathNiiMask, lstPathNiiFunc, strPathCch=strPathCch,
+                 **dicPrm)
+    assert len(os.listdir(strPathCch)) == 2
+
+    # Clean up:
+    shutil.rmtree(strPathCch)
+
+
+def test_pre_pro_func_slab():
+    """Test that slab-wise preprocessing equals preprocessing of volume."""
+    # Functional data and mask:
+    lstPathNiiFunc = [(strDir + '/exmpl_data_func_01.nii.gz')]
+    strPathNiiMask = strDir + '/exmpl_data_mask.nii.gz'
+
+    # Preprocessing parameters (with spatial smoothing, so that the halo
+    # around slabs matters):
+    dicPrm = {'lgcLinTrnd': True,
+              'varSdSmthTmp': 1.2,
+              'varSdSmthSpt': 1.25,
+              'varPar': 2}
+
+    # Preprocessing of entire volume:
+    aryLgcMsk, _, _, aryLgcVar, aryFunc, tplNiiShp = pre_pro_func(
+        strPathNiiMask, lstPathNiiFunc, **dicPrm)
+
+    # Put preprocessed data back into volume:
+    aryRef = np.zeros((np.sum(aryLgcMsk), aryFunc.shape[1]),
+                      dtype=np.float32)
+    aryRef[aryLgcVar, :] = aryFunc
+    aryTmp = np.zeros((aryLgcMsk.shape[0], aryFunc.shape[1]),
+                      dtype=np.float32)
+    aryTmp[aryLgcMsk, :] = aryRef
+    aryRef = np.reshape(aryTmp, (tplNiiShp[0], tplNiiShp[1], tplNiiShp[2],
+                                 aryFunc.shape[1]))
+
+    # Preprocessing of slabs (three slices per slab):
+    for varSlbSrt in range(0, tplNiiShp[2], 3):
+
+        tplSlb = (varSlbSrt, min(tplNiiShp[2], (varSlbSrt + 3)))
+
+        aryLgcMsk, _, _, aryLgcVar, aryFunc, tplSlbShp = pre_pro_func(
+            strPathNiiMask, lstPathNiiFunc, tplSlb=tplSlb, **dicPrm)
+
+        assert tplSlbShp[2] == (tplSlb[1] - tplSlb[0])
+
+        # Voxels in mask & with sufficient variance in reference data:
+        aryTmp = np.reshape(aryRef[:, :, tplSlb[0]:tplSlb[1], :],
+                            (-1, aryRef.shape[3]))
+        aryTmp = aryTmp[aryLgcMsk, :][aryLgcVar, :]
+
+        assert np.array_equal(aryTmp, aryFunc)
+
+
+def test_pre_pro_par_serial():
+    """Test that preprocessing without parallelisation equals parallel."""
+    # Random data & mask:
+    objRnd = np.random.RandomState(0)
+    aryFunc = objRnd.randn(6, 5, 4, 30).astype(np.float32)
+    aryMask = np.ones((6, 5, 4), dtype=np.int16)
+    aryMask[0, 0, :] = 0
+
+    lstRes = [pre_pro_par(aryFunc.copy(), aryMask=aryMask, lgcLinTrnd=True,
+                          varSdSmthTmp=1.2, varSdSmthSpt=1.0, varPar=varPar)
+              for varPar in [1, 2]]
+
+    assert np.allclose(lstRes[0], lstRes[1])
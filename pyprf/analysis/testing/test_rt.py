@@ -0,0 +1,71 @@
+"""Test real-time pRF mapping."""
+
+import os
+import shutil
+import numpy as np
+import nibabel as nb
+from pyprf.analysis.load_config import load_config
+from pyprf.analysis.utilities import load_nii
+from pyprf.analysis.find_prf_main import crt_mdl_prms
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.pyprf_rt import cls_rt_prf
+from pyprf.analysis.pyprf_rt import pyprf_rt
+from pyprf.analysis.testing.test_shard import crt_test_config
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_rt():
+    """Test that incremental results equal results of complete fit."""
+    strCsvCnfg, strPathBse = crt_test_config('rt_test')
+    dicCnfg = load_config(strCsvCnfg)
+    aryPrfTc = np.load(strPathBse + '_model_tc.npy')
+    vecMdlXpos, vecMdlYpos, vecMdlSd = crt_mdl_prms(dicCnfg)
+
+    aryMask = load_nii(strDir + '/exmpl_data_mask.nii.gz')[0]
+    aryFunc = np.concatenate(
+        [load_nii(strDir + '/exmpl_data_func_0' + str(idxRun)
+                  + '.nii.gz')[0] for idxRun in [1, 2]], axis=3)
+    aryLgcMsk = np.greater(aryMask, 0)
+    # Scaling of the data (the initial residuals in `find_prf_cpu` are not
+    # suited for raw data):
+    aryFunc = np.divide(
+        np.subtract(aryFunc, np.mean(aryFunc, axis=3)[:, :, :, None]),
+        np.add(np.std(aryFunc, axis=3)[:, :, :, None], 1.0)
+        ).astype(np.float32)
+
+    objRt = cls_rt_prf(aryPrfTc, aryMask, vecMdlXpos, vecMdlYpos, vecMdlSd,
+                       varNumBuf=7)
+
+    for varNumVol in [150, 400]:
+
+        while objRt.get_num_vol() < varNumVol:
+            objRt.add_vol(aryFunc[:, :, :, objRt.get_num_vol()])
+        aryPrfRes = objRt.get_res()
+
+        # Reference, complete fit for the volumes so far:
+        aryRef = find_prf(dicCnfg, aryFunc[aryLgcMsk, :varNumVol],
+                          aryPrfTc[:, :, :, :varNumVol])
+        for idxPrm in range(3):
+            assert np.array_equal(aryPrfRes[aryLgcMsk, idxPrm],
+                                  aryRef[idxPrm])
+        assert np.allclose(aryPrfRes[aryLgcMsk, 3], aryRef[3], atol=1e-4)
+
+    # Real-time mapping, with volumes read from a directory:
+    strDirIn = strPathBse + '_input'
+    os.makedirs(strDirIn)
+    for idxVol in range(0, 400, 100):
+        nb.save(nb.Nifti1Image(aryFunc[:, :, :, idxVol:(idxVol + 100)],
+                               np.eye(4)),
+                os.path.join(strDirIn, 'vol_' + str(idxVol).zfill(4)
+                             + '.nii.gz'))
+    pyprf_rt(strCsvCnfg, strDirIn, varExpIntv=100, varTmeOut=1.0)
+    aryTest = np.asarray(nb.load(strPathBse + '_x_pos.nii.gz').dataobj)
+    assert np.array_equal(aryTest, aryPrfRes[:, :, :, 0])
+
+    # Clean up:
+    shutil.rmtree(strDirIn)
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('rt_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
@@ -0,0 +1,135 @@
+"""Test local pRF mapping service."""
+
+import os
+import time
+import pytest
+import threading
+import multiprocessing as mp
+import numpy as np
+import nibabel as nb
+from pyprf.analysis.pyprf_main import pyprf
+from pyprf.analysis.pyprf_serve import pyprf_serve
+from pyprf.analysis.pyprf_serve import load_bank
+from pyprf.analysis.pyprf_serve import pyprf_submit
+from pyprf.analysis.export_results import lstNiiNames
+from pyprf.analysis.testing.test_shard import crt_test_config
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_serve():
+    """Test that service gives same results as separate analysis."""
+    strCsvCnfg, strPathBse = crt_test_config('serve_test')
+    strPathSck = strPathBse + '.sock'
+
+    # Reference:
+    pyprf(strCsvCnfg)
+
+    objPrc = mp.Process(target=pyprf_serve, args=([strCsvCnfg], strPathSck))
+    objPrc.start()
+
+    # Wait for service to be ready:
+    for idxTry in range(600):
+        if os.path.exists(strPathSck):
+            break
+        time.sleep(0.1)
+    assert pyprf_submit(strPathSck, {'cmd': 'ping'})['status'] == 'ok'
+
+    # Two jobs (the second one uses the persistent workers again):
+    for idxJob in range(2):
+        dicRes = pyprf_submit(
+            strPathSck,
+            {'func': [(strDir + '/exmpl_data_func_01.nii.gz'),
+                      (strDir + '/exmpl_data_func_02.nii.gz')],
+             'mask': strDir + '/exmpl_data_mask.nii.gz',
+             'out': strPathBse + '_job0' + str(idxJob)})
+        assert dicRes['status'] == 'ok'
+
+    # Job with non-existing data fails, without stopping the service:
+    dicRes = pyprf_submit(strPathSck,
+                          {'func': [strDir + '/missing.nii.gz'],
+                           'mask': strDir + '/exmpl_data_mask.nii.gz',
+                           'out': strPathBse + '_missing'})
+    assert dicRes['status'] == 'error'
+
+    assert pyprf_submit(strPathSck, {'cmd': 'shutdown'})['status'] == 'ok'
+    objPrc.join()
+    assert objPrc.exitcode == 0
+
+    for strNii in lstNiiNames:
+        aryRef = np.asarray(nb.load(strPathBse + strNii
+                                    + '.nii.gz').dataobj)
+        for idxJob in range(2):
+            aryTest = np.asarray(nb.load(strPathBse + '_job0' + str(idxJob)
+                                         + strNii + '.nii.gz').dataobj)
+            assert np.array_equal(aryRef, aryTest)
+
+    # Clean up:
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('serve_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
+
+
+def test_serve_shutdown():
+    """Test that queued jobs are answered when the service is shut down."""
+    strCsvCnfg, strPathBse = crt_test_config('serve_stop_test')
+    strPathSck = strPathBse + '.sock'
+
+    objPrc = mp.Process(target=pyprf_serve, args=([strCsvCnfg], strPathSck))
+    objPrc.start()
+    for idxTry in range(600):
+        if os.path.exists(strPathSck):
+            break
+        time.sleep(0.1)
+
+    # Several jobs are queued, and the service is shut down while the first
+    # one is running:
+    lstRes = []
+
+    def funcSubmit(idxJob):
+        """Submit job & keep reply."""
+        lstRes.append(pyprf_submit(
+            strPathSck,
+            {'func': [(strDir + '/exmpl_data_func_01.nii.gz'),
+                      (strDir + '/exmpl_data_func_02.nii.gz')],
+             'mask': strDir + '/exmpl_data_mask.nii.gz',
+             'out': strPathBse + '_job0' + str(idxJob)}))
+
+    lstThrd = [threading.Thread(target=funcSubmit, args=(idxJob,))
+               for idxJob in range(3)]
+    for objThrd in lstThrd:
+        objThrd.start()
+    for idxTry in range(600):
+        if pyprf_submit(strPathSck, {'cmd': 'ping'})['queued'] == 2:
+            break
+        time.sleep(0.1)
+    assert pyprf_submit(strPathSck, {'cmd': 'shutdown'})['status'] == 'ok'
+
+    # All clients receive a reply:
+    for objThrd in lstThrd:
+        objThrd.join(120.0)
+        assert not objThrd.is_alive()
+    objPrc.join()
+    assert len(lstRes) == 3
+    assert 'error' in [dicRes['status'] for dicRes in lstRes]
+
+    # Clean up:
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('serve_stop_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
+
+
+def test_load_bank_unsupported():
+    """Test that options not implemented for the service are rejected."""
+    for strOpt in ['varNumClst = 2', 'varThrScr = 0.1', 'lgcPair = True']:
+        strCsvCnfg, strPathBse = crt_test_config('serve_bank_test')
+        with open(strCsvCnfg, 'a') as fleOut:
+            fleOut.write(strOpt + '\n')
+        with pytest.raises(ValueError):
+            load_bank(strCsvCnfg)
+
+    # Clean up:
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('serve_bank_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
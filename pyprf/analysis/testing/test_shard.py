@@ -0,0 +1,120 @@
+"""Test sharded pRF finding."""
+
+import os
+import shutil
+import socket
+import multiprocessing as mp
+import numpy as np
+from pyprf.analysis.pyprf_stages import load_stg_config
+from pyprf.analysis.pyprf_shard import pyprf_shard
+from pyprf.analysis.pyprf_shard import pyprf_merge
+from pyprf.analysis.pyprf_shard import claim
+from pyprf.analysis.find_prf_main import find_prf
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def crt_test_config(strName):
+    """Create config file & pRF time course models for test."""
+    strPathBse = strDir + '/result/' + strName
+    strPathMdl = strPathBse + '_model_tc'
+
+    # Small model grid, random model time courses:
+    objRnd = np.random.RandomState(0)
+    np.save(strPathMdl, objRnd.randn(3, 3, 2, 400).astype(np.float32))
+
+    lstCnfg = ['varNumX = 3',
+               'varNumY = 3',
+               'varNumPrfSizes = 2',
+               'varExtXmin = -5.0',
+               'varExtXmax = 5.0',
+               'varExtYmin = -5.0',
+               'varExtYmax = 5.0',
+               'varPrfStdMin = 0.5',
+               'varPrfStdMax = 2.0',
+               'varTr = 2.079',
+               'varVoxRes = 0.8',
+               'varSdSmthTmp = 2.5',
+               'varSdSmthSpt = 0.0',
+               'lgcLinTrnd = True',
+               'varNumVol = 400',
+               'varPar = 2',
+               'varVslSpcSzeX = 100',
+               'varVslSpcSzeY = 100',
+               ("lstPathNiiFunc = ['" + strDir + "/exmpl_data_func_01.nii.gz"
+                + "', '" + strDir + "/exmpl_data_func_02.nii.gz']"),
+               "strPathNiiMask = '" + strDir + "/exmpl_data_mask.nii.gz'",
+               "strPathOut = '" + strPathBse + "'",
+               "strVersion = 'numpy'",
+               'lgcCrteMdl = False',
+               "strPathMdl = '" + strPathMdl + "'"]
+
+    strCsvCnfg = strPathBse + '_config.csv'
+    with open(strCsvCnfg, 'w') as fleOut:
+        fleOut.write('\n'.join(lstCnfg) + '\n')
+
+    return strCsvCnfg, strPathBse
+
+
+def test_shard_merge():
+    """Test that merged results of shards equal results of single process."""
+    for strMode in ['static', 'dynamic']:
+
+        strCsvCnfg, strPathBse = crt_test_config('shard_test_' + strMode)
+
+        if strMode == 'static':
+            # Shards one after the other:
+            for idxShrd in range(3):
+                pyprf_shard(strCsvCnfg, idxShrd=idxShrd, varNumShrd=3)
+        else:
+            # Several shards at the same time, claiming chunks dynamically:
+            lstPrcs = [mp.Process(target=pyprf_shard, args=(strCsvCnfg,),
+                                  kwargs={'varNumChnk': 7})
+                       for _ in range(3)]
+            for objPrc in lstPrcs:
+                objPrc.start()
+            for objPrc in lstPrcs:
+                objPrc.join()
+                assert objPrc.exitcode == 0
+
+        pyprf_merge(strCsvCnfg)
+        assert os.path.isfile(strPathBse + '_R2.nii.gz')
+
+        # Reference (all voxels at once):
+        dicCnfg, strDirStg = load_stg_config(strCsvCnfg)
+        aryFunc = np.load(os.path.join(strDirStg, 'aryFunc.npy'))
+        aryPrfTc = np.load(os.path.join(strDirStg, 'aryPrfTcPre.npy'))
+        aryRef = np.stack(find_prf(dicCnfg, aryFunc, aryPrfTc), axis=1)
+        aryTest = np.load(os.path.join(strDirStg, 'aryBstPrm.npy'))
+        assert np.array_equal(aryRef[:, :3], aryTest[:, :3])
+        assert np.allclose(aryRef[:, 3], aryTest[:, 3], atol=1e-5)
+
+        # Clean up:
+        shutil.rmtree(strDirStg)
+        for strTmp in os.listdir(strDir + '/result'):
+            if strTmp.startswith('shard_test_' + strMode):
+                os.remove(os.path.join(strDir + '/result', strTmp))
+
+
+def test_claim_stale():
+    """Test that lock files of dead processes on this host are reclaimed."""
+    strPathLck = strDir + '/result/claim_test.lock'
+
+    # Process ID of a process that has exited:
+    objPrc = mp.Process(target=os.getpid)
+    objPrc.start()
+    objPrc.join()
+
+    # Lock files of a living process (this one), of a dead process on this
+    # host, and of a process on another host:
+    for strCntn, lgcClm in [((socket.gethostname() + ':' + str(os.getpid())),
+                             False),
+                            ((socket.gethostname() + ':' + str(objPrc.pid)),
+                             True),
+                            (('other-host-' + socket.gethostname() + ':'
+                              + str(objPrc.pid)), False)]:
+        with open(strPathLck, 'w') as fleOut:
+            fleOut.write(strCntn)
+        assert claim(strPathLck) == lgcClm
+        os.remove(strPathLck)
@@ -0,0 +1,201 @@
+"""Test stage-wise pRF analysis."""
+
+import os
+import shutil
+import pytest
+import numpy as np
+from pyprf.analysis.pyprf_main import pyprf
+from pyprf.analysis.pyprf_stages import lstStg
+from pyprf.analysis.pyprf_stages import get_stg_status
+from pyprf.analysis.pyprf_stages import pyprf_stages
+from pyprf.analysis.export_results import lstNiiNames
+from pyprf.analysis.testing.test_shard import crt_test_config
+from pyprf.analysis.testing.test_suff import load_res
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_get_stg_status():
+    """Test that changed parameters only invalidate dependent stages."""
+    strDirStg = strDir + '/result/stages_test'
+    os.makedirs(strDirStg)
+
+    dicCnfg = {'varNumX': 10, 'varSdSmthTmp': 1.0, 'varSdSmthSpt': 0.0,
+               'strVersion': 'numpy', 'varPar': 2, 'lgcCrteMdl': False,
+               'strPathMdl': os.path.join(strDirStg, 'model_tc'),
+               'strPathNiiMask': os.path.join(strDirStg, 'mask.nii'),
+               'lstPathNiiFunc': [os.path.join(strDirStg, 'func.nii')],
+               'strPathOut': os.path.join(strDirStg, 'res'),
+               'varCmprLvl': 0, 'lgcOut4d': True, 'lgcSdcr': False}
+
+    # Pretend that all stages have been run:
+    dicStmp, dicUpd = get_stg_status(dicCnfg, strDirStg)
+    assert not any(dicUpd.values())
+    for strStg in lstStg:
+        with open(os.path.join(strDirStg, (strStg + '.stamp')), 'w') as fle:
+            fle.write(dicStmp[strStg])
+    for strOut in ['dicCnfg.pkl', 'aryPrfTc.npy', 'aryPrfTcPre.npy',
+                   'aryLgcMsk.npy', 'aryLgcVar.npy', 'aryFunc.npy',
+                   'func_meta.pkl', 'aryBstPrm.npy']:
+        open(os.path.join(strDirStg, strOut), 'w').close()
+    _, dicUpd = get_stg_status(dicCnfg, strDirStg)
+    assert not dicUpd['export']
+    open((dicCnfg['strPathOut'] + '_params.nii'), 'w').close()
+    _, dicUpd = get_stg_status(dicCnfg, strDirStg)
+    assert all(dicUpd.values())
+
+    # Number of processes does not affect any outputs (except for the saved
+    # config):
+    dicCnfg['varPar'] = 4
+    _, dicUpd = get_stg_status(dicCnfg, strDirStg)
+    assert [strStg for strStg in lstStg if not dicUpd[strStg]] == ['config']
+
+    # Spatial smoothing affects functional preprocessing & later stages,
+    # but not the models:
+    dicCnfg['varSdSmthSpt'] = 1.0
+    _, dicUpd = get_stg_status(dicCnfg, strDirStg)
+    assert [strStg for strStg in lstStg if not dicUpd[strStg]] == \
+        ['config', 'func_preprocessing', 'fit', 'export']
+
+    # A changed input file invalidates the dependent stages:
+    open(dicCnfg['strPathNiiMask'], 'w').close()
+    _, dicUpd = get_stg_status(dicCnfg, strDirStg)
+    assert [strStg for strStg in lstStg if not dicUpd[strStg]] == \
+        ['config', 'func_preprocessing', 'fit', 'export']
+    open((dicCnfg['strPathMdl'] + '.npy'), 'w').close()
+    _, dicUpd = get_stg_status(dicCnfg, strDirStg)
+    assert [strStg for strStg in lstStg if not dicUpd[strStg]] == \
+        ['config', 'model_creation', 'model_preprocessing',
+         'func_preprocessing', 'fit', 'export']
+
+    # Clean up:
+    shutil.rmtree(strDirStg)
+
+
+def test_run_stages():
+    """Test that stages reproduce `pyprf` and are re-run after changes."""
+    strCsvCnfg, strPathBse = crt_test_config('stages_run_test')
+
+    # Reference:
+    pyprf(strCsvCnfg)
+    lstRef = load_res(strPathBse)
+
+    # All stages:
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("strPathOut = '" + strPathBse + "_stg'\n")
+    pyprf_stages(strCsvCnfg)
+    lstTest = load_res(strPathBse + '_stg')
+    for idxPrm in range(len(lstNiiNames)):
+        assert np.allclose(lstRef[idxPrm], lstTest[idxPrm], atol=1e-5)
+
+    strDirStg = strPathBse + '_stg_stages'
+    dicStmp01 = {}
+    dicMtme01 = {}
+    for strStg in lstStg:
+        strPathStmp = os.path.join(strDirStg, (strStg + '.stamp'))
+        with open(strPathStmp, 'r') as fleIn:
+            dicStmp01[strStg] = fleIn.read()
+        dicMtme01[strStg] = os.stat(strPathStmp).st_mtime_ns
+
+    # After a change of the spatial smoothing, the preprocessing of the
+    # functional data & later stages are run again, but not the models:
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("varSdSmthSpt = 1.0\n")
+    pyprf_stages(strCsvCnfg)
+    for strStg in lstStg:
+        strPathStmp = os.path.join(strDirStg, (strStg + '.stamp'))
+        with open(strPathStmp, 'r') as fleIn:
+            strStmp = fleIn.read()
+        if strStg in ['model_creation', 'model_preprocessing']:
+            assert strStmp == dicStmp01[strStg]
+            assert os.stat(strPathStmp).st_mtime_ns == dicMtme01[strStg]
+        else:
+            assert strStmp != dicStmp01[strStg]
+
+    # Missing results are exported again (without running earlier stages):
+    strPathStmp = os.path.join(strDirStg, 'fit.stamp')
+    varMtme = os.stat(strPathStmp).st_mtime_ns
+    os.remove(strPathBse + '_stg_R2.nii.gz')
+    pyprf_stages(strCsvCnfg)
+    assert os.path.isfile(strPathBse + '_stg_R2.nii.gz')
+    assert os.stat(strPathStmp).st_mtime_ns == varMtme
+
+    # After the models have been overwritten (at the same path), the models
+    # & later stages are run again:
+    strPathStmp = os.path.join(strDirStg, 'model_creation.stamp')
+    with open(strPathStmp, 'r') as fleIn:
+        strStmp = fleIn.read()
+    objRnd = np.random.RandomState(1)
+    np.save(strPathBse + '_model_tc',
+            objRnd.randn(3, 3, 2, 400).astype(np.float32))
+    pyprf_stages(strCsvCnfg)
+    with open(strPathStmp, 'r') as fleIn:
+        assert fleIn.read() != strStmp
+
+    # Results equal those of `pyprf` with the changed parameters & models:
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("strPathOut = '" + strPathBse + "'\n")
+    pyprf(strCsvCnfg)
+    lstRef = load_res(strPathBse)
+    lstTest = load_res(strPathBse + '_stg')
+    for idxPrm in range(len(lstNiiNames)):
+        assert np.allclose(lstRef[idxPrm], lstTest[idxPrm], atol=1e-5)
+
+    # Options that are not implemented for the stages are rejected:
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("varNumTopK = 3\n")
+    with pytest.raises(ValueError):
+        pyprf_stages(strCsvCnfg)
+
+    # Clean up:
+    shutil.rmtree(strDirStg)
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('stages_run_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
+
+
+def test_run_stages_avg():
+    """Test that stages average runs with the same stimulus sequence."""
+    strCsvCnfg, strPathBse = crt_test_config('stages_avg_test')
+
+    # Models for two runs with the same stimulus sequence:
+    aryPrfTc = np.load(strPathBse + '_model_tc.npy')[:, :, :, :200]
+    np.save(strPathBse + '_model_tc', np.concatenate((aryPrfTc, aryPrfTc),
+                                                     axis=3))
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("strAvgRun = 'auto'\n")
+
+    # Reference:
+    pyprf(strCsvCnfg)
+    lstRef = load_res(strPathBse)
+
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("strPathOut = '" + strPathBse + "_stg'\n")
+    pyprf_stages(strCsvCnfg)
+    lstTest = load_res(strPathBse + '_stg')
+    for idxPrm in range(len(lstNiiNames)):
+        assert np.allclose(lstRef[idxPrm], lstTest[idxPrm], atol=1e-5)
+
+    # Averaged functional data & models for one run:
+    strDirStg = strPathBse + '_stg_stages'
+    assert np.load(os.path.join(strDirStg, 'aryFunc.npy')).shape[1] == 200
+    assert np.load(os.path.join(strDirStg, 'aryPrfTc.npy')).shape[3] == 200
+
+    # Without averaging, the stages are run again with the functional data &
+    # models for both runs:
+    with open(os.path.join(strDirStg, 'export.stamp'), 'r') as fleIn:
+        strStmp = fleIn.read()
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("strAvgRun = 'none'\n")
+    pyprf_stages(strCsvCnfg)
+    assert np.load(os.path.join(strDirStg, 'aryFunc.npy')).shape[1] == 400
+    assert np.load(os.path.join(strDirStg, 'aryPrfTc.npy')).shape[3] == 400
+    with open(os.path.join(strDirStg, 'export.stamp'), 'r') as fleIn:
+        assert fleIn.read() != strStmp
+
+    # Clean up:
+    shutil.rmtree(strDirStg)
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('stages_avg_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
@@ -0,0 +1,158 @@
+"""Test pRF finding from per-run sufficient statistics."""
+
+import os
+import shutil
+import pytest
+import numpy as np
+import nibabel as nb
+from pyprf.analysis import pyprf_suff
+from pyprf.analysis.pyprf_main import pyprf
+from pyprf.analysis.load_config import load_config
+from pyprf.analysis.preprocessing_main import pre_pro_func
+from pyprf.analysis.preprocessing_main import pre_pro_models
+from pyprf.analysis.find_prf_main import find_prf
+from pyprf.analysis.find_prf_suff import crt_suff
+from pyprf.analysis.find_prf_suff import xval_suff
+from pyprf.analysis.export_results import lstNiiNames
+from pyprf.analysis.testing.test_shard import crt_test_config
+
+# Get directory of this file:
+strDir = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_res(strPathBse):
+    """Load exported results."""
+    return [np.asarray(nb.load(strPathBse + strNii + '.nii.gz').dataobj)
+            for strNii in lstNiiNames]
+
+
+def test_suff(monkeypatch):
+    """Test that results equal those for concatenated runs."""
+    strCsvCnfg, strPathBse = crt_test_config('suff_test')
+
+    # Reference:
+    pyprf(strCsvCnfg)
+    lstRef = load_res(strPathBse)
+
+    # Per-run sufficient statistics:
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("lgcSuff = True\n")
+        fleOut.write("strPathOut = '" + strPathBse + "_suff_all'\n")
+        fleOut.write("strPathSuff = '" + strPathBse + "_stats'\n")
+    pyprf(strCsvCnfg)
+    lstTest = load_res(strPathBse + '_suff_all')
+    for idxPrm in range(len(lstNiiNames)):
+        assert np.allclose(lstRef[idxPrm], lstTest[idxPrm], atol=1e-4)
+    assert len(os.listdir(strPathBse + '_stats')) == 2
+
+    # Refit with a subset of runs, from the stored statistics (the
+    # functional data are not preprocessed again):
+    def pre_pro_runs_fail(*args, **kwargs):
+        raise AssertionError('Functional data preprocessed again')
+
+    monkeypatch.setattr(pyprf_suff, 'pre_pro_runs', pre_pro_runs_fail)
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("lstRunSuff = [0]\n")
+        fleOut.write("strPathOut = '" + strPathBse + "_suff_run01'\n")
+    pyprf(strCsvCnfg)
+    lstTest = load_res(strPathBse + '_suff_run01')
+
+    # Reference for first run only:
+    dicCnfg = load_config(strCsvCnfg)
+    varSdSmthTmp = dicCnfg['varSdSmthTmp'] / dicCnfg['varTr']
+    aryLgcMsk, _, _, aryLgcVar, aryFunc, _ = pre_pro_func(
+        dicCnfg['strPathNiiMask'], dicCnfg['lstPathNiiFunc'][:1],
+        varSdSmthTmp=varSdSmthTmp, varPar=2)
+    aryPrfTc = pre_pro_models(np.load(strPathBse + '_model_tc.npy'),
+                              varSdSmthTmp=varSdSmthTmp, varPar=2)
+    tplRef = find_prf(dicCnfg, aryFunc, aryPrfTc[:, :, :, :200])
+    vecIdxVox = np.flatnonzero(aryLgcMsk)[aryLgcVar]
+    for idxPrm in range(4):
+        assert np.allclose(lstTest[idxPrm].flatten()[vecIdxVox],
+                           tplRef[idxPrm], atol=1e-4)
+
+    # Clean up:
+    shutil.rmtree(strPathBse + '_stats')
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('suff_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
+
+
+def test_xval_suff():
+    """Test cross-validated R2 against explicit leave-one-run-out fits."""
+    objRnd = np.random.RandomState(1)
+    aryMdl = objRnd.randn(12, 90)
+    aryFunc = (aryMdl[objRnd.randint(0, 12, size=20), :]
+               + objRnd.randn(20, 90) + 3.0)
+    lstRun = [slice(0, 30), slice(30, 70), slice(70, 90)]
+
+    vecR2Xval = xval_suff([crt_suff(aryMdl[:, objSlc], aryFunc[:, objSlc])
+                           for objSlc in lstRun])
+
+    vecRss = np.zeros(20)
+    vecTss = np.zeros(20)
+    for objTst in lstRun:
+        vecLgcTrn = np.ones(90, dtype=bool)
+        vecLgcTrn[objTst] = False
+        vecCnst = np.ones(np.sum(vecLgcTrn))
+        for idxVox in range(20):
+            # Best model on training runs (regression with constant term):
+            lstFit = [np.linalg.lstsq(
+                np.stack((aryMdl[idxMdl, vecLgcTrn], vecCnst), axis=1),
+                aryFunc[idxVox, vecLgcTrn], rcond=None)
+                for idxMdl in range(12)]
+            idxBst = np.argmin([objFit[1][0] for objFit in lstFit])
+            vecPrd = (lstFit[idxBst][0][0] * aryMdl[idxBst, objTst]
+                      + lstFit[idxBst][0][1])
+            vecTst = aryFunc[idxVox, objTst]
+            vecRss[idxVox] += np.sum(np.square(vecTst - vecPrd))
+            vecTss[idxVox] += np.sum(np.square(vecTst - np.mean(vecTst)))
+
+    assert np.allclose(vecR2Xval, (1.0 - vecRss / vecTss), atol=1e-5)
+
+
+def test_xval():
+    """Test that cross-validation does not change the pRF finding results."""
+    strCsvCnfg, strPathBse = crt_test_config('xval_test')
+    pyprf(strCsvCnfg)
+    lstRef = load_res(strPathBse)
+
+    with open(strCsvCnfg, 'a') as fleOut:
+        fleOut.write("lgcXval = True\n")
+        fleOut.write("strPathOut = '" + strPathBse + "_xval'\n")
+    pyprf(strCsvCnfg)
+    lstTest = load_res(strPathBse + '_xval')
+    for idxPrm in range(len(lstNiiNames)):
+        assert np.allclose(lstRef[idxPrm], lstTest[idxPrm], atol=1e-4)
+    aryR2Xval = np.asarray(nb.load(strPathBse + '_xval_R2_xval.nii.gz')
+                           .dataobj)
+    # Cross-validated R2 cannot exceed R2 of the fit to all runs by much, and
+    # is zero outside the mask:
+    assert np.all(aryR2Xval[lstRef[3] == 0] == 0)
+    assert np.all(aryR2Xval <= (lstRef[3] + 0.1))
+
+    # Clean up:
+    shutil.rmtree(strPathBse + '_xval_suff')
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('xval_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
+
+
+def test_suff_unsupported():
+    """Test that options of the regular pRF finding are rejected."""
+    strCsvCnfg, strPathBse = crt_test_config('unsupported_test')
+
+    for strMode in ['lgcSuff = True', 'varMemBdgt = 100.0']:
+        for strOpt in ['varThrScr = 0.1', 'varNumTopK = 3', 'lgcPst = True',
+                       'varNumSrgt = 10', 'lgcPair = True', 'varSpcLtc = 2']:
+            strCsvTmp = strPathBse + '_tmp.csv'
+            shutil.copyfile(strCsvCnfg, strCsvTmp)
+            with open(strCsvTmp, 'a') as fleOut:
+                fleOut.write(strMode + '\n' + strOpt + '\n')
+            with pytest.raises(ValueError):
+                load_config(strCsvTmp)
+
+    # Clean up:
+    for strTmp in os.listdir(strDir + '/result'):
+        if strTmp.startswith('unsupported_test'):
+            os.remove(os.path.join(strDir + '/result', strTmp))
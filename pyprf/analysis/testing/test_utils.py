@@ -1,6 +1,7 @@
 """Test utility functions."""
 
 import os
+import pytest
 from os.path import isfile, join
 import numpy as np
 from pyprf.analysis import pyprf_main
@@ -127,3 +128,50 @@ def test_load_large_nii():
                                     varSzeThr=0.0)
 
     assert np.all(np.equal(aryFunc01, aryFunc02))
+
+
+def test_load_nii_prefetch():
+    """Test that prefetching nii-loader returns files in correct order."""
+    lstPathIn = [(strDir + '/exmpl_data_func_3vols.nii.gz'),
+                 (strDir + '/exmpl_data_mask.nii.gz'),
+                 (strDir + '/exmpl_data_func_3vols.nii.gz')]
+
+    # Load files one after the other:
+    lstRef = [util.load_nii(strTmp)[0] for strTmp in lstPathIn]
+
+    # Load files with prefetching:
+    lstTest = [tplTmp[0] for tplTmp in util.load_nii_prefetch(lstPathIn,
+                                                             varPrfDpth=1)]
+
+    assert len(lstRef) == len(lstTest)
+    for aryRef, aryTest in zip(lstRef, lstTest):
+        assert np.array_equal(aryRef, aryTest)
+
+    # Without prefetching (files loaded in calling thread):
+    lstTest = [tplTmp[0] for tplTmp in util.load_nii_prefetch(lstPathIn,
+                                                             varPrfDpth=0)]
+
+    assert len(lstRef) == len(lstTest)
+    for aryRef, aryTest in zip(lstRef, lstTest):
+        assert np.array_equal(aryRef, aryTest)
+
+    # With prefetching in background processes:
+    lstTest = [tplTmp[0] for tplTmp in util.load_nii_prefetch(lstPathIn,
+                                                             varPrfDpth=1,
+                                                             lgcPrc=True)]
+
+    assert len(lstRef) == len(lstTest)
+    for aryRef, aryTest in zip(lstRef, lstTest):
+        assert np.array_equal(aryRef, aryTest)
+
+
+def test_bckgrnd_prc():
+    """Test that background process returns value & re-raises exceptions."""
+    objPrc = util.cls_bckgrnd_prc(np.arange, 5)
+    objPrc.start()
+    assert np.array_equal(objPrc.get(), np.arange(5))
+
+    objPrc = util.cls_bckgrnd_prc(int, 'not a number')
+    objPrc.start()
+    with pytest.raises(ValueError):
+        objPrc.get()
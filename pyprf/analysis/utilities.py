@@ -18,13 +18,16 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import queue
+import threading
+import multiprocessing as mp
 import numpy as np
 import scipy as sp
 import nibabel as nb
 from scipy.stats import gamma
 
 
-def load_nii(strPathIn, varSzeThr=5000.0):
+def load_nii(strPathIn, varSzeThr=5000.0, tplSlb=None):
     """
     Load nii file.
 
@@ -36,6 +39,10 @@ def load_nii(strPathIn, varSzeThr=5000.0):
         If the nii file is larger than this threshold (in MB), the file is
         loaded volume-by-volume in order to prevent memory overflow. Default
         threshold is 5000 MB.
+    tplSlb : tuple or None
+        If not `None`, only a slab along the third (z) dimension is loaded.
+        Tuple with index of first and (exclusive) last slice of the slab,
+        e.g. `(10, 20)`.
 
     Returns
     -------
@@ -57,6 +64,12 @@ def load_nii(strPathIn, varSzeThr=5000.0):
     # Load nii file (this does not load the data into memory yet):
     objNii = nb.load(strPathIn)
 
+    # Slicing object for data array (whole array, or slab along z):
+    if tplSlb is None:
+        objSlc = (slice(None), slice(None), slice(None))
+    else:
+        objSlc = (slice(None), slice(None), slice(tplSlb[0], tplSlb[1]))
+
     # Get size of nii file:
     varNiiSze = os.path.getsize(strPathIn)
 
@@ -74,6 +87,8 @@ def load_nii(strPathIn, varSzeThr=5000.0):
 
         # Get image dimensions:
         tplSze = objNii.shape
+        if tplSlb is not None:
+            tplSze = (tplSze[0], tplSze[1], (tplSlb[1] - tplSlb[0]), tplSze[3])
 
         # Create empty array for nii data:
         aryNii = np.zeros(tplSze, dtype=np.float32)
@@ -81,7 +96,7 @@ def load_nii(strPathIn, varSzeThr=5000.0):
         # Loop through volumes:
         for idxVol in range(tplSze[3]):
             aryNii[..., idxVol] = np.asarray(
-                  objNii.dataobj[..., idxVol]).astype(np.float32)
+                  objNii.dataobj[objSlc + (idxVol,)]).astype(np.float32)
 
     else:
 
@@ -91,7 +106,7 @@ def load_nii(strPathIn, varSzeThr=5000.0):
         objNii = nb.load(strPathIn)
 
         # Load data into array:
-        aryNii = np.asarray(objNii.dataobj).astype(np.float32)
+        aryNii = np.asarray(objNii.dataobj[objSlc]).astype(np.float32)
 
     # Get headers:
     objHdr = objNii.header
@@ -103,6 +118,239 @@ def load_nii(strPathIn, varSzeThr=5000.0):
     return aryNii, objHdr, aryAff
 
 
+def load_nii_prefetch(lstPathIn, varPrfDpth=1, varSzeThr=5000.0,
+                      tplSlb=None, lgcPrc=False):
+    """
+    Load several nii files, prefetching the next file(s) in the background.
+
+    Parameters
+    ----------
+    lstPathIn : list
+        List of paths of nii files to load.
+    varPrfDpth : int
+        Prefetch depth, i.e. maximum number of files that are loaded ahead of
+        the file that is currently being processed by the caller. If zero,
+        files are loaded when they are requested (without background
+        thread).
+    varSzeThr : float
+        Threshold for volume-by-volume loading (see `load_nii`).
+    tplSlb : tuple or None
+        Slab along z to load (see `load_nii`).
+    lgcPrc : bool
+        Whether to load files in background processes instead of a background
+        thread (see `cls_bckgrnd_prc`). Needed if the caller forks processes
+        while files are being loaded.
+
+    Yields
+    ------
+    tplNii : tuple
+        Output of `load_nii` (i.e. nii data, header & affine) for each file,
+        in the order of `lstPathIn`.
+
+    Notes
+    -----
+    Files are loaded in a separate thread, so that loading of the next file
+    (which, for compressed nii files, is dominated by gzip decompression)
+    overlaps with the processing of the current file by the caller. Memory
+    usage is bounded by the prefetch depth. Exceptions raised while loading
+    a file are re-raised in the calling thread.
+
+    A process must not be forked while another thread is running (the child
+    may inherit locks held by that thread). If the caller forks processes
+    (e.g. for preprocessing, see `pre_pro_par`), files are therefore loaded
+    in spawned processes (`lgcPrc`), one per file, and the loaded data are
+    copied into the calling process.
+    """
+    # Without prefetching, files are loaded in the calling thread:
+    if int(varPrfDpth) < 1:
+        for strPathIn in lstPathIn:
+            yield load_nii(strPathIn, varSzeThr=varSzeThr, tplSlb=tplSlb)
+        return
+
+    # Files are loaded in background processes, up to the prefetch depth
+    # ahead of the file that is currently being processed:
+    if lgcPrc:
+        lstPrc = []
+        try:
+            for idxIn in range(len(lstPathIn)):
+                while ((len(lstPrc) <= int(varPrfDpth))
+                       and ((idxIn + len(lstPrc)) < len(lstPathIn))):
+                    objPrc = cls_bckgrnd_prc(load_nii,
+                                             lstPathIn[idxIn + len(lstPrc)],
+                                             varSzeThr=varSzeThr,
+                                             tplSlb=tplSlb)
+                    objPrc.start()
+                    lstPrc.append(objPrc)
+                yield lstPrc.pop(0).get()
+        finally:
+            # Stop loading of files that are not needed anymore (e.g. because
+            # of an exception):
+            for objPrc in lstPrc:
+                objPrc.terminate()
+        return
+
+    # Queue for loaded files. The queue size bounds the number of files that
+    # are held in memory in addition to the one being processed.
+    queNii = queue.Queue(maxsize=max(1, int(varPrfDpth)))
+
+    # Event used to signal the loading thread to stop (if the caller does not
+    # consume all files, e.g. because of an exception):
+    objStop = threading.Event()
+
+    def funcLoad():
+        """Load files and put them on the queue."""
+        for strPathIn in lstPathIn:
+            try:
+                tplNii = (load_nii(strPathIn, varSzeThr=varSzeThr,
+                                   tplSlb=tplSlb),
+                          None)
+            except Exception as objErr:
+                tplNii = (None, objErr)
+            # Wait for free slot on the queue (unless stop is requested):
+            while not objStop.is_set():
+                try:
+                    queNii.put(tplNii, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if (objStop.is_set()) or (tplNii[1] is not None):
+                break
+
+    objThrd = threading.Thread(target=funcLoad)
+    objThrd.daemon = True
+    objThrd.start()
+
+    try:
+        for _ in range(len(lstPathIn)):
+            tplNii, objErr = queNii.get()
+            if objErr is not None:
+                raise objErr
+            yield tplNii
+    finally:
+        objStop.set()
+        objThrd.join()
+
+
+class cls_bckgrnd(threading.Thread):
+    """
+    Call function in background thread and keep its return value.
+
+    Parameters
+    ----------
+    funcIn : function
+        Function to call.
+    *args, **kwargs
+        Arguments passed to the function.
+
+    Notes
+    -----
+    Call `get()` to wait for the function to return, and to obtain its return
+    value. If the function raised an exception, it is re-raised by `get()`.
+    """
+
+    def __init__(self, funcIn, *args, **kwargs):
+        """Prepare background thread."""
+        super(cls_bckgrnd, self).__init__()
+        self.daemon = True
+        self.funcIn = funcIn
+        self.args = args
+        self.kwargs = kwargs
+        self.objRes = None
+        self.objErr = None
+
+    def run(self):
+        """Call function (in background thread)."""
+        try:
+            self.objRes = self.funcIn(*self.args, **self.kwargs)
+        except Exception as objErr:
+            self.objErr = objErr
+
+    def get(self):
+        """Wait for function to return, and return its return value."""
+        self.join()
+        if self.objErr is not None:
+            raise self.objErr
+        return self.objRes
+
+
+def call_bckgrnd_prc(funcIn, args, kwargs, queOut, strMthd):
+    """Call function & put return value or exception on queue."""
+    # Processes started by the function use the start method of the calling
+    # process (not 'spawn', which is inherited otherwise):
+    mp.set_start_method(strMthd, force=True)
+    try:
+        queOut.put((funcIn(*args, **kwargs), None))
+    except Exception as objErr:
+        queOut.put((None, objErr))
+
+
+class cls_bckgrnd_prc(object):
+    """
+    Call function in background process and keep its return value.
+
+    Parameters
+    ----------
+    funcIn : function
+        Function to call (defined at module level, so that it can be pickled).
+    *args, **kwargs
+        Arguments passed to the function (have to be picklable).
+
+    Notes
+    -----
+    Same interface as `cls_bckgrnd` (`start()` & `get()`). The process is
+    started with the 'spawn' method, i.e. as a new interpreter, so that it
+    is safe to start it while other threads are running, and that the
+    calling process can fork processes (e.g. for pRF finding) while the
+    background process is running. Arguments & return value are pickled.
+    """
+
+    def __init__(self, funcIn, *args, **kwargs):
+        """Prepare background process."""
+        objCtx = mp.get_context('spawn')
+        self.queOut = objCtx.Queue()
+        self.objPrc = objCtx.Process(target=call_bckgrnd_prc,
+                                     args=(funcIn, args, kwargs,
+                                           self.queOut,
+                                           mp.get_start_method()))
+        # Not a daemon, because the function may start processes itself
+        # (e.g. for preprocessing):
+        self.objPrc.daemon = False
+
+    def start(self):
+        """Start background process."""
+        self.objPrc.start()
+
+    def get(self):
+        """Wait for function to return, and return its return value."""
+        # The return value is received before the process is joined (the
+        # process cannot exit before large return values have been received
+        # from the queue):
+        while True:
+            try:
+                objRes, objErr = self.queOut.get(True, 1.0)
+                break
+            except queue.Empty:
+                if not self.objPrc.is_alive():
+                    try:
+                        objRes, objErr = self.queOut.get(False)
+                        break
+                    except queue.Empty:
+                        raise RuntimeError(('Background process died (exit '
+                                            + 'code '
+                                            + str(self.objPrc.exitcode)
+                                            + ')'))
+        self.objPrc.join()
+        if objErr is not None:
+            raise objErr
+        return objRes
+
+    def terminate(self):
+        """Terminate background process (if it is still running)."""
+        if self.objPrc.is_alive():
+            self.objPrc.terminate()
+        self.objPrc.join()
+
+
 def crt_gauss(varSizeX, varSizeY, varPosX, varPosY, varSd):
     """
     Create 2D Gaussian kernel.